@@ -51,6 +51,13 @@ bulk_sql_manager = None
 # DBInfo object for the main miro database
 db_info = None
 
+# DatabaseMaintenance that runs checks, vacuums and backups for the main
+# database
+db_maintenance = None
+
+# MemoryReporter that periodically writes out memory reports
+memory_reporter = None
+
 # configuration data
 config = None
 
@@ -75,6 +82,15 @@ directory_watcher = None
 # MetadataManager for local items
 local_metadata_manager = None
 
+# MetadataResultCache shared by the local and device MetadataManagers
+metadata_result_cache = None
+
+# ProbeCache that stores ffmpeg probe results for conversions and transcodes
+probe_cache = None
+
+# SegmentCache that stores transcoded segments for DAAP streaming
+segment_cache = None
+
 # signal emiters for when config data changes
 backend_config_watcher = None
 frontend_config_watcher = None
@@ -173,6 +189,9 @@ get_item_type = None
 # Tracks ItemLists that are in-use
 item_list_pool = None
 
+# Loads rows for ItemLists in a background thread
+item_row_loader = None
+
 # cli frontend adds these
 # -----------------------
 
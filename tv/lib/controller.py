@@ -89,6 +89,10 @@ class Controller:
             if app.sharing_tracker is not None:
                 logging.info("Shutting down Sharing Tracker")
                 app.sharing_tracker.stop_tracking()
+            if app.probe_cache is not None:
+                logging.info("Saving media probe cache")
+                app.probe_cache.cancel_prefetch()
+                app.probe_cache.save()
         except StandardError:
             signals.system.failed_exn("while shutting down")
             # don't abort - it's not "fatal" and we can still shutdown
@@ -104,6 +108,10 @@ class Controller:
         logging.info("Shutting down event loop thread")
         eventloop.shutdown()
         logging.info("Saving cached ItemInfo objects")
+        if app.db_maintenance is not None:
+            app.db_maintenance.stop()
+        if app.memory_reporter is not None:
+            app.memory_reporter.stop()
         logging.info("Commiting DB changes")
         app.db.finish_transaction()
         logging.info("Closing Database...")
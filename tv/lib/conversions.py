@@ -37,6 +37,7 @@ import tempfile
 import threading
 import subprocess
 import errno
+import collections
 
 from glob import glob
 from ConfigParser import SafeConfigParser, NoOptionError
@@ -217,12 +218,21 @@ def get_media_info(filepath):
     """Takes a file path and returns a dict of information about
     this media file that it extracted from ffmpeg -i.
 
+    Results are stored in app.probe_cache, so we only run ffmpeg once for
+    each version of a file.
+
     :param filepath: absolute path to the media file in question
 
     :returns: dict of media info possibly containing: height, width,
     container, audio_codec, video_codec
     """
+    if app.probe_cache is None:
+        return _probe_media_info(filepath)
+    # return a copy so callers can't change the cached value
+    return dict(app.probe_cache.get('media-info', filepath,
+                                    _probe_media_info))
 
+def _probe_media_info(filepath):
     ffmpeg_bin = utils.get_ffmpeg_executable_path()
     retcode, stdout, stderr = util.call_command(
         ffmpeg_bin, "-i", "%s" % filepath,
@@ -334,7 +344,81 @@ class ConverterManager(object):
         return self.converters
 
 
+# Scheduling priorities for conversion tasks.  Higher priority tasks are
+# started first; tasks with the same priority are started in the order they
+# were queued.
+PRIORITY_NORMAL = 0
+PRIORITY_DEVICE_SYNC = 10
+
+class ConversionMetrics(object):
+    """Tracks queue latency and throughput for the ConversionManager.
+
+    Queue latency is the time between a task being queued and it being
+    started.  Throughput is the number of tasks that finished running per
+    minute over the last ``THROUGHPUT_WINDOW`` seconds.
+    """
+    THROUGHPUT_WINDOW = 600
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_count = 0
+        self.finished_count = 0
+        self.failed_count = 0
+        self.total_queue_latency = 0.0
+        self.max_queue_latency = 0.0
+        self._finish_times = collections.deque()
+
+    def task_started(self, task):
+        latency = max(0.0, time.time() - task.queued_time)
+        self.started_count += 1
+        self.total_queue_latency += latency
+        self.max_queue_latency = max(self.max_queue_latency, latency)
+
+    def task_done(self, task):
+        now = time.time()
+        if task.is_failed():
+            self.failed_count += 1
+        else:
+            self.finished_count += 1
+        self._finish_times.append(now)
+        self._prune_finish_times(now)
+
+    def _prune_finish_times(self, now):
+        cutoff = now - self.THROUGHPUT_WINDOW
+        while self._finish_times and self._finish_times[0] < cutoff:
+            self._finish_times.popleft()
+
+    def get_metrics(self):
+        """Get a snapshot of the current metrics.
+
+        :returns: dict with the started, finished and failed task counts,
+            the average and max queue latency in seconds and the throughput
+            in tasks per minute
+        """
+        self._prune_finish_times(time.time())
+        if self.started_count:
+            average_latency = self.total_queue_latency / self.started_count
+        else:
+            average_latency = 0.0
+        throughput = (len(self._finish_times) * 60.0 /
+                      self.THROUGHPUT_WINDOW)
+        return {
+            'started': self.started_count,
+            'finished': self.finished_count,
+            'failed': self.failed_count,
+            'average_queue_latency': average_latency,
+            'max_queue_latency': self.max_queue_latency,
+            'throughput': throughput,
+        }
+
 class ConversionManager(signals.SignalEmitter):
+    # Upper bound on how long the task loop sleeps without being woken up.
+    # Normally the loop is woken by new messages, new tasks and tasks
+    # exiting, this is just a safety net.
+    MAX_IDLE_WAIT = 5.0
+
     def __init__(self):
         signals.SignalEmitter.__init__(self,
                                        'thread-will-start',
@@ -355,6 +439,11 @@ class ConversionManager(signals.SignalEmitter):
         self.running_tasks = list()
         self.finished_tasks = list()
         self.quit_flag = False
+        # protects pending_tasks and _wakeup_pending, and is used to wake up
+        # the task loop
+        self.condition = threading.Condition()
+        self._wakeup_pending = False
+        self.metrics = ConversionMetrics()
 
         self.last_conversion_id = None
 
@@ -399,24 +488,45 @@ class ConversionManager(signals.SignalEmitter):
     def lookup_converter(self, converter_id):
         return self.converters.lookup_converter(converter_id)
 
+    def get_metrics(self):
+        """Get queue latency and throughput metrics.
+
+        See ConversionMetrics.get_metrics() for the format.
+        """
+        return self.metrics.get_metrics()
+
     def start_conversion(self, converter_id, item_info, target_folder=None,
-                         create_item=True):
+                         create_item=True, priority=PRIORITY_NORMAL):
         task = self._make_conversion_task(
             converter_id, item_info, target_folder, create_item)
         if ((task is not None
              and task.get_executable() is not None
              and not self._has_running_task(task.key)
              and not self._has_finished_task(task.key))):
+            task.priority = priority
+            task.queued_time = time.time()
             self._check_task_loop()
-            self.pending_tasks.append(task)
+            with self.condition:
+                self.pending_tasks.append(task)
             self._notify_task_added(task)
+            self.wakeup()
 
         return task
 
+    def wakeup(self):
+        """Wake up the task loop so that it runs a cycle right away.
+
+        This is safe to call from any thread.
+        """
+        with self.condition:
+            self._wakeup_pending = True
+            self.condition.notify()
+
     def _enqueue_message(self, message, **kw):
         msg = {'message': message}
         msg.update(kw)
         self.message_queue.put(msg)
+        self.wakeup()
 
     def _make_conversion_task(self, converter_id, item_info, target_folder,
                               create_item):
@@ -445,43 +555,92 @@ class ConversionManager(signals.SignalEmitter):
             self.emit('begin-loop')
             self._run_loop_cycle()
             self.emit('end-loop')
-            time.sleep(0.5)
+            self._wait_for_wakeup()
         logging.debug("Conversions manager thread loop finished.")
         self.task_loop = None
 
+    def _wait_for_wakeup(self):
+        with self.condition:
+            if not self._wakeup_pending and not self.quit_flag:
+                self.condition.wait(self.MAX_IDLE_WAIT)
+            self._wakeup_pending = False
+
     def _run_loop_cycle(self):
         self._process_message_queue()
+        if self.quit_flag:
+            return
 
-        notify_count = False
+        notify_count = self._collect_done_tasks()
         max_concurrent_tasks = int(app.config.get(
                 prefs.MAX_CONCURRENT_CONVERSIONS))
-        if ((self.pending_tasks_count() > 0
-             and self.running_tasks_count() < max_concurrent_tasks)):
-            task = self.pending_tasks.pop()
-            if not self._has_running_task(task.key):
-                self.running_tasks.append(task)
-                task.run()
-                self._notify_task_changed(task)
-                notify_count = True
+        while self.running_tasks_count() < max_concurrent_tasks:
+            task = self._pop_next_pending_task()
+            if task is None:
+                break
+            if self._has_running_task(task.key):
+                continue
+            self.running_tasks.append(task)
+            self.metrics.task_started(task)
+            task.run()
+            self._notify_task_changed(task)
+            notify_count = True
+
+        # tasks like CopyConversionTask finish inside run(), which frees up
+        # their slots for the next cycle
+        if self._collect_done_tasks():
+            notify_count = True
+            if self.pending_tasks:
+                self.wakeup()
+
+        if notify_count:
+            self._notify_tasks_count()
+            if not self.running_tasks and not self.pending_tasks:
+                logging.debug("Conversion queue drained: %s",
+                              self.get_metrics())
+
+    def _collect_done_tasks(self):
+        """Move tasks that are done running to the finished list.
 
+        :returns: True if any tasks were moved
+        """
+        collected = False
         for task in list(self.running_tasks):
             if task.done_running():
                 self._notify_task_changed(task)
                 self.running_tasks.remove(task)
                 self.finished_tasks.append(task)
-                notify_count = True
+                self.metrics.task_done(task)
+                collected = True
                 if task.is_finished():
                     self.schedule_staging(task.key)
+        return collected
 
-        if notify_count:
-            self._notify_tasks_count()
+    def _pop_next_pending_task(self):
+        """Remove and return the next pending task to run.
+
+        Tasks with a higher priority come first, then tasks that were queued
+        earlier.
+
+        :returns: ConversionTask or None if there are no pending tasks
+        """
+        with self.condition:
+            if not self.pending_tasks:
+                return None
+            best_index = 0
+            for i, task in enumerate(self.pending_tasks):
+                if task.priority > self.pending_tasks[best_index].priority:
+                    best_index = i
+            return self.pending_tasks.pop(best_index)
 
     def _process_message_queue(self):
-        try:
-            msg = self.message_queue.get_nowait()
-        except Queue.Empty:
-            return
+        while True:
+            try:
+                msg = self.message_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._process_message(msg)
 
+    def _process_message(self, msg):
         if msg['message'] == 'get_tasks_list':
             self._notify_tasks_list()
 
@@ -497,11 +656,15 @@ class ConversionManager(signals.SignalEmitter):
                 task_list = self.running_tasks
             else:
                 task_list = self.finished_tasks
-            try:
-                task_list.remove(task)
-            except ValueError:
-                logging.warn("Task not in list: %s", msg['key'])
-            else:
+            with self.condition:
+                try:
+                    task_list.remove(task)
+                except ValueError:
+                    logging.warn("Task not in list: %s", msg['key'])
+                    removed = False
+                else:
+                    removed = True
+            if removed:
                 self._notify_task_removed(task)
                 self._notify_tasks_count()
             task.interrupt()
@@ -536,7 +699,7 @@ class ConversionManager(signals.SignalEmitter):
                 destination, fp = next_free_filename(task.final_output_path)
                 fp.close()
             except ValueError:
-                logging.warn('_process_message_queue: ' 
+                logging.warn('_process_message: ' 
                              'next_free_filename failed.  Candidate = %r',
                              task.final_output_path)
                 return
@@ -652,7 +815,8 @@ class ConversionManager(signals.SignalEmitter):
     def _terminate(self):
         if len(self.pending_tasks) > 0:
             logging.debug("Clearing pending conversion tasks...")
-            self.pending_tasks = list()
+            with self.condition:
+                self.pending_tasks = list()
         if len(self.running_tasks) > 0:
             logging.debug("Interrupting running conversion tasks...")
             for task in list(self.running_tasks):
@@ -806,6 +970,10 @@ class ConversionTask(object):
         self.process_handle = None
         self.error = None
         self.start_time = time.time()
+        self.queued_time = self.start_time
+        self.priority = PRIORITY_NORMAL
+        # set once the task thread is about to exit
+        self.exited = False
 
     def get_executable(self):
         raise NotImplementedError()
@@ -850,10 +1018,12 @@ class ConversionTask(object):
         return self.thread is None
 
     def is_running(self):
-        return self.thread is not None and self.thread.isAlive()
+        return (self.thread is not None and not self.exited and
+                self.thread.isAlive())
 
     def done_running(self):
-        return self.thread is not None and not self.thread.isAlive()
+        return self.thread is not None and (self.exited or
+                                            not self.thread.isAlive())
 
     def is_finished(self):
         return self.done_running() and not self.is_failed()
@@ -896,6 +1066,8 @@ class ConversionTask(object):
             if self.is_failed():
                 conversion_manager._notify_task_failed(self)
                 conversion_manager._notify_tasks_count()
+            self.exited = True
+            conversion_manager.wakeup()
 
     def process_output(self, lines_generator):
         """Takes a function that's a generator of lines, iterates
@@ -0,0 +1,87 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.changecounter -- Count insertions and deletions of items
+
+The frontend needs to know when items have been added to or removed from the
+database since it last looked (see ItemFetcherWAL.refresh_items()).
+Counting rows to figure that out means scanning the entire item table, so
+instead we keep a counter in a one-row table that triggers increment.
+Reading it is cheap and it works across connections.
+"""
+
+import sqlite3
+
+def setup_change_counter(connection, table='item'):
+    """Set up the change counter for a database.
+
+    This is safe to call on a database that already has the counter.  If
+    the database doesn't have an item table (for example databases with a
+    custom schema), there's nothing to count and we don't set anything up.
+    Since we get called every time the database is opened, the counter gets
+    created once the table exists.
+    """
+    if _no_item_table(connection, table):
+        return
+    connection.execute("CREATE TABLE IF NOT EXISTS item_change_counter "
+                       "(id integer PRIMARY KEY, change_count integer)")
+    # The table starts out empty, the triggers create the row the first time
+    # they run.
+    increment_sql = ("INSERT OR REPLACE INTO "
+                     "item_change_counter(id, change_count) "
+                     "VALUES(1, IFNULL((SELECT change_count "
+                     "FROM item_change_counter WHERE id=1), 0) + 1);")
+    connection.execute("CREATE TRIGGER IF NOT EXISTS item_change_ai "
+                       "AFTER INSERT ON %s BEGIN %s END;" %
+                       (table, increment_sql))
+    connection.execute("CREATE TRIGGER IF NOT EXISTS item_change_ad "
+                       "AFTER DELETE ON %s BEGIN %s END;" %
+                       (table, increment_sql))
+
+def get_change_count(connection):
+    """Get the current value of the change counter.
+
+    :returns: number of item insertions/deletions, or None if the database
+        doesn't have a change counter.
+    """
+    try:
+        cursor = connection.execute("SELECT change_count "
+                                    "FROM item_change_counter WHERE id=1")
+    except sqlite3.OperationalError:
+        return None
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+def _no_item_table(connection, table_name):
+    cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
+                                "WHERE type='table' and name=?",
+                                (table_name,))
+    return (cursor.fetchone()[0] == 0)
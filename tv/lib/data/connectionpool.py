@@ -42,14 +42,17 @@ class ConnectionLimitError(StandardError):
 class Connection(object):
     """Wraps the sqlite3.Connection object."""
     def __init__(self, path):
+        # Connections are only used by one thread at a time, but not always
+        # by the thread that created them (see itemtrack.RowLoader).
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False)
 
     def execute(self, sql, values=()):
         return self._connection.execute(sql, values)
 
-    def execute_many(self, sql, values):
-        self._connection.execute_many(sql, values)
+    def executemany(self, sql, values):
+        return self._connection.executemany(sql, values)
 
     def commit(self):
         self._connection.commit()
@@ -120,6 +123,16 @@ class ConnectionPool(object):
                 raise ConnectionLimitError()
         return self.free_connections.pop()
 
+    def has_spare_connections(self, count):
+        """Check if we could hand out count more connections.
+
+        This is used by code that only wants a connection if it won't
+        starve other callers of get_connection().
+        """
+        spare = (len(self.free_connections) + self.max_connections -
+                 len(self.all_connections))
+        return spare >= count
+
     def release_connection(self, connection):
         """Put a connection back into the pool."""
 
@@ -0,0 +1,82 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.idset -- Query using a set of ids without inlining them in SQL
+"""
+
+class IdSet(object):
+    """Temporary table that stores a set of ids.
+
+    Queries can use IdSet.select_sql() in place of a literal list of ids.
+    This keeps the SQL the same no matter which ids we are using, so SQLite
+    doesn't have to parse and plan a new statement each time.  It also avoids
+    the limit on the number of variables in a statement.
+
+    The table is created in the temp database.  It's only visible to the
+    connection that created it and writing to it doesn't lock the main
+    database.  Each name refers to a single table per connection, so code
+    that uses an IdSet should own the connection while it does.
+
+    Usage:
+        id_set = IdSet(connection, 'playable')
+        id_set.set_ids(id_list)
+        connection.execute("SELECT title FROM item WHERE id IN (%s)" %
+                           id_set.select_sql())
+    """
+    def __init__(self, connection, name):
+        """Create an IdSet
+
+        :param connection: sqlite Connection or Cursor to use
+        :param name: name for the table.  Use a constant for this.
+        """
+        self.connection = connection
+        self.table_name = 'idset_' + name
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS %s "
+                                "(id integer PRIMARY KEY)" % self.table_name)
+
+    def set_ids(self, id_list):
+        """Change the ids in the set."""
+        # Use a savepoint so that the inserts happen in one transaction.
+        # This works both inside and outside of a transaction and, since we
+        # only touch the temp database, doesn't start a read transaction on
+        # the main database.
+        self.connection.execute("SAVEPOINT idset")
+        self.clear()
+        self.connection.executemany("INSERT OR IGNORE INTO temp.%s(id) "
+                                    "VALUES (?)" % self.table_name,
+                                    ((id_,) for id_ in id_list))
+        self.connection.execute("RELEASE idset")
+
+    def clear(self):
+        """Remove all ids from the set."""
+        self.connection.execute("DELETE FROM temp.%s" % self.table_name)
+
+    def select_sql(self):
+        """Get a SELECT statement for the ids in the set."""
+        return "SELECT id FROM temp.%s" % self.table_name
@@ -0,0 +1,263 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.indexadvisor -- Suggest indexes for the ItemTracker queries
+
+ItemTrackerQuery builds its SQL from conditions and ORDER BY columns, so
+queries that only differ in their values have the same QueryShape.
+ItemTracker passes the QueryShape to QueryStats.record() along with the SQL.
+IndexAdvisor looks at the slowest shapes and proposes indexes for them:
+
+- For the item table, an index on the columns compared with "=" or "IS",
+  followed by the ORDER BY columns.  That lets sqlite find the rows without a
+  scan and read them in order without sorting them.  If there's no usable
+  ORDER BY, a column compared with a range operator goes last instead.
+- For other tables that EXPLAIN QUERY PLAN shows being scanned, a covering
+  index with the columns that the conditions use.  Scanning the index is a
+  lot cheaper than scanning the table, since it only contains those columns.
+  If there's an index on some of those columns, the new one extends it.
+
+Indexes that already exist don't get proposed again.  The advisor doesn't
+create indexes itself, the ones that help get added to schema.py and
+created by an upgrade function.
+
+We don't propose partial indexes.  The conditions use bound values, and
+sqlite can't tell that "downloaded_time IS NOT ?" matches an index with
+"WHERE downloaded_time IS NOT NULL" when it prepares the statement.
+"""
+
+from miro import util
+from miro.data import querystats
+
+QueryShape = util.namedtuple(
+    "QueryShape",
+    "table conditions order_by search",
+
+    """QueryShape describes the SQL that an ItemTrackerQuery runs.
+
+    :attribute table: main table for the query
+    :attribute conditions: sorted tuple of (table, column, operator) tuples
+    for the WHERE clause.  operator is None for complex conditions.
+    :attribute order_by: tuple of (table, column, collation) tuples for the
+    ORDER BY clause, or None if the ORDER BY is a complex expression
+    :attribute search: does the query use a full-text search?
+    """)
+
+IndexProposal = util.namedtuple(
+    "IndexProposal",
+    "name table columns count total_time",
+
+    """IndexProposal is an index that IndexAdvisor thinks we should create.
+
+    :attribute name: suggested name for the index
+    :attribute table: table to create the index on
+    :attribute columns: tuple of columns for the index
+    :attribute count: number of queries that the index would help
+    :attribute total_time: time those queries took
+    """)
+
+# operators that an index can look up directly
+EQUALITY_OPERATORS = ('=', '==', 'IS')
+# operators that an index can use as a range
+RANGE_OPERATORS = ('<', '<=', '>', '>=', 'IS NOT')
+
+def index_name(table, columns):
+    """Make up a name for an index."""
+    return '%s_%s' % (table, '_'.join(columns))
+
+class IndexAdvisor(object):
+    """Proposes indexes for the query shapes in a QueryStats."""
+
+    def __init__(self, connection):
+        """Create an IndexAdvisor
+
+        :param connection: connection to the database that the queries run
+            on.  We use it to find the indexes that already exist and to
+            explain the queries.
+        """
+        self.connection = connection
+        # maps table names to lists of column tuples
+        self.indexes = {}
+        cursor = connection.execute("SELECT name FROM sqlite_master "
+                                    "WHERE type='table'")
+        for (table,) in cursor.fetchall():
+            self.indexes[table] = []
+        cursor = connection.execute("SELECT name, tbl_name FROM sqlite_master "
+                                    "WHERE type='index'")
+        for name, table in cursor.fetchall():
+            index_info = connection.execute('PRAGMA index_info("%s")' %
+                                            name.replace('"', '""'))
+            columns = tuple(row[2] for row in index_info.fetchall())
+            self.indexes.setdefault(table, []).append(columns)
+
+    def propose(self, query_stats, max_shapes=10):
+        """Propose indexes for the slowest shapes.
+
+        :param query_stats: QueryStats to get the query shapes from
+        :param max_shapes: only look at this many shapes
+        :returns: list of IndexProposals, the ones that would help the most
+            come first
+        """
+        proposals = {}
+        shapes = [s for s in query_stats.get_query_shapes()
+                  if s[0].table in self.indexes]
+        for shape, count, total_time, example in shapes[:max_shapes]:
+            for table, columns in self.candidate_indexes(shape, example):
+                # several shapes can want the same index
+                key = (table, columns)
+                old = proposals.get(key)
+                if old is None:
+                    proposals[key] = IndexProposal(index_name(table, columns),
+                                                   table, columns, count,
+                                                   total_time)
+                else:
+                    proposals[key] = old._replace(
+                        count=old.count + count,
+                        total_time=old.total_time + total_time)
+        proposals = proposals.values()
+        proposals.sort(key=lambda p: p.total_time, reverse=True)
+        return proposals
+
+    def candidate_indexes(self, shape, example=None):
+        """Get the indexes that would help a query shape.
+
+        :param shape: QueryShape to look at
+        :param example: (sql, values) for a query with the shape.  If given,
+            we explain it to find the other tables that get scanned.
+        :returns: list of (table, columns) tuples for indexes that don't
+            exist yet
+        """
+        candidates = []
+        columns = self._main_table_columns(shape)
+        if columns and not self.is_covered(shape.table, columns,
+                                           self._equality_count(shape)):
+            candidates.append((shape.table, columns))
+        if example is not None:
+            for table in self._scanned_tables(*example):
+                if table == shape.table:
+                    continue
+                columns = self._covering_columns(shape, table)
+                if columns and not self.is_covering(table, columns):
+                    candidates.append((table, columns))
+        return candidates
+
+    def _equality_columns(self, shape):
+        columns = []
+        for table, column, operator in shape.conditions:
+            if (table == shape.table and operator in EQUALITY_OPERATORS and
+                    column not in columns):
+                columns.append(column)
+        return columns
+
+    def _equality_count(self, shape):
+        return len(self._equality_columns(shape))
+
+    def _main_table_columns(self, shape):
+        columns = self._equality_columns(shape)
+        sort_columns = []
+        if shape.order_by:
+            for table, column, collation in shape.order_by:
+                # indexes use the default collation, they can't help sort
+                # using anything else.
+                if table != shape.table or collation is not None:
+                    sort_columns = []
+                    break
+                if column not in columns and column not in sort_columns:
+                    sort_columns.append(column)
+        if sort_columns:
+            columns.extend(sort_columns)
+        else:
+            # An index on one of the equality columns already narrows the
+            # search down.  The extra columns only pay off when they let
+            # sqlite skip a sort.
+            for column in columns:
+                if self._leading_column_indexed(shape.table, column):
+                    return ()
+            for table, column, operator in shape.conditions:
+                if (table == shape.table and operator in RANGE_OPERATORS and
+                        column not in columns):
+                    columns.append(column)
+                    break
+        return tuple(columns)
+
+    def _covering_columns(self, shape, table):
+        columns = []
+        for condition_table, column, operator in shape.conditions:
+            if condition_table == table and column not in columns:
+                columns.append(column)
+        # If an existing index only has some of the columns, extend it, so
+        # that the new index can replace it.
+        for index in self.indexes.get(table, ()):
+            if set(index).issubset(columns):
+                columns = list(index) + [c for c in columns
+                                         if c not in index]
+                break
+        return tuple(columns)
+
+    def _leading_column_indexed(self, table, column):
+        return any(index[:1] == (column,)
+                   for index in self.indexes.get(table, ()))
+
+    def is_covered(self, table, columns, equality_count):
+        """Check if an existing index works as well as a new one would.
+
+        The first equality_count columns can be in any order, the rest must
+        match.
+        """
+        for index in self.indexes.get(table, ()):
+            if (set(index[:equality_count]) ==
+                    set(columns[:equality_count]) and
+                    index[equality_count:len(columns)] ==
+                    columns[equality_count:]):
+                return True
+        return False
+
+    def is_covering(self, table, columns):
+        """Check if an existing index contains all of columns."""
+        return any(set(columns).issubset(index)
+                   for index in self.indexes.get(table, ()))
+
+    def _scanned_tables(self, sql, values):
+        plan = querystats.explain(self.connection, sql, values)
+        if plan is None:
+            return []
+        return querystats.full_scan_tables(plan)
+
+def get_report(connection, query_stats, max_shapes=10):
+    """Get a report of the proposed indexes.
+
+    :returns: dict with the keys name and proposals.  proposals is a list of
+        dicts, one for each IndexProposal.
+    """
+    advisor = IndexAdvisor(connection)
+    return {
+        'name': 'IndexAdvisor',
+        'proposals': [p._asdict() for p in
+                      advisor.propose(query_stats, max_shapes)],
+    }
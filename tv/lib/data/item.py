@@ -782,6 +782,30 @@ class DBErrorItemInfo(ItemInfoBase):
         self.filename_unicode = None
         self.source_type = 'dberror'
 
+class DeletedItemInfo(DBErrorItemInfo):
+    """Placeholder for an item that was deleted after its list was selected.
+
+    The ItemChanges message for the deletion will make the list get refetched
+    shortly.
+    """
+
+    def __init__(self, id):
+        DBErrorItemInfo.__init__(self, id)
+        self.title = u''
+        self.source_type = 'deleted'
+
+class LoadingItemInfo(DBErrorItemInfo):
+    """Placeholder for an item that's being loaded in the background.
+
+    ItemTracker.get_display_row() returns these while a prefetch is pending,
+    so that drawing doesn't have to wait on the database.
+    """
+
+    def __init__(self, id):
+        DBErrorItemInfo.__init__(self, id)
+        self.title = u''
+        self.source_type = 'loading'
+
 class DeviceItemSelectInfo(ItemSelectInfo):
     """ItemSelectInfo for DeviceItems."""
 
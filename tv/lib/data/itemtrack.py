@@ -30,11 +30,15 @@
 """miro.data.itemtrack -- Track Items in the database
 """
 import collections
+import itertools
 import logging
+import Queue
 import string
 import sqlite3
 import random
 import re
+import threading
+import time
 import weakref
 
 from miro import app
@@ -43,12 +47,27 @@ from miro import prefs
 from miro import schema
 from miro import signals
 from miro import util
+from miro.data import changecounter
+from miro.data import connectionpool
+from miro.data import idset
+from miro.data import indexadvisor
 from miro.data import item
+from miro.data import querystats
 from miro.gtcache import gettext as _
 
+# statistics for the queries that ItemTrackerQuery objects run
+query_stats = querystats.QueryStats('ItemTracker')
+
+def _run_query(connection, sql, arg_list, shape):
+    start = time.time()
+    rows = connection.execute(sql, arg_list).fetchall()
+    query_time = time.time() - start
+    query_stats.record(sql, arg_list, query_time, len(rows), shape)
+    return rows
+
 ItemTrackerCondition = util.namedtuple(
     "ItemTrackerCondition",
-    "columns sql values",
+    "columns sql values operator",
 
     """ItemTrackerCondition defines one term for the WHERE clause of a query.
 
@@ -57,16 +76,20 @@ ItemTrackerCondition = util.namedtuple(
     re-run the query.
     :attribute sql: sql string for the clause
     :attribute values: list of values to use to fill in sql
+    :attribute operator: operator used to compare the column, or None for
+    complex conditions
     """)
 
 ItemTrackerOrderBy = util.namedtuple(
     "ItemTrackerOrderBy",
-    "columns sql",
+    "columns sql collations",
 
     """ItemTrackerOrderBy defines one term for the ORDER BY clause of a query.
 
     :attribute columns: list of (table, column) tuples used in the query
     :attribute sql: sql expression
+    :attribute collations: list of collations for columns, or None if sql is
+    a complex expression
     """)
 
 class ItemTrackerQueryBase(object):
@@ -118,7 +141,8 @@ class ItemTrackerQueryBase(object):
         """
         table, column = self._parse_column(column)
         sql = "%s.%s %s ?" % (table, column, operator)
-        cond = ItemTrackerCondition([(table, column)], sql, (value,))
+        cond = ItemTrackerCondition([(table, column)], sql, (value,),
+                                    operator)
         self.conditions.append(cond)
 
     def set_search(self, search_string):
@@ -161,7 +185,7 @@ class ItemTrackerQueryBase(object):
         :param values: tuple of values to substitute into sql
         """
         columns = [self._parse_column(c) for c in columns]
-        cond = ItemTrackerCondition(columns, sql, values)
+        cond = ItemTrackerCondition(columns, sql, values, None)
         self.conditions.append(cond)
 
     def set_order_by(self, columns, collations=None):
@@ -192,7 +216,8 @@ class ItemTrackerQueryBase(object):
             sql_parts.append(self._order_by_expression(table, column,
                                                        descending, collation))
         self.order_by = ItemTrackerOrderBy(order_by_columns,
-                                           ', '.join(sql_parts))
+                                           ', '.join(sql_parts),
+                                           tuple(collations))
 
     def set_complex_order_by(self, columns, sql):
         """Change the ORDER BY clause to a complex SQL expression
@@ -201,7 +226,7 @@ class ItemTrackerQueryBase(object):
         :param sql: SQL to execute
         """
         order_by_columns = [self._parse_column(c) for c in columns]
-        self.order_by = ItemTrackerOrderBy(order_by_columns, sql)
+        self.order_by = ItemTrackerOrderBy(order_by_columns, sql, None)
 
     def _order_by_expression(self, table, column, descending, collation):
         parts = []
@@ -232,6 +257,28 @@ class ItemTrackerQueryBase(object):
                            if table == self.table_name())
         return columns
 
+    def shape(self):
+        """Get the QueryShape for this query.
+
+        Queries with the same shape only differ in their values.
+        """
+        conditions = []
+        for c in self.conditions:
+            for table, column in c.columns:
+                conditions.append((table, column, c.operator))
+        conditions.sort()
+        if self.order_by is None:
+            order_by = ()
+        elif self.order_by.collations is None:
+            order_by = None
+        else:
+            order_by = tuple((table, column, collation)
+                             for ((table, column), collation)
+                             in zip(self.order_by.columns,
+                                    self.order_by.collations))
+        return indexadvisor.QueryShape(self.table_name(), tuple(conditions),
+                                       order_by, bool(self.match_string))
+
     def get_other_tables_to_track(self):
         """Get tables other than item that could affect this query."""
         other_tables = set()
@@ -258,7 +305,8 @@ class ItemTrackerQueryBase(object):
         self._add_limit(sql_parts, arg_list)
         sql = ' '.join(sql_parts)
         logging.debug("ItemTracker: running query %s (%s)", sql, arg_list)
-        item_ids = [row[0] for row in connection.execute(sql, arg_list)]
+        item_ids = [row[0] for row in _run_query(connection, sql, arg_list,
+                                                 self.shape())]
         logging.debug("ItemTracker: done running query")
         return item_ids
 
@@ -282,7 +330,7 @@ class ItemTrackerQueryBase(object):
         self._add_limit(sql_parts, arg_list)
         sql = ' '.join(sql_parts)
         logging.debug("ItemTracker: running query %s (%s)", sql, arg_list)
-        item_data = list(connection.execute(sql, arg_list))
+        item_data = _run_query(connection, sql, arg_list, self.shape())
         logging.debug("ItemTracker: done running query")
         return item_data
 
@@ -404,12 +452,22 @@ class ItemTracker(signals.SignalEmitter):
     - "items-changed" (changed_id_list): some items have been changed, but the
     list is the same.
     - "list-changed": items have been added, removed, or reorded in the list.
+    - "rows-loaded" (id_list): rows requested with prefetch_rows() are now
+    loaded.  get_display_row() will return the real data for them.
+
+    :attribute prefetch_stats: Counter that tracks how well prefetching works.
+    "prefetch_hits" counts rows that were displayed after being prefetched,
+    which are stalls that we avoided.  "stalls" counts rows that
+    get_display_row() had to load synchronously.  "placeholders" counts how
+    many times get_display_row() returned a placeholder.
     """
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # most rows we request in one prefetch_rows() call
+    PREFETCH_MAX_ROWS = 500
 
-    def __init__(self, idle_scheduler, query, item_source):
+    def __init__(self, idle_scheduler, query, item_source, row_loader=None):
         """Create an ItemTracker
 
         :param idle_scheduler: function to schedule idle callback functions.
@@ -417,15 +475,25 @@ class ItemTracker(signals.SignalEmitter):
         idletime.
         :param query: ItemTrackerQuery to use
         :param item_source: ItemSource to use.
+        :param row_loader: RowLoader to use for prefetch_rows().  If None,
+        rows are always loaded synchronously.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("will-change")
         self.create_signal("items-changed")
         self.create_signal("list-changed")
+        self.create_signal("rows-loaded")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
         self.item_fetcher = None
         self.item_source = item_source
+        self.row_loader = row_loader
+        # maps ids being prefetched to the job that's loading them
+        self._prefetch_pending = {}
+        # ids that were prefetched, but haven't been displayed yet
+        self._prefetched_ids = set()
+        self._prefetch_job_ids = itertools.count()
+        self.prefetch_stats = collections.Counter()
         self._db_retry_callback_pending = False
         self._set_query(query)
         self._fetch_id_list()
@@ -447,6 +515,11 @@ class ItemTracker(signals.SignalEmitter):
         """
         self._destroy_item_fetcher()
         self.id_list = self.id_to_index = self.row_data = None
+        self._prefetch_pending = {}
+        self._prefetched_ids = set()
+        if self.prefetch_stats:
+            logging.debug("ItemTracker prefetch stats: %s",
+                          dict(self.prefetch_stats))
 
     def make_item_fetcher(self, connection, id_list):
         """Make an ItemFetcher to use.
@@ -499,6 +572,9 @@ class ItemTracker(signals.SignalEmitter):
             self._make_empty_list_after_db_error()
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
+        # results from pending prefetches are for the old list, ignore them
+        self._prefetch_pending = {}
+        self._prefetched_ids = set()
 
     def _make_empty_list_after_db_error(self):
         self.id_list = []
@@ -533,6 +609,8 @@ class ItemTracker(signals.SignalEmitter):
         for id_ in id_list:
             if id_ in self.row_data:
                 del self.row_data[id_]
+            # a prefetch may have read the old data
+            self._prefetch_pending.pop(id_, None)
 
     def _refetch_id_list(self, send_signals=True):
         """Refetch a new id list after we already have one."""
@@ -650,6 +728,79 @@ class ItemTracker(signals.SignalEmitter):
             raise IndexError("%s is out of range" % index)
         return self.row_data[id_]
 
+    def get_display_row(self, index):
+        """Get an ItemRow to draw for row index.
+
+        This works like get_row(), except when the row is being loaded by
+        prefetch_rows().  In that case we return a LoadingItemInfo
+        placeholder rather than waiting on the database.  "rows-loaded" will
+        be emitted when the real data is ready.
+
+        :raises IndexError: index out of range
+        """
+        try:
+            id_ = self.id_list[index]
+        except IndexError:
+            raise IndexError("%s is out of range" % index)
+        if id_ in self.row_data:
+            if id_ in self._prefetched_ids:
+                self._prefetched_ids.remove(id_)
+                self.prefetch_stats['prefetch_hits'] += 1
+            return self.row_data[id_]
+        elif id_ in self._prefetch_pending:
+            self.prefetch_stats['placeholders'] += 1
+            return item.LoadingItemInfo(id_)
+        else:
+            self.prefetch_stats['stalls'] += 1
+            return self.get_row(index)
+
+    def prefetch_rows(self, start, end):
+        """Start loading rows in the background.
+
+        This is a hint that rows in the range will be displayed soon.  It
+        only has an effect if we have a RowLoader and our ItemFetcher
+        supports background fetching.  Rows that are already loaded or
+        being loaded are skipped.
+
+        :param start: index of the first row to load
+        :param end: index one past the last row to load
+        """
+        if (self.row_loader is None or self.item_fetcher is None or
+                not self.item_fetcher.background_fetch):
+            return
+        start = max(start, 0)
+        end = min(end, len(self.id_list), start + self.PREFETCH_MAX_ROWS)
+        id_list = [id_ for id_ in self.id_list[start:end]
+                   if id_ not in self.row_data and
+                   id_ not in self._prefetch_pending]
+        if not id_list:
+            return
+        job_id = self._prefetch_job_ids.next()
+        if not self.row_loader.load_rows(self.item_source, id_list,
+                                         self._on_rows_prefetched, job_id):
+            return
+        for id_ in id_list:
+            self._prefetch_pending[id_] = job_id
+
+    def _on_rows_prefetched(self, items, job_id):
+        if self.id_list is None:
+            # destroy() was called while the rows were loading
+            return
+        loaded_ids = []
+        if items is not None:
+            for item_info in items:
+                if self._prefetch_pending.get(item_info.id) == job_id:
+                    self.row_data[item_info.id] = item_info
+                    self._prefetched_ids.add(item_info.id)
+                    loaded_ids.append(item_info.id)
+        # Forget about the rest of this job's ids.  They were either
+        # uncached while we were loading them, or we got an error.  Either
+        # way, get_display_row() will load them itself.
+        for id_, pending_job_id in self._prefetch_pending.items():
+            if pending_job_id == job_id:
+                del self._prefetch_pending[id_]
+        self.emit('rows-loaded', loaded_ids)
+
     def get_first_item(self):
         return self.get_row(0)
 
@@ -719,13 +870,15 @@ class ItemFetcher(object):
 
     The connection that gets passed to ItemFetcher still has a read
     transaction open from the query that selected the item ids.  ItemFetcher
-    should ensure that the data it fetches to create the ItemInfo is from that
-    same transaction.  ItemFetcher should take ownership of the connection and
-    ensure that it gets released.
+    should ensure that it can create an ItemInfo for each of those ids, even
+    if the backend changes the database afterwards.  ItemFetcher should take
+    ownership of the connection and ensure that it gets released.
 
-    We handle this 2 ways.  If we are using the WAL journal mode, then we can
-    just keep the transaction open, since it won't block writers from
-    committing data.
+    We handle this 2 ways.  If we are using the WAL journal mode, then we
+    don't freeze the data at all.  Each batch of items is read from a fresh
+    snapshot and we use a change counter to notice when items were removed
+    after the ids were selected.  Keeping the transaction open would stop
+    SQLite from checkpointing the WAL file.
 
     If we aren't using WAL journal mode, then we select the data we need into
     a temporary table to freeze it in place.  This is slower than the WAL
@@ -738,12 +891,24 @@ class ItemFetcher(object):
     select_has_playables() which figure out which items in the list are
     playable using an SQL select.  This is needed because we want to calculate
     this without having to load all the ItemInfos in the list.
+
+    Ids get passed to SQLite using IdSet tables rather than inlined into the
+    SQL, so that our statements stay the same for every list and batch.
     """
 
+    # Can ItemTracker use a RowLoader to fetch our items on another
+    # connection?  That only works if fetch_items() reads the current data
+    # rather than a frozen copy.
+    background_fetch = False
+
     def __init__(self, connection, item_source, id_list):
         self.connection = connection
         self.item_source = item_source
         self.id_list = id_list
+        # ids for the current fetch_items() call
+        self.fetch_id_set = idset.IdSet(connection, 'fetch')
+        # ids for the entire list.  We fill this in when it's first needed.
+        self._list_id_set = None
 
     def select_columns(self):
         return self.item_source.select_info.select_columns
@@ -757,8 +922,21 @@ class ItemFetcher(object):
     def path_column(self):
         return self.item_source.select_info.path_column
 
+    def list_id_set(self):
+        """Get an IdSet that contains the ids in our list."""
+        if self._list_id_set is None:
+            self._list_id_set = idset.IdSet(self.connection, 'list')
+            self._list_id_set.set_ids(self.id_list)
+        return self._list_id_set
+
     def release_connection(self):
         if self.connection is not None:
+            # free the memory used by our id sets, the connection will stay
+            # in the pool.
+            self.fetch_id_set.clear()
+            if self._list_id_set is not None:
+                self._list_id_set.clear()
+                self._list_id_set = None
             self.item_source.release_connection(self.connection)
             self.connection = None
 
@@ -803,99 +981,109 @@ class ItemFetcher(object):
 
         :returns: list of item ids
         """
-        raise NotImplementedError()
+        sql = ("SELECT id FROM %s "
+               "WHERE %s IS NOT NULL AND "
+               "file_type != 'other' AND "
+               "id in (%s)" %
+               (self.table_name(), self.path_column(),
+                self.list_id_set().select_sql()))
+        return [row[0] for row in self.connection.execute(sql)]
 
     def select_has_playables(self):
         """Calculate if any items are playable using a select statement.
 
         :returns: True/False
         """
-        raise NotImplementedError()
+        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
+               "WHERE %s IS NOT NULL AND "
+               "file_type != 'other' AND "
+               "id in (%s))" %
+               (self.table_name(), self.path_column(),
+                self.list_id_set().select_sql()))
+        return self.connection.execute(sql).fetchone()[0] == 1
 
 class ItemFetcherWAL(ItemFetcher):
+    """ItemFetcher for WAL mode.
+
+    We don't hold onto a read transaction, since that would stop SQLite from
+    checkpointing the WAL file for as long as the list is displayed.
+    Instead, each fetch_items() call reads from its own snapshot.  If an item
+    was deleted after our id list was selected, we return a placeholder for
+    it.  The deletion will bump the change counter, so the next
+    refresh_items() call will tell ItemTracker to refetch the list.
+    """
+    background_fetch = True
+
     def __init__(self, connection, item_source, id_list):
         ItemFetcher.__init__(self, connection, item_source, id_list)
         self._prepare_sql()
-        self.item_count = self.calc_item_count()
-        self.max_item_id = self.calc_max_item_id()
+        # read the counter in the same transaction that selected id_list
+        self.change_count = self.calc_change_count()
+        self.connection.commit()
 
     def destroy(self):
         self.release_connection()
 
-    def done_fetching(self):
-        # We can safely finish the read transaction here
-        self.connection.commit()
-
-    def calc_item_count(self):
-        sql = "SELECT COUNT(1) FROM %s" % self.table_name()
-        return self.connection.execute(sql).fetchone()[0]
-
-    def calc_max_item_id(self):
-        sql = "SELECT MAX(id) FROM %s" % self.table_name()
-        return self.connection.execute(sql).fetchone()[0]
+    def calc_change_count(self):
+        """Get a value that changes when items are added or removed."""
+        change_count = changecounter.get_change_count(self.connection)
+        if change_count is not None:
+            return change_count
+        # No change counter in the database, fall back to scanning the item
+        # table.
+        sql = "SELECT COUNT(1), MAX(id) FROM %s" % self.table_name()
+        return tuple(self.connection.execute(sql).fetchone())
 
     def _prepare_sql(self):
         """Get an SQL statement ready to fire when fetch() is called.
 
-        The statement will be ready to go, except the WHERE clause will not be
-        present, since we can't know that in advance.
+        The statement selects the items in fetch_id_set.
         """
-        columns = ['%s.%s' % (c.table, c.column)
-                   for c in self.select_columns()]
-        self._sql = ("SELECT %s FROM %s %s" %
-                     (', '.join(columns), self.table_name(), self.join_sql()))
+        self._sql = _item_select_sql(self.item_source.select_info,
+                                     self.fetch_id_set)
 
     def fetch_items(self, id_list):
         """Create Item objects."""
-        where = ("WHERE %s.id in (%s)" %
-                 (self.table_name(), ', '.join(str(i) for i in id_list)))
-        sql = ' '.join((self._sql, where))
-        cursor = self.connection.execute(sql)
-        return [self.item_source.make_item_info(row) for row in cursor]
+        self.fetch_id_set.set_ids(id_list)
+        # We're not inside a transaction, so the SELECT gets its own snapshot
+        # which ends once we've read all the rows.
+        return _read_item_infos(self.connection, self.item_source, self._sql,
+                                id_list)
 
     def refresh_items(self, changed_ids):
-        # We ignore changed_ids and just start a new transaction which will
-        # refresh all the data.
-        self.connection.commit()
-        self.connection.execute("BEGIN TRANSACTION")
-        # check if an item has been added/removed from the DB now that we have
-        # a new transaction.  This can happen if the backend changes some
+        # We ignore changed_ids, since fetch_items() always reads the current
+        # data.  Check if an item has been added/removed from the DB since we
+        # selected our id list.  This can happen if the backend changes some
         # items sends an ItemsChanged message, then deletes them before we
         # process the message (see #19823)
-
-        new_max_id = self.calc_max_item_id()
-        new_item_count = self.calc_item_count()
-        # checks for items have been added
-        if new_max_id != self.max_item_id:
-            self.max_item_id = new_max_id
-            # update item_count since that could have changed too
-            self.item_count = new_item_count
-            return True
-        # given that items haven't been added, we can use the total number of
-        # items to check if any have been deleted
-        if new_item_count != self.item_count:
-            self.item_count = new_item_count
+        new_change_count = self.calc_change_count()
+        if new_change_count != self.change_count:
+            self.change_count = new_change_count
             return True
         # nothing has changed, we can return false
         return False
 
-    def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" % 
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
+def _item_select_sql(select_info, id_set):
+    """Get SQL that selects the item data for the ids in an IdSet."""
+    columns = ['%s.%s' % (c.table, c.column)
+               for c in select_info.select_columns]
+    return ("SELECT %s FROM %s %s WHERE %s.id in (%s)" %
+            (', '.join(columns), select_info.table_name,
+             select_info.join_sql(), select_info.table_name,
+             id_set.select_sql()))
 
-    def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
+def _read_item_infos(connection, item_source, sql, id_list):
+    """Run SQL from _item_select_sql() and create ItemInfos
+
+    Ids from id_list that are no longer in the database get DeletedItemInfo
+    placeholders.
+    """
+    cursor = connection.execute(sql)
+    items = [item_source.make_item_info(row) for row in cursor]
+    if len(items) < len(id_list):
+        missing = set(id_list).difference(i.id for i in items)
+        items.extend(item.DeletedItemInfo(id_) for id_ in missing)
+    return items
 
 class ItemFetcherNoWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
@@ -922,18 +1110,19 @@ INSERT OR REPLACE INTO $temp_table_name($dest_columns)
 SELECT $source_columns
 FROM $table_name
 $join_sql
-WHERE $table_name.id in ($id_list)""")
+WHERE $table_name.id in ($id_list_sql)""")
         d = {
             'temp_table_name': self.temp_table_name,
             'table_name': self.table_name(),
             'join_sql': self.join_sql(),
-            'id_list': ', '.join(str(id_) for id_ in id_list),
+            'id_list_sql': self.fetch_id_set.select_sql(),
             'dest_columns': ','.join(ci.attr_name
                                      for ci in self.select_columns()),
             'source_columns': ','.join('%s.%s' % (ci.table, ci.column)
                                        for ci in self.select_columns()),
         }
         sql = template.substitute(d)
+        self.fetch_id_set.set_ids(id_list)
         self.connection.execute(sql)
 
     def destroy(self):
@@ -947,9 +1136,9 @@ WHERE $table_name.id in ($id_list)""")
         """Create Item objects."""
         # We can use SELECT * here because we know that we defined the columns
         # in the same order as select_columns() returned them.
-        id_list_str = ', '.join(str(i) for i in id_list)
-        sql = "SELECT * FROM %s WHERE id IN (%s)" % (self.temp_table_name,
-                                                     id_list_str)
+        self.fetch_id_set.set_ids(id_list)
+        sql = "SELECT * FROM %s WHERE id IN (%s)" % (
+            self.temp_table_name, self.fetch_id_set.select_sql())
         return [self.item_source.make_item_info(row)
                 for row in self.connection.execute(sql)]
 
@@ -957,23 +1146,110 @@ WHERE $table_name.id in ($id_list)""")
         self._select_into_temp_table(changed_ids)
         return False
 
-    def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
+class RowLoader(object):
+    """Load ItemInfos in a background thread.
 
-    def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
+    ItemTracker uses this to implement prefetch_rows(), so that rows are
+    ready by the time they're scrolled into view.
+
+    We run one job at a time.  If a job is requested while another one is
+    running, it waits, and replaces any other waiting job, since the newest
+    request is the one closest to what the user is looking at.
+
+    Connections come from the ItemSource's ConnectionPool.  ConnectionPool
+    isn't thread-safe, so we get and release them in the calling thread and
+    only use them in our thread in between.  We only take a connection if
+    the pool has one to spare, so that we never cause ConnectionLimitError
+    for the ItemTrackers.
+    """
+    def __init__(self, result_scheduler):
+        """Create a RowLoader
+
+        :param result_scheduler: function that calls a function in the
+        thread that uses our ItemTrackers (for example call_on_ui_thread)
+        """
+        self.result_scheduler = result_scheduler
+        self.job_queue = Queue.Queue()
+        self.thread = None
+        self.running_job = None
+        self.waiting_job = None
+
+    def load_rows(self, item_source, id_list, callback, *args):
+        """Load ItemInfos for a list of ids.
+
+        Once the rows are loaded, callback will be called using
+        result_scheduler.  Its first argument will be the list of ItemInfos,
+        or None if the rows couldn't be loaded.  The rest of the arguments
+        will be args.
+
+        callback is always called, unless load_rows() returns False.
+        """
+        if not item_source.connection_pool.has_spare_connections(2):
+            return False
+        job = (item_source, id_list, callback, args)
+        if self.running_job is None:
+            self._start_job(job)
+        else:
+            if self.waiting_job is not None:
+                self._cancel_job(self.waiting_job)
+            self.waiting_job = job
+        return True
+
+    def shutdown(self):
+        """Stop our thread."""
+        if self.thread is not None:
+            self.job_queue.put(None)
+            self.thread = None
+        if self.waiting_job is not None:
+            self._cancel_job(self.waiting_job)
+            self.waiting_job = None
+
+    def _start_job(self, job):
+        item_source, id_list, callback, args = job
+        try:
+            connection = item_source.get_connection()
+        except connectionpool.ConnectionLimitError:
+            self._cancel_job(job)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._thread_loop,
+                                           name="ItemTracker RowLoader")
+            self.thread.daemon = True
+            self.thread.start()
+        self.running_job = job
+        self.job_queue.put((connection, job))
+
+    def _cancel_job(self, job):
+        item_source, id_list, callback, args = job
+        callback(None, *args)
+
+    def _thread_loop(self):
+        while True:
+            next_job = self.job_queue.get()
+            if next_job is None:
+                return
+            connection, job = next_job
+            item_source, id_list, callback, args = job
+            try:
+                id_set = idset.IdSet(connection, 'prefetch')
+                id_set.set_ids(id_list)
+                sql = _item_select_sql(item_source.select_info, id_set)
+                items = _read_item_infos(connection, item_source, sql,
+                                         id_list)
+                id_set.clear()
+            except sqlite3.DatabaseError, e:
+                logging.warn("%s while prefetching items", e, exc_info=True)
+                items = None
+            self.result_scheduler(self._finish_job, connection, job, items)
+
+    def _finish_job(self, connection, job, items):
+        item_source, id_list, callback, args = job
+        item_source.release_connection(connection)
+        self.running_job = None
+        callback(items, *args)
+        if self.waiting_job is not None and self.thread is not None:
+            job, self.waiting_job = self.waiting_job, None
+            self._start_job(job)
 
 class BackendItemTracker(signals.SignalEmitter):
     """Item tracker used by the backend
@@ -73,3 +73,21 @@ class SharingItemPlaylistMap(object):
             "INSERT INTO sharing_item_playlist_map(playlist_id, item_id) "
             "VALUES (?, ?)",
             [(playlist_id, item_id) for item_id in item_ids])
+
+    def add_playlist_items(self, playlist_id, item_ids):
+        """Add items to a playlist."""
+        self.connection.executemany(
+            "INSERT INTO sharing_item_playlist_map(playlist_id, item_id) "
+            "VALUES (?, ?)",
+            [(playlist_id, item_id) for item_id in item_ids])
+
+    def remove_playlist_items(self, playlist_id, item_ids):
+        """Remove items from a playlist."""
+        self.connection.executemany(
+            "DELETE FROM sharing_item_playlist_map "
+            "WHERE playlist_id=? AND item_id=?",
+            [(playlist_id, item_id) for item_id in item_ids])
+
+    def clear(self):
+        """Remove all entries."""
+        self.connection.execute("DELETE FROM sharing_item_playlist_map")
@@ -0,0 +1,264 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.querystats -- Collect statistics about the SQL we run
+
+QueryStats groups statements by their shape: the SQL with literal values
+replaced by "?", IN lists collapsed and whitespace normalized.  Queries that
+only differ in their values get counted together.  For each shape we track
+the number of runs, the total and maximum time, a sample of recent times
+for percentiles and the number of rows returned.
+
+get_report() can also run EXPLAIN QUERY PLAN for the slowest shapes and flag
+the ones that do a full scan of a table.  The main one to watch out for is
+"item", since it has a row for every item in the library.
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import collections
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+_FULL_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+
+def statement_shape(sql):
+    """Get the shape of an SQL statement."""
+    shape = _STRING_RE.sub('?', sql)
+    shape = _NUMBER_RE.sub('?', shape)
+    shape = _IN_LIST_RE.sub('IN (...)', shape)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+def explain(connection, sql, values):
+    """Run EXPLAIN QUERY PLAN for a statement.
+
+    :returns: list of detail strings, or None if sqlite couldn't explain the
+        statement
+    """
+    try:
+        cursor = connection.execute("EXPLAIN QUERY PLAN %s" % sql, values)
+        # The detail string is always the last column.  The other columns
+        # differ between sqlite versions.
+        return [row[-1] for row in cursor.fetchall()]
+    except sqlite3.Error, e:
+        logging.warn("querystats: error explaining %s (%s)", sql, e)
+        return None
+
+def full_scan_tables(plan):
+    """Get the tables that a query plan does a full scan of.
+
+    :param plan: list of detail strings from EXPLAIN QUERY PLAN
+    """
+    tables = []
+    for detail in plan:
+        match = _FULL_SCAN_RE.match(detail)
+        if match is not None:
+            tables.append(match.group(1))
+    return tables
+
+class _ShapeStats(object):
+    def __init__(self, sample_size):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.times = collections.deque(maxlen=sample_size)
+        # sql and values from the last run, for EXPLAIN QUERY PLAN.  We only
+        # keep them for SELECT statements.
+        self.example = None
+        # query shape that the caller passed to record()
+        self.query_shape = None
+
+class QueryStats(object):
+    """Tracks statistics for the statements run on a database.
+
+    record() can be called from any thread.
+    """
+
+    # number of recent times kept for each shape to calculate percentiles
+    SAMPLE_SIZE = 200
+    # maximum number of shapes we track.  Statements with new shapes are
+    # ignored after that.
+    MAX_SHAPES = 1000
+    # maximum number of SQL strings we remember the shape of
+    MAX_CACHED_SQL = 2000
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Throw away the statistics that we've collected."""
+        with self.lock:
+            self.start_time = time.time()
+            self._shapes = {}
+            # maps SQL strings to shapes.  Most of our SQL uses parameters,
+            # so the same strings keep coming back.
+            self._sql_to_shape = {}
+
+    def record(self, sql, values, query_time, rows=None, query_shape=None):
+        """Record a statement that we ran.
+
+        :param sql: SQL that we ran
+        :param values: values used for the statement
+        :param query_time: time the statement took
+        :param rows: number of rows it returned, or None for updates
+        :param query_shape: hashable description of the statement from the
+            code that built it, for get_query_shapes().  ItemTracker passes
+            the QueryShape that indexadvisor uses.
+        """
+        with self.lock:
+            try:
+                shape = self._sql_to_shape[sql]
+            except KeyError:
+                shape = statement_shape(sql)
+                if len(self._sql_to_shape) >= self.MAX_CACHED_SQL:
+                    self._sql_to_shape.clear()
+                self._sql_to_shape[sql] = shape
+            try:
+                stats = self._shapes[shape]
+            except KeyError:
+                if len(self._shapes) >= self.MAX_SHAPES:
+                    return
+                stats = self._shapes[shape] = _ShapeStats(self.SAMPLE_SIZE)
+            stats.count += 1
+            stats.total_time += query_time
+            if query_time > stats.max_time:
+                stats.max_time = query_time
+            stats.times.append(query_time)
+            if rows is not None:
+                stats.rows += rows
+                stats.example = (sql, values)
+            if query_shape is not None:
+                stats.query_shape = query_shape
+
+    def get_query_shapes(self):
+        """Get the statistics for the query shapes passed to record().
+
+        Statement shapes with the same query shape get combined.
+
+        :returns: list of (query_shape, count, total_time, example) tuples.
+            The query shapes that took the most time come first.
+        """
+        combined = {}
+        with self.lock:
+            for stats in self._shapes.itervalues():
+                if stats.query_shape is None:
+                    continue
+                info = combined.setdefault(stats.query_shape, [0, 0.0, None])
+                info[0] += stats.count
+                info[1] += stats.total_time
+                if stats.example is not None:
+                    info[2] = stats.example
+        shapes = [(query_shape, count, total_time, example)
+                  for query_shape, (count, total_time, example)
+                  in combined.iteritems()]
+        shapes.sort(key=lambda s: s[2], reverse=True)
+        return shapes
+
+    def get_report(self, connection=None, explain_count=10):
+        """Get a report of the statistics that we've collected.
+
+        :param connection: connection to use for EXPLAIN QUERY PLAN.  If this
+            is None, we don't explain any statements.
+        :param explain_count: explain this many of the slowest shapes
+        :returns: dict with the keys name, start_time, duration and shapes.
+            shapes is a list of dicts, one for each statement shape, with
+            the slowest shapes (by total time) first.
+        """
+        with self.lock:
+            shape_reports = []
+            for shape, stats in self._shapes.iteritems():
+                shape_reports.append(self._shape_report(shape, stats))
+            report = {
+                'name': self.name,
+                'start_time': self.start_time,
+                'duration': time.time() - self.start_time,
+                'shapes': shape_reports,
+            }
+        shape_reports.sort(key=lambda r: r['total_time'], reverse=True)
+        if connection is not None:
+            explained = 0
+            for shape_report in shape_reports:
+                if explained >= explain_count:
+                    break
+                example = shape_report.pop('example')
+                if example is not None:
+                    self._explain(connection, shape_report, *example)
+                    explained += 1
+        for shape_report in shape_reports:
+            shape_report.pop('example', None)
+        return report
+
+    def _shape_report(self, shape, stats):
+        times = sorted(stats.times)
+        def percentile(p):
+            return times[min(int(len(times) * p), len(times) - 1)]
+        return {
+            'shape': shape,
+            'count': stats.count,
+            'total_time': stats.total_time,
+            'mean_time': stats.total_time / stats.count,
+            'max_time': stats.max_time,
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'rows': stats.rows,
+            'example': stats.example,
+        }
+
+    def _explain(self, connection, shape_report, sql, values):
+        plan = explain(connection, sql, values)
+        if plan is None:
+            return
+        shape_report['plan'] = plan
+        shape_report['full_scans'] = full_scan_tables(plan)
+
+def write_json(path, reports):
+    """Write a list of reports from QueryStats.get_report() to a file."""
+    f = open(path, 'w')
+    try:
+        json.dump(reports, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def count_full_scans(report, table):
+    """Count the explained shapes in a report that do a full scan of table."""
+    return len([r for r in report['shapes']
+                if table in r.get('full_scans', ())])
@@ -29,6 +29,7 @@
 
 import itertools
 import logging
+import operator
 import traceback
 import threading
 
@@ -516,14 +517,101 @@ class AttributeUpdateTracker(object):
             instance.changed_attributes.add(self.name)
         instance.__dict__[self.name] = value
 
-class DDBObject(signals.SignalEmitter):
+# template for the setters that compact classes use to track changes
+_COMPACT_SETTER_TEMPLATE = """
+def set_%(name)s(self, value):
+    if getattr(self, '%(slot)s', _MISSING) != value:
+        self.changed_attributes.add('%(name)s')
+    self.%(slot)s = value
+"""
+
+def _make_compact_property(name, slot):
+    namespace = {'_MISSING': object()}
+    exec _COMPACT_SETTER_TEMPLATE % {'name': name, 'slot': slot} in namespace
+    return property(operator.attrgetter(slot), namespace['set_' + name])
+
+def _set_compact_db_values(self, dct):
+    setters = self._slot_setters
+    for name, value in dct.iteritems():
+        if name in setters:
+            setters[name](self, value)
+        else:
+            self.__dict__[name] = value
+
+def _make_compact_restore(slots):
+    """Make a _set_db_values() method for a compact class.
+
+    The common case is getting exactly our fields from
+    _restore_object_from_row().  For that we generate code that assigns each
+    slot directly, anything else goes through _set_compact_db_values().
+    """
+    lines = ['def set_db_values(self, dct):',
+             '    if len(dct) != %d:' % len(slots),
+             '        return _set_compact_db_values(self, dct)',
+             '    try:']
+    for name, slot in slots.items():
+        lines.append('        self.%s = dct[%r]' % (slot, name))
+    lines.extend(['    except KeyError:',
+                  '        _set_compact_db_values(self, dct)'])
+    namespace = {'_set_compact_db_values': _set_compact_db_values}
+    exec '\n'.join(lines) in namespace
+    return namespace['set_db_values']
+
+class DDBObject(signals.LazySignalEmitter):
     """Dynamic Database object
     """
 
+    signal_names = ('removed',)
+    # Set to True to store database fields in __slots__ rather than
+    # __dict__.  See make_compact_class().
+    compact_storage = False
+
+    def __new__(cls, *args, **kwargs):
+        # use our compact class if LiveStorage has created one
+        compact_class = cls.__dict__.get('_compact_class')
+        if compact_class is not None:
+            cls = compact_class
+        return super(DDBObject, cls).__new__(cls)
+
+    @classmethod
+    def make_compact_class(cls, field_names):
+        """Create a subclass that stores field_names in __slots__.
+
+        Once this is called, creating a cls object creates an instance of
+        the subclass instead.  The fields are accessed with properties that
+        read the slot directly and update changed_attributes when they're
+        set, which is cheaper than going through AttributeUpdateTracker.
+        Other attributes still get stored in __dict__.
+
+        The subclass is only created once, later calls return it.
+        """
+        compact_class = cls.__dict__.get('_compact_class')
+        if compact_class is not None:
+            return compact_class
+        slots = dict((name, '_f_' + name) for name in field_names)
+        class_dict = {
+            '__slots__': tuple(slots.values()),
+            '__module__': cls.__module__,
+            '__doc__': cls.__doc__,
+            '_set_db_values': _make_compact_restore(slots),
+        }
+        for name, slot in slots.items():
+            class_dict[name] = _make_compact_property(name, slot)
+        compact_class = type(cls.__name__, (cls,), class_dict)
+        compact_class._slot_setters = dict(
+            (name, compact_class.__dict__[slot].__set__)
+            for name, slot in slots.items())
+        cls._compact_class = compact_class
+        return compact_class
+
+    def _set_db_values(self, dct):
+        """Set database values without tracking changes."""
+        self.__dict__.update(dct)
+
     def __init__(self, *args, **kwargs):
         self.confirm_db_thread()
         self.in_db_init = True
-        signals.SignalEmitter.__init__(self, 'removed')
+        signals.LazySignalEmitter.__init__(self)
         self.changed_attributes = set()
 
         if 'db_info' in kwargs:
@@ -537,7 +625,7 @@ class DDBObject(signals.SignalEmitter):
             restoring = False
 
         if restoring:
-            self.__dict__.update(kwargs['restored_data'])
+            self._set_db_values(kwargs['restored_data'])
             self.db_info.db.remember_object(self)
             self.setup_restored()
             # handle setup_restored() calling remove()
@@ -680,7 +768,7 @@ class DDBObject(signals.SignalEmitter):
 
         :param dct: dict of new values for our database attributes
         """
-        self.__dict__.update(dct)
+        self._set_db_values(dct)
         self.changed_attributes.update(dct.keys())
 
     def get_id(self):
@@ -744,6 +832,11 @@ class DDBObject(signals.SignalEmitter):
             # view trackers in this case.  Both will be done when the
             # BulkSQLManager.finish() is called.
             return
+        if needs_save and self.db_info.db.write_behind:
+            # LiveStorage will send the UPDATE and check the view trackers
+            # when it flushes its dirty objects.
+            self.db_info.db.mark_dirty(self, can_change_views)
+            return
         if needs_save:
             self.db_info.db.update_obj(self)
         self.db_info.view_tracker_manager.update_view_trackers(
@@ -4417,3 +4417,17 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+def upgrade202(cursor):
+    """Add indexes for the ItemTracker queries that scan or sort the most."""
+    cursor.execute("CREATE INDEX item_feed_release_date "
+                   "ON item (feed_id, release_date)")
+    cursor.execute("CREATE INDEX item_unwatched_downloaded "
+                   "ON item (expired, parent_id, watched_time, "
+                   "downloaded_time)")
+    cursor.execute("CREATE INDEX item_file_type_last_watched "
+                   "ON item (file_type, last_watched)")
+    # downloader_state_item works for everything that downloader_state did
+    cursor.execute("DROP INDEX downloader_state")
+    cursor.execute("CREATE INDEX downloader_state_item "
+                   "ON remote_downloader (state, main_item_id)")
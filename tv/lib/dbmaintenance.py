@@ -0,0 +1,374 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dbmaintenance`` -- Background maintenance for the sqlite database.
+
+DatabaseMaintenance runs the housekeeping tasks for a LiveStorage:
+
+- checkpoint -- move the WAL file contents into the database
+- analyze -- update the query planner statistics, one table at a time
+- incremental_vacuum -- give free pages back to the filesystem
+- quick_check -- run PRAGMA quick_check
+- backup -- copy the database to the dbbackups directory
+
+Tasks only start once the database has been idle for IDLE_TIME seconds, and
+they run in small steps so that they never hold up the eventloop for long.
+quick_check can't be split up, so it runs in the thread pool instead.  The
+checks and backups use their own connection, which in WAL mode doesn't block
+the main connection.  A backup keeps a read transaction open between its
+steps, which stops sqlite from checkpointing the WAL, so it gets aborted if
+the database gets busy and starts over once it's idle again.
+
+The time each task took is logged and kept in get_report().
+"""
+
+import logging
+import os
+import time
+
+from miro import eventloop
+from miro import fileutil
+from miro import signals
+from miro import storedatabase
+from miro.plat.utils import filename_to_unicode
+
+class DatabaseMaintenance(signals.SignalEmitter):
+    """Runs maintenance tasks for a LiveStorage when it's idle.
+
+    Signals:
+
+    - task-finished(name, report) -- a task finished running.  report is
+      the dict that get_report() returns for the task.
+    """
+
+    # seconds since the last statement before we consider the database idle
+    IDLE_TIME = 30
+    # how often we check for tasks to run
+    POLL_INTERVAL = 60
+    # delay between the steps of a task
+    STEP_DELAY = 0.1
+    # rows to copy in each step of a backup
+    BACKUP_ROWS_PER_STEP = 1000
+    # pages to free in each step of an incremental vacuum
+    VACUUM_PAGES_PER_STEP = 256
+    # don't bother vacuuming unless we can free at least this many pages
+    VACUUM_MIN_PAGES = 1024
+
+    # This shouldn't start with LiveStorage.backup_filename_prefix.  Those
+    # files are the backups from before upgrades, which the diagnostics
+    # dialog lists and deletes.
+    BACKUP_NAME = "periodic_backup"
+    LAST_RUN_VARIABLE = 'maintenance_last_run'
+
+    # (task name, seconds between runs)
+    TASKS = [
+        ('checkpoint', 10 * 60),
+        ('incremental_vacuum', 24 * 60 * 60),
+        ('analyze', 7 * 24 * 60 * 60),
+        ('quick_check', 7 * 24 * 60 * 60),
+        ('backup', 24 * 60 * 60),
+    ]
+    # tasks that hold a read transaction open between steps
+    ABORT_WHEN_BUSY = ('backup',)
+
+    def __init__(self, db):
+        signals.SignalEmitter.__init__(self, 'task-finished')
+        self.db = db
+        try:
+            self._last_run = db.get_variable(self.LAST_RUN_VARIABLE)
+        except KeyError:
+            self._last_run = {}
+        # maps task names to reports for their last run
+        self._reports = {}
+        # (name, iterator, report) for the task that's running
+        self._current = None
+        self._dc = None
+
+    def start(self):
+        """Start checking for tasks to run."""
+        if self._dc is None:
+            self._schedule(self.POLL_INTERVAL)
+
+    def stop(self):
+        """Stop running tasks.
+
+        If a task is in the middle of running, it gets aborted.
+        """
+        if self._dc is not None:
+            self._dc.cancel()
+            self._dc = None
+        if self._current is not None:
+            self._abort_task()
+
+    def get_report(self):
+        """Get info about the last run of each task.
+
+        :returns: dict mapping task names to dicts with the keys start,
+            duration (wall-clock seconds), work_time (seconds spent in our
+            steps), steps and result
+        """
+        return dict((name, report.copy())
+                    for name, report in self._reports.items())
+
+    def running_task(self):
+        """Get the name of the task that's running, or None."""
+        if self._current is None:
+            return None
+        return self._current[0]
+
+    def is_idle(self):
+        return time.time() - self.db.last_execute_time >= self.IDLE_TIME
+
+    def next_task(self):
+        """Get the name of the next task that's due, or None."""
+        now = time.time()
+        for name, interval in self.TASKS:
+            if now - self._last_run.get(name, 0) >= interval:
+                return name
+        return None
+
+    def _schedule(self, delay):
+        self._dc = eventloop.add_timeout(delay, self._on_timeout,
+                                         "database maintenance")
+
+    def _on_timeout(self):
+        self._dc = None
+        if self.db.is_closed():
+            return
+        if self._current is None:
+            name = self.next_task()
+            if name is None or not self.is_idle():
+                self._schedule(self.POLL_INTERVAL)
+                return
+            self.start_task(name)
+        elif not self.is_idle():
+            # let the app have the database until it goes quiet again.
+            if self._current[0] in self.ABORT_WHEN_BUSY:
+                self._abort_task()
+            self._schedule(self.IDLE_TIME)
+            return
+        self.run_step()
+        self._schedule(self.STEP_DELAY)
+
+    def start_task(self, name):
+        """Start running a task.
+
+        Normally tasks are started from our timeout, this is mostly useful
+        for debugging.  Use run_step() to run the task.
+        """
+        if self._current is not None:
+            raise ValueError("%s is already running" % self._current[0])
+        report = {
+            'start': time.time(),
+            'duration': None,
+            'work_time': 0.0,
+            'steps': 0,
+            'result': None,
+        }
+        iterator = getattr(self, '_%s_task' % name)(report)
+        self._current = (name, iterator, report)
+
+    def run_step(self):
+        """Run the next step of the current task.
+
+        :returns: True if the task has more steps
+        """
+        name, iterator, report = self._current
+        start = time.time()
+        try:
+            iterator.next()
+        except StopIteration:
+            finished = True
+        except StandardError, e:
+            logging.exception("database maintenance: error running %s", name)
+            report['result'] = 'error: %s' % e
+            finished = True
+        else:
+            finished = False
+        report['work_time'] += time.time() - start
+        report['steps'] += 1
+        if finished:
+            self._finish_task()
+        return not finished
+
+    def _abort_task(self):
+        name, iterator, report = self._current
+        self._current = None
+        # closing the iterator runs its cleanup code.  We don't update
+        # _last_run, so the task runs again next time.
+        iterator.close()
+        logging.info("database maintenance: aborted %s after %d steps",
+                     name, report['steps'])
+
+    def _finish_task(self):
+        name, iterator, report = self._current
+        self._current = None
+        report['duration'] = time.time() - report['start']
+        self._reports[name] = report
+        self._last_run[name] = report['start']
+        self.db.set_variable(self.LAST_RUN_VARIABLE, self._last_run)
+        logging.timing("database maintenance: %s took %0.3fs in %d steps "
+                       "(%0.3fs total): %s", name, report['work_time'],
+                       report['steps'], report['duration'], report['result'])
+        self.emit('task-finished', name, report)
+
+    def _checkpoint_task(self, report):
+        report['result'] = self.db.checkpoint()
+        yield
+
+    def _analyze_task(self, report):
+        table_names = self.db.table_names()
+        for table_name in table_names:
+            self.db.analyze(table_name)
+            yield
+        report['result'] = '%d tables' % len(table_names)
+
+    def _incremental_vacuum_task(self, report):
+        pages = self.db.reclaimable_pages()
+        if pages < self.VACUUM_MIN_PAGES:
+            report['result'] = 'skipped (%d free pages)' % pages
+            return
+        freed = 0
+        while freed < pages:
+            count = min(self.VACUUM_PAGES_PER_STEP, pages - freed)
+            self.db.incremental_vacuum(count)
+            freed += count
+            yield
+        report['result'] = '%d pages' % freed
+
+    def _quick_check_task(self, report):
+        results = []
+        eventloop.call_in_thread(results.append, results.append,
+                                 _run_quick_check, "database quick_check",
+                                 self.db)
+        while not results:
+            yield
+        result = results[0]
+        if isinstance(result, Exception):
+            raise result
+        elif result is None:
+            report['result'] = 'skipped'
+        elif result == ['ok']:
+            report['result'] = 'ok'
+        else:
+            logging.warn("database quick_check failed: %s", result)
+            report['result'] = 'failed: %s' % '; '.join(result)
+
+    def _backup_task(self, report):
+        connection = self.db.open_maintenance_connection()
+        if connection is None:
+            report['result'] = 'skipped'
+            return
+        backup_dir = self.db.get_backup_directory()
+        path = os.path.join(backup_dir, self.BACKUP_NAME)
+        temp_path = path + '.tmp'
+        if fileutil.exists(temp_path):
+            fileutil.remove(temp_path)
+        finished = False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("ATTACH ? AS backup",
+                           (filename_to_unicode(temp_path),))
+            # Everything happens in one transaction, so we copy a consistent
+            # snapshot even though the main connection keeps writing while
+            # we're between steps.
+            cursor.execute("BEGIN TRANSACTION")
+            row_count = 0
+            for step_rows in _copy_database(cursor, self.BACKUP_ROWS_PER_STEP):
+                row_count += step_rows
+                yield
+            cursor.execute("COMMIT TRANSACTION")
+            cursor.execute("DETACH backup")
+            connection.close()
+            if fileutil.exists(path):
+                fileutil.remove(path)
+            fileutil.rename(temp_path, path)
+            finished = True
+            report['result'] = '%d rows' % row_count
+        finally:
+            if not finished:
+                connection.close()
+                if fileutil.exists(temp_path):
+                    fileutil.remove(temp_path)
+
+def _run_quick_check(db):
+    # This runs in the thread pool.  It only uses its own connection, never
+    # the main one.
+    connection = db.open_maintenance_connection()
+    if connection is None:
+        return None
+    try:
+        return [row[0] for row in connection.execute("PRAGMA quick_check")]
+    finally:
+        connection.close()
+
+def _copy_database(cursor, rows_per_step):
+    """Copy the main database to the one attached as "backup".
+
+    This is a generator that copies up to rows_per_step rows each time
+    it's iterated.  It yields the number of rows copied.
+    """
+    cursor.execute("SELECT type, name, tbl_name, sql FROM main.sqlite_master "
+                   "WHERE sql IS NOT NULL")
+    schema_rows = cursor.fetchall()
+    tables = [(name, sql) for (type_, name, tbl_name, sql) in schema_rows
+              if type_ == 'table' and storedatabase.should_copy_table(name)]
+    for table, sql in tables:
+        cursor.execute(sql.replace("TABLE %s" % table,
+                                   "TABLE backup.%s" % table, 1))
+    for table, sql in tables:
+        cursor.execute("PRAGMA main.table_info(%s)" % table)
+        columns = ', '.join(['rowid'] + [row[1] for row in cursor.fetchall()])
+        copy_sql = ("INSERT INTO backup.%s (%s) SELECT %s FROM main.%s "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT %d" %
+                    (table, columns, columns, table, rows_per_step))
+        last_rowid = -(2 ** 63)
+        while True:
+            cursor.execute(copy_sql, (last_rowid,))
+            count = cursor.rowcount
+            if count <= 0:
+                break
+            cursor.execute("SELECT MAX(rowid) FROM backup.%s" % table)
+            last_rowid = cursor.fetchone()[0]
+            yield count
+            if count < rows_per_step:
+                break
+    # Create indexes and triggers once the data is in place, so that the
+    # triggers don't run for the rows we copy.  Indexes on the fts shadow
+    # tables were created along with the fts tables.
+    table_names = set(table for table, sql in tables)
+    for type_, name, tbl_name, sql in schema_rows:
+        if tbl_name not in table_names:
+            continue
+        if type_ == 'index':
+            cursor.execute(sql.replace("INDEX %s" % name,
+                                       "INDEX backup.%s" % name, 1))
+        elif type_ == 'trigger':
+            cursor.execute(sql.replace(name, "backup." + name, 1))
+    yield 0
@@ -1113,7 +1113,8 @@ class DeviceSyncManager(object):
                         signal, callback))
 
         task = start_conversion(conversion, info, target,
-                                create_item=False)
+                                create_item=False,
+                                priority=conversions.PRIORITY_DEVICE_SYNC)
         self.total_size[task.key] = (task.get_output_size_guess() *
                                      CONVERSION_SCALE)
         self.waiting.add(task.key)
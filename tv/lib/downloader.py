@@ -219,6 +219,8 @@ def generate_dlid():
 class RemoteDownloader(DDBObject):
     """Download a file using the downloader daemon."""
 
+    compact_storage = True
+
     # attributes that get set from the BatchUpdateDownloadStatus command
     status_attributes = [
         'state',
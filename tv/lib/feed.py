@@ -391,6 +391,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     It works by passing on attributes to the actual feed.
     """
     ICON_CACHE_VITAL = True
+    signal_names = DDBObject.signal_names + ('update-finished',)
 
     def setup_new(self, url, initiallyAutoDownloadable=None,
                  search_term=None, title=None):
@@ -444,7 +445,6 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.setup_common()
 
     def setup_common(self):
-        self.create_signal('update-finished')
         self.download = None
         self.wasUpdating = False
         self.inlineSearchTerm = None
@@ -56,6 +56,7 @@ from miro import messages
 from miro import eventloop
 from miro import conversions
 from miro import filetypes
+from miro.data import itemtrack
 from miro.gtcache import gettext as _
 from miro.gtcache import ngettext
 from miro.frontends.widgets import dialogs
@@ -105,6 +106,7 @@ class Application:
         self.ui_initialized = False
         messages.FrontendMessage.install_handler(self.message_handler)
         app.item_list_pool = itemlist.ItemListPool()
+        app.item_row_loader = itemtrack.RowLoader(call_on_ui_thread)
         app.item_tracker_updater = itemlist.ItemTrackerUpdater()
         app.info_updater = infoupdater.InfoUpdater()
         app.saved_items = set()
@@ -1121,6 +1123,8 @@ class Application:
         self._printout_memory_stats('MEMORY STATS BEFORE GARBAGE COLLECTION')
         gc.collect()
         self._printout_memory_stats('MEMORY STATS AFTER GARBAGE COLLECTION')
+        # the backend replies with CurrentMemoryReport
+        messages.QueryMemoryReport().send_to_backend()
 
     def force_feedparser_processing(self):
         messages.ForceFeedparserProcessing().send_to_backend()
@@ -1234,6 +1238,7 @@ class Application:
         width = self.get_left_width()
         if width:
             app.widget_state.set_tabs_width(width)
+        app.item_row_loader.shutdown()
         app.controller.shutdown()
         self.quit_ui()
 
@@ -1698,6 +1703,17 @@ class WidgetsMessageHandler(messages.MessageHandler):
         app.widget_state.setup_global_state(message)
         self._saw_pre_startup_message('global-state')
 
+    def handle_current_memory_report(self, message):
+        lines = [
+                'BACKEND MEMORY REPORT (rss: %s KB):' % message.report['rss'],
+                '-' * 40,
+        ]
+        for subsystem, counts in sorted(message.report['subsystems'].items()):
+            for label, count in sorted(counts.items()):
+                lines.append('%-50s: %s' % ('%s: %s' % (subsystem, label),
+                                            count))
+        logging.debug('\n'.join(lines))
+
     def handle_progress_dialog_start(self, message):
         self.progress_dialog = dialogs.ProgressDialog(message.title)
         self.progress_dialog.run()
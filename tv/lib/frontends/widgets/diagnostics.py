@@ -48,6 +48,9 @@ from miro.dialogs import BUTTON_OK
 from miro import app
 from miro import prefs
 from miro import util
+from miro.data import indexadvisor
+from miro.data import itemtrack
+from miro.data import querystats
 
 from miro.plat.utils import get_available_bytes_for_movies
 
@@ -76,6 +79,35 @@ def get_database_object_count():
     # should be a read-only endeavor, so it should be ok.
     return app.db.persistent_object_count()
 
+def get_query_reports():
+    """Get the query statistics for the backend database and item lists.
+
+    We explain the slowest queries using a connection from the main pool.
+    """
+    with app.connection_pools.get_main_pool().context() as connection:
+        return [app.db.query_stats.get_report(connection),
+                itemtrack.query_stats.get_report(connection)]
+
+def get_query_summary():
+    reports = get_query_reports()
+    count = sum(shape['count'] for report in reports
+                for shape in report['shapes'])
+    scans = sum(querystats.count_full_scans(report, 'item')
+                for report in reports)
+    return _("%(count)s queries, %(scans)s slow ones scan all items",
+             {"count": count, "scans": scans})
+
+def get_index_report():
+    """Get the indexes that indexadvisor proposes for the item lists."""
+    with app.connection_pools.get_main_pool().context() as connection:
+        return indexadvisor.get_report(connection, itemtrack.query_stats)
+
+def save_query_report(widget):
+    path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                        'query-stats.json')
+    querystats.write_json(path, get_query_reports() + [get_index_report()])
+    app.widgetapp.reveal_file(path)
+
 SEPARATOR = None
 SHOW = _("Show")
 
@@ -130,6 +162,10 @@ def run_dialog():
                  get_database_size(), "0B", False)},
             {"label": _("Total db objects in memory:"),
              "data": lambda: "%d" % get_database_object_count()},
+            {"label": _("Database queries:"),
+             "data": get_query_summary,
+             "button_face": _("Save Report"),
+             "button_fun": save_query_report},
 
             SEPARATOR,
 
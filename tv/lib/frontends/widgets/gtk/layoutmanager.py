@@ -55,6 +55,9 @@ _font_cache = FontCache(512)
 
 class LayoutManager(object):
     def __init__(self, widget):
+        # incremented whenever a style or direction change means layouts
+        # made with us are out of date
+        self.style_generation = 0
         self.pango_context = widget.get_pango_context()
         self.update_style(widget.style)
         self.update_direction(widget.get_direction())
@@ -71,12 +74,14 @@ class LayoutManager(object):
     def on_style_set(self, widget, previous_style):
         old_font_desc = self.style_font_desc
         self.update_style(widget.style)
+        self.style_generation += 1
         if self.style_font_desc != old_font_desc:
             # bug #17423 font changed, so the widget's width might have changed
             widget.queue_resize()
 
     def on_direction_changed(self, widget, previous_direction):
         self.update_direction(widget.get_direction())
+        self.style_generation += 1
 
     def update_style(self, style):
         self.style_font_desc = style.font_desc
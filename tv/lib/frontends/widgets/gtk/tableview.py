@@ -46,6 +46,8 @@ HEADER_HEIGHT = 25
 from miro import signals
 from miro.errors import (WidgetActionError, WidgetDomainError, WidgetRangeError,
         WidgetNotReadyError)
+from miro.data.item import LoadingItemInfo
+from miro.frontends.widgets import itemlist
 from miro.frontends.widgets.tableselection import SelectionOwnerMixin
 from miro.frontends.widgets.tablescroll import ScrollbarOwnerMixin
 from miro.frontends.widgets.gtk import pygtkhacks
@@ -114,6 +116,9 @@ class TreeViewScrolling(object):
         GTKScrollbarOwnerMixin, making this unnecessary.
         """
 
+    def scroll_position_changed(self):
+        """Faux-signal, called when the vertical scroll position changes."""
+
     @property
     def manually_scrolled(self):
         """Return whether the view has been scrolled explicitly by the user
@@ -146,6 +151,8 @@ class TreeViewScrolling(object):
         self.scrollbars = scrollbars
         for i, bar in enumerate(scrollbars):
             weak_connect(bar, 'changed', self.on_scroll_range_changed, i)
+        weak_connect(scrollbars[1], 'value-changed',
+                     self.on_scroll_position_changed)
         if self.restoring_scroll:
             self.set_scroll_position(self.restoring_scroll)
 
@@ -159,6 +166,9 @@ class TreeViewScrolling(object):
         # our wrapper handles the same thing for iters
         self.scroll_range_changed()
 
+    def on_scroll_position_changed(self, adjustment):
+        self.scroll_position_changed()
+
     def set_scroll_position(self, scroll_position):
         """Restore the scrollbars to a remembered state."""
         try:
@@ -1163,6 +1173,7 @@ class TableView(Widget, GTKSelectionOwnerMixin, DNDHandlerMixin,
         ColumnOwnerMixin.__init__(self)
         HoverTrackingMixin.__init__(self)
         GTKScrollbarOwnerMixin.__init__(self)
+        self._widget.scroll_position_changed = self.on_scroll_position_changed
         if custom_headers:
             self._enable_custom_headers()
 
@@ -1181,10 +1192,20 @@ class TableView(Widget, GTKSelectionOwnerMixin, DNDHandlerMixin,
         This should be called when you want to destroy a TableView and
         there's a new TableView sharing its model.
         """
+        self.model_handler.cleanup()
         self.model.cleanup()
         self._widget.set_model(None)
         self.model_handler = self.model = None
 
+    def on_scroll_position_changed(self):
+        if self.model_handler is None:
+            return
+        visible_range = self._widget.get_visible_range()
+        if visible_range is not None:
+            start_path, end_path = visible_range
+            self.model_handler.visible_range_changed(start_path[0],
+                                                     end_path[0])
+
     def _connect_signals(self):
         self.create_signal('row-expanded')
         self.create_signal('row-collapsed')
@@ -1381,7 +1402,7 @@ class TableView(Widget, GTKSelectionOwnerMixin, DNDHandlerMixin,
         if (not isinstance(modelwrapper, ItemListModel) or
             modelwrapper.item_list.group_func is None):
             return
-        modelwrapper.item_list.group_info(path[0])
+        group_info = modelwrapper.item_list.get_group_info(path[0])
 
         start_row = path[0] - group_info[0]
         total_rows = group_info[1]
@@ -1670,6 +1691,7 @@ class ItemListModel(TableModelBase):
         self.list_changed_handle = self.item_list.connect_before(
             "list-changed", self.on_list_changed)
         self._model = fixedliststore.FixedListStore(len(item_list))
+        self.prefetcher = itemlist.ScrollPrefetcher(item_list)
 
     def cleanup(self):
         if self.list_changed_handle is not None:
@@ -1696,9 +1718,13 @@ class ItemListModel(TableModelBase):
         For ItemListModel, this is the tuple (info, attrs, group_info)
         """
         index = self._model.row_of_iter(it)
-        item = self.item_list.get_row(index)
+        item = self.item_list.get_display_row(index)
         attrs = self.item_list.get_attrs(item.id)
-        group_info = self.item_list.get_group_info(index)
+        if isinstance(item, LoadingItemInfo):
+            # don't load the rest of the group just to draw a placeholder
+            group_info = (0, 1, item)
+        else:
+            group_info = self.item_list.get_group_info(index)
         return (item, attrs, group_info)
 
     def check_new_column(self, column):
@@ -1740,16 +1766,36 @@ class ModelHandler(object):
         self._set_gtk_model()
 
     # Note: by default, we don't need to do anything special for
-    # model_changed().
+    # model_changed(), visible_range_changed(), or cleanup().
     def model_changed(self):
         return
 
+    def visible_range_changed(self, first_row, last_row):
+        return
+
+    def cleanup(self):
+        return
+
 class ItemListModelHandler(ModelHandler):
     """
     """
     def __init__(self, model, gtk_treeview):
         ModelHandler.__init__(self, model, gtk_treeview)
         item_list = self.model.item_list
+        self.rows_loaded_handle = item_list.connect("rows-loaded",
+                                                    self.on_rows_loaded)
+
+    def cleanup(self):
+        if self.rows_loaded_handle is not None:
+            self.model.item_list.disconnect(self.rows_loaded_handle)
+            self.rows_loaded_handle = None
+
+    def visible_range_changed(self, first_row, last_row):
+        self.model.prefetcher.on_scroll(first_row, last_row)
+
+    def on_rows_loaded(self, item_list, id_list):
+        # redraw to replace the placeholder rows
+        self.gtk_treeview.queue_draw()
 
     def model_changed(self):
         if self.model._model != self.gtk_treeview.get_model():
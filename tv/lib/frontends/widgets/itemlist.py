@@ -36,7 +36,9 @@ It also defines several ItemTrackerQuery subclasses that correspond to tabs
 in the interface.
 """
 
+import bisect
 import collections
+import time
 
 from miro import app
 from miro import prefs
@@ -61,9 +63,6 @@ class ItemList(itemtrack.ItemTracker):
             - set_sort changes the sort
     """
 
-    # sentinel used to represent a group_info that hasn't been calculated
-    NOT_CALCULATED = object()
-
     def __init__(self, tab_type, tab_id, sort=None, group_func=None,
                  filters=None, search_text=None):
         """Create a new ItemList
@@ -91,9 +90,11 @@ class ItemList(itemtrack.ItemTracker):
             self.sorter = sort
         self.search_text = search_text
         self.group_func = group_func
+        self._reset_group_info()
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
                                        self._make_query(),
-                                       self._make_item_source())
+                                       self._make_item_source(),
+                                       row_loader=app.item_row_loader)
 
     def is_for_device(self):
         return self.tab_type.startswith('device-')
@@ -114,13 +115,15 @@ class ItemList(itemtrack.ItemTracker):
         return int(self.tab_id.split("-")[1])
 
     def _fetch_id_list(self):
+        old_id_list = getattr(self, 'id_list', None)
         itemtrack.ItemTracker._fetch_id_list(self)
-        self._reset_group_info()
+        self._move_group_info(old_id_list)
 
     def _uncache_row_data(self, id_list):
         itemtrack.ItemTracker._uncache_row_data(self, id_list)
-        # items have changed, so we need to reset all group info
-        self._reset_group_info()
+        # the group keys for these items may have changed
+        self._invalidate_group_rows(self.id_to_index[id_] for id_ in id_list
+                                    if id_ in self.id_to_index)
 
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
@@ -290,6 +293,12 @@ class ItemList(itemtrack.ItemTracker):
             del self.item_attributes[item_id][name]
 
     # grouping
+    #
+    # We store the groups that we've calculated as runs of rows.
+    # _group_starts and _group_ends are sorted lists of the first and last
+    # row of each run, so we can find the group for a row with a binary
+    # search.  When items change, or the list gets refetched, we only throw
+    # away the runs that could be affected.
     def get_group_info(self, row):
         """Get the info about the group an info is inside.
 
@@ -301,9 +310,14 @@ class ItemList(itemtrack.ItemTracker):
         """
         if self.group_func is None:
             raise ValueError("no grouping set")
-        if self.group_info[row] is ItemList.NOT_CALCULATED:
-            self._calc_group_info(row)
-        return self.group_info[row]
+        if not 0 <= row < len(self):
+            raise IndexError("%s is out of range" % row)
+        pos = self._find_group(row)
+        if pos is None:
+            pos = self._calc_group_info(row)
+        start = self._group_starts[pos]
+        end = self._group_ends[pos]
+        return (row - start, end - start + 1, self.get_row(start))
 
     def get_group_top(self, item_id):
         """Get the first info for an item's group.
@@ -332,9 +346,29 @@ class ItemList(itemtrack.ItemTracker):
         self._reset_group_info()
 
     def _reset_group_info(self):
-        self.group_info = [ItemList.NOT_CALCULATED] * len(self)
+        self._group_starts = []
+        self._group_ends = []
+
+    def _find_group(self, row):
+        """Find the group run that contains row.
+
+        :returns: position of the run in _group_starts, or None if we
+        haven't calculated the group for row.
+        """
+        pos = bisect.bisect_right(self._group_starts, row) - 1
+        if pos >= 0 and self._group_ends[pos] >= row:
+            return pos
+        return None
+
+    def _remove_group(self, pos):
+        del self._group_starts[pos]
+        del self._group_ends[pos]
 
     def _calc_group_info(self, row):
+        """Calculate the group run for row and store it.
+
+        :returns: position of the new run in _group_starts
+        """
         # FIXME: for normal item lists, this is fairly fast, but it is slow in
         # a specific case:
         #
@@ -344,21 +378,65 @@ class ItemList(itemtrack.ItemTracker):
         # run mutagen on them yet.  In that case, when you first switch to the
         # music tab, basically all items will be in the same group.
         key = self.group_func(self.get_row(row))
-        if key is None:
-            # if group_func returns None, then put this item in a group by
-            # itself.
-            self.group_info[row] = (0, 1, self.get_row(row))
-            return
         start = end = row
-        while (start > 0 and
-               self.group_func(self.get_row(start-1)) == key):
-            start -= 1
-        while (end < len(self) - 1 and
-               self.group_func(self.get_row(end+1)) == key):
-            end += 1
-        total = end - start + 1
-        for row in xrange(start, end+1):
-            self.group_info[row] = (row-start, total, self.get_row(start))
+        # if group_func returns None, then put this item in a group by
+        # itself.
+        if key is not None:
+            while (start > 0 and
+                   self.group_func(self.get_row(start-1)) == key):
+                start -= 1
+            while (end < len(self) - 1 and
+                   self.group_func(self.get_row(end+1)) == key):
+                end += 1
+        pos = bisect.bisect_left(self._group_starts, start)
+        self._group_starts.insert(pos, start)
+        self._group_ends.insert(pos, end)
+        return pos
+
+    def _invalidate_group_rows(self, rows):
+        """Forget the groups for rows whose group keys may have changed."""
+        for row in rows:
+            pos = self._find_group(row)
+            if pos is not None:
+                start = self._group_starts[pos]
+                end = self._group_ends[pos]
+                self._remove_group(pos)
+            else:
+                start = end = row
+            # the row may now have the same key as the groups next to it
+            for neighbor in (start - 1, end + 1):
+                pos = self._find_group(neighbor)
+                if pos is not None:
+                    self._remove_group(pos)
+
+    def _move_group_info(self, old_id_list):
+        """Move our group runs over to a new id list.
+
+        A run is still valid if its items are in the same order in the new
+        list and have the same items next to them.  Otherwise, we drop it
+        and calculate it again when needed.
+        """
+        if not old_id_list or not self._group_starts:
+            self._reset_group_info()
+            return
+        id_list = self.id_list
+        def neighbors(id_list, start, end):
+            before = id_list[start-1] if start > 0 else None
+            after = id_list[end+1] if end + 1 < len(id_list) else None
+            return before, after
+        runs = []
+        for start, end in zip(self._group_starts, self._group_ends):
+            new_start = self.id_to_index.get(old_id_list[start])
+            if new_start is None:
+                continue
+            new_end = new_start + (end - start)
+            if (id_list[new_start:new_end+1] == old_id_list[start:end+1] and
+                neighbors(id_list, new_start, new_end) ==
+                neighbors(old_id_list, start, end)):
+                runs.append((new_start, new_end))
+        runs.sort()
+        self._group_starts = [start for start, end in runs]
+        self._group_ends = [end for start, end in runs]
 
 class ItemTrackerUpdater(object):
     """Keep a list of ItemTrackers and call on_item_changes when needed.
@@ -469,6 +547,52 @@ class ItemListPool(object):
             item_list.destroy()
             app.item_tracker_updater.remove_tracker(item_list)
 
+class ScrollPrefetcher(object):
+    """Prefetch rows of an ItemList before they're scrolled into view.
+
+    TableViews call on_scroll() when their visible range changes.  We track
+    how fast the user is scrolling and ask the ItemList to load the rows that
+    will be shown next, in the direction of the scroll.  The faster the
+    scroll, the further ahead we load.
+    """
+
+    # how far ahead we load, in seconds of scrolling at the current speed
+    LOOKAHEAD_SECONDS = 0.5
+    # most rows past the visible range that we load
+    MAX_LOOKAHEAD_ROWS = 400
+    # how much weight new samples get in our velocity average
+    VELOCITY_SMOOTHING = 0.5
+
+    def __init__(self, item_list):
+        self.item_list = item_list
+        self.last_first_row = None
+        self.last_time = None
+        # scroll speed in rows per second.  Negative means scrolling up
+        self.velocity = 0.0
+
+    def on_scroll(self, first_row, last_row, now=None):
+        """Call this when the visible rows change.
+
+        :param first_row: index of the first visible row
+        :param last_row: index of the last visible row
+        :param now: current time, defaults to time.time()
+        """
+        if now is None:
+            now = time.time()
+        if self.last_time is not None and now > self.last_time:
+            sample = (first_row - self.last_first_row) / (now - self.last_time)
+            self.velocity = (self.VELOCITY_SMOOTHING * sample +
+                             (1 - self.VELOCITY_SMOOTHING) * self.velocity)
+        self.last_first_row = first_row
+        self.last_time = now
+        lookahead = (last_row - first_row + 1 +
+                     int(abs(self.velocity) * self.LOOKAHEAD_SECONDS))
+        lookahead = min(lookahead, self.MAX_LOOKAHEAD_ROWS)
+        if self.velocity < 0:
+            self.item_list.prefetch_rows(first_row - lookahead, last_row + 1)
+        else:
+            self.item_list.prefetch_rows(first_row, last_row + 1 + lookahead)
+
 # grouping functions
 def album_grouping(info):
     """Grouping function that groups infos by albums."""
@@ -28,6 +28,7 @@
 # statement from all source files in the program, then also delete it here.
 
 """Constants that define the look-and-feel."""
+import collections
 import math
 import os
 
@@ -113,6 +114,9 @@ NEWLY_AVAILABLE_TEXT = _("Newly Available")
 SAVED_TEXT = _("Saved")
 STOP_SEEDING_TEXT = _("Stop seeding")
 
+# Set by the dev menu to draw layout cache stats on top of each cell
+show_layout_cache_stats = False
+
 class EmblemVisuals(object):
     """Holds the visual needed to draw an item's emblem."""
     def __init__(self, text_color_css, image_name, text_bold):
@@ -216,15 +220,23 @@ def _load_image(image_name):
 class ItemRenderer(widgetset.ItemListRenderer):
     MIN_WIDTH = 600
     HEIGHT = 147
+    # how many cell layouts we keep for re-use.  This should cover a few
+    # screenfulls of rows.
+    LAYOUT_CACHE_SIZE = 200
 
     def __init__(self, display_channel=True, is_podcast=False,
                  wide_image=False):
         widgetset.ItemListRenderer.__init__(self)
+        self.wide_image = wide_image
         self.canvas = ItemRendererCanvas(wide_image)
         self.signals = ItemRendererSignals()
         self.display_channel = display_channel
         self.is_podcast = is_podcast
         self.setup_torrent_folder_description()
+        # maps layout_cache_key() results to Layouts.  Ordered from least to
+        # most recently used.
+        self.layout_cache = collections.OrderedDict()
+        self.layout_cache_hits = self.layout_cache_misses = 0
 
     def get_size(self, style, layout_manager):
         return self.MIN_WIDTH, self.HEIGHT
@@ -252,6 +264,21 @@ class ItemRenderer(widgetset.ItemListRenderer):
         layout = self.layout_all(layout_manager, context.width,
                 context.height, selected, hotspot)
         layout.draw(context)
+        if show_layout_cache_stats:
+            self.draw_layout_cache_stats(context, layout_manager)
+
+    def draw_layout_cache_stats(self, context, layout_manager):
+        total = self.layout_cache_hits + self.layout_cache_misses
+        if total == 0:
+            return
+        text = u"layout cache: %d%% hits (%d/%d), %d cached" % (
+            100 * self.layout_cache_hits // total, self.layout_cache_hits,
+            total, len(self.layout_cache))
+        layout_manager.set_font(EXTRA_INFO_FONT_SIZE)
+        layout_manager.set_text_color((1, 0, 0))
+        textbox = layout_manager.textbox(text)
+        textbox.draw(context, PADDING[0], 0, context.width - PADDING[0],
+                     PADDING[2] * 2)
 
     def setup_torrent_folder_description(self):
         text = (u'<a href="#show-torrent-contents">%s</a>' %
@@ -259,6 +286,60 @@ class ItemRenderer(widgetset.ItemListRenderer):
         self.torrent_folder_description = util.HTMLStripper().strip(text)
 
     def layout_all(self, layout_manager, width, height, selected, hotspot):
+        if self.info.is_download:
+            # download mode changes constantly and add_progress_bar() emits
+            # signals, don't bother caching it.
+            return self._layout_all(layout_manager, width, height, selected,
+                                    hotspot)
+        key = self.layout_cache_key(layout_manager, width, height, selected,
+                                    hotspot)
+        layout = self.layout_cache.pop(key, None)
+        if layout is None:
+            self.layout_cache_misses += 1
+            layout = self._layout_all(layout_manager, width, height, selected,
+                                      hotspot)
+            if len(self.layout_cache) >= self.LAYOUT_CACHE_SIZE:
+                self.layout_cache.popitem(last=False)
+        else:
+            self.layout_cache_hits += 1
+        self.layout_cache[key] = layout
+        return layout
+
+    def layout_cache_key(self, layout_manager, width, height, selected,
+                         hotspot):
+        """Get a key for layout_cache.
+
+        The key needs to change whenever our layout would change.
+        ItemInfos compare equal when their data is the same, so the key
+        changes when ItemChanges updates an item, but a refetched list with
+        the same data still gets cache hits.  The layout manager's
+        style_generation changes with the theme, font and text direction.
+        Subclasses that use extra state in their layout should extend this.
+        """
+        info = self.info
+        key = (type(info), info, layout_manager,
+               layout_manager.style_generation, width, height, selected,
+               hotspot)
+        if isinstance(info, item.DBErrorItemInfo):
+            return key
+        playing_item = app.playback_manager.get_playing_item()
+        is_playing = (playing_item is not None and
+                      playing_item.id == info.id)
+        if info.expiration_date:
+            # this text depends on the current time
+            expiration_text = info.expiration_date_text
+        else:
+            expiration_text = None
+        return key + (app.config.get(prefs.PLAY_IN_MIRO), is_playing,
+                      is_playing and app.playback_manager.is_paused,
+                      app.playback_manager.is_playing_id(info.id),
+                      info.id in app.saved_items, self.should_resume_item(),
+                      expiration_text)
+
+    def _layout_all(self, layout_manager, width, height, selected, hotspot):
+        # Layouts draw using the state of the canvas that made them, so each
+        # layout that might be cached needs a canvas of its own.
+        self.canvas = ItemRendererCanvas(self.wide_image)
         download_mode = self.info.is_download
         self.canvas.start_new_cell(layout_manager, width, height, selected,
                 hotspot, download_mode)
@@ -1270,6 +1351,12 @@ class PlaylistItemRenderer(ItemRenderer):
     def remove_button_info(self):
         return ('remove-playlist', 'remove')
 
+    def layout_cache_key(self, layout_manager, width, height, selected,
+                         hotspot):
+        return (ItemRenderer.layout_cache_key(self, layout_manager, width,
+                                              height, selected, hotspot) +
+                (self.playlist_order.item_position(self.info),))
+
     def calc_description_preface(self):
         order_number = self.playlist_order.item_position(self.info)
         if self.info.description_stripped[0]:
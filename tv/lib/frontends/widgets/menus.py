@@ -444,6 +444,16 @@ class DevMenu(Menu):
         new_value = int(time.time()) - (60 * 60 * 24 * 7) + 60
         app.config.set(prefs.LAST_RETRY_NET_LOOKUP, new_value)
 
+    @menu_item(_("Toggle Item Layout Cache Stats"))
+    def toggle_layout_cache_stats(menu_item):
+        from miro.frontends.widgets import itemrenderer
+        itemrenderer.show_layout_cache_stats = (
+            not itemrenderer.show_layout_cache_stats)
+        displayed = app.item_list_controller_manager.displayed
+        if displayed is not None:
+            displayed.item_list.emit('will-change')
+            displayed.item_list.emit('items-changed', [])
+
     @menu_item(_("Test Database Error Item Rendering"))
     def test_database_error_item_rendering(menu_item):
         displayed = app.item_list_controller_manager.displayed
@@ -919,6 +919,19 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
+    def get_memory_counts(self):
+        """Get the number of transfers we're handling.
+
+        This gets called from other threads, but just reading the sizes of
+        our containers is safe.
+        """
+        return {
+            'transfers': len(self.transfer_map),
+            'transfers_to_add': self.transfers_to_add.qsize(),
+            'transfers_to_remove': self.transfers_to_remove.qsize(),
+            'after_perform_callbacks': len(self.after_perform_callbacks),
+        }
+
     def calc_fds(self):
         return self.multi.fdset()
 
@@ -97,6 +97,8 @@ class IconCacheUpdater:
         self.in_shutdown = True
 
 class IconCache(DDBObject):
+    compact_storage = True
+
     def setup_new(self, dbItem):
         self.etag = None
         self.modified = None
@@ -382,7 +382,13 @@ class _ItemsForPathCountTracker(object):
             return # counts not created yet we can just ignore
 
 class ItemChangeTracker(signals.SignalEmitter):
-    """Tracks changes to items and send the ItemChanges message."""
+    """Tracks changes to items and send the ItemChanges message.
+
+    The frontend reads the changed items using its own connections, so the
+    changes need to be committed before we send the message.  If group
+    commit is holding them in an open transaction, we commit it right away
+    rather than making the frontend wait for the group commit timeout.
+    """
     def __init__(self):
         signals.SignalEmitter.__init__(self)
         self.create_signal('item-changes')
@@ -400,9 +406,22 @@ class ItemChangeTracker(signals.SignalEmitter):
         self.playlists_changed = False
 
     def after_event_finished(self, event_loop, success):
+        if not success:
+            # the event's changes were rolled back, don't tell the frontend
+            # about them
+            self.reset()
+            return
         self.send_changes()
 
     def send_changes(self):
+        """Commit our changes and send them to the frontend."""
+        if not self.has_changes():
+            return
+        if app.db.has_uncommitted_changes():
+            app.db.finish_transaction()
+        self._send_changes()
+
+    def _send_changes(self):
         if self.has_changes():
             m = messages.ItemChanges(self.added, self.changed, self.removed,
                                      self.changed_columns,
@@ -484,6 +503,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     """
 
     ICON_CACHE_VITAL = False
+    compact_storage = True
 
     # tweaked by the unittests to make things easier
     _allow_nonexistent_paths = False
@@ -2825,6 +2845,7 @@ def setup_metadata_manager(cover_art_dir=None, screenshot_dir=None):
     if screenshot_dir is None:
         icon_cache_dir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
         screenshot_dir = os.path.join(icon_cache_dir, 'extracted')
+    app.metadata_result_cache = metadata.MetadataResultCache()
     app.local_metadata_manager = metadata.LibraryMetadataManager(
         cover_art_dir, screenshot_dir)
     app.local_metadata_manager.connect('new-metadata', on_new_metadata)
@@ -35,6 +35,8 @@ import sys
 import itertools
 import socket
 import random
+import select
+import time
 import traceback
 # XXX merged into urllib.urlparse in Python 3
 import urlparse
@@ -42,8 +44,10 @@ import urlparse
 import BaseHTTPServer
 import SocketServer
 import threading
+import Queue
 import httplib
 import gzip
+import zlib
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -55,9 +59,11 @@ MAX_SESSION = 2147483647
 
 import mdns
 from const import *
-from subr import (encode_response, decode_response, split_url_path, atoi,
-                  atol, StreamObj, ChunkedStreamObj, find_daap_tag,
-                  find_daap_listitems)
+from subr import (encode_response, encode_response_data, decode_response,
+                  split_url_path, parse_range, atoi, atol, StreamObj,
+                  ChunkedStreamObj,
+                  EncodedResponse, ResponseCache, DMAPStreamDecoder,
+                  find_daap_tag, find_daap_listitems)
 
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
@@ -65,6 +71,10 @@ DAAP_TIMEOUT = 1800    # timeout (in seconds)
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
 
+# Worker threads for the pooled server (see DaapPoolTCPServer).  File
+# streams get a thread of their own, so these only handle the short requests.
+DAAP_WORKERS = 4
+
 # !!! No user servicable parts below. !!!
 
 VERSION = '0.1'
@@ -83,6 +93,7 @@ DAAP_PARTIAL_CONTENT = 206 # Partial content, if Range header included.
 DAAP_FORBIDDEN = 403   # Access denied
 DAAP_BADREQUEST = 400  # Bad URI request
 DAAP_FILENOTFOUND = 404 # File not found
+DAAP_RANGE_NOT_SATISFIABLE = 416 # Range header is outside of the file
 DAAP_UNAVAILABLE = 503 # We are full
 
 DEFAULT_CONTENT_TYPE = 'application/x-dmap-tagged'
@@ -103,8 +114,11 @@ DEFAULT_DAAP_PLAYLIST_META = ('dmap.itemid,dmap.itemname,dmap.persistentid,' +
 class SessionObject(object):
     # Container object for a daap session.  Basically a heartbeat timeout
     # timer object and a generation counter so we can impose some ordering
-    # on the requests which come in.
-    pass
+    # on the requests which come in.  We also count the bytes of media
+    # streamed and the time spent streaming them.
+    def __init__(self):
+        self.bytes_sent = 0
+        self.send_time = 0.0
 
 class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
@@ -123,6 +137,12 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        # Encoded item/playlist listings for the backend's current revision.
+        self.response_cache = ResponseCache()
+        # Persistent id for our database.  It's new every time the server
+        # starts, so clients can tell that revisions they got from an
+        # earlier server mean nothing to this one.
+        self.database_id = random.getrandbits(63)
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
@@ -187,6 +207,39 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    def record_transfer(self, s, nbytes, elapsed):
+        with self.session_lock:
+            try:
+                session_obj = self.activeconn[s]
+            except KeyError:
+                return
+            session_obj.bytes_sent += nbytes
+            session_obj.send_time += elapsed
+
+    def get_session_stats(self):
+        """get_session_stats() -> dict
+
+           Get the streaming stats for the active sessions.  Maps session
+           ids to (bytes_sent, throughput) tuples.  throughput is in bytes
+           per second while we were streaming.
+        """
+        stats = dict()
+        with self.session_lock:
+            for s, session_obj in self.activeconn.iteritems():
+                if session_obj.send_time:
+                    throughput = session_obj.bytes_sent / session_obj.send_time
+                else:
+                    throughput = 0.0
+                stats[s] = (session_obj.bytes_sent, throughput)
+        return stats
+
+    def wait_for_revision(self, handler, old_revision):
+        """Arrange to send the /update reply once the revision changes.
+
+        Returns False if the handler should block until then instead.
+        """
+        return False
+
     def handle_error(self, request, client_address):
         pass
 
@@ -205,6 +258,10 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
+    # Set by do_update() to the old revision when the reply has to wait for
+    # a new revision and the server will send it later (see
+    # DaapPoolTCPServer).
+    waiting_revision = None
 
     # Not used at the moment.
     # def __init__(self, request, client_address, server):
@@ -235,6 +292,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_send_reply(self, rcode, reply, content_type=DEFAULT_CONTENT_TYPE,
                       content_encoding=None, extra_headers=[]):
         blob = encode_response(reply, content_encoding=content_encoding)
+        streaming = isinstance(blob, ChunkedStreamObj)
+        if streaming and not blob.satisfiable:
+            rcode = DAAP_RANGE_NOT_SATISFIABLE
         try:
             self.send_response(rcode)
             self.send_header('Content-type', content_type)
@@ -247,8 +307,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            if streaming:
+                self.send_stream(blob)
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -257,6 +320,20 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.server.del_session(session)
             raise    # Give upper layer a chance to deal
 
+    def send_stream(self, blob):
+        # Write straight to the socket, so that the file data doesn't have to
+        # pass through Python.
+        self.wfile.flush()
+        start = time.time()
+        try:
+            blob.send(self.connection)
+        finally:
+            session = getattr(self, 'stream_session', 0)
+            if session:
+                self.server.record_transfer(session,
+                                            blob.streamsize - blob.unread,
+                                            time.time() - start)
+
     # Convenience function: convenient that session-id must be non-zero so
     # you can use it for True/False testing too.
     def get_session(self):
@@ -357,8 +434,13 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             return (DAAP_BADREQUEST, [], [])
         if not session:
             return (DAAP_FORBIDDEN, [], [])
+        if self.server.wait_for_revision(self, old_revision):
+            return (None, [], [])
         revision = self.server.backend.get_revision(session, old_revision,
                                                     self.request)
+        return self.update_reply(revision)
+
+    def update_reply(self, revision):
         reply = []
         reply.append(('mupd', [('mstt', DAAP_OK), ('musr', revision)]))
         return (DAAP_OK, reply, [])
@@ -367,24 +449,24 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         rc = DAAP_OK
         extra_headers = []
         self.log_message('daap server: do_stream_file')
-        seekpos = seekend = 0
-        rangehdr = self.headers.getheader('Range')
-        typ = ''
-        if rangehdr:
-            bytes = 'bytes='
-            if rangehdr.startswith(bytes):
-                seekpos = atol(rangehdr[len(bytes):])
-                idx = rangehdr.find('-')
-                if idx >= 0:
-                    seekend = atol(rangehdr[(idx + 1):])
-                if seekend < seekpos:
-                    seekend = 0
-                rc = DAAP_PARTIAL_CONTENT
+        seekpos, seekend = parse_range(self.headers.getheader('Range'))
+        if seekpos is not None:
+            rc = DAAP_PARTIAL_CONTENT
+        # get_session() sets the generation for the thread
+        session = self.get_session()
         generation = threading.current_thread().generation
+        # used to keep the stats for this stream
+        self.stream_session = session
+        # suffix ranges (negative seekpos) are resolved by ChunkedStreamObj
+        if seekpos is not None and seekpos > 0:
+            offset = seekpos
+        else:
+            offset = 0
         file_obj, hint = self.server.backend.get_file(item_id, generation, ext,
-                                                self.get_session(),
+                                                session,
                                                 self.get_request_path,
-                                                offset=seekpos, chunk=chunk)
+                                                offset=offset,
+                                                chunk=chunk)
         if not file_obj:
             return (DAAP_FILENOTFOUND, [], extra_headers)
         self.log_message('daap server: streaming with filobj %s', file_obj)
@@ -416,7 +498,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             npl = 1 + len([p for p in playlists.values() if p['valid']])
             db.append(('mlit', [
                                 ('miid', 1),    # Item ID
-                                ('mper', 1),    # Persistent ID
+                                ('mper', self.server.database_id),
                                 ('minm', name), # Name
                                 ('mimc', count),# Total count
                                 # Playlist is always non-zero because of
@@ -449,6 +531,29 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def _check_db_id(self, db_id):
         return db_id == 1
 
+    def get_db_revision(self):
+        # Backends that can tell us their current revision without blocking
+        # let us cache encoded listings.  Returns None if we can't cache.
+        try:
+            get_current_revision = self.server.backend.get_current_revision
+        except AttributeError:
+            return None
+        return get_current_revision()
+
+    def get_cached_reply(self, db_revision, key):
+        if db_revision is None:
+            return None
+        return self.server.response_cache.get(db_revision, key)
+
+    def cache_reply(self, db_revision, key, reply):
+        # Encode the reply now and keep it for the other clients that ask
+        # for the same listing.
+        if db_revision is None:
+            return reply
+        reply = EncodedResponse(encode_response_data(reply))
+        self.server.response_cache.set(db_revision, key, reply)
+        return reply
+
     # NB: Should probably be a static class method.
     def get_revision(self, query):
         revision = delta = 0
@@ -468,6 +573,13 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         revision, delta = self.get_revision(query)
         reply = []
         if len(path) == 3:
+            # Get the revision before the data, so that we never cache old
+            # data under a new revision.
+            db_revision = self.get_db_revision()
+            cache_key = ('containers', query.get('meta'), delta)
+            cached = self.get_cached_reply(db_revision, cache_key)
+            if cached is not None:
+                return (DAAP_OK, cached, [])
             # There is a requirement to send a default playlist so we
             # try to always send that one.
             count = len(self.server.backend.get_items())
@@ -520,6 +632,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             if deleted:
                 content.append(('mudl', deleted))
             reply.append(('aply', content))
+            reply = self.cache_reply(db_revision, cache_key, reply)
         else:
             # len(path) > 3
             playlist_id = int(path[3])
@@ -545,14 +658,21 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
         revision, delta = self.get_revision(query) 
+        # Get the revision before the items, so that we never cache old
+        # items under a new revision.
+        db_revision = self.get_db_revision()
+        cache_key = ('items', playlist_id, meta, delta)
+        cached = self.get_cached_reply(db_revision, cache_key)
+        if cached is not None:
+            return (DAAP_OK, cached, [])
+        items = self.server.backend.get_items(playlist_id=backend_id)
+        itemlist = []
+        deleted = []
         meta_list = [m.strip() for m in meta.split(',')]
         # NB: mikd must be the first guy in the listing.
         # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
@@ -595,6 +715,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             content.append(('mudl', deleted))    # Itemlist deleted
 
         reply = [(tag, content)]
+        reply = self.cache_reply(db_revision, cache_key, reply)
         return (DAAP_OK, reply, [])
 
     def do_database_items(self, path, query):
@@ -679,6 +800,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             rcode = DAAP_BADREQUEST
             reply = []
             extra_headers = []
+        if self.waiting_revision is not None:
+            # the server sends the /update reply when the revision changes
+            return
         try:
             content_encoding = self.reply_encoding()
             self.do_send_reply(rcode, reply, extra_headers=extra_headers,
@@ -693,6 +817,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             raise e
         if endconn:
             self.wfile.close()
+            self.close_connection = 1
 
     def reply_encoding(self):
         supported = ['gzip']
@@ -734,6 +859,311 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # prohibited list.
         return None
 
+class DaapPooledRequestHandler(DaapHttpRequestHandler):
+    """
+       Request handler for DaapPoolTCPServer.
+
+       Instead of handling all the requests on a connection in a loop, each
+       call to handle_next() handles one request.  That way the connection
+       can wait for the next one without holding on to a worker thread.
+    """
+    # Don't let a client that stops half way through a request hold a
+    # worker forever.
+    timeout = 60
+    # Read requests straight from the socket.  If rfile buffered ahead, a
+    # pipelined request could sit in the buffer where the poller's select()
+    # won't see it.
+    rbufsize = 0
+    # Set by send_stream() to the ChunkedStreamObj the server should send
+    # once the worker is done with the request.
+    pending_stream = None
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle_next(self):
+        self.waiting_revision = None
+        self.pending_stream = None
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def send_stream(self, blob):
+        # A stream lasts as long as the client takes to play it.  Leave it
+        # to the server to send from a thread of its own, so it doesn't
+        # hold a worker.
+        self.wfile.flush()
+        self.pending_stream = blob
+
+    def finish_stream(self):
+        blob = self.pending_stream
+        self.pending_stream = None
+        # The timeout is for requests.  A client reading a stream slowly is
+        # just playing it, so wait for it like the threaded server does.
+        self.connection.settimeout(None)
+        try:
+            DaapHttpRequestHandler.send_stream(self, blob)
+        except IOError:
+            session = getattr(self, 'session', 0)
+            if session:
+                self.server.del_session(session)
+            raise
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_update(self, revision):
+        self.waiting_revision = None
+        rcode, reply, extra_headers = self.update_reply(revision)
+        self.do_send_reply(rcode, reply, extra_headers=extra_headers,
+                           content_encoding=self.reply_encoding())
+        self.wfile.flush()
+
+def make_wakeup_pair():
+    """
+       make_wakeup_pair() -> (read_socket, write_socket)
+
+       Make a pair of connected sockets.  Writing to one wakes up a select()
+       on the other.
+    """
+    if hasattr(socket, 'socketpair'):
+        r, w = socket.socketpair()
+    else:
+        # Windows: do it by hand over the loopback interface.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            w = socket.create_connection(listener.getsockname())
+            r, _ = listener.accept()
+        finally:
+            listener.close()
+    w.setblocking(0)
+    return r, w
+
+class DaapPoolTCPServer(DaapTCPServer):
+    """
+       DAAP server that handles requests with a fixed pool of worker
+       threads.
+
+       Connections are kept alive between requests, but they only use a
+       worker while a request is being handled.  Between requests, and
+       while an /update request waits for a new revision, a single poller
+       thread watches them.  File data is sent from a thread started for
+       the stream, so long streams don't tie up the pool.
+
+       The backend must have a get_current_revision() method for /update
+       requests to wait in the poller.  If it also has
+       set_revision_callback(callback) it calls us when the revision
+       changes, otherwise we check every POLL_INTERVAL seconds.
+    """
+    POLL_INTERVAL = 1.0
+    # Close connections that have been idle for this long.
+    KEEPALIVE_TIMEOUT = DAAP_TIMEOUT
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, workers=DAAP_WORKERS):
+        DaapTCPServer.__init__(self, server_address, RequestHandlerClass,
+                               bind_and_activate)
+        self.workers = workers
+        # (function, args) tuples for the workers.  None tells a worker to
+        # quit.
+        self.jobs = Queue.Queue()
+        self.poll_lock = threading.Lock()
+        # maps sockets to (handler, time of last request) for connections
+        # that are waiting for their next request.
+        self.idle = dict()
+        # maps sockets to handlers for /update requests that are waiting for
+        # a new revision.
+        self.waiting = dict()
+        self.wakeup_r, self.wakeup_w = make_wakeup_pair()
+        self.threads = []
+        self.poll_thread = None
+        self.running = False
+        self.has_revision_callback = False
+
+    def set_backend(self, backend):
+        DaapTCPServer.set_backend(self, backend)
+        set_callback = getattr(backend, 'set_revision_callback', None)
+        if set_callback is not None:
+            set_callback(self.wakeup)
+            self.has_revision_callback = True
+
+    def start_pool(self):
+        self.running = True
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.worker_loop,
+                                      name='DAAP worker %d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.poll_thread = threading.Thread(target=self.poll_loop,
+                                            name='DAAP poller')
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send('x')
+        except socket.error:
+            # Full, so the poller will wake up anyway.
+            pass
+
+    # Called by handle_request() for new connections.
+    def process_request(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address,
+                                               self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.jobs.put((self.handle_next_request, (handler,)))
+
+    def wait_for_revision(self, handler, old_revision):
+        get_current_revision = getattr(self.backend, 'get_current_revision',
+                                       None)
+        if (get_current_revision is None or
+                get_current_revision() != old_revision):
+            return False
+        handler.waiting_revision = old_revision
+        return True
+
+    def worker_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception:
+                # The connection is no good to us anymore.
+                self.end_connection(args[0])
+
+    def handle_next_request(self, handler):
+        handler.handle_next()
+        if handler.pending_stream is not None:
+            thread = threading.Thread(target=self.stream_loop,
+                                      args=(handler,), name='DAAP stream')
+            thread.daemon = True
+            thread.start()
+            return
+        self.request_done(handler)
+
+    def stream_loop(self, handler):
+        try:
+            handler.finish_stream()
+        except Exception:
+            self.end_connection(handler)
+        else:
+            self.request_done(handler)
+
+    def send_update(self, handler):
+        handler.send_update(self.backend.get_current_revision())
+        self.request_done(handler)
+
+    def request_done(self, handler):
+        if handler.waiting_revision is not None:
+            with self.poll_lock:
+                self.waiting[handler.connection] = handler
+            self.wakeup()
+        elif handler.close_connection:
+            self.end_connection(handler)
+        else:
+            with self.poll_lock:
+                self.idle[handler.connection] = (handler, time.time())
+            self.wakeup()
+
+    def end_connection(self, handler):
+        try:
+            handler.finish()
+        except (IOError, socket.error):
+            pass
+        self.shutdown_request(handler.connection)
+
+    def _poll_timeout(self, now):
+        # Called with poll_lock held.
+        timeout = None
+        if self.idle:
+            oldest = min(last for handler, last in self.idle.itervalues())
+            timeout = max(oldest + self.KEEPALIVE_TIMEOUT - now, 0)
+        if self.waiting and not self.has_revision_callback:
+            if timeout is None or timeout > self.POLL_INTERVAL:
+                timeout = self.POLL_INTERVAL
+        return timeout
+
+    def poll_loop(self):
+        while self.running:
+            with self.poll_lock:
+                socks = self.idle.keys() + self.waiting.keys()
+                timeout = self._poll_timeout(time.time())
+            try:
+                r, w, x = select.select([self.wakeup_r] + socks, [], [],
+                                        timeout)
+            except select.error, (err, errstring):
+                if err != errno.EINTR:
+                    self.log_message('daap server: poll error %s',
+                                     errstring)
+                continue
+            if self.wakeup_r in r:
+                self.wakeup_r.recv(4096)
+            self.poll_once(r)
+
+    def poll_once(self, readable):
+        jobs = []
+        expired = []
+        with self.poll_lock:
+            for sock in readable:
+                if sock in self.idle:
+                    handler, last = self.idle.pop(sock)
+                    jobs.append((self.handle_next_request, (handler,)))
+                elif sock in self.waiting:
+                    # We didn't expect anything from the other end, it's
+                    # either closed the connection or sent us garbage.
+                    # Either way, reply now.
+                    handler = self.waiting.pop(sock)
+                    jobs.append((self.send_update, (handler,)))
+            if self.waiting:
+                revision = self.backend.get_current_revision()
+                for sock, handler in self.waiting.items():
+                    if handler.waiting_revision != revision:
+                        del self.waiting[sock]
+                        jobs.append((self.send_update, (handler,)))
+            now = time.time()
+            for sock, (handler, last) in self.idle.items():
+                if now - last >= self.KEEPALIVE_TIMEOUT:
+                    del self.idle[sock]
+                    expired.append(handler)
+        for job in jobs:
+            self.jobs.put(job)
+        for handler in expired:
+            self.end_connection(handler)
+
+    def log_message(self, format, *args):
+        if self.log_message_callback:
+            self.log_message_callback(format, *args)
+
+    def server_close(self):
+        DaapTCPServer.server_close(self)
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup()
+        self.poll_thread.join()
+        for thread in self.threads:
+            self.jobs.put(None)
+        with self.poll_lock:
+            handlers = ([handler for handler, last in self.idle.values()] +
+                        self.waiting.values())
+            self.idle.clear()
+            self.waiting.clear()
+        for handler in handlers:
+            self.end_connection(handler)
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
 def mdns_init():
     return mdns.mdns_init()
 
@@ -795,12 +1225,19 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
-    handler = DaapHttpRequestHandler
+                     max_conn=DAAP_MAXCONN, robust=True, pool=False,
+                     workers=DAAP_WORKERS):
+    # pool: use a DaapPoolTCPServer with this many workers, rather than a
+    # thread for each connection.
     failed = False
     while True:
         try:
-            httpd = DaapTCPServer(('', port), handler)
+            if pool:
+                httpd = DaapPoolTCPServer(('', port),
+                                          DaapPooledRequestHandler,
+                                          workers=workers)
+            else:
+                httpd = DaapTCPServer(('', port), DaapHttpRequestHandler)
             break
         except socket.error, e:
             if robust and not port == 0:
@@ -815,6 +1252,8 @@ def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
     httpd.set_name(name)
     httpd.set_backend(backend)
     httpd.set_maxconn(max_conn)
+    if pool:
+        httpd.start_pool()
     return httpd
 
 ###############################################################################
@@ -835,6 +1274,7 @@ def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
 # HTTP/1.1.
 class DaapClient(object):
     HEARTBEAT = 60    # seconds
+    READ_SIZE = 64 * 1024
     def __init__(self, host, port, gzip=False):
         self.conn = None
         self.host = host
@@ -844,6 +1284,7 @@ class DaapClient(object):
         self.headers = dict()
         self.old_revision = self.revision = 1
         self.supports_update = False
+        self.db_persistent_id = None
         if self.gzip:
            self.headers['Accept-encoding'] = 'gzip, identity'
 
@@ -883,6 +1324,65 @@ class DaapClient(object):
         if callback:
             callback(data, *args)
 
+    def iter_reply(self, response, http_code=httplib.OK):
+        """Decode a response as it comes in.
+
+        Yields the (container, code, value) tuples from DMAPStreamDecoder
+        while we read the response, so big listings don't have to be read
+        and decoded in one go.  Raises ValueError on unexpected responses or
+        malformed data.
+        """
+        if response.status != http_code:
+            raise ValueError(
+                'Unexpected code %d, wanted %d' % (response.status, http_code))
+        if response.version != 11:
+            raise ValueError('Server did not return HTTP/1.1')
+        encoding = response.getheader('Content-encoding')
+        if encoding is not None and encoding.strip() == 'gzip':
+            # 16 + MAX_WBITS: expect a gzip header and trailer
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            inflater = None
+        decoder = DMAPStreamDecoder()
+        try:
+            while True:
+                data = response.read(self.READ_SIZE)
+                if not data:
+                    break
+                if inflater:
+                    data = inflater.decompress(data)
+                for event in decoder.feed(data):
+                    yield event
+            if inflater:
+                for event in decoder.feed(inflater.flush()):
+                    yield event
+        except zlib.error, e:
+            raise ValueError('Error decompressing reply: %s' % e)
+        decoder.close()
+
+    def iter_listing(self, response, meta):
+        """Iterate through a playlist or item listing response.
+
+        Yields ('item', daap_id, item_data) for each entry in the listing
+        and ('deleted', daap_id, None) for each deleted entry.  item_data is
+        a dict mapping the names in meta to their values.
+        """
+        meta_list = []
+        for m in meta.split(','):
+            m = m.strip()
+            try:
+                meta_list.append((m, dmap_consts_rmap[m]))
+            except KeyError:
+                continue
+        for container, code, value in self.iter_reply(response):
+            if container == 'mlcl' and code == 'mlit':
+                itemid = find_daap_tag('miid', value)
+                yield ('item', itemid,
+                       dict((m, find_daap_tag(tag, value))
+                            for m, tag in meta_list))
+            elif container == 'mudl' and code in ('mlit', 'miid'):
+                yield ('deleted', value, None)
+
     def handle_server_info(self, data):
         update = find_daap_tag('msup', decode_response(data))
         self.supports_update = True if update else False
@@ -901,57 +1401,13 @@ class DaapClient(object):
         db = find_daap_tag('mlit', db_list)
         self.db_id = find_daap_tag('miid', db)
         self.db_name = find_daap_tag('minm', db)
+        self.db_persistent_id = find_daap_tag('mper', db)
 
     def handle_update(self, data):
         revision = find_daap_tag('musr', decode_response(data))
         self.old_revision = self.revision
         self.revision = revision
 
-    def handle_playlist(self, data, meta):
-        r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
-        playlist_dict = dict()
-        deleted_list = []
-        meta_list = [m.strip() for m in meta.split(',')]
-        if listing is not None:
-            for item in find_daap_listitems(listing):
-                playlist_id = find_daap_tag('miid', item)
-                playlist_dict[playlist_id] = dict()
-                for m in meta_list:
-                    try:
-                        playlist_dict[playlist_id][m] = find_daap_tag(
-                                                    dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
-        if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
-
-        self.daap_playlists = (playlist_dict, deleted_list)
-
-    def handle_items(self, data, playlist_id, meta):
-        r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
-        meta_list = [m.strip() for m in meta.split(',')]
-        itemdict = dict()
-        deleted_list = []
-        if listing is not None:
-            for item in find_daap_listitems(listing):
-                itemid = find_daap_tag('miid', item)
-                itemdict[itemid] = dict()
-                for m in meta_list:
-                    try:
-                        itemdict[itemid][m] = find_daap_tag(
-                                              dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
-        if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
-        self.daap_items = itemdict, deleted_list
-
     def sessionize(self, request, query):
         if not self.session:
             raise ValueError('no session (not logged in?)')
@@ -1034,29 +1490,39 @@ class DaapClient(object):
             self.disconnect()
             return None
 
-    def playlists(self, meta=DEFAULT_DAAP_PLAYLIST_META, update=False):
+    def iter_playlists(self, meta=DEFAULT_DAAP_PLAYLIST_META, update=False):
+        """Iterate through the playlists as they're received.
+
+        Yields the same tuples as iter_listing().  Raises IOError if we get
+        disconnected or there was a problem.
+        """
         try:
             revquery = self.revision_query(update)
             self.conn.request('GET', self.sessionize(
                               '/databases/%d/containers' % self.db_id,
                               [('meta', meta)] + revquery),
                               headers=self.headers)
-            self.check_reply(self.conn.getresponse(),
-                             callback=self.handle_playlist,
-                             args=[meta])
-            playlists = self.daap_playlists
-            del self.daap_playlists
-            return playlists
+            for entry in self.iter_listing(self.conn.getresponse(), meta):
+                yield entry
         # We've been disconnected or there was a problem?
         except (AttributeError, socket.error, IOError, ValueError,
-                httplib.BadStatusLine):
+                httplib.BadStatusLine), e:
             self.disconnect()
-            return None
+            raise IOError(str(e))
+
+    def playlists(self, meta=DEFAULT_DAAP_PLAYLIST_META, update=False):
+        return self._collect_listing(self.iter_playlists(meta, update))
 
     # XXX: I think this could be cleaner, maybe abstract to have an
     # easy way to provide the daap meta without resorting to providing
     # the raw string which includes the names requested.
-    def items(self, playlist_id=None, meta=DEFAULT_DAAP_META, update=False):
+    def iter_items(self, playlist_id=None, meta=DEFAULT_DAAP_META,
+                   update=False):
+        """Iterate through the items as they're received.
+
+        Yields the same tuples as iter_listing().  Raises IOError if we get
+        disconnected or there was a problem.
+        """
         try:
             query = self.revision_query(update) + [('meta', meta)]
             if playlist_id is None:
@@ -1068,17 +1534,32 @@ class DaapClient(object):
                     ('/databases/%d/containers/%d/items' % 
                      (self.db_id, playlist_id)),
                     query), headers=self.headers)
-            self.check_reply(self.conn.getresponse(),
-                             callback=self.handle_items,
-                             args=[playlist_id, meta])
-            items = self.daap_items
-            del self.daap_items
-            return items
+            for entry in self.iter_listing(self.conn.getresponse(), meta):
+                yield entry
         # We've been disconnected or there was a problem?
         except (AttributeError, socket.error, IOError, ValueError,
-                httplib.BadStatusLine):
+                httplib.BadStatusLine), e:
             self.disconnect()
+            raise IOError(str(e))
+
+    def items(self, playlist_id=None, meta=DEFAULT_DAAP_META, update=False):
+        return self._collect_listing(self.iter_items(playlist_id, meta,
+                                                     update))
+
+    def _collect_listing(self, listing):
+        # Returns (dict mapping ids to data, list of deleted ids), or None if
+        # there was a problem
+        data = dict()
+        deleted_list = []
+        try:
+            for kind, daap_id, item_data in listing:
+                if kind == 'item':
+                    data[daap_id] = item_data
+                else:
+                    deleted_list.append(daap_id)
+        except IOError:
             return None
+        return data, deleted_list
 
     def disconnect(self, polite=False):
         try:
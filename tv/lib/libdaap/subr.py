@@ -28,11 +28,17 @@
 
 # subr.py
 
+import errno
+import mmap
 import os
+import select
+import socket
 import stat
 import struct
+import threading
 import urllib
 import gzip
+import collections
 
 try:
     from cStringIO import StringIO
@@ -40,6 +46,13 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+# sendfile() for streaming files.  Python 2 doesn't have os.sendfile(), but the
+# pysendfile module has the same interface.
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, 'sendfile', None)
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -56,18 +69,33 @@ fmts = {
     DMAP_TYPE_VERSION: ('I', 4),
 }
 
+# Precompiled code (4 bytes) + length (4 bytes) + data structs for the fixed
+# size types, and the header struct for strings and lists.
+header_struct = struct.Struct('!4sI')
+value_structs = dict((typ, struct.Struct('!4sI' + fmt))
+                     for typ, (fmt, size) in fmts.iteritems()
+                     if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+# Data structs without the header, for decoding.
+decode_structs = dict((typ, struct.Struct('!' + fmt))
+                      for typ, (fmt, size) in fmts.iteritems()
+                      if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+
+def gzip_data(data):
+    gzdata = StringIO()
+    f = gzip.GzipFile(fileobj=gzdata, mode='wb')
+    f.write(data)
+    f.close()
+    return gzdata.getvalue()
+
 class StreamObj(object):
     """
        Data object for encoding HTTP responses.  Use once then dispose.
     """
-    def __init__(self, data, content_encoding=None):
+    def __init__(self, data, content_encoding=None, encoded=False):
+        # encoded: data has already been encoded with content_encoding
         self.content_encoding = content_encoding
-        if content_encoding == 'gzip':
-            gzdata = StringIO()
-            f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
-            f.close()
-            self.data = gzdata.getvalue()
+        if content_encoding == 'gzip' and not encoded:
+            self.data = gzip_data(data)
         else:
             self.data = data
 
@@ -90,6 +118,74 @@ class StreamObj(object):
     def get_rangetext(self):
         return ''
 
+class EncodedResponse(object):
+    """
+       A DMAP response that has been encoded once and can be sent many
+       times, see ResponseCache.  The gzipped version is made the first time
+       it's asked for and then kept around.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.gzip_data = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_stream(self, content_encoding=None):
+        if content_encoding == 'gzip':
+            with self.lock:
+                if self.gzip_data is None:
+                    self.gzip_data = gzip_data(self.data)
+            return StreamObj(self.gzip_data, content_encoding=content_encoding,
+                             encoded=True)
+        return StreamObj(self.data)
+
+class ResponseCache(object):
+    """
+       Cache of EncodedResponses for one revision of the database.
+
+       Responses like the item listing only change when the revision
+       changes, so there's no need to encode them again for each client that
+       asks.  Keys are whatever the caller needs to identify the response
+       (e.g. the playlist, meta list and delta).  Changing the revision throws
+       away everything.
+    """
+    DEFAULT_MAX_SIZE = 32
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.revision = None
+        # least recently used first
+        self.responses = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def get(self, revision, key):
+        """get(revision, key) -> EncodedResponse or None"""
+        with self.lock:
+            if revision != self.revision:
+                self.responses.clear()
+                self.revision = revision
+                return None
+            try:
+                response = self.responses.pop(key)
+            except KeyError:
+                return None
+            self.responses[key] = response
+            return response
+
+    def set(self, revision, key, response):
+        with self.lock:
+            if revision != self.revision:
+                self.responses.clear()
+                self.revision = revision
+            self.responses[key] = response
+            while len(self.responses) > self.max_size:
+                self.responses.popitem(last=False)
+
 class ChunkedStreamObj(object):
     """
        Streaming object.  Use once and then you must dispose.
@@ -100,36 +196,52 @@ class ChunkedStreamObj(object):
 
        for chunk in streamobj:
            write(chunk)
+
+       or, to let the kernel copy the data where we can, call
+       send(sock) after the headers have been written.
+
+       start and end are the byte range asked for, as returned by
+       parse_range().  If the range can't be satisfied, the satisfiable
+       attribute is False and nothing is sent.
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
+    MIN_CHUNK_SIZE = 32 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024
 
-    def __init__(self, file_obj, hint, start=0, end=0,
+    def __init__(self, file_obj, hint, start=None, end=None,
                  chunksize=DEFAULT_CHUNK_SIZE):
         hint = os.path.basename(hint) if hint else ''
         self.file_hint = hint
         self.chunksize = chunksize
         self.file_obj = file_obj
-        self.end = end
         self.filesize = os.fstat(file_obj.fileno())[stat.ST_SIZE]
-        self.streamsize = self.filesize
+        self.satisfiable = True
         rangetext = ''
-        if start and start < self.filesize:
-            self.streamsize = self.filesize - start
-            rangetext = (str(start) + '-' + str(self.filesize - 1) + '/' + 
-                         str(self.filesize))
-        if end and end < self.filesize and end >= start:
-            self.streamsize = end - start + 1
-            rangetext = (str(start) + '-' + str(end) + '/' + 
-                         str(self.filesize))
-        # XXX
-        # On error, I think we need to reposition the stream back to the start?
+        if start is None:
+            start = 0
+            end = self.filesize - 1
+        else:
+            if start < 0:
+                start = max(self.filesize + start, 0)
+            if end is None or end >= self.filesize:
+                end = self.filesize - 1
+            if start > end:
+                self.satisfiable = False
+                start, end = 0, -1
+                rangetext = '*/' + str(self.filesize)
+            else:
+                rangetext = (str(start) + '-' + str(end) + '/' +
+                             str(self.filesize))
+        self.start = start
+        self.end = end
+        self.streamsize = end - start + 1
         self.unread = self.streamsize
         self.rangetext = rangetext
 
     # Be careful: debug only: if you call this your object is consumed and 
     # you will need to create new one.
     def __str__(self):
-        return self.file_obj.read()
+        return ''.join(self)
 
     def _get_readsize(self):
         readsize = 0
@@ -140,19 +252,112 @@ class ChunkedStreamObj(object):
         return readsize
 
     def __iter__(self):
-        while True:
+        self.file_obj.seek(self.end - self.unread + 1, os.SEEK_SET)
+        while self.unread > 0:
             readsize = self._get_readsize()
             data = self.file_obj.read(readsize)
-            self.unread -= readsize
             # Maybe file got truncated
-            if data:
-                yield data
-            if self.unread == 0:
+            if not data:
                 break
+            self.unread -= len(data)
+            yield data
 
     def __len__(self):
         return self.streamsize
 
+    def tune_chunksize(self, sock):
+        """Match the chunk size to the socket's send buffer."""
+        try:
+            sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        except socket.error:
+            return
+        self.chunksize = min(max(sndbuf, self.MIN_CHUNK_SIZE),
+                             self.MAX_CHUNK_SIZE)
+
+    def send(self, sock):
+        """
+           send(sock) -> bytes sent
+
+           Send the data to sock without copying it through Python strings
+           if we can: with sendfile() if it's available, otherwise from an
+           mmap of the file.  Falls back to reading the file.  Raises
+           socket.error/IOError if the other end goes away.
+        """
+        self.tune_chunksize(sock)
+        if self.unread <= 0:
+            return 0
+        sent = 0
+        if sendfile is not None:
+            try:
+                sent += self._send_with_sendfile(sock)
+            except OSError, e:
+                # not supported for this file or socket, try something else
+                if e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                   errno.EOPNOTSUPP):
+                    raise
+            if self.unread <= 0:
+                return sent
+        sent += self._send_with_mmap(sock)
+        if self.unread > 0:
+            for data in self:
+                sock.sendall(data)
+                sent += len(data)
+        return sent
+
+    def _send_with_sendfile(self, sock):
+        sent = 0
+        offset = self.end - self.unread + 1
+        while self.unread > 0:
+            try:
+                count = sendfile(sock.fileno(), self.file_obj.fileno(),
+                                 offset, self._get_readsize())
+            except OSError, e:
+                # Sockets with a timeout are non-blocking underneath, so
+                # sendfile() can fail with EAGAIN when the send buffer is
+                # full.  Wait for room and try again.
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                self._wait_writable(sock)
+                continue
+            # Maybe file got truncated
+            if count == 0:
+                self.unread = 0
+                break
+            offset += count
+            sent += count
+            self.unread -= count
+        return sent
+
+    def _wait_writable(self, sock):
+        timeout = sock.gettimeout()
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable:
+            raise socket.timeout('timed out')
+
+    def _send_with_mmap(self, sock):
+        sent = 0
+        offset = self.end - self.unread + 1
+        try:
+            mm = mmap.mmap(self.file_obj.fileno(), 0,
+                           access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            # mmap not possible (e.g. file too big for our address space).
+            # Errors sending to the socket are not caught here, they mean
+            # the other end went away.
+            return 0
+        try:
+            # Maybe file got truncated
+            self.unread = min(self.unread, max(len(mm) - offset, 0))
+            while self.unread > 0:
+                count = self._get_readsize()
+                sock.sendall(buffer(mm, offset, count))
+                offset += count
+                sent += count
+                self.unread -= count
+        finally:
+            mm.close()
+        return sent
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -165,6 +370,36 @@ class ChunkedStreamObj(object):
     def get_rangetext(self):
         return 'bytes ' + self.rangetext if self.rangetext else ''
 
+def parse_range(rangehdr):
+    """
+       parse_range(rangehdr) -> (start, end)
+
+       Parse a HTTP Range header of the form "bytes=start-end".  end is
+       inclusive, or None to read to the end of the file.  A suffix range
+       ("bytes=-500") gives a negative start.  Returns (None, None) if the
+       header isn't a byte range.  Only the first range of a multiple range
+       request is used.
+    """
+    units = 'bytes='
+    if not rangehdr or not rangehdr.startswith(units):
+        return None, None
+    first = rangehdr[len(units):].split(',')[0].strip()
+    start, sep, end = first.partition('-')
+    if not sep:
+        return None, None
+    if not start.strip():
+        length = atol(end)
+        if length <= 0:
+            return None, None
+        return -length, None
+    start = atol(start)
+    if not end.strip():
+        return start, None
+    end = atol(end)
+    if end < start:
+        return None, None
+    return start, end
+
 def atol(s, base=10):
     """
        atol(s, base) -> long
@@ -232,6 +467,33 @@ def find_daap_tag(searchtag, data):
     except (RuntimeError, ValueError):
         return None
 
+def _decode_range(data, start, end):
+    # Decode the responses in data[start:end].  We work with offsets into the
+    # one buffer rather than slicing off what we've read, which used to make
+    # decoding big item listings quadratic.
+    decoded = []
+    off = start
+    while off < end:
+        code, size = header_struct.unpack_from(data, off)
+        off += header_struct.size
+        realname, realtype = dmap_consts[code]
+        if realtype == DMAP_TYPE_LIST:
+            try:
+                value = _decode_range(data, off, min(off + size, end))
+            except (struct.error, KeyError, ValueError), e:
+                value = [(-1, [])]
+        elif realtype == DMAP_TYPE_STRING:
+            if off + size > end:
+                raise ValueError
+            value = str(data[off:off + size])
+        else:
+            if fmts[realtype][1] != size:
+                raise ValueError
+            (value, ) = decode_structs[realtype].unpack_from(data, off)
+        decoded.append((code, value))
+        off += size
+    return decoded
+
 def decode_response(reply):
     """
        decode_response(reply) -> reply
@@ -244,37 +506,146 @@ def decode_response(reply):
     """
     # This must be wrapped around a try ... except block in case the other
     # end lies to us about the size of the individual items.
-    decoded = []
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
+        return _decode_range(reply, 0, len(reply))
+    except (struct.error, KeyError, ValueError), e:
+        return [(-1, [])]
+
+class DMAPStreamDecoder(object):
+    """
+       Incremental DMAP decoder, for responses that arrive a piece at a time.
+
+       Feed it data as it comes off the socket and it returns the responses
+       it has finished decoding.  Unlike decode_response(), we don't wait
+       for the whole reply: list containers are opened as soon as their
+       header arrives and their children come out as they're complete.  The
+       one exception are the records inside a listing ('mlcl'), for example
+       a single item, which come out as one decoded list.
+
+       feed() returns a list of (container, code, value) tuples.  container
+       is the code of the enclosing list or None at the top level.  Opening
+       a list container is reported with a value of None.  Malformed data
+       raises ValueError.
+    """
+    # Don't bother moving the unread data to the start of the buffer until
+    # we've read this much.
+    COMPACT_SIZE = 64 * 1024
+
+    # containers whose children are decoded whole (listing records and the
+    # deleted id list)
+    RECORD_CONTAINERS = ('mlcl', 'mudl')
+
+    def __init__(self):
+        self.buf = bytearray()
+        # offset into buf of the first byte we haven't decoded
+        self.pos = 0
+        # total number of bytes removed from the front of buf
+        self.consumed = 0
+        # (code, end offset) for the lists we're inside of.  The end offsets
+        # count from the start of the response, not the start of buf.
+        self.stack = []
+
+    def feed(self, data):
+        self.buf.extend(data)
+        try:
+            events = self._decode()
+        except (struct.error, KeyError), e:
+            raise ValueError("Error decoding DMAP data: %s" % e)
+        if self.pos >= self.COMPACT_SIZE:
+            del self.buf[:self.pos]
+            self.consumed += self.pos
+            self.pos = 0
+        return events
+
+    def close(self):
+        """Check that the response wasn't cut off."""
+        if self.stack or self.pos < len(self.buf):
+            raise ValueError("Truncated DMAP response")
+
+    def _decode(self):
+        events = []
+        buf = self.buf
+        stack = self.stack
+        while True:
+            offset = self.consumed + self.pos
+            while stack and stack[-1][1] <= offset:
+                if stack[-1][1] < offset:
+                    raise ValueError("DMAP list overrun")
+                stack.pop()
+            if len(buf) - self.pos < header_struct.size:
+                break
+            code, size = header_struct.unpack_from(buf, self.pos)
             realname, realtype = dmap_consts[code]
-            realfmt, realsize = fmts[realtype]
-            # XXX check size == realsize
-            if realtype == DMAP_TYPE_LIST:
-                decoded.append((code,
-                                decode_response(reply[:size])))
-                # next guy
-                reply = reply[size:]
+            if stack:
+                container = stack[-1][0]
+            else:
+                container = None
+            end = self.pos + header_struct.size + size
+            if (realtype == DMAP_TYPE_LIST and
+                    container not in self.RECORD_CONTAINERS):
+                stack.append((code, self.consumed + end))
+                self.pos += header_struct.size
+                events.append((container, code, None))
                 continue
-            if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
+            if len(buf) < end:
+                break
+            start = self.pos + header_struct.size
+            if realtype == DMAP_TYPE_LIST:
+                value = _decode_range(buf, start, end)
+            elif realtype == DMAP_TYPE_STRING:
+                value = str(buf[start:end])
             else:
-                if realsize != size:
-                    raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
-            decoded.append((code, value))
-            reply = reply[realfmtsize:]
-        return decoded
-    except (struct.error, KeyError, ValueError), e:
-        return [(-1, [])]
+                if fmts[realtype][1] != size:
+                    raise ValueError("Bad size for %s" % code)
+                (value, ) = decode_structs[realtype].unpack_from(buf, start)
+            events.append((container, code, value))
+            self.pos = end
+        return events
+
+def encode_into(reply, buf):
+    """
+       encode_into(reply, buf)
+
+       Encode reply, in the same format as encode_response() takes, by
+       appending to the bytearray buf.  List containers are written in the
+       same pass: we write their header with a zero length, encode the
+       contents and then patch the length in.
+    """
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            start = len(buf)
+            buf.extend(header_struct.pack(code, 0))
+            encode_into(value, buf)
+            struct.pack_into('!I', buf, start + 4,
+                             len(buf) - start - header_struct.size)
+        elif typ == DMAP_TYPE_STRING:
+            size = len(value)
+            if not isinstance(value, str):
+                # This ensures we always get a string type even if we are
+                # lame and passed a unicode in.
+                value = str(buffer(value))[:size].ljust(size, '\0')
+            buf.extend(header_struct.pack(code, size))
+            buf.extend(value)
+        else:
+            # code (4 bytes), length (4 bytes), data (variable), network
+            # byte order
+            try:
+                buf.extend(value_structs[typ].pack(code, fmts[typ][1],
+                                                   value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                pass
+
+def encode_response_data(reply):
+    """
+       encode_response_data(reply) -> str
+
+       Like encode_response(), but just returns the encoded data.
+    """
+    buf = bytearray()
+    encode_into(reply, buf)
+    return str(buf)
 
 def encode_response(reply, content_encoding=None):
     """
@@ -287,39 +658,16 @@ def encode_response(reply, content_encoding=None):
        DMAP_TYPE_LIST should have a value of list containing other response
        codes.
 
+       reply can also be an EncodedResponse, in which case it's sent as is.
+
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
+    if isinstance(reply, EncodedResponse):
+        return reply.get_stream(content_encoding)
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        blob = StreamObj(encode_response_data(reply),
+                         content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
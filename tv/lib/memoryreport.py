@@ -0,0 +1,237 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.memoryreport`` -- Count what the backend is holding in memory.
+
+get_report() counts the entries in the structures that grow along with the
+library or with the time Miro has been running, grouped by subsystem:
+
+- database -- DDBObjects that LiveStorage has loaded, per class, and the
+  DatabaseObjectCache categories
+- messages -- the infos that the ViewTrackers keep to compare with the next
+  change
+- sharing -- the DAAP data and transcode jobs for our share
+- workers -- pending worker process tasks and libcurl transfers
+- search -- the segments and blocks of the item_fts full-text index
+
+The report only covers structures that the backend thread owns.  The
+frontend has its own caches, which its thread changes while we run.
+
+We count entries rather than bytes, since that's cheap enough to do while
+Miro is running and still shows which structure is growing.  The process RSS
+is included to line the counts up with the real memory usage.
+
+MemoryReporter appends a report to a file every EXPORT_INTERVAL seconds and
+logs the counts that grew since the last one, which makes slow leaks show
+up in bug reports.  Use the QueryMemoryReport message to get a report at
+other times.
+"""
+
+import logging
+import os
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from miro import app
+from miro import eventloop
+from miro import fileutil
+from miro import httpclient
+from miro import util
+from miro import workerprocess
+
+def get_report():
+    """Count the entries in the backend's structures.
+
+    :returns: dict with the keys name, time, rss (process RSS in KB, or None
+        if we can't get it) and subsystems.  subsystems maps subsystem names
+        to dicts that map structure names to entry counts.
+    """
+    return {
+        'name': 'MemoryReport',
+        'time': time.time(),
+        'rss': get_rss(),
+        'subsystems': {
+            'database': _database_counts(),
+            'messages': _message_counts(),
+            'sharing': _sharing_counts(),
+            'workers': _worker_counts(),
+            'search': _search_counts(),
+        },
+    }
+
+def get_rss():
+    try:
+        return util.get_mem_usage()
+    except (OSError, ValueError):
+        return None
+
+def _add_counts(totals, prefix, counts):
+    for name, count in counts.items():
+        key = '%s.%s' % (prefix, name)
+        totals[key] = totals.get(key, 0) + count
+
+def _add_instance_counts(totals, instances):
+    # instances of the same class get added together
+    for obj in list(instances):
+        _add_counts(totals, obj.__class__.__name__, obj.get_memory_counts())
+
+def _database_counts():
+    counts = {}
+    if app.db is None or app.db.is_closed():
+        return counts
+    _add_counts(counts, 'objects', app.db.object_counts())
+    _add_counts(counts, 'cache', app.db.cache.category_counts())
+    return counts
+
+def _message_counts():
+    # messagehandler imports us, so wait until we need it
+    from miro import messagehandler
+    counts = {}
+    _add_instance_counts(counts, messagehandler.ViewTracker.instances)
+    return counts
+
+def _sharing_counts():
+    backend = getattr(app.sharing_manager, 'backend', None)
+    if backend is None:
+        return {}
+    return backend.get_memory_counts()
+
+def _worker_counts():
+    counts = {}
+    _add_counts(counts, 'worker',
+                workerprocess._miro_task_queue.get_memory_counts())
+    if httpclient.curl_manager is not None:
+        _add_counts(counts, 'curl', httpclient.curl_manager.get_memory_counts())
+    return counts
+
+def _search_counts():
+    counts = {}
+    if app.db is None or app.db.is_closed():
+        return counts
+    _add_counts(counts, 'item_fts', app.db.search_index_counts())
+    return counts
+
+def find_growth(old_report, new_report):
+    """Find the structures that grew between two reports.
+
+    :returns: list of (subsystem, name, old_count, new_count) tuples, with
+        the largest increases first
+    """
+    growth = []
+    for subsystem, counts in new_report['subsystems'].items():
+        old_counts = old_report['subsystems'].get(subsystem, {})
+        for name, count in counts.items():
+            old_count = old_counts.get(name, 0)
+            if count > old_count:
+                growth.append((subsystem, name, old_count, count))
+    growth.sort(key=lambda info: info[3] - info[2], reverse=True)
+    return growth
+
+class MemoryReporter(object):
+    """Periodically writes memory reports to a file.
+
+    Each report is written as a line of JSON.  Once the file gets bigger than
+    MAX_FILE_SIZE, it's moved to path + ".old" and a new file is started.
+    """
+
+    # seconds between reports
+    EXPORT_INTERVAL = 10 * 60
+    MAX_FILE_SIZE = 1024 * 1024
+    # how many of the structures that grew the most we log
+    GROWTH_LOG_COUNT = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.last_report = None
+        self._dc = None
+
+    def start(self):
+        """Start writing reports."""
+        if self._dc is None:
+            self._schedule()
+
+    def stop(self):
+        if self._dc is not None:
+            self._dc.cancel()
+            self._dc = None
+
+    def _schedule(self):
+        self._dc = eventloop.add_timeout(self.EXPORT_INTERVAL,
+                                         self._on_timeout, "memory report")
+
+    def _on_timeout(self):
+        self._dc = None
+        try:
+            self.export()
+        finally:
+            # keep exporting even if this report failed
+            self._schedule()
+
+    def export(self):
+        """Write a report to our file now.
+
+        :returns: the report
+        """
+        start = time.time()
+        report = get_report()
+        try:
+            self._write(report)
+        except (IOError, OSError), e:
+            logging.warn("error writing memory report to %s (%s)", self.path,
+                         e)
+        if self.last_report is not None:
+            self._log_growth(find_growth(self.last_report, report))
+        self.last_report = report
+        logging.timing("memory report took %0.3fs (rss: %s KB)",
+                       time.time() - start, report['rss'])
+        return report
+
+    def _write(self, report):
+        if (fileutil.exists(self.path) and
+                os.path.getsize(self.path) > self.MAX_FILE_SIZE):
+            old_path = self.path + '.old'
+            if fileutil.exists(old_path):
+                fileutil.remove(old_path)
+            fileutil.rename(self.path, old_path)
+        f = fileutil.open_file(self.path, 'a')
+        try:
+            f.write(json.dumps(report, sort_keys=True))
+            f.write('\n')
+        finally:
+            f.close()
+
+    def _log_growth(self, growth):
+        for subsystem, name, old_count, count in \
+                growth[:self.GROWTH_LOG_COUNT]:
+            logging.info("memory report: %s %s grew from %d to %d", subsystem,
+                         name, old_count, count)
@@ -34,6 +34,7 @@ import copy
 import logging
 import time
 import os
+import weakref
 
 from miro import app
 from miro import autoupdate
@@ -48,6 +49,7 @@ from miro import fileutil
 from miro import commandline
 from miro import item
 from miro import itemsource
+from miro import memoryreport
 from miro import messages
 from miro import filetypes
 from miro import prefs
@@ -72,12 +74,24 @@ class ViewTracker(object):
     type = None
     info_factory = None
 
+    # ViewTracker objects that are still alive, for miro.memoryreport
+    instances = weakref.WeakSet()
+
     def __init__(self):
         self.trackers = []
         self.add_callbacks()
         self.reset_changes()
         self.tabs_being_reordered = False
         self._last_sent_info = {}
+        ViewTracker.instances.add(self)
+
+    def get_memory_counts(self):
+        """Get the number of infos we're holding on to."""
+        return {
+            'last_sent_info': len(self._last_sent_info),
+            'pending_changes': (len(self.added) + len(self.changed) +
+                                len(self.removed)),
+        }
 
     def reset_changes(self):
         self.changed = {}
@@ -1625,6 +1639,10 @@ New ids: %s""", playlist_item_ids, message.item_ids)
     def handle_force_device_dbsave_error(self, message):
         app.device_manager.force_db_save_error(message.device_info)
 
+    def handle_query_memory_report(self, message):
+        m = messages.CurrentMemoryReport(memoryreport.get_report())
+        m.send_to_frontend()
+
     def handle_set_net_lookup_enabled(self, message):
         paths = set()
         if message.item_ids is None:
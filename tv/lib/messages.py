@@ -890,6 +890,11 @@ class ForceDeviceDBSaveError(BackendMessage):
     def __init__(self, device_info):
         self.device_info = device_info
 
+class QueryMemoryReport(BackendMessage):
+    """Ask for a CurrentMemoryReport message to be sent back.
+    """
+    pass
+
 # Frontend Messages
 class DownloaderSyncCommandComplete(FrontendMessage):
     """Tell the frontend that the pause/resume all command are complete,
@@ -1556,6 +1561,14 @@ class CurrentViewStates(FrontendMessage):
     def __init__(self, view_infos):
         self.views = view_infos
 
+class CurrentMemoryReport(FrontendMessage):
+    """Returns the counts of what the backend is holding in memory.
+
+    report is the dict from memoryreport.get_report().
+    """
+    def __init__(self, report):
+        self.report = report
+
 class DisplayInfo(object):
     """Contains the properties that:
        -are shared across all TableViews for a Display or
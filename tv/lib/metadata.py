@@ -36,8 +36,10 @@ Module properties:
 
 import collections
 import contextlib
+import hashlib
 import logging
 import os.path
+import shutil
 import time
 
 from miro import app
@@ -52,6 +54,7 @@ from miro import messages
 from miro import net
 from miro import prefs
 from miro import signals
+from miro import util
 from miro import workerprocess
 from miro.plat.utils import (filename_to_unicode,
                              get_enmfp_executable_info)
@@ -470,28 +473,66 @@ class _MetadataProcessor(signals.SignalEmitter):
         pass
 
 class _TaskProcessor(_MetadataProcessor):
-    """Handle sending tasks to the worker process.  """
+    """Handle sending tasks to the worker process.
 
-    def __init__(self, source_name, limit):
+    If make_batch_task is given, tasks that have to wait in the queue get
+    sent to the worker process in batches.  make_batch_task gets called with
+    a list of tasks and should return a single TaskMessage for them.  The
+    batch size adapts to the per-file processing time that the worker reports
+    so that each batch takes roughly BATCH_TARGET_TIME to process.
+    """
+
+    BATCH_TARGET_TIME = 0.5
+    MIN_BATCH_SIZE = 1
+    MAX_BATCH_SIZE = 25
+    INITIAL_BATCH_SIZE = 10
+
+    def __init__(self, source_name, limit, make_batch_task=None):
         _MetadataProcessor.__init__(self, source_name)
         self.limit = limit
+        self.make_batch_task = make_batch_task
+        if make_batch_task is not None:
+            self.batch_size = self.INITIAL_BATCH_SIZE
+        else:
+            self.batch_size = 1
+        # average processing time per file, as reported by the worker
+        self.per_file_time = None
         # map source paths to tasks
         self._active_tasks = {}
-        self._pending_tasks = {}
+        self._pending_tasks = collections.OrderedDict()
 
     def task_count(self):
         return len(self._active_tasks) + len(self._pending_tasks)
 
     def add_task(self, task):
-        if len(self._active_tasks) < self.limit:
-            self._send_task(task)
-        else:
+        self.add_tasks([task])
+
+    def add_tasks(self, tasks):
+        for task in tasks:
             self._pending_tasks[task.source_path] = task
+        self._send_pending_tasks()
+
+    def _send_pending_tasks(self):
+        while len(self._active_tasks) < self.limit and self._pending_tasks:
+            count = min(self.limit - len(self._active_tasks),
+                        self.batch_size, len(self._pending_tasks))
+            tasks = [self._pending_tasks.popitem(last=False)[1]
+                     for i in xrange(count)]
+            if len(tasks) == 1:
+                self._send_task(tasks[0])
+            else:
+                self._send_batch(tasks)
 
     def _send_task(self, task):
         self._active_tasks[task.source_path] = task
         workerprocess.send(task, self._callback, self._errback)
 
+    def _send_batch(self, tasks):
+        for task in tasks:
+            self._active_tasks[task.source_path] = task
+        workerprocess.send(self.make_batch_task(tasks), self._batch_callback,
+                           self._batch_errback)
+
     def remove_task_for_path(self, path):
         self.remove_tasks_for_paths([path])
 
@@ -505,10 +546,7 @@ class _TaskProcessor(_MetadataProcessor):
                     del self._pending_tasks[path]
                 except KeyError:
                     pass
-
-        while len(self._active_tasks) < self.limit and self._pending_tasks:
-            path, task = self._pending_tasks.popitem()
-            self._send_task(task)
+        self._send_pending_tasks()
 
     def _callback(self, task, result):
         if task.source_path not in self._active_tasks:
@@ -520,6 +558,51 @@ class _TaskProcessor(_MetadataProcessor):
         self.emit('task-complete', task.source_path, result)
         self.remove_task_for_path(task.source_path)
 
+    def _batch_callback(self, batch_task, batch_result):
+        self._update_batch_size(len(batch_result.results),
+                                batch_result.processing_time)
+        finished = []
+        for path, result in batch_result.results.iteritems():
+            if path not in self._active_tasks:
+                logging.debug("%s done but already removed: %r",
+                              self.source_name, path)
+                continue
+            if isinstance(result, Exception):
+                logging.warn("Error running %s for %r: %s", self.source_name,
+                             path, result)
+                self.emit('task-error', path, result)
+            else:
+                self._check_for_none_values(result)
+                self.emit('task-complete', path, result)
+            finished.append(path)
+        self.remove_tasks_for_paths(finished)
+
+    def _batch_errback(self, batch_task, error):
+        logging.warn("Error running %s: %s", batch_task, error)
+        failed = [p for p in batch_task.source_paths
+                  if p in self._active_tasks]
+        for path in failed:
+            self.emit('task-error', path, error)
+        self.remove_tasks_for_paths(failed)
+
+    def _update_batch_size(self, file_count, processing_time):
+        """Adjust batch_size based on how long the worker took per file."""
+        if file_count == 0:
+            return
+        per_file_time = float(processing_time) / file_count
+        if self.per_file_time is None:
+            self.per_file_time = per_file_time
+        else:
+            # use an exponential moving average to smooth out odd files
+            self.per_file_time = (0.8 * self.per_file_time +
+                                  0.2 * per_file_time)
+        if self.per_file_time > 0:
+            batch_size = int(self.BATCH_TARGET_TIME / self.per_file_time)
+        else:
+            batch_size = self.MAX_BATCH_SIZE
+        self.batch_size = max(self.MIN_BATCH_SIZE,
+                              min(self.MAX_BATCH_SIZE, batch_size))
+
     def _check_for_none_values(self, result):
         """Check that result dicts don't have keys for None values."""
         # FIXME: we shouldn't need this function, metadata extractors should
@@ -812,6 +895,122 @@ class _EchonestProcessor(_MetadataProcessor):
         # since we may have deleted active paths, process the new ones
         self._process_queue()
 
+class MetadataResultCache(object):
+    """Cache of extractor results keyed by file contents.
+
+    When a file that we've already processed shows up under a new path (it
+    was synced to a device, moved between watched folders, re-downloaded,
+    etc), we can reuse the mutagen/movie data results instead of running the
+    extractors again.
+
+    Files are identified by a cheap fingerprint built from the file size and
+    hashes of the first and last FINGERPRINT_BLOCK_SIZE bytes (see
+    calc_fingerprint()).  The cache holds at most max_size fingerprints and
+    evicts the least recently used ones first.
+
+    Calculating a fingerprint means reading the file, so we try to avoid
+    doing it in the eventloop.  has_size() lets callers skip files that
+    can't possibly match anything.
+    """
+
+    DEFAULT_MAX_SIZE = 20000
+    FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.max_size = max_size
+        # maps fingerprints to dicts that map source names to results.
+        # Ordered from least to most recently used.
+        self._entries = collections.OrderedDict()
+        # maps the size part of our fingerprints to the number of entries
+        # with that size
+        self._size_counts = collections.defaultdict(int)
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @classmethod
+    def calc_fingerprint(cls, path):
+        """Calculate the content fingerprint for a file.
+
+        :returns: fingerprint string, or None if we can't read the file
+        """
+        block_size = cls.FINGERPRINT_BLOCK_SIZE
+        try:
+            size = os.path.getsize(path)
+            f = fileutil.open_file(path, 'rb')
+            try:
+                head = f.read(block_size)
+                if size > block_size * 2:
+                    f.seek(-block_size, os.SEEK_END)
+                    tail = f.read(block_size)
+                else:
+                    # the head block covers most of the file, don't bother
+                    # reading it twice
+                    tail = ''
+            finally:
+                f.close()
+        except EnvironmentError:
+            return None
+        return '%d-%s-%s' % (size, hashlib.md5(head).hexdigest(),
+                             hashlib.md5(tail).hexdigest())
+
+    @staticmethod
+    def _fingerprint_size(fingerprint):
+        return fingerprint.split('-', 1)[0]
+
+    def has_size(self, size):
+        """Check if we have results for a file with a given size."""
+        return str(size) in self._size_counts
+
+    def get(self, fingerprint, source_name):
+        """Get a cached result.
+
+        :returns: copy of the result dict or None if we don't have a result
+        """
+        try:
+            results = self._entries.pop(fingerprint)
+        except KeyError:
+            self.misses += 1
+            return None
+        # re-insert to mark the entry as the most recently used
+        self._entries[fingerprint] = results
+        try:
+            result = results[source_name]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result.copy()
+
+    def set(self, fingerprint, source_name, result):
+        """Store a result for a fingerprint."""
+        results = self._entries.pop(fingerprint, None)
+        if results is None:
+            results = {}
+            while len(self._entries) >= self.max_size:
+                self._forget(self._entries.popitem(last=False)[0])
+            self._size_counts[self._fingerprint_size(fingerprint)] += 1
+        results[source_name] = result.copy()
+        self._entries[fingerprint] = results
+
+    def remove(self, fingerprint):
+        """Forget all results for a fingerprint."""
+        if self._entries.pop(fingerprint, None) is not None:
+            self._forget(fingerprint)
+
+    def _forget(self, fingerprint):
+        size = self._fingerprint_size(fingerprint)
+        self._size_counts[size] -= 1
+        if self._size_counts[size] == 0:
+            del self._size_counts[size]
+
+    def clear(self):
+        self._entries.clear()
+        self._size_counts.clear()
+
 class ProgressCountTracker(object):
     """Helps MetadataManager keep track of counts for MetadataProgressUpdate
 
@@ -1115,7 +1314,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.cover_art_dir = cover_art_dir
         self.screenshot_dir = screenshot_dir
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
-        self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
+        self.mutagen_processor = _TaskProcessor(u'mutagen', 100,
+                                                self._make_mutagen_batch_task)
         self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
         self.echonest_processor = _EchonestProcessor(
             5, self.echonest_cover_art_dir)
@@ -1147,6 +1347,14 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._retry_net_lookup_caller = \
                 eventloop.DelayedFunctionCaller(self.retry_net_lookup)
         self._retry_net_lookup_entries = {}
+        # maps (source_name, path) tuples to content fingerprints for tasks
+        # that we will store in app.metadata_result_cache once they finish.
+        # The fingerprint is None if we haven't calculated it yet.
+        self._pending_fingerprints = {}
+        # (source_name, path) tuples for files that we're looking up in
+        # app.metadata_result_cache.  The lookup runs partly in the thread
+        # pool, so the file can get removed while it's going.
+        self._cache_lookups = set()
         self._setup_path_placeholders()
         self._setup_net_lookup_count()
         # send initial NetLookupCounts message
@@ -1233,10 +1441,13 @@ class MetadataManagerBase(signals.SignalEmitter):
         return self.bulk_add_count != 0
 
     def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
+        self.mutagen_processor.add_tasks(self.pending_mutagen_tasks)
         self.pending_mutagen_tasks = []
 
+    def _make_mutagen_batch_task(self, tasks):
+        return workerprocess.MutagenBatchTask(
+            [task.source_path for task in tasks], self.cover_art_dir)
+
     def _translate_path(self, path):
         """Translate a path value from the db to a filesystem path.
         """
@@ -1292,13 +1503,21 @@ class MetadataManagerBase(signals.SignalEmitter):
     def worker_task_count(self):
         return (self.mutagen_processor.task_count() +
                 self.moviedata_processor.task_count() +
-                self.echonest_processor.task_count())
+                self.echonest_processor.task_count() +
+                len(self._cache_lookups))
 
     def _cancel_processing_paths(self, paths):
         paths = [self._translate_path(p) for p in paths]
         workerprocess.cancel_tasks_for_files(paths)
         for processor in self.metadata_processors:
             processor.remove_tasks_for_paths(paths)
+        path_set = set(paths)
+        for key in self._pending_fingerprints.keys():
+            if key[1] in path_set:
+                del self._pending_fingerprints[key]
+        for key in list(self._cache_lookups):
+            if key[1] in path_set:
+                self._cache_lookups.discard(key)
 
     def remove_file(self, path):
         """Remove a file from the metadata system.
@@ -1562,16 +1781,19 @@ class MetadataManagerBase(signals.SignalEmitter):
 
         This method queues calls to mutagen, movie data, etc.
         """
-        for id_ in self.restart_ids:
-            try:
-                status = MetadataStatus.get_by_id(id_, self.db_info)
-            except database.ObjectNotFoundError:
-                continue # just ignore deleted objects
-            self.run_next_processor(status)
-            # get_metadata() is sometimes more accurate than
-            # _get_metadata_from_filename() but slower.  Let's go for speed.
-            metadata = self._get_metadata_from_filename(status.path)
-            self.count_tracker.file_started(status.path, metadata)
+        # use bulk_add() so that the mutagen tasks get sent in batches
+        with self.bulk_add():
+            for id_ in self.restart_ids:
+                try:
+                    status = MetadataStatus.get_by_id(id_, self.db_info)
+                except database.ObjectNotFoundError:
+                    continue # just ignore deleted objects
+                self.run_next_processor(status)
+                # get_metadata() is sometimes more accurate than
+                # _get_metadata_from_filename() but slower.  Let's go for
+                # speed.
+                metadata = self._get_metadata_from_filename(status.path)
+                self.count_tracker.file_started(status.path, metadata)
 
         del self.restart_ids
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
@@ -1637,18 +1859,152 @@ class MetadataManagerBase(signals.SignalEmitter):
         """Run mutagen on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
-        task = workerprocess.MutagenTask(path, self.cover_art_dir)
-        if not self.in_bulk_add():
-            self.mutagen_processor.add_task(task)
-        else:
-            self.pending_mutagen_tasks.append(task)
+        def run_task():
+            task = workerprocess.MutagenTask(path, self.cover_art_dir)
+            if not self.in_bulk_add():
+                self.mutagen_processor.add_task(task)
+            else:
+                self.pending_mutagen_tasks.append(task)
+        self._run_unless_cached(self.mutagen_processor, path, run_task)
 
     def _run_movie_data(self, path):
         """Run the movie data program on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
-        task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
-        self.moviedata_processor.add_task(task)
+        def run_task():
+            task = workerprocess.MovieDataProgramTask(path,
+                                                      self.screenshot_dir)
+            self.moviedata_processor.add_task(task)
+        self._run_unless_cached(self.moviedata_processor, path, run_task)
+
+    def _run_unless_cached(self, processor, path, run_task):
+        """Try to reuse a result from app.metadata_result_cache
+
+        If we have a result for a file with the same contents, we act as if
+        processor just finished with that result.  If not, we call run_task
+        and remember the fingerprint so that we can cache the result once
+        the processor finishes.
+
+        Reading the file for its fingerprint and copying the cached images
+        happen in the thread pool, so run_task may get called later.
+
+        :param processor: _TaskProcessor that would handle path
+        :param path: filesystem path to the file
+        :param run_task: function that starts processor for path
+        """
+        key = (processor.source_name, path)
+        cache = app.metadata_result_cache
+        if cache is None:
+            run_task()
+            return
+        try:
+            size = os.path.getsize(path)
+        except EnvironmentError:
+            run_task()
+            return
+        if not cache.has_size(size):
+            # Nothing can match, so don't read the file now.  We calculate
+            # the fingerprint in the thread pool once processor finishes.
+            self._pending_fingerprints[key] = None
+            run_task()
+            return
+        self._cache_lookups.add(key)
+
+        def lookup_failed(fingerprint):
+            self._cache_lookups.discard(key)
+            self._pending_fingerprints[key] = fingerprint
+            run_task()
+
+        def on_fingerprint(fingerprint):
+            if key not in self._cache_lookups:
+                # the file was removed while we were reading it
+                return
+            if fingerprint is None or app.metadata_result_cache is None:
+                lookup_failed(fingerprint)
+                return
+            result = app.metadata_result_cache.get(fingerprint,
+                                                   processor.source_name)
+            if result is None:
+                lookup_failed(fingerprint)
+                return
+            eventloop.call_in_thread(
+                lambda new_result: on_images(fingerprint, new_result),
+                errback, self._import_cached_images,
+                "import cached metadata images", path, result.copy())
+
+        def on_images(fingerprint, result):
+            if key not in self._cache_lookups:
+                if result is not None and 'screenshot' in result:
+                    fileutil.delete(result['screenshot'])
+                return
+            if result is None:
+                # the images for the result are gone, it's no good anymore
+                if app.metadata_result_cache is not None:
+                    app.metadata_result_cache.remove(fingerprint)
+                lookup_failed(fingerprint)
+                return
+            self._cache_lookups.discard(key)
+            logging.debug("%s: using cached result for %r",
+                          processor.source_name, path)
+            self._on_task_complete(processor, path, result)
+
+        def errback(error):
+            logging.warn("MetadataManager: error looking up cached result "
+                         "for %r (%s)", path, error)
+            if key in self._cache_lookups:
+                lookup_failed(None)
+
+        eventloop.call_in_thread(on_fingerprint, errback,
+                                 MetadataResultCache.calc_fingerprint,
+                                 "calculate metadata fingerprint", path)
+
+    def _import_cached_images(self, path, result):
+        """Copy the images for a cached result into our directories.
+
+        This runs in the thread pool.
+
+        Cover art is stored per-album, so we can share the file if it's
+        already in our cover art directory.  Screenshots get deleted along
+        with their item, so we always make a copy for path.
+
+        :param path: filesystem path of the file we are using result for
+        :param result: copy of the cached result dict
+        :returns: result with updated image paths, or None if an image file
+                  is missing
+        """
+        try:
+            if 'cover_art' in result:
+                src = result['cover_art']
+                dest = os.path.join(self.cover_art_dir,
+                                    os.path.basename(src))
+                if not fileutil.exists(src) and not fileutil.exists(dest):
+                    return None
+                if not fileutil.exists(dest):
+                    shutil.copyfile(src, dest)
+                    # let other items in the album know about the file
+                    result['created_cover_art'] = True
+                result['cover_art'] = dest
+            if 'screenshot' in result:
+                src = result['screenshot']
+                if not fileutil.exists(src):
+                    return None
+                dest, fp = util.next_free_filename(
+                    os.path.join(self.screenshot_dir,
+                                 os.path.basename(path) + '.png'))
+                try:
+                    src_fp = fileutil.open_file(src, 'rb')
+                    try:
+                        shutil.copyfileobj(src_fp, fp)
+                    finally:
+                        src_fp.close()
+                finally:
+                    fp.close()
+                result['screenshot'] = dest
+        except EnvironmentError, e:
+            logging.warn("MetadataManager: error copying cached images for "
+                         "%r (%s)", path, e)
+            return None
+        return result
 
     def _run_echonest(self, path, echonest_id=None):
         """Run echonest and other internet queries on a path."""
@@ -1675,11 +2031,43 @@ class MetadataManagerBase(signals.SignalEmitter):
                                          metadata_fetcher)
 
     def _on_task_complete(self, processor, path, result):
+        key = (processor.source_name, path)
+        if key in self._pending_fingerprints:
+            self._cache_result(processor, path,
+                               self._pending_fingerprints.pop(key), result)
         path = self._untranslate_path(path)
         self.metadata_finished.append((processor, path, result))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
+    def _cache_result(self, processor, path, fingerprint, result):
+        """Store a result in app.metadata_result_cache.
+
+        If fingerprint is None, we calculate it in the thread pool and store
+        the result once that's done.
+        """
+        if app.metadata_result_cache is None:
+            return
+        cached_result = result.copy()
+        # created_cover_art only makes sense for this run
+        cached_result.pop('created_cover_art', None)
+        def store_result(fingerprint):
+            if (fingerprint is not None and
+                    app.metadata_result_cache is not None):
+                app.metadata_result_cache.set(fingerprint,
+                                              processor.source_name,
+                                              cached_result)
+        if fingerprint is not None:
+            store_result(fingerprint)
+            return
+        def errback(error):
+            logging.warn("MetadataManager: error calculating fingerprint "
+                         "for %r (%s)", path, error)
+        eventloop.call_in_thread(store_result, errback,
+                                 MetadataResultCache.calc_fingerprint,
+                                 "calculate metadata fingerprint", path)
+
     def _on_task_error(self, processor, path, error):
+        self._pending_fingerprints.pop((processor.source_name, path), None)
         path = self._untranslate_path(path)
         self.metadata_errors.append((processor, path, error))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
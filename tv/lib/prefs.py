@@ -126,6 +126,12 @@ SHARE_WARN_ON_QUIT          = Pref(key='ShareWarnOnQuit',       default=True, pl
 SHARE_VIDEO                 = Pref(key='ShareVideo',            default=True, platformSpecific=False)
 SHARE_AUDIO                 = Pref(key='ShareAudio',            default=True, platformSpecific=False)
 SHARE_FEED                  = Pref(key='ShareFeed',             default=True, platformSpecific=False)
+SHARE_PRETRANSCODE          = Pref(key='SharePretranscode',     default=False, platformSpecific=False)
+SHARE_SERVER_POOL           = Pref(key='ShareServerPool',       default=False, platformSpecific=False)
+# keep database transactions open across events for up to this many seconds
+# or statements (see LiveStorage.set_group_commit()).  0 disables it.
+DB_GROUP_COMMIT_DELAY       = Pref(key='DBGroupCommitDelay',    default=1.0,   platformSpecific=False)
+DB_GROUP_COMMIT_STATEMENTS  = Pref(key='DBGroupCommitStatements', default=1000, platformSpecific=False)
 # the musicTabClicked key was used before miro 5.0.  It's been changed because
 # we want to pop up the dialog for users who ran 4.0.x and let them know about
 # internet lookups
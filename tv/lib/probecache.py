@@ -0,0 +1,199 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.probecache`` -- Cache the results of probing media files.
+
+Running ``ffmpeg -i`` on a file takes anywhere from half a second to a couple
+seconds.  conversions.get_media_info() and transcode.needs_transcode() both
+do it, so we store their results here, keyed by the path, size and mtime of
+the file.  The cache is saved to the support directory so that it survives
+restarts.
+
+ProbeCache is thread-safe, since it's used from the DAAP server threads and
+the conversion thread as well as the backend thread.
+"""
+
+import collections
+import cPickle
+import logging
+import os
+import threading
+
+from miro import fileutil
+
+class ProbeCache(object):
+    """Stores probe results for media files.
+
+    Each result is stored under a kind string (for example 'media-info') and
+    a path.  If the size or mtime of the file changes, the results for it
+    are thrown away.
+    """
+
+    # version of the pickle format, bump this if the format or the results
+    # we store change
+    FORMAT_VERSION = 1
+    DEFAULT_MAX_SIZE = 10000
+
+    def __init__(self, cache_path, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        # maps paths to (size, mtime, results) tuples, where results maps
+        # kinds to values.  Ordered from least to most recently used.
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        self._prefetch_queue = collections.deque()
+        self._prefetch_thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _file_key(self, path):
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def get(self, kind, path, probe_func):
+        """Get the probe result for a file.
+
+        If we don't have a current result, probe_func(path) is called to
+        calculate it.  Exceptions from probe_func are not cached, they are
+        passed on to the caller.
+        """
+        file_key = self._file_key(path)
+        if file_key is not None:
+            with self.lock:
+                entry = self._entries.pop(path, None)
+                if entry is not None and entry[:2] == file_key:
+                    self._entries[path] = entry
+                    if kind in entry[2]:
+                        return entry[2][kind]
+        # run the probe without holding our lock, it can take a while
+        result = probe_func(path)
+        if file_key is not None:
+            self.set(kind, path, file_key, result)
+        return result
+
+    def set(self, kind, path, file_key, result):
+        with self.lock:
+            entry = self._entries.pop(path, None)
+            if entry is None or entry[:2] != file_key:
+                entry = file_key + ({},)
+                while len(self._entries) >= self.max_size:
+                    self._entries.popitem(last=False)
+            entry[2][kind] = result
+            self._entries[path] = entry
+            self._dirty = True
+
+    def remove(self, path):
+        with self.lock:
+            if self._entries.pop(path, None) is not None:
+                self._dirty = True
+
+    def load(self):
+        """Load saved results from cache_path."""
+        try:
+            f = fileutil.open_file(self.cache_path, 'rb')
+            try:
+                version, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except EnvironmentError:
+            # no cache file yet
+            return
+        except (StandardError, EOFError, cPickle.UnpicklingError), e:
+            # UnpicklingError isn't a StandardError.  Throw out the bad file
+            # contents and start with an empty cache.
+            logging.warn("ProbeCache: error loading %s (%s)", self.cache_path,
+                         e)
+            return
+        if version != self.FORMAT_VERSION:
+            return
+        with self.lock:
+            self._entries = collections.OrderedDict(entries)
+            self._dirty = False
+
+    def save(self):
+        """Save our results to cache_path if they've changed."""
+        with self.lock:
+            if not self._dirty:
+                return
+            data = (self.FORMAT_VERSION, self._entries.items())
+            self._dirty = False
+        temp_path = self.cache_path + '.tmp'
+        try:
+            f = fileutil.open_file(temp_path, 'wb')
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.path.exists(self.cache_path):
+                # windows can't rename over an existing file
+                fileutil.remove(self.cache_path)
+            fileutil.rename(temp_path, self.cache_path)
+        except EnvironmentError, e:
+            logging.warn("ProbeCache: error saving %s (%s)", self.cache_path,
+                         e)
+
+    def prefetch(self, paths, probe_func):
+        """Probe a list of files in a background thread.
+
+        probe_func should be a function that uses this cache (for example
+        transcode.needs_transcode).  Errors are logged and ignored.  Once the
+        queue is empty, we save the cache.
+        """
+        with self.lock:
+            self._prefetch_queue.extend((path, probe_func) for path in paths)
+            if self._prefetch_thread is None and self._prefetch_queue:
+                self._prefetch_thread = threading.Thread(
+                    target=self._prefetch_thread_body,
+                    name='ProbeCache Prefetch Thread')
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+
+    def cancel_prefetch(self):
+        with self.lock:
+            self._prefetch_queue.clear()
+
+    def _prefetch_thread_body(self):
+        while True:
+            with self.lock:
+                if not self._prefetch_queue:
+                    self._prefetch_thread = None
+                    break
+                path, probe_func = self._prefetch_queue.popleft()
+            try:
+                probe_func(path)
+            except StandardError, e:
+                logging.debug("ProbeCache: error probing %s (%s)", path, e)
+        self.save()
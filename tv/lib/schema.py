@@ -493,6 +493,13 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            # These ones come from indexadvisor.  They let sqlite read the
+            # items for the feed tabs, the recently downloaded and the
+            # recently played lists in order without sorting them.
+            ('item_feed_release_date', ('feed_id', 'release_date')),
+            ('item_unwatched_downloaded', ('expired', 'parent_id',
+                                           'watched_time', 'downloaded_time')),
+            ('item_file_type_last_watched', ('file_type', 'last_watched')),
     )
 
 class DeviceItemSchema(ObjectSchema):
@@ -753,7 +760,8 @@ class RemoteDownloaderSchema(DDBObjectSchema):
     ]
 
     indexes = (
-        ('downloader_state', ('state',)),
+        # covering index for the downloading tab, which scans the downloaders
+        ('downloader_state_item', ('state', 'main_item_id')),
     )
 
     @staticmethod
@@ -998,7 +1006,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+VERSION = 202
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
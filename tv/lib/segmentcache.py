@@ -0,0 +1,329 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.segmentcache`` -- Cache transcoded mpegts segments on disk.
+
+When a DAAP client streams an item that needs transcoding, transcode.py
+splits the output of ffmpeg into numbered segments.  We keep those segments
+around so that when a client seeks back to a part it already played, or
+another client plays the same item, we can send the segments from disk
+instead of starting another ffmpeg job.
+
+Segments are stored under a key built from the media file and the transcode
+profile (see make_key()).  The total size of the cache is bounded, the least
+recently used segments are thrown out first.  Segments for keys that a
+transcode job is using can be pinned so that they don't get thrown out while
+it's sending them.
+
+The cache persists between runs.  When a SegmentCache is created, it
+rebuilds its index from the files in the cache directory.  Since the key
+changes when the media file does, old segments can never be sent for a
+changed file, they just age out of the cache.
+
+SegmentCache is thread-safe, since it's used from the DAAP server threads and
+the transcode threads.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from miro import fileutil
+
+class SegmentCache(object):
+    """Stores transcoded segments for media files."""
+
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+    COPY_BLOCK_SIZE = 64 * 1024
+
+    SEGMENT_RE = re.compile(r'^([0-9a-f]{32})-(\d+)\.ts$')
+    CHUNK_COUNT_RE = re.compile(r'^([0-9a-f]{32})\.count$')
+
+    def __init__(self, cache_dir, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        # maps (key, chunk) tuples to (path, size) tuples.  Ordered from
+        # least to most recently used.
+        self._segments = collections.OrderedDict()
+        # maps keys to the total number of chunks, once we know it
+        self._chunk_counts = {}
+        # maps keys to the number of pin_key() calls for them
+        self._pinned = collections.defaultdict(int)
+        self.total_size = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._segments)
+
+    @staticmethod
+    def make_key(media_file, profile):
+        """Make a key for a media file and transcode profile.
+
+        The key includes the size and mtime of the file, so if the file
+        changes we won't send out stale segments.
+
+        :param media_file: path to the source file
+        :param profile: string that describes the transcode parameters
+        :returns: key string, or None if media_file can't be stat'ed
+        """
+        try:
+            stat = os.stat(media_file)
+        except OSError:
+            return None
+        data = repr((media_file, stat.st_size, stat.st_mtime, profile))
+        return hashlib.md5(data).hexdigest()
+
+    def _segment_path(self, key, chunk):
+        return os.path.join(self.cache_dir, '%s-%d.ts' % (key, chunk))
+
+    def _chunk_count_path(self, key):
+        return os.path.join(self.cache_dir, '%s.count' % key)
+
+    def _load(self):
+        """Rebuild our index from the cache directory.
+
+        Anything that isn't a segment or a chunk count, like the temp files
+        from a copy that got interrupted, gets deleted.
+        """
+        with self.lock:
+            try:
+                fileutil.makedirs(self.cache_dir)
+            except OSError:
+                pass
+            try:
+                filenames = os.listdir(self.cache_dir)
+            except OSError, e:
+                logging.warn("SegmentCache: error reading %s (%s)",
+                             self.cache_dir, e)
+                return
+            segments = []
+            chunk_counts = {}
+            for filename in filenames:
+                path = os.path.join(self.cache_dir, filename)
+                match = self.SEGMENT_RE.match(filename)
+                if match:
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    segments.append((stat.st_mtime, match.group(1),
+                                     int(match.group(2)), path,
+                                     stat.st_size))
+                    continue
+                match = self.CHUNK_COUNT_RE.match(filename)
+                if match:
+                    try:
+                        f = open(path)
+                        try:
+                            chunk_counts[match.group(1)] = int(f.read())
+                        finally:
+                            f.close()
+                        continue
+                    except (IOError, ValueError):
+                        pass
+                self._delete_file(path)
+            # the least recently written segments come first
+            segments.sort()
+            keys = set()
+            for mtime, key, chunk, path, size in segments:
+                self._segments[(key, chunk)] = (path, size)
+                self.total_size += size
+                keys.add(key)
+            for key, count in chunk_counts.items():
+                if key in keys:
+                    self._chunk_counts[key] = count
+                else:
+                    self._delete_file(self._chunk_count_path(key))
+            self._evict()
+
+    def pin_key(self, key):
+        """Keep the segments for key from being evicted.
+
+        Each call must be matched by a call to unpin_key().  While a key is
+        pinned the cache may grow past max_size.
+        """
+        with self.lock:
+            self._pinned[key] += 1
+
+    def unpin_key(self, key):
+        with self.lock:
+            self._pinned[key] -= 1
+            if self._pinned[key] <= 0:
+                del self._pinned[key]
+            self._evict()
+
+    def has_segment(self, key, chunk):
+        with self.lock:
+            return (key, chunk) in self._segments
+
+    def get_segment(self, key, chunk):
+        """Open a cached segment.
+
+        :returns: file object opened for reading, or None if the segment
+            isn't cached
+        """
+        with self.lock:
+            try:
+                path, size = self._segments.pop((key, chunk))
+            except KeyError:
+                return None
+            self._segments[(key, chunk)] = (path, size)
+            try:
+                return open(path, 'rb')
+            except IOError, e:
+                logging.warn("SegmentCache: error opening %s (%s)", path, e)
+                self._remove_segment(key, chunk)
+                return None
+
+    def add_segment(self, key, chunk, fileobj):
+        """Copy a segment into the cache.
+
+        fileobj is read from its start.  Afterwards it is left positioned at
+        its start as well.
+
+        The data is copied into a temp file without holding our lock, so
+        that other threads can read segments while we're writing.
+        """
+        path = self._segment_path(key, chunk)
+        fileobj.seek(0, os.SEEK_SET)
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                             suffix='.part')
+            out = os.fdopen(fd, 'wb')
+            try:
+                shutil.copyfileobj(fileobj, out, self.COPY_BLOCK_SIZE)
+                size = out.tell()
+            finally:
+                out.close()
+            with self.lock:
+                # replacing a segment doesn't make the key incomplete, and
+                # the file gets replaced below
+                self._remove_segment(key, chunk, forget_count=False,
+                                     delete_file=False)
+                if os.name == 'nt' and fileutil.exists(path):
+                    # rename() won't replace files on windows
+                    fileutil.remove(path)
+                fileutil.rename(temp_path, path)
+                temp_path = None
+                self._segments[(key, chunk)] = (path, size)
+                self.total_size += size
+                self._evict()
+        except (IOError, OSError), e:
+            logging.warn("SegmentCache: error writing %s (%s)", path, e)
+            if temp_path is not None:
+                self._delete_file(temp_path)
+        fileobj.seek(0, os.SEEK_SET)
+
+    def find_missing(self, key, start_chunk):
+        """Find the first chunk at or after start_chunk that isn't cached."""
+        with self.lock:
+            chunk = start_chunk
+            while (key, chunk) in self._segments:
+                chunk += 1
+            return chunk
+
+    def set_chunk_count(self, key, count):
+        """Record the total number of chunks for key.
+
+        This lets find_missing() callers tell that everything past a cached
+        run has been transcoded.
+        """
+        with self.lock:
+            self._chunk_counts[key] = count
+            try:
+                f = open(self._chunk_count_path(key), 'w')
+                try:
+                    f.write(str(count))
+                finally:
+                    f.close()
+            except IOError, e:
+                logging.warn("SegmentCache: error writing chunk count for "
+                             "%s (%s)", key, e)
+
+    def get_chunk_count(self, key):
+        with self.lock:
+            return self._chunk_counts.get(key)
+
+    def is_complete(self, key):
+        """Check if every chunk for key is cached."""
+        with self.lock:
+            count = self._chunk_counts.get(key)
+            return count is not None and self.find_missing(key, 0) >= count
+
+    def _remove_segment(self, key, chunk, forget_count=True,
+                        delete_file=True):
+        try:
+            path, size = self._segments.pop((key, chunk))
+        except KeyError:
+            return
+        self.total_size -= size
+        if forget_count and self._chunk_counts.pop(key, None) is not None:
+            self._delete_file(self._chunk_count_path(key))
+        if delete_file:
+            self._delete_file(path)
+
+    def _delete_file(self, path):
+        # a DAAP thread may still be sending the file.  That's fine on unix,
+        # on windows the file gets left behind until the next _load().
+        try:
+            fileutil.remove(path)
+        except OSError, e:
+            logging.debug("SegmentCache: error deleting %s (%s)", path, e)
+
+    def _evict(self):
+        if self.total_size <= self.max_size:
+            return
+        for key, chunk in list(self._segments):
+            if self.total_size <= self.max_size:
+                break
+            if key not in self._pinned:
+                self._remove_segment(key, chunk)
+
+    def clear(self):
+        """Remove all segments, including ones left over on disk."""
+        with self.lock:
+            self._segments.clear()
+            self._chunk_counts.clear()
+            self.total_size = 0
+            try:
+                if fileutil.exists(self.cache_dir):
+                    fileutil.rmtree(self.cache_dir)
+                fileutil.makedirs(self.cache_dir)
+            except OSError, e:
+                logging.warn("SegmentCache: error resetting %s (%s)",
+                             self.cache_dir, e)
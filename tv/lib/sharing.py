@@ -26,6 +26,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import collections
 import errno
 import logging
 import os
@@ -113,8 +114,23 @@ def inet_ntop(af, ip):
         raise ValueError('unknown address family %d' % af)
 
 class Share(object):
-    """Backend object that tracks data for an active DAAP share."""
+    """Backend object that tracks data for an active DAAP share.
+
+    The items in our database are kept after we stop tracking the share, as
+    long as we know which DAAP revision they're from.  When we start
+    tracking again, we only need to ask the server for the changes since
+    then.
+
+    Attributes:
+        item_ids - set of DAAP ids for the SharingItems in our database
+        playlist_tracker - _ClientPlaylistTracker for the share's playlists
+    """
     _used_db_paths = set()
+    # dtv_variables name for the DAAP revision our database is synced to
+    REVISION_VARIABLE = 'daap_revision'
+    # dtv_variables name for the server's persistent database id at that
+    # revision
+    DATABASE_ID_VARIABLE = 'daap_database_id'
 
     def __init__(self, share_id, name, host, port):
         self.id = share_id
@@ -125,6 +141,8 @@ class Share(object):
         self.db_info = database.DBInfo(self.db)
         self.__class__._used_db_paths.add(self.db_path)
         self.tracker = None
+        self.item_ids = set()
+        self.playlist_tracker = _ClientPlaylistTracker()
         # SharingInfo object for this share.  We use this to send updates to
         # the frontend when things change.
         self.info = None
@@ -197,7 +215,8 @@ class Share(object):
         if self.tracker is not None:
             self.tracker.client_disconnect()
             self.tracker = None
-            self.reset_database()
+            if self.get_synced_revision() is None:
+                self.reset_database()
             if self.info:
                 self.info.is_updating = False
                 self.info.mount = False
@@ -205,8 +224,37 @@ class Share(object):
 
     def reset_database(self):
         SharingItem.delete(db_info=self.db_info)
+        mappings.SharingItemPlaylistMap(self.db.connection).clear()
+        self.db.unset_variable(self.REVISION_VARIABLE)
+        self.db.unset_variable(self.DATABASE_ID_VARIABLE)
         self.db.forget_all_objects()
         self.db.cache.clear_all()
+        self.item_ids.clear()
+        self.playlist_tracker.reset()
+
+    def get_synced_revision(self):
+        """Get the DAAP revision that our database is synced to.
+
+        :returns: revision number, or None if we don't know it
+        """
+        try:
+            return self.db.get_variable(self.REVISION_VARIABLE)
+        except KeyError:
+            return None
+
+    def get_synced_database_id(self):
+        """Get the persistent id of the server database we synced with.
+
+        :returns: database id, or None if we don't know it
+        """
+        try:
+            return self.db.get_variable(self.DATABASE_ID_VARIABLE)
+        except KeyError:
+            return None
+
+    def set_synced_revision(self, revision, database_id):
+        self.db.set_variable(self.REVISION_VARIABLE, revision)
+        self.db.set_variable(self.DATABASE_ID_VARIABLE, database_id)
 
     def set_info(self, info):
         """Set the SharingInfo to use to send updates for."""
@@ -555,9 +603,17 @@ class _ClientUpdateResult(object):
         playlist_deleted_items - dictionary tracking items deleted from
                                  playlists.  Maps playlist ids to a list of
                                  item ids.
+        revision - DAAP revision that the result brings us up to, or None if
+                   the server doesn't support updates
+        database_id - persistent id of the server database the revision
+                      belongs to
     """
-    def __init__(self, client, update=False):
+    # Number of items to collect before passing them to item_batch_callback
+    ITEM_BATCH_SIZE = 500
+
+    def __init__(self, client, update=False, item_batch_callback=None):
         self.update = update
+        self.item_batch_callback = item_batch_callback
         self.items = {}
         self.item_paths = {}
         self.deleted_items = []
@@ -565,6 +621,11 @@ class _ClientUpdateResult(object):
         self.deleted_playlists = []
         self.playlist_items = {}
         self.playlist_deleted_items = {}
+        if client.supports_update:
+            self.revision = client.revision
+        else:
+            self.revision = None
+        self.database_id = client.db_persistent_id
 
         self.fetch_from_client(client)
 
@@ -592,38 +653,63 @@ class _ClientUpdateResult(object):
             raise IOError('Cannot get database')
 
     def fetch_playlists(self, client):
-        self.playlists, self.deleted_playlists = client.playlists(
-            update=self.update)
-        if self.playlists is None:
-            raise IOError('Cannot get playlist')
-        # Clean the playlist: remove NUL characters.
-        self.strip_nuls_from_data(self.playlists.values())
-        # Only return playlist that are not the base playlist.  We don't
-        # explicitly show base playlist.
-        for daap_id, data in self.playlists.items():
-            if data.get('daap.baseplaylist', False):
-                del self.playlists[daap_id]
+        for kind, daap_id, data in client.iter_playlists(update=self.update):
+            if kind == 'deleted':
+                self.deleted_playlists.append(daap_id)
+                continue
+            # Clean the playlist: remove NUL characters.
+            self.strip_nuls_from_data([data])
+            # Only return playlist that are not the base playlist.  We don't
+            # explicitly show base playlist.
+            if not data.get('daap.baseplaylist', False):
+                self.playlists[daap_id] = data
 
     def fetch_items(self, client):
-        self.items, self.deleted_items = client.items(
-            meta=DAAP_META,
-            update=self.update)
-        if self.items is None:
-            raise ValueError('Cannot find items in base playlist')
-
-        self.strip_nuls_from_data(self.items.values())
-        for daap_id, item_data in self.items.items():
+        """Fetch the items in the base playlist.
+
+        Items are handled as they come in from the client.  If we have an
+        item_batch_callback, every ITEM_BATCH_SIZE items are passed to it as
+        a _ClientItemBatch rather than kept on this object.
+        """
+        for kind, daap_id, item_data in client.iter_items(meta=DAAP_META,
+                                                          update=self.update):
+            if kind == 'deleted':
+                self.deleted_items.append(daap_id)
+                continue
+            self.strip_nuls_from_data([item_data])
+            self.items[daap_id] = item_data
             self.item_paths[daap_id] = client.daap_get_file_request(
                 daap_id, item_data['daap.songformat'])
+            if (self.item_batch_callback is not None and
+                    len(self.items) >= self.ITEM_BATCH_SIZE):
+                self.item_batch_callback(
+                    _ClientItemBatch(self.items, self.item_paths))
+                self.items = {}
+                self.item_paths = {}
 
     def fetch_playlist_items(self, client, playlist_key):
-        items, deleted = client.items(playlist_id=playlist_key,
-                                      meta=DAAP_META, update=self.update)
-        if items is None:
-            raise ValueError('Cannot find items for playlist %d' % k)
-        self.playlist_items[playlist_key] = items.keys()
+        items = []
+        deleted = []
+        for kind, daap_id, item_data in client.iter_items(
+                playlist_id=playlist_key, meta=DAAP_META, update=self.update):
+            if kind == 'deleted':
+                deleted.append(daap_id)
+            else:
+                items.append(daap_id)
+        self.playlist_items[playlist_key] = items
         self.playlist_deleted_items[playlist_key] = deleted
 
+class _ClientItemBatch(object):
+    """Batch of items from the client, see _ClientUpdateResult.fetch_items()
+
+    This has the attributes that SharingItemTrackerImpl.update_sharing_items()
+    needs from a _ClientUpdateResult.
+    """
+    def __init__(self, items, item_paths):
+        self.items = items
+        self.item_paths = item_paths
+        self.deleted_items = []
+
 class _ClientPlaylistTracker(object):
     """Tracks playlist data from the DAAP client for SharingItemTrackerImpl
 
@@ -632,6 +718,9 @@ class _ClientPlaylistTracker(object):
         playlist_items - maps DAAP playlist ids to sets of DAAP item ids
     """
     def __init__(self):
+        self.reset()
+
+    def reset(self):
         self.playlist_data = {}
         self.playlist_items = {}
 
@@ -639,18 +728,38 @@ class _ClientPlaylistTracker(object):
         """Update data
         
         :param result: _ClientUpdateResult
+        :returns: (removed_playlists, item_changes) tuple.  removed_playlists
+            is a set of ids for playlists that were removed.  item_changes
+            maps playlist ids to (added_ids, removed_ids) tuples for the
+            playlists whose items changed.
         """
+        removed_playlists = set()
+        item_changes = {}
         for playlist_id, playlist_data in result.playlists.items():
             if playlist_id not in self.playlist_data:
                 self.playlist_items[playlist_id] = set()
             self.playlist_data[playlist_id] = playlist_data
         for playlist_id in result.deleted_playlists:
-            del self.playlist_data[playlist_id]
-            del self.playlist_items[playlist_id]
+            if playlist_id in self.playlist_data:
+                del self.playlist_data[playlist_id]
+                del self.playlist_items[playlist_id]
+                removed_playlists.add(playlist_id)
         for playlist_id, item_ids in result.playlist_items.items():
-            self.playlist_items[playlist_id].update(item_ids)
+            current = self.playlist_items[playlist_id]
+            added = set(item_ids) - current
+            if added:
+                current.update(added)
+                item_changes[playlist_id] = (added, set())
         for playlist_id, item_ids in result.playlist_deleted_items.items():
-            self.playlist_items[playlist_id].difference_update(item_ids)
+            current = self.playlist_items.get(playlist_id)
+            if current is None:
+                continue
+            removed = current.intersection(item_ids)
+            if removed:
+                current.difference_update(removed)
+                added = item_changes.get(playlist_id, (set(), None))[0]
+                item_changes[playlist_id] = (added - removed, removed)
+        return removed_playlists, item_changes
 
     def current_playlists(self):
         """Get a the playlists that should be visible.  """
@@ -736,9 +845,13 @@ class SharingItemTrackerImpl(object):
         self.share = share
         self.playlist_item_map = mappings.SharingItemPlaylistMap(
             share.db_info.db.connection)
-        self.current_item_ids = set()
+        # the share keeps these between connections, see
+        # Share.get_synced_revision()
+        self.current_item_ids = share.item_ids
+        self.playlist_tracker = share.playlist_tracker
+        self.synced_revision = share.get_synced_revision()
+        self.synced_database_id = share.get_synced_database_id()
         self.current_playlist_ids = set()
-        self.playlist_tracker = _ClientPlaylistTracker()
         self.info_cache = dict()
         self.share.update_started()
         self.start_thread()
@@ -873,9 +986,59 @@ class SharingItemTrackerImpl(object):
 
     def client_connect(self):
         self.make_client()
-        result = _ClientUpdateResult(self.client)
+        # fetch the database listing first, so we know which server database
+        # we're talking to.
+        if not self.client.databases():
+            raise IOError('Cannot get database')
+        if self.can_resume():
+            # We still have the items from the last time we were connected.
+            # Just ask for what changed since then.
+            self.client.old_revision = self.synced_revision
+            if not self.client.databases(update=True):
+                raise IOError('Cannot get database')
+            result = _ClientUpdateResult(self.client, update=True)
+            result.resumed = True
+        else:
+            if self.synced_revision is None:
+                batch_callback = self.client_item_batch
+            else:
+                # We need to throw away the old items before adding the
+                # new ones, so we can't add items until the whole result is
+                # in.
+                batch_callback = None
+            result = _ClientUpdateResult(
+                self.client, item_batch_callback=batch_callback)
+            result.resumed = False
         return result
 
+    def can_resume(self):
+        """Can we sync our database with a delta from synced_revision?
+
+        Revisions only mean something to the server database that gave them
+        out.  If the database's persistent id changed, the server was
+        restarted (or replaced) and we need a full resync, even if its
+        revision happens to be higher than ours.
+        """
+        return (self.synced_revision is not None and
+                self.client.supports_update and
+                self.synced_database_id is not None and
+                self.synced_database_id == self.client.db_persistent_id and
+                self.synced_revision <= self.client.revision)
+
+    # NB: this runs in the client thread.
+    def client_item_batch(self, batch):
+        # add_idle() runs callbacks in order, so the batches get added
+        # before the rest of the result is handled.
+        eventloop.add_idle(self.client_item_batch_callback,
+                           'item batch (%s)' % self.thread.name,
+                           args=(batch,))
+
+    def client_item_batch_callback(self, batch):
+        if self.share.is_closed():
+            logging.warn("client_item_batch_callback: database is closed")
+            return
+        self.update_sharing_items(batch)
+
     def make_client(self):
         name = self.share.name
         host = self.share.host
@@ -904,8 +1067,7 @@ class SharingItemTrackerImpl(object):
         if self.share.is_closed():
             logging.warn("client_update_callback: database is closed")
             return
-        self.update_sharing_items(result)
-        self.update_playlists(result)
+        self.apply_result(result)
 
     def client_update_error_callback(self, unused):
         if self.share.is_closed():
@@ -920,18 +1082,50 @@ class SharingItemTrackerImpl(object):
         if self.share.is_closed():
             logging.warn("client_connect_callback: database is closed")
             return
-        result.deleted_items = []
-        result.deleted_playlists = []
-        result.playlist_deleted_items = {}
-        self.update_sharing_items(result)
-        self.update_playlists(result)
+        if not result.resumed:
+            if self.synced_revision is not None:
+                # our old items are from a revision the server doesn't know
+                # about anymore.
+                self.share.reset_database()
+            # ignore deleted items for the first run
+            result.deleted_items = []
+            result.deleted_playlists = []
+            result.playlist_deleted_items = {}
+        self.apply_result(result)
         self.share.update_finished()
 
+    def apply_result(self, result):
+        """Apply a _ClientUpdateResult to our database.
+
+        All the changes go in one transaction, then we remember the revision
+        they bring us to.
+        """
+        bulk_sql_manager = self.share.db_info.bulk_sql_manager
+        bulk_sql_manager.start()
+        try:
+            self._update_sharing_items(result)
+            self.update_playlists(result)
+        finally:
+            bulk_sql_manager.finish()
+        if result.revision is not None:
+            self.share.set_synced_revision(result.revision,
+                                           result.database_id)
+            self.synced_revision = result.revision
+            self.synced_database_id = result.database_id
+
     def update_sharing_items(self, result):
         """Create or update SharingItems on the database.
 
-        :param new_item_data: _ClientUpdateResult
+        :param new_item_data: _ClientUpdateResult or _ClientItemBatch
         """
+        bulk_sql_manager = self.share.db_info.bulk_sql_manager
+        bulk_sql_manager.start()
+        try:
+            self._update_sharing_items(result)
+        finally:
+            bulk_sql_manager.finish()
+
+    def _update_sharing_items(self, result):
         for daap_id, item_data in result.items.items():
             if daap_id not in self.current_item_ids:
                 self.make_sharing_item(item_data, result)
@@ -941,7 +1135,9 @@ class SharingItemTrackerImpl(object):
                 new_data = self.convert_raw_sharing_item(item_data, result)
                 for key, value in new_data.items():
                     setattr(sharing_item, key, value)
-                sharing_item.signal_change()
+                # only send out changes for the columns that actually changed
+                if sharing_item.changed_attributes:
+                    sharing_item.signal_change()
         for item_id in result.deleted_items:
             try:
                 sharing_item = SharingItem.get_by_daap_id(
@@ -949,7 +1145,9 @@ class SharingItemTrackerImpl(object):
             except database.ObjectNotFoundError:
                 logging.warn("SharingItemTrackerImpl.update_sharing_items: "
                              "deleted item not found: %s", item_id)
+                continue
             sharing_item.remove()
+            self.current_item_ids.discard(item_id)
 
     def update_playlists(self, result):
         added = []
@@ -958,23 +1156,15 @@ class SharingItemTrackerImpl(object):
         changed = []
         removed = []
 
-        old_playlist_items = {}
-        for daap_id, item_ids in self.playlist_tracker.playlist_items.items():
-            old_playlist_items[daap_id] = item_ids.copy()
-
-        self.playlist_tracker.update(result)
-        # update the playlist item map
-        playlist_items_changed = False
-        new_playlist_items = self.playlist_tracker.playlist_items
-        for playlist_id in old_playlist_items:
-            if playlist_id not in new_playlist_items:
-                self.playlist_item_map.remove_playlist(playlist_id)
-                playlist_items_changed = True
-        for playlist_id, item_ids in new_playlist_items.items():
-            if item_ids != old_playlist_items.get(playlist_id):
-                self.playlist_item_map.set_playlist_items(playlist_id,
-                                                          item_ids)
-                playlist_items_changed = True
+        removed_playlists, item_changes = self.playlist_tracker.update(result)
+        # update the playlist item map with just the changes
+        for playlist_id in removed_playlists:
+            self.playlist_item_map.remove_playlist(playlist_id)
+        for playlist_id, (added_ids, removed_ids) in item_changes.items():
+            self.playlist_item_map.remove_playlist_items(playlist_id,
+                                                         removed_ids)
+            self.playlist_item_map.add_playlist_items(playlist_id, added_ids)
+        playlist_items_changed = bool(removed_playlists or item_changes)
 
         current_playlists = self.playlist_tracker.current_playlists()
         # check for added/changed playlists
@@ -1061,6 +1251,9 @@ class _SharedDataSet(object):
         # condition gets signaled when changes occur.
         self.lock = threading.RLock()
         self.condition = threading.Condition(self.lock)
+        # called (with our lock held) when changes occur, see
+        # set_revision_callback()
+        self.revision_callback = None
         # current revision number
         self.revision = 1
         # map DAAP ids to dicts of item data
@@ -1110,8 +1303,10 @@ class _SharedDataSet(object):
                 'item-changes', self.on_item_changes)
 
     def stop_tracking(self):
+        if app.probe_cache is not None:
+            app.probe_cache.cancel_prefetch()
         if self.config_handle is not None:
-            backend_config_watcher.disconnect(self.config_handle)
+            app.backend_config_watcher.disconnect(self.config_handle)
             self.config_handle = None
         if self.item_tracker is not None:
             self.item_tracker.destroy()
@@ -1126,7 +1321,7 @@ class _SharedDataSet(object):
             eventloop.disconnect(self.after_event_finished_handle)
             self.after_event_finished_handle = None
         if self.item_changes_handle:
-            models.Item.changes.disconnect(self.item_changes_handle)
+            models.Item.change_tracker.disconnect(self.item_changes_handle)
             self.item_changes_handle = None
 
     def calc_share_types(self):
@@ -1141,9 +1336,24 @@ class _SharedDataSet(object):
     def start_tracking_items(self):
         query = self._make_item_tracker_query()
         self.item_tracker = itemtrack.BackendItemTracker(query)
-        for item_info in self.item_tracker.get_items():
+        item_infos = self.item_tracker.get_items()
+        for item_info in item_infos:
             self.make_daap_item(item_info)
         self.item_tracker.connect('items-changed', self.on_items_changed)
+        self._prefetch_transcode_info(item_infos)
+
+    def _prefetch_transcode_info(self, item_infos):
+        """Probe video items in the background.
+
+        This way the first request to stream an item doesn't have to wait for
+        transcode.needs_transcode() to run ffmpeg.
+        """
+        if app.probe_cache is None:
+            return
+        paths = [info.filename for info in item_infos
+                 if info.file_type == u'video' and info.filename]
+        if paths:
+            app.probe_cache.prefetch(paths, transcode.needs_transcode)
 
     def start_tracking_playlists(self):
         view = models.SavedPlaylist.make_view()
@@ -1179,7 +1389,8 @@ class _SharedDataSet(object):
                 self.make_daap_item(item_info)
             for item_id in removed:
                 self.daap_items[item_id] = self._deleted_item(item_id)
-            self.condition.notify_all()
+            self.notify_changed()
+        self._prefetch_transcode_info(added)
 
     def on_playlist_added(self, tracker, playlist_or_feed):
         self.playlists_changed.add(playlist_or_feed)
@@ -1201,18 +1412,26 @@ class _SharedDataSet(object):
                 self.daap_playlists[obj.id] = self._deleted_item(obj.id)
             self.playlists_changed = set()
             self.playlists_removed = set()
-            self.condition.notify_all()
+            self.notify_changed()
 
     def on_item_changes(self, tracker, message):
-        if 'feed_id' in message.changed_columns:
-            # items have changed feeds, regenerate the item lists
-            for feed in models.Feed.visible_view():
-                self.make_daap_playlist(feed)
-        if message.playlists_changed:
-            # items have been added/removed from playlists,
-            # regenerate the item lists
-            for playlist in models.SavedPlaylist.make_view():
-                self.make_daap_playlist(playlist)
+        feeds_changed = 'feed_id' in message.changed_columns
+        if not (feeds_changed or message.playlists_changed):
+            return
+        with self.lock:
+            # bump the revision so that clients (and the DAAP server's
+            # response cache) see the new item lists
+            self.revision += 1
+            if feeds_changed:
+                # items have changed feeds, regenerate the item lists
+                for feed in models.Feed.visible_view():
+                    self.make_daap_playlist(feed)
+            if message.playlists_changed:
+                # items have been added/removed from playlists,
+                # regenerate the item lists
+                for playlist in models.SavedPlaylist.make_view():
+                    self.make_daap_playlist(playlist)
+            self.notify_changed()
 
     def _make_item_tracker_query(self):
         query = itemtrack.ItemTrackerQuery()
@@ -1406,7 +1625,7 @@ class _SharedDataSet(object):
                 if changed.intersection([self.SHARE_AUDIO, self.SHARE_VIDEO]):
                     query = self._make_item_tracker_query()
                     self.item_tracker.change_query(query)
-                self.condition.notify_all()
+                self.notify_changed()
 
     def get_item(self, item_id):
         with self.lock:
@@ -1429,6 +1648,34 @@ class _SharedDataSet(object):
         with self.lock:
             return self.daap_playlists.copy()
 
+    def get_current_revision(self):
+        with self.lock:
+            return self.revision
+
+    def get_memory_counts(self):
+        """Get the number of entries in our dicts."""
+        with self.lock:
+            return {
+                'daap_items': len(self.daap_items),
+                'daap_playlists': len(self.daap_playlists),
+                'playlist_items': sum(len(ids) for ids in
+                                      self.playlist_item_map.itervalues()),
+                'deleted_items': sum(len(ids) for ids in
+                                     self.deleted_item_map.itervalues()),
+                'playlists_changed': len(self.playlists_changed),
+                'playlists_removed': len(self.playlists_removed),
+            }
+
+    def set_revision_callback(self, callback):
+        with self.lock:
+            self.revision_callback = callback
+
+    def notify_changed(self):
+        # Called with our lock held
+        self.condition.notify_all()
+        if self.revision_callback is not None:
+            self.revision_callback()
+
     def get_revision(self, old_revision, request_socket):
         with self.lock:
             while self.revision == old_revision:
@@ -1457,10 +1704,22 @@ class SharingManagerBackend(object):
     type = u'sharing-backend'
     id = u'sharing-backend'
 
+    # Once an item has been requested for transcoding this many times, we
+    # transcode the rest of it in the background (if SHARE_PRETRANSCODE is
+    # set) so later plays and seeks come from the segment cache.
+    PRETRANSCODE_MIN_REQUESTS = 2
+    # How many items we count transcode requests for.  Items that haven't
+    # been requested for a while get forgotten first.
+    MAX_TRANSCODE_REQUEST_ITEMS = 1000
+
     def __init__(self):
         self.data_set = _SharedDataSet()
         self.transcode_lock = threading.Lock()
         self.transcode = dict()
+        # maps item ids to transcode request counts.  Ordered from least to
+        # most recently requested.
+        self.transcode_requests = collections.OrderedDict()
+        self.pretranscoder = transcode.Pretranscoder()
         self.in_shutdown = False
 
     # Reserved for future use: you can register new sharing protocols here.
@@ -1473,6 +1732,15 @@ class SharingManagerBackend(object):
     def stop_tracking(self):
         self.data_set.stop_tracking()
 
+    def get_memory_counts(self):
+        """Get the number of entries in our dicts and our data set's."""
+        counts = self.data_set.get_memory_counts()
+        # Don't wait for transcode_lock, it's held while ffmpeg probes files.
+        # Reading the dict sizes is safe without it.
+        counts['transcode'] = len(self.transcode)
+        counts['transcode_requests'] = len(self.transcode_requests)
+        return counts
+
     def get_revision(self, session, old_revision, request):
         """Block until the there is a new revision.
 
@@ -1488,6 +1756,25 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_revision(old_revision, request)
 
+    def get_current_revision(self):
+        """Get the current revision without blocking.
+
+        pydaap uses this to tell when its cached item and playlist listings
+        are out of date, so the revision must change whenever the data
+        returned by get_items() or get_playlists() does.
+        """
+        return self.data_set.get_current_revision()
+
+    def set_revision_callback(self, callback):
+        """Set a function to call when the revision changes.
+
+        The pooled pydaap server uses this to answer waiting /update requests
+        instead of parking a thread in get_revision() for each one.  callback
+        gets called from whatever thread changed the revision, so it should
+        be quick.
+        """
+        self.data_set.set_revision_callback(callback)
+
     def get_file(self, itemid, generation, ext, session, request_path_func,
                  offset=0, chunk=None):
         """Get a file to serve
@@ -1529,6 +1816,7 @@ class SharingManagerBackend(object):
                 except KeyError:
                     need_create = True
                 if need_create:
+                    self._count_transcode_request(itemid, path)
                     yes, info = transcode.needs_transcode(path)
                     transcode_obj = transcode.TranscodeObject(
                                                           path,
@@ -1579,6 +1867,16 @@ class SharingManagerBackend(object):
                     file_obj.close()
         return file_obj, os.path.basename(path)
 
+    def _count_transcode_request(self, itemid, path):
+        # Called with transcode_lock held
+        count = self.transcode_requests.pop(itemid, 0) + 1
+        self.transcode_requests[itemid] = count
+        while len(self.transcode_requests) > self.MAX_TRANSCODE_REQUEST_ITEMS:
+            self.transcode_requests.popitem(last=False)
+        if ((count == self.PRETRANSCODE_MIN_REQUESTS and
+             app.config.get(prefs.SHARE_PRETRANSCODE))):
+            self.pretranscoder.add(path)
+
     def get_playlists(self):
         """Get the current list of playlists
 
@@ -1630,6 +1928,7 @@ class SharingManagerBackend(object):
             self.in_shutdown = True
             for key in self.transcode.keys():
                 self.transcode[key].shutdown()
+        self.pretranscoder.shutdown()
 
 class SharingManager(object):
     """SharingManager is the sharing server.  It publishes Miro media items
@@ -1863,6 +2162,7 @@ class SharingManager(object):
                         cmd = self.r.recv(4)
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
+                            self.server.server_close()
                             del self.thread
                             del self.server
                             self.reload_done_event.set()
@@ -1908,8 +2208,9 @@ class SharingManager(object):
             return
 
         name = app.config.get(prefs.SHARE_NAME).encode('utf-8')
-        self.server = libdaap.make_daap_server(self.backend, debug=True,
-                                               name=name)
+        self.server = libdaap.make_daap_server(
+            self.backend, debug=True, name=name,
+            pool=app.config.get(prefs.SHARE_SERVER_POOL))
         if not self.server:
             self.sharing = False
             return
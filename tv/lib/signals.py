@@ -67,6 +67,8 @@ class WeakMethodReference:
         return func.__get__(obj, self.cls)
 
 class Callback:
+    is_weak = False
+
     def __init__(self, func, extra_args):
         self.func = func
         self.extra_args = extra_args
@@ -81,6 +83,8 @@ class Callback:
         return False
 
 class WeakCallback:
+    is_weak = True
+
     def __init__(self, method, extra_args):
         self.ref = WeakMethodReference(method)
         self.extra_args = extra_args
@@ -104,26 +108,33 @@ class CallbackSet(object):
         self.callbacks = {}
         self.callbacks_after = {}
         self.callbacks_before = {}
+        # number of WeakCallbacks we store.  Most signals don't have any, so
+        # clear_old_weak_references() can usually return right away.
+        self.weak_count = 0
+
+    def _add(self, callback_dict, id_, callback):
+        callback_dict[id_] = callback
+        if callback.is_weak:
+            self.weak_count += 1
 
     def add_callback(self, id_, callback):
-        self.callbacks[id_] = callback
+        self._add(self.callbacks, id_, callback)
 
     def add_callback_after(self, id_, callback):
-        self.callbacks_after[id_] = callback
+        self._add(self.callbacks_after, id_, callback)
 
     def add_callback_before(self, id_, callback):
-        self.callbacks_before[id_] = callback
+        self._add(self.callbacks_before, id_, callback)
 
     def remove_callback(self, id_):
-        if id_ in self.callbacks:
-            del self.callbacks[id_]
-        elif id_ in self.callbacks_after:
-            del self.callbacks_after[id_]
-        elif id_ in self.callbacks_before:
-            del self.callbacks_before[id_]
-        else:
-            logging.warning(
-                "disconnect called but callback_handle not in the callback")
+        for callback_dict in (self.callbacks, self.callbacks_after,
+                              self.callbacks_before):
+            if id_ in callback_dict:
+                if callback_dict.pop(id_).is_weak:
+                    self.weak_count -= 1
+                return
+        logging.warning(
+            "disconnect called but callback_handle not in the callback")
 
     def all_callbacks(self):
         """Get a list of all Callback objects stored.
@@ -137,6 +148,8 @@ class CallbackSet(object):
 
     def clear_old_weak_references(self):
         """Remove any dead WeakCallbacks."""
+        if not self.weak_count:
+            return
         all_dicts = (self.callbacks,
                      self.callbacks_after,
                      self.callbacks_before)
@@ -144,11 +157,16 @@ class CallbackSet(object):
             for id_, callback in callback_dict.items():
                 if callback.is_dead():
                     del callback_dict[id_]
+                    self.weak_count -= 1
 
     def __len__(self):
         return (len(self.callbacks) + len(self.callbacks_after) +
                 len(self.callbacks_before))
 
+# CallbackSet shared by LazySignalEmitters that haven't had any callbacks
+# connected.  It should never get modified.
+_EMPTY_CALLBACK_SET = CallbackSet()
+
 class SignalEmitter(object):
     def __init__(self, *signal_names):
         self.signal_callbacks = {}
@@ -260,7 +278,7 @@ class SignalEmitter(object):
             callback_returned_true = self._run_signal(name, args)
         finally:
             self._currently_emitting.discard(name)
-            self.clear_old_weak_references()
+            self.get_callbacks(name).clear_old_weak_references()
         return callback_returned_true
 
     def _run_signal(self, name, args):
@@ -283,6 +301,76 @@ class SignalEmitter(object):
         for callback_set in self.signal_callbacks.values():
             callback_set.clear_old_weak_references()
 
+class LazySignalEmitter(SignalEmitter):
+    """SignalEmitter that allocates its signal tables on first use.
+
+    This is meant for classes that have lots of instances, but rarely get
+    callbacks connected, like DDBObject.  Subclasses list their signals in
+    the signal_names class attribute instead of passing them to __init__().
+    Until something gets connected (or create_signal() is called), all
+    instances share an empty class-level state and emit() only has to look
+    for a do_* method.
+    """
+
+    signal_names = ()
+    # class-level state shared by instances that haven't been materialized
+    signal_callbacks = None
+    _frozen = False
+
+    def __init__(self):
+        pass
+
+    def _materialize_signals(self):
+        if self.signal_callbacks is None:
+            SignalEmitter.__init__(self, *self.signal_names)
+
+    def create_signal(self, name, okay_to_nest=False):
+        self._materialize_signals()
+        SignalEmitter.create_signal(self, name, okay_to_nest)
+
+    def get_callbacks(self, signal_name):
+        if self.signal_callbacks is None:
+            if signal_name not in self.signal_names:
+                raise KeyError("Signal: %s doesn't exist" % signal_name)
+            return _EMPTY_CALLBACK_SET
+        return SignalEmitter.get_callbacks(self, signal_name)
+
+    def connect(self, name, func, *extra_args):
+        self._materialize_signals()
+        return SignalEmitter.connect(self, name, func, *extra_args)
+
+    def connect_after(self, name, func, *extra_args):
+        self._materialize_signals()
+        return SignalEmitter.connect_after(self, name, func, *extra_args)
+
+    def connect_before(self, name, func, *extra_args):
+        self._materialize_signals()
+        return SignalEmitter.connect_before(self, name, func, *extra_args)
+
+    def connect_weak(self, name, method, *extra_args):
+        self._materialize_signals()
+        return SignalEmitter.connect_weak(self, name, method, *extra_args)
+
+    def disconnect_all(self):
+        if self.signal_callbacks is not None:
+            SignalEmitter.disconnect_all(self)
+
+    def emit(self, name, *args):
+        if self.signal_callbacks is None:
+            if self._frozen:
+                return
+            if name not in self.signal_names:
+                raise KeyError("Signal: %s doesn't exist" % name)
+            if not hasattr(self, 'do_' + name.replace('-', '_')):
+                return False
+            # need the full machinery to catch nested emits
+            self._materialize_signals()
+        return SignalEmitter.emit(self, name, *args)
+
+    def clear_old_weak_references(self):
+        if self.signal_callbacks is not None:
+            SignalEmitter.clear_old_weak_references(self)
+
 class SystemSignals(SignalEmitter):
     """System wide signals for Miro.  These can be accessed from the singleton
     object signals.system.  Signals include:
@@ -42,7 +42,6 @@ import os
 import config
 import sys
 import traceback
-import threading
 import time
 
 from miro import api
@@ -54,6 +53,7 @@ from miro import controller
 from miro import extensionmanager
 from miro import database
 from miro import databaselog
+from miro import dbmaintenance
 from miro import databaseupgrade
 from miro import dbupgradeprogress
 from miro import dialogs
@@ -70,10 +70,13 @@ from miro import itemsource
 from miro import feed
 from miro import folder
 from miro import messages
+from miro import memoryreport
 from miro import messagehandler
 from miro import models
 from miro import playlist
 from miro import prefs
+from miro import probecache
+from miro import segmentcache
 import miro.plat.resources
 from miro.plat.utils import setup_logging, filename_to_unicode
 from miro import tabs
@@ -88,9 +91,6 @@ from miro import sharing
 from miro import workerprocess
 from miro.plat import devicetracker
 
-DEBUG_DB_MEM_USAGE = False
-mem_usage_test_event = threading.Event()
-
 class StartupError(StandardError):
     def __init__(self, summary, description):
         self.summary = summary
@@ -225,8 +225,6 @@ def startup():
     httpclient.start_thread()
     logging.info("Starting event loop thread")
     eventloop.startup()
-    if DEBUG_DB_MEM_USAGE:
-        mem_usage_test_event.wait()
     load_extensions()
 
 @startup_function
@@ -266,6 +264,10 @@ def startup_for_frontend(obj, thread):
         return
     except storedatabase.UpgradeError:
         raise StartupError(None, None)
+    app.db.set_group_commit(app.config.get(prefs.DB_GROUP_COMMIT_DELAY),
+                            app.config.get(prefs.DB_GROUP_COMMIT_STATEMENTS))
+    app.db.set_write_behind(True)
+    app.db_maintenance = dbmaintenance.DatabaseMaintenance(app.db)
     database.initialize()
     downloader.reset_download_stats()
     end = time.time()
@@ -275,9 +277,9 @@ def startup_for_frontend(obj, thread):
                 app.db.startup_version, app.db.current_version)
     databaselog.print_old_log_entries()
     models.initialize()
-    if DEBUG_DB_MEM_USAGE:
-        util.db_mem_usage_test()
-        mem_usage_test_event.set()
+    app.memory_reporter = memoryreport.MemoryReporter(
+        os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                     'memory-report.json'))
 
     dbupgradeprogress.upgrade_end()
 
@@ -293,6 +295,12 @@ def startup_for_frontend(obj, thread):
     setup_theme()
     install_message_handler()
 
+    app.probe_cache = probecache.ProbeCache(
+        os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY), 'probe-cache'))
+    app.probe_cache.load()
+    app.segment_cache = segmentcache.SegmentCache(
+        os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                     'transcode-cache'))
     app.sharing_manager = sharing.SharingManager()
     app.download_state_manager = downloader.DownloadStateManager()
     item.setup_change_tracker()
@@ -515,6 +523,10 @@ def on_frontend_started():
     eventloop.add_timeout(60, item.update_incomplete_metadata,
             "update metadata data")
     eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans")
+    eventloop.add_timeout(120, app.db_maintenance.start,
+            "start database maintenance")
+    eventloop.add_timeout(150, app.memory_reporter.start,
+            "start memory reports")
 
 def setup_global_feeds():
     setup_global_feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
@@ -677,7 +689,8 @@ def reconnect_downloaders():
         downloader_.remove()
     manualItems = item.Item.feed_view(feed.Feed.get_manual_feed().get_id())
     for item_ in manualItems:
-        if (item_.__class__ == item.Item and not item_.has_downloader() and
+        if (not isinstance(item_, item.FileItem) and
+          not item_.has_downloader() and
           not item_.pending_manual_download):
             logging.warn("removing cancelled external torrent: %s", item_)
             item_.remove()
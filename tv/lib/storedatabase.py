@@ -46,7 +46,9 @@ The hope is that it will be human readable.  We use the type
 ``pythonrepr`` to label these columns.
 """
 
+import collections
 import glob
+import hashlib
 import shutil
 import cPickle
 import itertools
@@ -54,6 +56,7 @@ import logging
 import datetime
 import traceback
 import time
+import types
 import os
 import sys
 from cStringIO import StringIO
@@ -76,7 +79,10 @@ from miro import schema
 from miro import signals
 from miro import prefs
 from miro import util
+from miro.data import changecounter
 from miro.data import fulltextsearch
+from miro.data import idset
+from miro.data import querystats
 from miro.data import item
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType, filename_to_unicode
@@ -110,6 +116,25 @@ _sqlite_type_map = {
 
 VERSION_KEY = "Democracy Version"
 
+# value of PRAGMA auto_vacuum for incremental vacuuming
+AUTO_VACUUM_INCREMENTAL = 2
+
+def should_copy_table(table_name):
+    """Check if a table needs to be copied when we copy a database.
+
+    Tables that sqlite creates automatically (including the fts shadow
+    tables) get recreated along with the tables we copy.
+    """
+    if (table_name.endswith("fts_content") or
+        table_name.endswith("fts_segments") or
+        table_name.endswith("fts_stat") or
+        table_name.endswith("fts_docsize") or
+        table_name.endswith("fts_segdir") or
+        table_name.startswith("sqlite_")):
+        # these tables are auto-generated by sqlite
+        return False
+    return True
+
 class DatabaseObjectCache(object):
     """Handles caching objects for a database.
 
@@ -174,6 +199,16 @@ class DatabaseObjectCache(object):
         """Clear all objects in the cache"""
         self._objects = {}
 
+    def category_counts(self):
+        """Get the number of objects in each category.
+
+        :returns: dict mapping categories to object counts
+        """
+        counts = collections.defaultdict(int)
+        for category, cache_key in self._objects:
+            counts[category] += 1
+        return dict(counts)
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -380,12 +415,44 @@ class LiveStorage(signals.SignalEmitter):
     Attributes:
 
     - cache -- DatabaseObjectCache object
+    - query_stats -- QueryStats for the statements we run (see
+      miro.data.querystats)
 
     Signals:
 
     - transaction-finished(success) -- We committed or rolled back a
     transaction
+
+    Group commit:
+
+    Normally we commit at the end of each eventloop event that changed the
+    database.  Once set_group_commit() is called, we keep the transaction
+    open across events until it's older than the delay or has more than
+    max_statements statements.  Each event after the first runs inside a
+    savepoint, so that a failed event only rolls back its own changes.  Code
+    that needs other connections to see our changes should call
+    finish_transaction() to commit right away.
+
+    Maintenance:
+
+    New databases use incremental auto_vacuum.  DatabaseMaintenance (see
+    miro.dbmaintenance) calls checkpoint(), analyze() and
+    incremental_vacuum() when the database is idle, and uses
+    open_maintenance_connection() for the work that only needs to read.
+
+    Write-behind:
+
+    Once set_write_behind() is called, signal_change() only marks objects as
+    dirty.  At the end of the event, we send one UPDATE per object, then
+    check the view trackers.  Dirty objects are also written before any
+    other SQL statement runs, so queries always see the current values.
+    Rolling back a transaction drops the dirty objects along with it.
     """
+
+    # SQLite checkpoints the WAL file automatically once the readers are done
+    # with it, but it only shrinks the file if we set a size limit.
+    WAL_SIZE_LIMIT = 4 * 1024 * 1024
+
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
                  start_in_temp_mode=False):
@@ -432,7 +499,7 @@ class LiveStorage(signals.SignalEmitter):
         self.cache = DatabaseObjectCache()
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
-        self._query_times = {}
+        self.query_stats = querystats.QueryStats('LiveStorage')
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
@@ -443,6 +510,30 @@ class LiveStorage(signals.SignalEmitter):
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
         self._statements_in_transaction = []
+        # index in _statements_in_transaction where the statements for the
+        # current event start.  This is only non-zero when group commit
+        # deferred the commit for earlier events.
+        self._event_start = 0
+        self._transaction_start_time = None
+        self._group_commit_delay = 0
+        self._group_commit_max_statements = 0
+        self._group_commit_timeout = None
+        # time that the last statement finished.  DatabaseMaintenance uses
+        # this to tell if we're idle.
+        self.last_execute_time = time.time()
+        self._commit_count = 0
+        self._commit_time_total = 0.0
+        self._commit_time_max = 0.0
+        self._commit_stats_start = time.time()
+        # write-behind state.  _dirty_objects maps (id, table_name) keys to
+        # objects that need an UPDATE, _pending_view_updates maps them to
+        # (obj, can_change_views) tuples for the view tracker checks.
+        self.write_behind = False
+        self._dirty_objects = collections.OrderedDict()
+        self._pending_view_updates = collections.OrderedDict()
+        # maps (id, table_name) keys to dicts that map column names to a
+        # digest of the value we last wrote for non-simple columns
+        self._sql_digests = {}
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -450,6 +541,10 @@ class LiveStorage(signals.SignalEmitter):
                 self._schema_map[klass] = oschema
                 for field_name, schema_item in oschema.fields:
                     klass.track_attribute_changes(field_name)
+                if klass.compact_storage:
+                    compact_class = klass.make_compact_class(
+                        [name for name, schema_item in oschema.fields])
+                    self._schema_map[compact_class] = oschema
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
         self._converter = SQLiteConverter()
@@ -500,18 +595,28 @@ class LiveStorage(signals.SignalEmitter):
         http://www.sqlite.org/wal.html
         """
         try:
+            self._set_auto_vacuum()
             self.cursor.execute("PRAGMA journal_mode=wal");
         except sqlite3.DatabaseError:
             msg = "Error running 'PRAGMA journal_mode=wal'"
             self.error_handler.handle_load_error()
             self._handle_load_error(msg, init_schema=False)
             # rerun the command with our fresh database
+            self._set_auto_vacuum()
             self.cursor.execute("PRAGMA journal_mode=wal");
         # check that we actually succesfully switch to wal mode
         actual_mode = self.cursor.fetchall()[0][0]
         if actual_mode != u'wal' and not hasattr(app, 'in_unit_tests'):
             logging.warn("PRAGMA journal_mode=wal didn't change the "
                          "mode.  journal_mode=%s", actual_mode)
+        self.cursor.execute("PRAGMA journal_size_limit=%d" %
+                            self.WAL_SIZE_LIMIT)
+
+    def _set_auto_vacuum(self, db_name='main'):
+        # auto_vacuum can only be changed before any tables are created, so
+        # this only affects new databases.  It has to come before we switch
+        # to WAL mode.
+        self.cursor.execute("PRAGMA %s.auto_vacuum=INCREMENTAL" % db_name)
 
     def _ensure_database_directory_exists(self, path):
         if not self.force_directory_creation:
@@ -568,20 +673,11 @@ class LiveStorage(signals.SignalEmitter):
 
     def _copy_data_to_newdb(self):
         # copy current schema
+        self._set_auto_vacuum('newdb')
         self.cursor.execute("SELECT name, sql FROM main.sqlite_master "
                             "WHERE type='table'")
-        def should_recreate_table(table_name):
-            if (table_name.endswith("fts_content") or
-                table_name.endswith("fts_segments") or
-                table_name.endswith("fts_stat") or
-                table_name.endswith("fts_docsize") or
-                table_name.endswith("fts_segdir") or
-                table_name.startswith("sqlite_")):
-                # these tables are auto-generated by sqlite
-                return False
-            return True
         table_info = [(table, sql) for (table, sql) in self.cursor.fetchall()
-                      if should_recreate_table(table)]
+                      if should_copy_table(table)]
 
         for table, sql in table_info:
             sql = sql.replace("TABLE %s" % table,
@@ -631,6 +727,11 @@ class LiveStorage(signals.SignalEmitter):
         :returns True if the integrity check passed.
         """
 
+        # make sure we're checking our changes along with the rest
+        self.finish_transaction()
+        return self._run_integrity_check()
+
+    def _run_integrity_check(self):
         try:
             self.cursor.execute("PRAGMA integrity_check")
             return self.cursor.fetchall() == [
@@ -641,10 +742,69 @@ class LiveStorage(signals.SignalEmitter):
                          exc_info=True)
             return False
 
+    def open_maintenance_connection(self):
+        """Open a second connection to our database file.
+
+        Maintenance tasks use this for long reads.  In WAL mode they don't
+        block our connection.
+
+        :returns: sqlite3 connection, or None if there's no database file to
+            connect to (in-memory databases and temporary mode)
+        """
+        if self.path == ':memory:' or self.temp_mode:
+            return None
+        return sqlite3.connect(self.path, isolation_level=None)
+
+    def table_names(self):
+        """Get the names of the tables for our object schemas."""
+        return [oschema.table_name for oschema in self._all_schemas]
+
+    def checkpoint(self):
+        """Run a passive WAL checkpoint.
+
+        :returns: (busy, log_pages, checkpointed_pages) tuple
+        """
+        self.finish_transaction()
+        self.cursor.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return self.cursor.fetchone()
+
+    def analyze(self, table_name):
+        """Update the query planner statistics for a table."""
+        self.finish_transaction()
+        self.cursor.execute("ANALYZE %s" % table_name)
+
+    def reclaimable_pages(self):
+        """Count the free pages that incremental_vacuum() can give back.
+
+        We keep enough free pages to cover the space that we preallocate.
+        Databases created without incremental auto_vacuum can't be vacuumed
+        this way, for those we return 0.
+        """
+        self.cursor.execute("PRAGMA auto_vacuum")
+        if self.cursor.fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            return 0
+        size_info = self._get_size_info()
+        if size_info is None:
+            return 0
+        page_size, page_count, freelist_count = size_info
+        reserved_pages = (self.preallocate or 0) // page_size
+        return max(freelist_count - reserved_pages, 0)
+
+    def incremental_vacuum(self, pages):
+        """Give back up to pages free pages to the filesystem."""
+        self.finish_transaction()
+        # sqlite frees one page each time the statement is stepped, so we
+        # need to fetch all the rows.
+        self.cursor.execute("PRAGMA incremental_vacuum(%d)" % pages)
+        self.cursor.fetchall()
+
     def close(self):
         if self.connection is not None:
             logging.info("closing database")
             self.finish_transaction()
+            if self._commit_count:
+                logging.info("database commit stats: %s",
+                             self.get_commit_stats())
             self.connection.close()
             self.connection = None
 
@@ -789,6 +949,10 @@ class LiveStorage(signals.SignalEmitter):
             self.set_version()
             self._change_database_file_back()
         self.current_version = self._schema_version
+        # The change counter isn't part of the schema versioning, since
+        # device databases have their own version.  Create it if needed here
+        # instead of in an upgrade function.
+        self.setup_change_counter()
 
     def _upgrade_20_database(self):
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
@@ -878,10 +1042,12 @@ class LiveStorage(signals.SignalEmitter):
                        (obj.id, obj))
             logging.error(details)
         self._ids_loaded.discard(key)
+        self._sql_digests.pop(key, None)
 
     def forget_all_objects(self):
         self._object_map = {}
         self._ids_loaded = set()
+        self._sql_digests = {}
 
     def _insert_sql_for_schema(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
@@ -897,9 +1063,8 @@ class LiveStorage(signals.SignalEmitter):
             except schema.ValidationError, e:
                 logging.warn("error validating %s for %s (%s)", name, obj, e)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
-        return values
+            values.append(value)
+        return self._converter.row_encoder(obj_schema)(values)
 
     def insert_obj(self, obj):
         """Add a new DDBObject to disk."""
@@ -931,41 +1096,133 @@ class LiveStorage(signals.SignalEmitter):
 
     def update_obj(self, obj):
         """Update a DDBObject on disk."""
+        self._update_objects([obj])
+
+    def mark_dirty(self, obj, can_change_views=True):
+        """Schedule an UPDATE for a DDBObject.
 
+        This is used instead of update_obj() when write_behind is set.  All
+        changes to obj until the next flush get written with one UPDATE and
+        the view trackers get checked once afterwards.  The values are
+        validated right away, so that errors get raised to our caller like
+        they are with update_obj().
+        """
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        self._validate_changes(obj, obj_schema)
+        key = (obj.id, obj_schema.table_name)
+        self._dirty_objects[key] = obj
+        if key in self._pending_view_updates:
+            can_change_views = (can_change_views or
+                                self._pending_view_updates[key][1])
+        self._pending_view_updates[key] = (obj, can_change_views)
+
+    def _forget_dirty_object(self, obj):
+        key = (obj.id, self._schema_map[obj.__class__].table_name)
+        self._dirty_objects.pop(key, None)
+        self._pending_view_updates.pop(key, None)
+
+    def _forget_dirty_objects(self):
+        """Drop the changes from mark_dirty() when we roll back."""
+        self._dirty_objects = collections.OrderedDict()
+        self._pending_view_updates = collections.OrderedDict()
+
+    def flush_dirty_objects(self):
+        """Write out objects from mark_dirty() and update view trackers.
+
+        View tracker handlers may change more objects, we keep going until
+        there's nothing left to flush.
+        """
+        while self._pending_view_updates:
+            self._write_dirty_objects()
+            pending = self._pending_view_updates
+            self._pending_view_updates = collections.OrderedDict()
+            for obj, can_change_views in pending.itervalues():
+                obj.db_info.view_tracker_manager.update_view_trackers(obj,
+                        can_change_views)
+        self._write_dirty_objects()
+
+    def _write_dirty_objects(self):
+        if not self._dirty_objects:
+            return
+        objects = self._dirty_objects.values()
+        # reset _dirty_objects before calling execute(), otherwise it would
+        # try to write them again.
+        self._dirty_objects = collections.OrderedDict()
+        # mark_dirty() already validated them
+        self._update_objects(objects, validate=False)
+
+    def _validate_changes(self, obj, obj_schema):
+        """Validate the columns that _update_objects() would write."""
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
-            value = getattr(obj, name)
             try:
-                schema_item.validate(value)
+                schema_item.validate(getattr(obj, name))
             except schema.ValidationError:
                 logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
-        obj.reset_changed_attributes()
-        if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self.execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
-                    self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+
+    def _update_objects(self, objects, validate=True):
+        """Send UPDATE statements for a list of objects.
+
+        Simple columns are only written if they're in changed_attributes.
+        Other columns are written if their value is different than what we
+        last wrote.  Objects that change the same set of columns get sent
+        with one executemany() call.
+        """
+        # maps (schema, column names) to lists of (value list, id) tuples
+        updates = collections.OrderedDict()
+        for obj in objects:
+            obj_schema = self._schema_map[obj.__class__]
+            if validate:
+                self._validate_changes(obj, obj_schema)
+            key = (obj.id, obj_schema.table_name)
+            digests = self._sql_digests.setdefault(key, {})
+            names = []
+            values = []
+            for name, schema_item in obj_schema.fields:
+                simple = isinstance(schema_item, schema.SchemaSimpleItem)
+                if simple and name not in obj.changed_attributes:
+                    continue
+                value = getattr(obj, name)
+                sql_value = self._converter.to_sql(obj_schema, name,
+                        schema_item, value)
+                if not simple:
+                    digest = hashlib.md5(repr(sql_value)).digest()
+                    if digests.get(name) == digest:
+                        continue
+                    digests[name] = digest
+                names.append(name)
+                values.append(sql_value)
+            obj.reset_changed_attributes()
+            if values:
+                values.append(obj.id)
+                updates.setdefault((obj_schema, tuple(names)), []).append(
+                    values)
+        for (obj_schema, names), value_list in updates.iteritems():
+            sql = "UPDATE %s SET %s WHERE id=?" % (obj_schema.table_name,
+                    ', '.join('%s=?' % name for name in names))
+            if len(value_list) == 1:
+                self.execute(sql, value_list[0], is_update=True)
+            else:
+                self.execute(sql, value_list, is_update=True, many=True)
+            self._check_update_count([values[-1] for values in value_list])
+
+    def _check_update_count(self, ids):
+        if (self.cursor.rowcount == len(ids) or
+                self._quitting_from_operational_error):
+            return
+        if self.cursor.rowcount < len(ids):
+            raise KeyError("Updating non-existent row (ids: %s)" % ids)
+        else:
+            raise ValueError("Update changed multiple rows "
+                    "(ids: %s, count: %s)" % (ids, self.cursor.rowcount))
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
 
+        self._forget_dirty_object(obj)
         schema = self._schema_map[obj.__class__]
         sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
         self.execute(sql, (obj.id,), is_update=True)
@@ -984,6 +1241,7 @@ class LiveStorage(signals.SignalEmitter):
         for obj in objects:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk remove")
+            self._forget_dirty_object(obj)
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         for objects_chunk in util.split_values_for_sqlite(objects):
@@ -1070,6 +1328,9 @@ class LiveStorage(signals.SignalEmitter):
         sql.write("SELECT %s.id " % table_name)
         sql.write(self._get_query_bottom(table_name, where, joins,
             order_by, limit))
+        if self._dirty_objects:
+            # write pending changes first so that the query sees them
+            self._write_dirty_objects()
         self.cursor.execute(sql.getvalue(), values)
         return (row[0] for row in self.cursor.fetchall())
 
@@ -1077,20 +1338,32 @@ class LiveStorage(signals.SignalEmitter):
         column_names = ['%s.%s' % (schema.table_name, f[0])
                 for f in schema.fields]
 
-        # we can only feed sqlite so many variables at once, send it chunks of
-        # 900 ids at once
-        id_list = tuple(id_set)
-        for id_list_chunk in util.split_values_for_sqlite(id_list):
-            sql = StringIO()
-            sql.write("SELECT %s " % (', '.join(column_names),))
-            sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name, 
-                ', '.join('?' for i in xrange(len(id_list_chunk)))))
-
-            self.cursor.execute(sql.getvalue(), id_list_chunk)
-            for row in self.cursor.fetchall():
-                self._restore_object_from_row(schema, row, db_info)
+        # Pass the ids using an IdSet.  This avoids sqlite's limit on the
+        # number of variables and the SQL stays the same for each call.
+        restore_ids = idset.IdSet(self.cursor, 'restore')
+        restore_ids.set_ids(id_set)
+        sql = StringIO()
+        sql.write("SELECT %s " % (', '.join(column_names),))
+        sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name,
+                                                restore_ids.select_sql()))
+        self.cursor.execute(sql.getvalue())
+        rows = self.cursor.fetchall()
+        restore_ids.clear()
+        for row in rows:
+            self._restore_object_from_row(schema, row, db_info)
 
     def _restore_object_from_row(self, schema, db_row, db_info):
+        decoder = self._converter.row_decoder(schema, as_dict=True)
+        try:
+            restored_data = decoder(db_row)
+        except StandardError:
+            # Fall back to converting one column at a time, so that we can
+            # use the schema's malformed data handlers.
+            restored_data = self._restore_data_with_handlers(schema, db_row)
+        klass = schema.get_ddb_class(restored_data)
+        return klass(restored_data=restored_data, db_info=db_info)
+
+    def _restore_data_with_handlers(self, schema, db_row):
         restored_data = {}
         columns_to_update = []
         values_to_update = []
@@ -1124,12 +1397,40 @@ class LiveStorage(signals.SignalEmitter):
             sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
                     ', '.join(setters), restored_data['id'])
             self.execute(sql, values_to_update)
-        klass = schema.get_ddb_class(restored_data)
-        return klass(restored_data=restored_data, db_info=db_info)
+        return restored_data
 
     def persistent_object_count(self):
         return len(self._object_map)
 
+    def object_counts(self):
+        """Get the number of objects in memory for each DDBObject class.
+
+        :returns: dict mapping class names to object counts
+        """
+        counts = collections.defaultdict(int)
+        for obj in self._object_map.itervalues():
+            counts[obj.__class__.__name__] += 1
+        return dict(counts)
+
+    def search_index_counts(self):
+        """Get the size of the item_fts full-text index.
+
+        sqlite stores the index as segment b-trees made of blocks.  It reads
+        the blocks into its page cache when we search, and merges segments
+        as more get added.
+
+        :returns: dict with the number of segments and blocks, or an empty
+            dict if there's no item_fts table
+        """
+        try:
+            self.cursor.execute("SELECT COUNT(*) FROM item_fts_segdir")
+            segments = self.cursor.fetchone()[0]
+            self.cursor.execute("SELECT COUNT(*) FROM item_fts_segments")
+            blocks = self.cursor.fetchone()[0]
+        except sqlite3.OperationalError:
+            return {}
+        return {'segments': segments, 'blocks': blocks}
+
     def query_count(self, table_name, where, values=None, joins=None,
             limit=None):
         sql = StringIO()
@@ -1156,31 +1457,139 @@ class LiveStorage(signals.SignalEmitter):
         results = self.execute(sql.getvalue(), values)
         if not convert:
             return results
-        schema_items = [self._schema_column_map[schema, c] for c in columns]
-        rows = []
-        for row in results:
-            converted_row = []
-            for name, schema_item, value in itertools.izip(columns,
-                    schema_items, row):
-                converted_row.append(self._converter.from_sql(schema, name,
-                    schema_item, value))
-            rows.append(converted_row)
-        return rows
+        fields = [(c, self._schema_column_map[schema, c]) for c in columns]
+        decoder = self._converter.row_decoder(schema, fields)
+        return [decoder(row) for row in results]
+
+    def set_group_commit(self, delay, max_statements):
+        """Keep transactions open across eventloop events.
+
+        :param delay: commit once the transaction is this many seconds old.
+            0 disables group commit.
+        :param max_statements: commit once the transaction has this many
+            statements
+        """
+        self._group_commit_delay = delay
+        self._group_commit_max_statements = max_statements
+        if delay <= 0:
+            self.finish_transaction()
 
-    def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+    def set_write_behind(self, write_behind):
+        """Turn write-behind on/off.
+
+        When write-behind is on, DDBObject.signal_change() calls mark_dirty()
+        rather than update_obj() and the dirty objects get flushed at the end
+        of each eventloop event.
+        """
+        self.flush_dirty_objects()
+        self.write_behind = write_behind
+
+    def get_commit_stats(self):
+        """Get statistics about our commits.
+
+        The commit times are mostly time spent syncing the WAL file to disk.
+
+        :returns: dict with the keys count, per_second, avg_time and max_time
+        """
+        elapsed = max(time.time() - self._commit_stats_start, 0.001)
+        if self._commit_count:
+            avg_time = self._commit_time_total / self._commit_count
+        else:
+            avg_time = 0.0
+        return {
+            'count': self._commit_count,
+            'per_second': self._commit_count / elapsed,
+            'avg_time': avg_time,
+            'max_time': self._commit_time_max,
+        }
+
+    def on_event_finished(self, event_loop, success):
+        try:
+            self.flush_dirty_objects()
+        except StandardError:
+            logging.exception("Error flushing dirty objects")
+            success = False
+        if len(self._statements_in_transaction) > self._event_start > 0:
+            # Group commit kept our transaction open and this event ran
+            # inside a savepoint.  Finish the savepoint, afterwards the
+            # transaction only contains changes from successful events.
+            self._finish_event_savepoint(success)
+            success = True
+        if success and self._should_defer_commit():
+            self._event_start = len(self._statements_in_transaction)
+            if self._group_commit_timeout is None:
+                self._group_commit_timeout = eventloop.add_timeout(
+                    self._group_commit_delay, self._on_group_commit_timeout,
+                    "group commit")
+        else:
+            self.finish_transaction(commit=success)
+
+    def _finish_event_savepoint(self, success):
+        if self._quitting_from_operational_error:
+            return
+        if not success:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT event")
+            del self._statements_in_transaction[self._event_start:]
+            self._sql_digests = {}
+            self._forget_dirty_objects()
+        self.cursor.execute("RELEASE SAVEPOINT event")
+        if not success:
+            self.emit("transaction-finished", False)
+
+    def _should_defer_commit(self):
+        if (self._group_commit_delay <= 0 or
+                not self._statements_in_transaction or
+                self._quitting_from_operational_error):
+            return False
+        if (len(self._statements_in_transaction) >=
+                self._group_commit_max_statements):
+            return False
+        age = time.time() - self._transaction_start_time
+        return age < self._group_commit_delay
+
+    def _on_group_commit_timeout(self):
+        self._group_commit_timeout = None
+        self.finish_transaction()
+
+    def has_uncommitted_changes(self):
+        """Do we have changes that other connections can't see yet?"""
+        return bool(self._statements_in_transaction or self._dirty_objects)
 
     def finish_transaction(self, commit=True):
+        if commit:
+            self._write_dirty_objects()
+        else:
+            self._forget_dirty_objects()
+        if self._group_commit_timeout is not None:
+            self._group_commit_timeout.cancel()
+            self._group_commit_timeout = None
+        self._event_start = 0
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
             if commit:
+                start = time.time()
                 self.cursor.execute("COMMIT TRANSACTION")
+                commit_time = time.time() - start
+                self._commit_count += 1
+                self._commit_time_total += commit_time
+                self._commit_time_max = max(self._commit_time_max,
+                                            commit_time)
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
+                # the digests may be for values that just got rolled back
+                self._sql_digests = {}
         self._statements_in_transaction = []
         self.emit("transaction-finished", commit)
 
+    def _begin_transaction(self):
+        """Start a transaction for the current event."""
+        if self._event_start == 0:
+            self.cursor.execute("BEGIN TRANSACTION")
+            self._transaction_start_time = time.time()
+        else:
+            self.cursor.execute("SAVEPOINT event")
+
     def execute(self, sql, values=None, is_update=False, many=False):
         """Execute an sql statement and return the results.
 
@@ -1196,16 +1605,22 @@ class LiveStorage(signals.SignalEmitter):
             # We want to avoid updating the database at this point.
             return
 
-        if is_update and len(self._statements_in_transaction) == 0:
-            self.cursor.execute("BEGIN TRANSACTION")
+        if self._dirty_objects:
+            # write pending changes first so that the statement sees them
+            self._write_dirty_objects()
+
+        if (is_update and
+                len(self._statements_in_transaction) == self._event_start):
+            self._begin_transaction()
 
         if values is None:
             values = ()
 
         if is_update:
             self._statements_in_transaction.append((sql, values, many))
+        query_time = 0.0
         try:
-            self._time_execute(sql, values, many)
+            query_time = self._time_execute(sql, values, many)
         except sqlite3.DatabaseError, e:
             self._log_error(sql, values, many, e)
             if is_update:
@@ -1220,9 +1635,16 @@ class LiveStorage(signals.SignalEmitter):
             raise
 
         if is_update:
+            self._check_time(sql, values, query_time)
             return None
         else:
-            return self.cursor.fetchall()
+            # sqlite does most of the work for a SELECT while we fetch the
+            # rows, so include that in the time.
+            start = time.time()
+            rows = self.cursor.fetchall()
+            query_time += time.time() - start
+            self._check_time(sql, values, query_time, len(rows))
+            return rows
 
     def _time_execute(self, sql, values, many):
         start = time.time()
@@ -1231,7 +1653,8 @@ class LiveStorage(signals.SignalEmitter):
         else:
             self.cursor.execute(sql, values)
         end = time.time()
-        self._check_time(sql, end-start)
+        self.last_execute_time = end
+        return end - start
 
     def _log_error(self, sql, values, many, e):
             # printing the traceback here in whole rather than doing
@@ -1250,7 +1673,11 @@ class LiveStorage(signals.SignalEmitter):
         to_run = self._statements_in_transaction[:]
         if self._current_select_statement:
             to_run.append(self._current_select_statement)
-        for (sql, values, many) in to_run:
+        for i, (sql, values, many) in enumerate(to_run):
+            if (0 < self._event_start == i and
+                    i < len(self._statements_in_transaction)):
+                # re-create the savepoint for the current event
+                self.cursor.execute("SAVEPOINT event")
             try:
                 self._time_execute(sql, values, many)
             except sqlite3.DatabaseError, e:
@@ -1291,7 +1718,9 @@ class LiveStorage(signals.SignalEmitter):
 
         :returns: True if we should try to re-run the query
         """
-        integrity_check_passed = self.check_integrity()
+        # Our transaction was rolled back, so don't use check_integrity(),
+        # which would try to commit it.
+        integrity_check_passed = self._run_integrity_check()
         action = self.error_handler.handle_save_error(error_text,
                                                       integrity_check_passed)
         if action == LiveStorageErrorHandler.ACTION_QUIT:
@@ -1305,6 +1734,7 @@ class LiveStorage(signals.SignalEmitter):
             # reset _statements_in_transaction.  The data for the old DB is
             # now lost
             self._statements_in_transaction = []
+            self._event_start = 0
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -1312,29 +1742,11 @@ class LiveStorage(signals.SignalEmitter):
             logging.warn("Bad return value for handle_save_error: %s", action)
             raise
 
-    def _check_time(self, sql, query_time):
+    def _check_time(self, sql, values, query_time, rows=None):
         SINGLE_QUERY_LIMIT = 0.5
-        CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
-
-        return # comment out to test cumulative query times
-
-        # more than half a second in the last
-        old_times = self._query_times.setdefault(sql, [])
-        now = time.time()
-        dropoff_time = now - 5
-        cumulative = query_time
-        for i in reversed(xrange(len(old_times))):
-            old_time, old_query_time = old_times[i]
-            if old_time < dropoff_time:
-                old_times = old_times[i+1:]
-                break
-            cumulative += old_query_time
-        old_times.append((now, query_time))
-        if cumulative > CUMULATIVE_LIMIT:
-            logging.timing('query cumulatively slow: %0.2f '
-                    '(%0.03f): %s', cumulative, query_time, sql)
+        self.query_stats.record(sql, values, query_time, rows)
 
     def _calc_created_new(self):
         """Decide if the database that we just opened is new."""
@@ -1359,10 +1771,14 @@ class LiveStorage(signals.SignalEmitter):
         self._create_variables_table()
         self.set_version()
         self.setup_fulltext_search()
+        self.setup_change_counter()
 
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection)
 
+    def setup_change_counter(self):
+        changecounter.setup_change_counter(self.connection)
+
     def _get_size_info(self):
         """Get info about the database size
 
@@ -1472,6 +1888,9 @@ class DeviceLiveStorage(LiveStorage):
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection, 'device_item')
 
+    def setup_change_counter(self):
+        changecounter.setup_change_counter(self.connection, 'device_item')
+
     def show_upgrade_progress(self):
         return False
 
@@ -1500,6 +1919,9 @@ class SharingLiveStorage(LiveStorage):
                                              path_column='video_path',
                                              has_entry_description=False)
 
+    def setup_change_counter(self):
+        changecounter.setup_change_counter(self.connection, 'sharing_item')
+
 class SQLiteConverter(object):
     def __init__(self):
         self._to_sql_converters = {
@@ -1526,6 +1948,11 @@ class SQLiteConverter(object):
             self._to_sql_converters[schema_class] = self._repr_to_sql
             self._from_sql_converters[schema_class] = self._repr_from_sql
 
+        # maps (schema, column names) to compiled row converters
+        self._row_decoders = {}
+        self._row_encoders = {}
+        self._repr_parser = ReprParser()
+
     def to_sql(self, schema, name, schema_item, value):
         if value is None:
             return None
@@ -1540,6 +1967,85 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value, schema_item)
 
+    def row_decoder(self, schema, fields=None, as_dict=False):
+        """Get a function that converts a row of sqlite values.
+
+        The function takes a sequence of values as returned by sqlite and
+        returns a list with the from_sql() conversion of each one.  It's
+        built once per schema/column list, so converting a row doesn't need
+        to look up converters for each column.
+
+        :param schema: ObjectSchema the row comes from
+        :param fields: list of (name, schema_item) tuples for the columns
+            in the row.  Defaults to schema.fields.
+        :param as_dict: return a dict that maps column names to values
+            instead of a list
+        """
+        if fields is None:
+            fields = schema.fields
+        key = (schema, tuple(name for name, schema_item in fields), as_dict)
+        try:
+            return self._row_decoders[key]
+        except KeyError:
+            decoder = self._compile_row_converter(fields,
+                    self._from_sql_converters, as_dict)
+            self._row_decoders[key] = decoder
+            return decoder
+
+    def row_encoder(self, schema, fields=None):
+        """Get a function that converts a row of python values for sqlite.
+
+        This works like row_decoder(), but does the to_sql() conversion.
+        """
+        if fields is None:
+            fields = schema.fields
+        key = (schema, tuple(name for name, schema_item in fields))
+        try:
+            return self._row_encoders[key]
+        except KeyError:
+            encoder = self._compile_row_converter(fields,
+                    self._to_sql_converters)
+            self._row_encoders[key] = encoder
+            return encoder
+
+    def _compile_row_converter(self, fields, converter_map, as_dict=False):
+        # Generate a function like this:
+        #
+        #   def convert_row(row):
+        #       v0, v1, v2 = row
+        #       return [v0, (v1 if v1 is None else c1(v1, s1)), v2]
+        #
+        # Columns without a converter are passed through as-is.  For
+        # as_dict, the return value is {'name0': v0, ...} instead.
+        namespace = {}
+        variables = []
+        expressions = []
+        for i, (name, schema_item) in enumerate(fields):
+            variable = 'v%d' % i
+            variables.append(variable)
+            converter = converter_map.get(schema_item.__class__)
+            if converter is None:
+                expressions.append(variable)
+            else:
+                namespace['c%d' % i] = converter
+                namespace['s%d' % i] = schema_item
+                expressions.append('(%s if %s is None else c%d(%s, s%d))' %
+                        (variable, variable, i, variable, i))
+        if variables:
+            unpack = '    %s, = row\n' % ', '.join(variables)
+        else:
+            unpack = ''
+        if as_dict:
+            result = '{%s}' % ', '.join('%r: %s' % (name, expression)
+                    for (name, schema_item), expression in
+                    zip(fields, expressions))
+        else:
+            result = '[%s]' % ', '.join(expressions)
+        source = 'def convert_row(row):\n%s    return %s\n' % (unpack,
+                result)
+        exec source in namespace
+        return namespace['convert_row']
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1584,7 +2090,7 @@ class SQLiteConverter(object):
         return repr(value)
 
     def _repr_from_sql(self, value, schema_item):
-        return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+        return self._repr_parser.parse(value)
 
     def _string_set_to_sql(self, value, schema_item):
         return schema_item.delimiter.join(value)
@@ -1608,3 +2114,59 @@ class TimeModuleShadow:
         return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, tm_wday, tm_yday, tm_isdst)
 
 _TIME_MODULE_SHADOW = TimeModuleShadow()
+
+class ReprParser(object):
+    """Converts the strings stored in repr columns back to python values.
+
+    Strings are compiled, then we check that the code only uses the names
+    that can show up in a repr: True, False, None, datetime.datetime and
+    time.struct_time.  Anything else raises a ValueError, badly formed
+    strings raise SyntaxError.  We evaluate the code without builtins.
+
+    Short strings tend to repeat (empty containers, common tuples), so we
+    cache their code objects.  Since we cache code rather than values, each
+    parse() still returns new lists and dicts.
+    """
+
+    CACHE_SIZE = 1000
+    # Longer strings are almost never repeated, so we don't cache them
+    CACHE_MAX_LENGTH = 200
+
+    ALLOWED_NAMES = frozenset(['True', 'False', 'None', 'datetime', 'time',
+                               'struct_time'])
+
+    _namespace = {
+        '__builtins__': {},
+        'True': True,
+        'False': False,
+        'None': None,
+        'datetime': datetime,
+        'time': _TIME_MODULE_SHADOW,
+    }
+
+    def __init__(self):
+        self._cache = {}
+
+    def parse(self, value):
+        try:
+            code = self._cache[value]
+        except KeyError:
+            code = self.compile(value)
+            if len(value) <= self.CACHE_MAX_LENGTH:
+                if len(self._cache) >= self.CACHE_SIZE:
+                    self._cache.clear()
+                self._cache[value] = code
+        return eval(code, self._namespace)
+
+    def compile(self, value):
+        code = compile(value.strip(), '<repr>', 'eval')
+        if not self.ALLOWED_NAMES.issuperset(code.co_names):
+            raise ValueError("unsupported names in repr value: %s" %
+                    ', '.join(sorted(set(code.co_names) -
+                                     self.ALLOWED_NAMES)))
+        # lambdas, generator expressions, etc. compile to nested code
+        # objects that we don't check
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                raise ValueError("unsupported expression in repr value")
+        return code
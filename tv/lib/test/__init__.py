@@ -46,6 +46,12 @@ import unittest
 
 from miro.test.importtest import *
 from miro.test.conversionstest import *
+from miro.test.probecachetest import *
+from miro.test.segmentcachetest import *
+from miro.test.dbmaintenancetest import *
+from miro.test.querystatstest import *
+from miro.test.indexadvisortest import *
+from miro.test.memoryreporttest import *
 from miro.test.devicestest import *
 from miro.test.flashscrapertest import *
 from miro.test.unicodetest import *
@@ -88,6 +94,7 @@ from miro.test.itemtracktest import *
 from miro.test.itemlisttest import *
 from miro.test.itemrenderertest import *
 from miro.test.sharingtest import *
+from miro.test.libdaaptest import *
 from miro.test.databaseerrortest import *
 from miro.test.playbacktest import *
 
@@ -158,3 +158,69 @@ class ConversionInfoTest(MiroTestCase):
                     eval(output.strip()), info,
                     "%s != %s (%s)" % (eval(output.strip()), info, mem))
 
+
+class MockSchedulerTask(conversions.ConversionTask):
+    def __init__(self, key):
+        # not calling superclass init because it needs a real item info
+        self.key = key
+        self.error = None
+        self.thread = None
+        self.exited = False
+        self.process_handle = None
+        self.queued_time = 0
+        self.priority = conversions.PRIORITY_NORMAL
+        self.started = False
+
+    def run(self):
+        self.started = True
+
+    def is_pending(self):
+        return not self.started
+
+    def done_running(self):
+        return self.exited
+
+class ConversionManagerSchedulerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = conversions.ConversionManager()
+        # the scheduler test doesn't care about frontend messages
+        self.manager._notify_task_changed = lambda task: None
+        self.manager._notify_tasks_count = lambda: None
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 2)
+
+    def add_task(self, key, priority=conversions.PRIORITY_NORMAL):
+        task = MockSchedulerTask(key)
+        task.priority = priority
+        self.manager.pending_tasks.append(task)
+        return task
+
+    def test_start_multiple_per_cycle(self):
+        tasks = [self.add_task('task-%d' % i) for i in range(3)]
+        self.manager._run_loop_cycle()
+        # both slots should be filled in one cycle, in FIFO order
+        self.assertEquals([t.started for t in tasks], [True, True, False])
+        self.assertEquals(self.manager.running_tasks, tasks[:2])
+        # when a task exits, the next one should start on the next cycle
+        tasks[0].exited = True
+        self.manager._run_loop_cycle()
+        self.assert_(tasks[2].started)
+        self.assertEquals(self.manager.finished_tasks, [tasks[0]])
+        metrics = self.manager.get_metrics()
+        self.assertEquals(metrics['started'], 3)
+        self.assertEquals(metrics['finished'], 1)
+
+    def test_device_sync_priority(self):
+        normal = self.add_task('normal')
+        normal2 = self.add_task('normal2')
+        device = self.add_task('device', conversions.PRIORITY_DEVICE_SYNC)
+        self.manager._run_loop_cycle()
+        self.assert_(device.started)
+        self.assert_(normal.started)
+        self.assert_(not normal2.started)
+
+    def test_wakeup(self):
+        self.manager.wakeup()
+        # a pending wakeup makes the wait return right away
+        self.manager._wait_for_wakeup()
+        self.assert_(not self.manager._wakeup_pending)
@@ -1,4 +1,5 @@
 import logging
+import sys
 
 from miro.test.framework import MiroTestCase
 from miro import app
@@ -44,6 +45,7 @@ class ViewTrackerTest(DatabaseTestCase):
         self.remove_callbacks = []
         self.change_callbacks = []
         self.feed.set_title(u"booya")
+        self.flush_test_changes()
         self.setup_view(feed.Feed.make_view("userTitle LIKE 'booya%'"))
 
     def setup_view(self, view):
@@ -67,26 +69,31 @@ class ViewTrackerTest(DatabaseTestCase):
     def test_track(self):
         # test new addition
         self.feed2.set_title(u"booya")
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.feed2])
         self.assertEquals(self.remove_callbacks, [])
         self.assertEquals(self.change_callbacks, [])
         # test change that doesn't add or remove
         self.feed2.set_title(u"booya2")
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.feed2])
         self.assertEquals(self.remove_callbacks, [])
         self.assertEquals(self.change_callbacks, [self.feed2])
         # test removing existing objects
         self.feed.revert_title()
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.feed2])
         self.assertEquals(self.remove_callbacks, [self.feed])
         self.assertEquals(self.change_callbacks, [self.feed2])
         # test change of object not in view
         self.feed.revert_title()
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.feed2])
         self.assertEquals(self.remove_callbacks, [self.feed])
         self.assertEquals(self.change_callbacks, [self.feed2])
         # test removing newly added objects
         self.feed2.revert_title()
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.feed2])
         self.assertEquals(self.remove_callbacks, [self.feed, self.feed2])
         self.assertEquals(self.change_callbacks, [self.feed2])
@@ -142,6 +149,7 @@ class ViewTrackerTest(DatabaseTestCase):
         self.i2.remove()
         self.i1.mark_item_skipped()
         app.bulk_sql_manager.finish()
+        self.flush_test_changes()
         self.assertEquals(self.add_callbacks, [self.i3])
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
@@ -209,6 +217,131 @@ class DDBObjectTestCase(MiroTestCase):
         testobj.bar = 2
         self.assertEquals(testobj.changed_attributes, set(['foo']))
 
+class CompactDDBObject(database.DDBObject):
+    compact_storage = True
+
+    def setup_new(self, name, count=0):
+        self.name = name
+        self.count = count
+        self.data = {}
+
+class CompactDDBObjectSchema(schema.ObjectSchema):
+    klass = CompactDDBObject
+    table_name = 'compact_test'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('name', schema.SchemaString()),
+        ('count', schema.SchemaInt()),
+        ('data', schema.SchemaDict(schema.SchemaString(),
+                                   schema.SchemaInt())),
+    ]
+
+class NormalDDBObject(CompactDDBObject):
+    compact_storage = False
+
+class NormalDDBObjectSchema(CompactDDBObjectSchema):
+    klass = NormalDDBObject
+    table_name = 'normal_test'
+
+class CompactStorageTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database(schema_version=0,
+                object_schemas=[CompactDDBObjectSchema,
+                                NormalDDBObjectSchema])
+
+    def test_slots(self):
+        obj = CompactDDBObject(u'foo')
+        self.assert_(isinstance(obj, CompactDDBObject))
+        self.assertEquals(obj.__class__.__name__, 'CompactDDBObject')
+        self.assertEquals(obj.name, u'foo')
+        self.assert_('name' not in obj.__dict__)
+        # non-field attributes still work
+        obj.other = 1
+        self.assertEquals(obj.other, 1)
+
+    def test_change_tracking(self):
+        obj = CompactDDBObject(u'foo')
+        self.assertEquals(obj.changed_attributes, set())
+        obj.name = u'foo'
+        self.assertEquals(obj.changed_attributes, set())
+        obj.name = u'bar'
+        obj.count = 2
+        obj.other = 3
+        self.assertEquals(obj.changed_attributes, set(['name', 'count']))
+        obj.signal_change()
+        self.flush_test_changes()
+        self.assertEquals(obj.changed_attributes, set())
+        app.db.cursor.execute("SELECT name, count FROM compact_test")
+        self.assertEquals(app.db.cursor.fetchall(), [(u'bar', 2)])
+
+    def test_restore(self):
+        obj = CompactDDBObject(u'foo', 2)
+        app.db.forget_all_objects()
+        restored = CompactDDBObject.make_view().get_singleton()
+        self.assert_(restored is not obj)
+        self.assertEquals(restored.name, u'foo')
+        self.assertEquals(restored.count, 2)
+        self.assertEquals(restored.data, {})
+        self.assertEquals(restored.changed_attributes, set())
+
+    def test_get_by_id(self):
+        obj = CompactDDBObject(u'foo')
+        self.assert_(CompactDDBObject.get_by_id(obj.id) is obj)
+        obj.remove()
+        self.assertEquals(CompactDDBObject.make_view().count(), 0)
+
+    def test_size(self):
+        # performancetest.CompactStorageBenchmark measures this for a big
+        # table
+        CompactDDBObject(u'foo', 2)
+        NormalDDBObject(u'foo', 2)
+        app.db.forget_all_objects()
+        compact = CompactDDBObject.make_view().get_singleton()
+        normal = NormalDDBObject.make_view().get_singleton()
+        self.assert_(sys.getsizeof(compact) + sys.getsizeof(compact.__dict__) <
+                     sys.getsizeof(normal) + sys.getsizeof(normal.__dict__))
+
+def signal_storage_size(obj):
+    """Calculate how many bytes obj uses to store signal info."""
+    size = 0
+    for name in ('signal_callbacks', 'id_generator', '_currently_emitting',
+                 '_okay_to_nest'):
+        if name in obj.__dict__:
+            size += sys.getsizeof(obj.__dict__[name])
+    for callback_set in obj.__dict__.get('signal_callbacks', {}).values():
+        size += sys.getsizeof(callback_set)
+        size += sys.getsizeof(callback_set.__dict__)
+        size += sum(sys.getsizeof(d) for d in (callback_set.callbacks,
+                                               callback_set.callbacks_after,
+                                               callback_set.callbacks_before))
+    return size
+
+class SignalStorageTest(MiroTestCase):
+    # restored objects should only get signal tables once they're used.
+    # performancetest.SignalMemoryBenchmark checks how much memory that
+    # saves for a big table.
+    OBJECT_COUNT = 10
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database(schema_version=0,
+                object_schemas=[TestDDBObjectSchema])
+        app.db.cursor.executemany("INSERT INTO test (id) VALUES (?)",
+                                  ((i,) for i in xrange(self.OBJECT_COUNT)))
+        app.db_info.update_last_id()
+
+    def test_restored_objects(self):
+        objects = list(TestDDBObject.make_view())
+        self.assertEquals(len(objects), self.OBJECT_COUNT)
+        total = sum(signal_storage_size(obj) for obj in objects)
+        self.assertEquals(total, 0)
+        # connecting to an object gives it its own signal tables
+        obj = objects[0]
+        obj.connect('removed', lambda obj: None)
+        self.assert_(signal_storage_size(obj) > 0)
+        self.assertEquals(signal_storage_size(objects[1]), 0)
+
 class DatabaseLoggingTest(MiroTestCase):
     def check_db_logs(self, count):
         records = self.log_filter.records
@@ -0,0 +1,192 @@
+import os
+import sqlite3
+
+from miro import app
+from miro import dbmaintenance
+from miro import storedatabase
+from miro.test import testobjects
+from miro.test.framework import EventLoopTest
+
+class DatabaseMaintenanceTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.db_path = os.path.join(self.tempdir, 'testdb')
+        self.reload_database(self.db_path)
+        self.feed, self.items = testobjects.make_feed_with_items(50)
+        app.db.finish_transaction()
+        self.maintenance = dbmaintenance.DatabaseMaintenance(app.db)
+        self.finished = []
+        self.maintenance.connect('task-finished', self.on_task_finished)
+
+    def tearDown(self):
+        self.maintenance.stop()
+        EventLoopTest.tearDown(self)
+
+    def on_task_finished(self, maintenance, name, report):
+        self.finished.append(name)
+
+    def run_task(self, name):
+        self.maintenance.start_task(name)
+        while self.maintenance.run_step():
+            pass
+        self.assertEquals(self.finished[-1], name)
+        return self.maintenance.get_report()[name]
+
+    def pragma(self, name):
+        app.db.cursor.execute("PRAGMA %s" % name)
+        return app.db.cursor.fetchone()[0]
+
+    def test_new_database_auto_vacuum(self):
+        self.assertEquals(self.pragma('auto_vacuum'),
+                          storedatabase.AUTO_VACUUM_INCREMENTAL)
+
+    def test_checkpoint(self):
+        report = self.run_task('checkpoint')
+        busy, log_pages, checkpointed_pages = report['result']
+        self.assertEquals(busy, 0)
+        self.assertEquals(log_pages, checkpointed_pages)
+        # one step for the checkpoint, one to finish
+        self.assertEquals(report['steps'], 2)
+
+    def test_analyze(self):
+        report = self.run_task('analyze')
+        # one step per table, one to finish
+        self.assertEquals(report['steps'], len(app.db.table_names()) + 1)
+        app.db.cursor.execute("SELECT COUNT(*) FROM sqlite_stat1 "
+                              "WHERE tbl='item'")
+        self.assert_(app.db.cursor.fetchone()[0] > 0)
+
+    def test_incremental_vacuum(self):
+        app.db.execute("INSERT INTO dtv_variables (name, serialized_value) "
+                       "VALUES ('big', zeroblob(1000000))", is_update=True)
+        app.db.execute("DELETE FROM dtv_variables WHERE name='big'",
+                       is_update=True)
+        app.db.finish_transaction()
+        free_pages = app.db.reclaimable_pages()
+        self.assert_(free_pages > 100)
+        self.maintenance.VACUUM_MIN_PAGES = 100
+        self.maintenance.VACUUM_PAGES_PER_STEP = 50
+        report = self.run_task('incremental_vacuum')
+        self.assertEquals(report['result'], '%d pages' % free_pages)
+        self.assert_(report['steps'] > free_pages // 50)
+        self.assertEquals(self.pragma('freelist_count'), 0)
+
+    def test_incremental_vacuum_skipped(self):
+        report = self.run_task('incremental_vacuum')
+        self.assert_(report['result'].startswith('skipped'))
+
+    def test_preallocated_space_kept(self):
+        path = os.path.join(self.tempdir, 'preallocated-db')
+        storage = storedatabase.LiveStorage(path, preallocate=512 * 1024)
+        try:
+            self.assertEquals(storage.reclaimable_pages(), 0)
+        finally:
+            storage.close()
+
+    def test_backup(self):
+        self.maintenance.BACKUP_ROWS_PER_STEP = 10
+        self.maintenance.start_task('backup')
+        self.maintenance.run_step()
+        # changes made while the backup runs aren't included
+        testobjects.make_item(self.feed, u'added during backup')
+        app.db.finish_transaction()
+        while self.maintenance.run_step():
+            pass
+        report = self.maintenance.get_report()['backup']
+        self.assert_(report['steps'] > 5)
+
+        backup_path = os.path.join(app.db.get_backup_directory(),
+                                   self.maintenance.BACKUP_NAME)
+        self.assert_(os.path.exists(backup_path))
+        self.assert_(not os.path.exists(backup_path + '.tmp'))
+        # it's not one of the upgrade backups
+        self.assert_(backup_path not in app.db.get_backup_databases())
+        connection = sqlite3.connect(backup_path)
+        try:
+            self.assertEquals(connection.execute(
+                "SELECT COUNT(*) FROM item").fetchone()[0], 50)
+            self.assertEquals(connection.execute(
+                "SELECT COUNT(*) FROM item_fts").fetchone()[0], 50)
+            item_id = self.items[0].id
+            self.assertEquals(connection.execute(
+                "SELECT title FROM item WHERE id=?", (item_id,)).fetchone(),
+                (self.items[0].title,))
+            self.assertEquals(connection.execute(
+                "PRAGMA integrity_check").fetchall(), [(u'ok',)])
+            main_schema = app.db.cursor.execute(
+                "SELECT type, name FROM sqlite_master ORDER BY name").fetchall()
+            backup_schema = connection.execute(
+                "SELECT type, name FROM sqlite_master ORDER BY name").fetchall()
+            self.assertEquals(backup_schema, main_schema)
+        finally:
+            connection.close()
+
+    def test_backup_aborted(self):
+        self.maintenance.BACKUP_ROWS_PER_STEP = 10
+        self.maintenance.start_task('backup')
+        self.maintenance.run_step()
+        self.maintenance.stop()
+        backup_path = os.path.join(app.db.get_backup_directory(),
+                                   self.maintenance.BACKUP_NAME)
+        self.assert_(not os.path.exists(backup_path))
+        self.assert_(not os.path.exists(backup_path + '.tmp'))
+        self.assertEquals(self.maintenance.running_task(), None)
+
+    def test_backup_aborted_when_busy(self):
+        self.maintenance.BACKUP_ROWS_PER_STEP = 10
+        self.maintenance.IDLE_TIME = 0
+        self.maintenance.TASKS = [('backup', 100)]
+        self.maintenance._on_timeout()
+        self.assertEquals(self.maintenance.running_task(), 'backup')
+        # once the database is busy, the backup stops holding its read
+        # transaction open and waits for the next idle period
+        self.maintenance.IDLE_TIME = 1000
+        self.maintenance._on_timeout()
+        self.assertEquals(self.maintenance.running_task(), None)
+        backup_path = os.path.join(app.db.get_backup_directory(),
+                                   self.maintenance.BACKUP_NAME)
+        self.assert_(not os.path.exists(backup_path + '.tmp'))
+        self.assertEquals(self.maintenance.next_task(), 'backup')
+        # other tasks keep going
+        self.maintenance.IDLE_TIME = 0
+        self.maintenance.TASKS = [('analyze', 100)]
+        self.maintenance._on_timeout()
+        self.maintenance.IDLE_TIME = 1000
+        self.maintenance._on_timeout()
+        self.assertEquals(self.maintenance.running_task(), 'analyze')
+
+    def test_memory_database(self):
+        self.reload_database()
+        maintenance = dbmaintenance.DatabaseMaintenance(app.db)
+        maintenance.start_task('backup')
+        self.assert_(not maintenance.run_step())
+        self.assertEquals(maintenance.get_report()['backup']['result'],
+                          'skipped')
+
+    def test_scheduling(self):
+        # quick_check runs in the thread pool, run it using the eventloop
+        self.maintenance.IDLE_TIME = 0
+        self.maintenance.POLL_INTERVAL = 0
+        self.maintenance.STEP_DELAY = 0.01
+        self.maintenance.TASKS = [('quick_check', 100)]
+        def on_task_finished(maintenance, name, report):
+            self.stopEventLoop(abnormal=False)
+        self.maintenance.connect('task-finished', on_task_finished)
+        self.maintenance.start()
+        self.runEventLoop()
+        self.assertEquals(self.finished, ['quick_check'])
+        report = self.maintenance.get_report()['quick_check']
+        self.assertEquals(report['result'], 'ok')
+        self.assert_(report['duration'] >= report['work_time'])
+        # the run time gets saved, so a new object won't run it again
+        maintenance = dbmaintenance.DatabaseMaintenance(app.db)
+        maintenance.TASKS = [('quick_check', 100)]
+        self.assertEquals(maintenance.next_task(), None)
+
+    def test_wait_for_idle(self):
+        self.maintenance.IDLE_TIME = 1000
+        self.maintenance._on_timeout()
+        self.assertEquals(self.maintenance.running_task(), None)
+        self.maintenance.IDLE_TIME = 0
+        self.maintenance._on_timeout()
+        self.assertEquals(self.maintenance.running_task(), 'checkpoint')
@@ -536,6 +536,16 @@ class MiroTestCase(unittest.TestCase):
     def check_failed_soft_count(self, count):
         self.assertEquals(app.controller.failed_soft_count, count)
 
+    def flush_test_changes(self):
+        """Flush changes made by the test code itself.
+
+        With write-behind, objects get written and the view trackers get
+        checked at the end of each eventloop event.  Test code doesn't run
+        inside an event, so call this where its event would end.
+        """
+        if app.db:
+            app.db.flush_dirty_objects()
+
     def reload_database(self, path=':memory:', upgrade=True, **kwargs):
         self.shutdown_database()
         self.setup_new_database(path, **kwargs)
@@ -549,6 +559,8 @@ class MiroTestCase(unittest.TestCase):
                 # normal case: use _upgrade_database() because we want
                 # exceptions to keep propagating
                 app.db._upgrade_database(context='main')
+        # run with write-behind, like the main database does in production
+        app.db.set_write_behind(True)
         item.setup_change_tracker()
         database.initialize()
 
@@ -639,6 +651,7 @@ class EventLoopTest(MiroTestCase):
         eventloop.shutdown()
 
     def runPendingIdles(self):
+        self.flush_test_changes()
         idle_queue = eventloop._eventloop.idle_queue
         urgent_queue = eventloop._eventloop.urgent_queue
         while idle_queue.has_pending_idle() or urgent_queue.has_pending_idle():
@@ -650,6 +663,7 @@ class EventLoopTest(MiroTestCase):
             eventloop._eventloop._add_idles_for_next_loop()
 
     def runUrgentCalls(self):
+        self.flush_test_changes()
         urgent_queue = eventloop._eventloop.urgent_queue
         while urgent_queue.has_pending_idle():
             if urgent_queue.has_pending_idle():
@@ -0,0 +1,127 @@
+from miro import app
+from miro.data import indexadvisor
+from miro.data import itemtrack
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase
+
+class IndexAdvisorTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database()
+        itemtrack.query_stats.reset()
+
+    def tearDown(self):
+        itemtrack.query_stats.reset()
+        MiroTestCase.tearDown(self)
+
+    def run_tab_queries(self):
+        for tab in testobjects.TABS:
+            testobjects.make_tab_query(tab).select_ids(app.db.connection)
+
+    def propose(self):
+        advisor = indexadvisor.IndexAdvisor(app.db.connection)
+        return [(p.table, p.columns)
+                for p in advisor.propose(itemtrack.query_stats)]
+
+    def test_shape(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', 1)
+        query.add_condition('remote_downloader.state', 'IS NOT', None)
+        query.set_order_by(['-release_date'])
+        shape = query.shape()
+        self.assertEquals(shape.table, 'item')
+        self.assertEquals(shape.conditions, (
+            ('item', 'feed_id', '='),
+            ('remote_downloader', 'state', 'IS NOT')))
+        self.assertEquals(shape.order_by,
+                          (('item', 'release_date', None),))
+        self.assertEquals(shape.search, False)
+        # the values don't change the shape
+        query2 = itemtrack.ItemTrackerQuery()
+        query2.add_condition('remote_downloader.state', 'IS NOT', u'foo')
+        query2.add_condition('feed_id', '=', 2)
+        query2.set_order_by(['release_date'])
+        self.assertEquals(query2.shape(), shape)
+        # complex order by expressions don't get broken down
+        query2.set_complex_order_by(['title'], 'LOWER(title)')
+        self.assertEquals(query2.shape().order_by, None)
+        query2.set_search(u'foo')
+        self.assertEquals(query2.shape().search, True)
+
+    def test_record_shapes(self):
+        for i in range(3):
+            testobjects.make_tab_query('feed').select_ids(app.db.connection)
+        testobjects.make_tab_query('videos').select_ids(app.db.connection)
+        shapes = itemtrack.query_stats.get_query_shapes()
+        self.assertEquals(len(shapes), 2)
+        counts = dict((shape, count) for (shape, count, total_time, example)
+                      in shapes)
+        feed_shape = testobjects.make_tab_query('feed').shape()
+        videos_shape = testobjects.make_tab_query('videos').shape()
+        self.assertEquals(counts[feed_shape], 3)
+        self.assertEquals(counts[videos_shape], 1)
+
+    def test_new_indexes_exist(self):
+        # upgrade202 created indexes for all the tab queries, so there's
+        # nothing left to propose.
+        self.run_tab_queries()
+        self.assertEquals(self.propose(), [])
+
+    def test_propose(self):
+        testobjects.drop_tab_indexes(app.db.cursor)
+        self.run_tab_queries()
+        # With empty tables, sqlite doesn't scan remote_downloader for the
+        # downloading tab, so we only get the item indexes.
+        # performancetest.TabIndexBenchmark checks the remote_downloader one.
+        self.assertSameSet(self.propose(),
+                           [(table, columns)
+                            for (name, table, columns)
+                            in testobjects.TAB_INDEXES
+                            if table == 'item'])
+
+    def test_equality_columns_any_order(self):
+        testobjects.drop_tab_indexes(app.db.cursor)
+        app.db.cursor.execute("CREATE INDEX test_index ON item "
+                              "(watched_time, expired, parent_id, "
+                              "downloaded_time)")
+        query = testobjects.make_tab_query('recently-downloaded')
+        query.select_ids(app.db.connection)
+        self.assertEquals(self.propose(), [])
+
+    def test_collation(self):
+        # indexes can't help with ORDER BY title collate nocase.  Since there's
+        # already an index on file_type, we don't propose anything.
+        testobjects.make_tab_query('videos').select_ids(app.db.connection)
+        self.assertEquals(self.propose(), [])
+        app.db.cursor.execute("DROP INDEX item_file_type")
+        app.db.cursor.execute("DROP INDEX item_file_type_last_watched")
+        self.assertEquals(self.propose(), [('item', ('deleted', 'file_type'))])
+
+    def test_range_column(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', 1)
+        query.add_condition('size', '>', 100)
+        query.add_condition('title', '!=', u'foo')
+        app.db.cursor.execute("DROP INDEX item_feed")
+        app.db.cursor.execute("DROP INDEX item_feed_visible")
+        app.db.cursor.execute("DROP INDEX item_feed_downloader")
+        app.db.cursor.execute("DROP INDEX item_feed_release_date")
+        query.select_ids(app.db.connection)
+        self.assertEquals(self.propose(), [('item', ('feed_id', 'size'))])
+
+    def test_quoted_index_name(self):
+        app.db.cursor.execute('CREATE INDEX "item-title" ON item (title)')
+        advisor = indexadvisor.IndexAdvisor(app.db.connection)
+        self.assert_(('title',) in advisor.indexes['item'])
+
+    def test_report(self):
+        testobjects.drop_tab_indexes(app.db.cursor)
+        testobjects.make_tab_query('feed').select_ids(app.db.connection)
+        report = indexadvisor.get_report(app.db.connection,
+                                         itemtrack.query_stats)
+        self.assertEquals(report['name'], 'IndexAdvisor')
+        self.assertEquals(len(report['proposals']), 1)
+        proposal = report['proposals'][0]
+        self.assertEquals(proposal['name'], 'item_feed_id_release_date')
+        self.assertEquals(proposal['columns'], ('feed_id', 'release_date'))
+        self.assertEquals(proposal['count'], 1)
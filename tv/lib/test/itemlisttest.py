@@ -244,6 +244,78 @@ class ItemListTest(MiroTestCase):
             self.assertEquals(group_info[1], 1)
             self.assertEquals(group_info[2], list_items[i])
 
+    def test_grouping_incremental(self):
+        # test that item changes only cause us to recalculate the groups that
+        # they could affect
+        list_items = self.item_list.get_items()
+        groups = {}
+        for i, info in enumerate(list_items):
+            groups[info.id] = i // 3
+        group_func = mock.Mock(side_effect=lambda info: groups[info.id])
+        self.item_list.set_grouping(group_func)
+        for i in xrange(len(list_items)):
+            self.item_list.get_group_info(i)
+        # change an item in the last group.  Only that group and the one
+        # next to it should get recalculated.  Calculating the groups also
+        # checks the item just outside of them.
+        changed_item = list_items[-1]
+        msg = messages.ItemChanges(set(), set([changed_item.id]), set(),
+                                   set(['title']), False, False)
+        self.item_list.on_item_changes(msg)
+        group_func.reset_mock()
+        for i in xrange(len(list_items)):
+            self.item_list.get_group_info(i)
+        called_with = set(args[0].id for args, kwargs in
+                          group_func.call_args_list)
+        self.assertSameSet(called_with,
+                           [info.id for info in list_items[5:]])
+        # remove an item from the first group.  The other groups should stay
+        # calculated.
+        for item in self.items:
+            if item.id == list_items[0].id:
+                item.remove()
+        self.refresh_item_list()
+        group_func.reset_mock()
+        for i in xrange(len(self.item_list)):
+            self.assertEquals(self.item_list.get_group_info(i)[2].id,
+                              list_items[(i + 1) // 3 * 3 or 1].id)
+        called_with = set(args[0].id for args, kwargs in
+                          group_func.call_args_list)
+        self.assertSameSet(called_with,
+                           [info.id for info in list_items[1:4]])
+
+class ScrollPrefetcherTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.item_list = mock.Mock()
+        self.prefetcher = itemlist.ScrollPrefetcher(self.item_list)
+
+    def check_prefetch(self, start, end):
+        self.assertEquals(self.item_list.prefetch_rows.call_args[0],
+                          (start, end))
+
+    def test_prefetch(self):
+        # when we aren't scrolling, we should load the next page
+        self.prefetcher.on_scroll(100, 119, now=10.0)
+        self.check_prefetch(100, 140)
+        # scrolling down fast should load further ahead
+        self.prefetcher.on_scroll(300, 319, now=10.5)
+        self.assert_(self.prefetcher.velocity > 0)
+        start, end = self.item_list.prefetch_rows.call_args[0]
+        self.assertEquals(start, 300)
+        self.assert_(end > 340)
+        # but not too far
+        self.prefetcher.on_scroll(10000, 10019, now=10.6)
+        self.check_prefetch(10000,
+                            10020 + itemlist.ScrollPrefetcher.MAX_LOOKAHEAD_ROWS)
+        # when we scroll back up, we should load the rows above us
+        for i, now in enumerate((11.0, 11.1, 11.2)):
+            self.prefetcher.on_scroll(5000 - i * 1000, 5019 - i * 1000, now)
+        self.assert_(self.prefetcher.velocity < 0)
+        start, end = self.item_list.prefetch_rows.call_args[0]
+        self.assert_(start < 3000)
+        self.assertEquals(end, 3020)
+
 class TestItemListPool(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -52,12 +52,20 @@ class ItemRendererTest(MiroTestCase):
         app.saved_items = set()
         app.playback_manager = mock.Mock()
         app.playback_manager.item_resume_policy.return_value = False
+        # use the same layout manager for every render, like a real table
+        # does, so that the layout cache gets hits.
+        self.layout_manager = mock.Mock()
+        mock_textbox = self.layout_manager.textbox.return_value
+        mock_textbox.font.line_height.return_value = 16
+        mock_textbox.get_size.return_value = (100, 16)
+        self.layout_manager.current_font.line_height.return_value = 16
+        self.layout_manager.current_font.ascent.return_value = 12
 
     def _get_item(self, item_id):
         item_list = item.fetch_item_infos(app.db.connection, [item_id])
         return item_list[0]
 
-    def check_render(self, item):
+    def check_render(self, item, style_generation=0):
         """Check that ItemRenderer can sucessfully render a row.
 
         NOTE: we don't actually check the correctness of the render, just that
@@ -66,15 +74,11 @@ class ItemRendererTest(MiroTestCase):
         self.renderer.attrs = {}
         self.renderer.info = self._get_item(item.id)
         context = mock.Mock()
-        layout_manager = mock.Mock()
+        layout_manager = self.layout_manager
+        layout_manager.style_generation = style_generation
         hotspot = hover = None
         context.width = self.renderer.MIN_WIDTH
         context.height = self.renderer.HEIGHT
-        mock_textbox = layout_manager.textbox.return_value
-        mock_textbox.font.line_height.return_value = 16
-        mock_textbox.get_size.return_value = (100, 16)
-        layout_manager.current_font.line_height.return_value = 16
-        layout_manager.current_font.ascent.return_value = 12
         for selected in (False, True):
             self.renderer.render(context, layout_manager, selected, hotspot,
                                  hover)
@@ -113,3 +117,31 @@ class ItemRendererTest(MiroTestCase):
 
     def test_file_item(self):
         self.check_render(self.file_item)
+
+    def test_layout_cache(self):
+        self.check_render(self.item)
+        # the first render for each selected state should be a miss
+        self.assertEquals(self.renderer.layout_cache_misses, 2)
+        self.assertEquals(self.renderer.layout_cache_hits, 0)
+        # rendering the same data again should re-use the layouts
+        self.check_render(self.item)
+        self.assertEquals(self.renderer.layout_cache_misses, 2)
+        self.assertEquals(self.renderer.layout_cache_hits, 2)
+        # changing the item should result in a new layout
+        self.item.title = u'new title'
+        self.item.signal_change()
+        app.db.finish_transaction()
+        self.check_render(self.item)
+        self.assertEquals(self.renderer.layout_cache_misses, 4)
+        self.assertEquals(self.renderer.layout_cache_hits, 2)
+        # so should a style change
+        self.check_render(self.item, style_generation=1)
+        self.assertEquals(self.renderer.layout_cache_misses, 6)
+        self.assertEquals(self.renderer.layout_cache_hits, 2)
+
+    def test_layout_cache_size(self):
+        self.renderer.LAYOUT_CACHE_SIZE = 1
+        self.check_render(self.item)
+        self.check_render(self.item)
+        self.assertEquals(len(self.renderer.layout_cache), 1)
+        self.assertEquals(self.renderer.layout_cache_hits, 0)
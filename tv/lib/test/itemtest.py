@@ -547,3 +547,44 @@ class ItemSizeTest(MiroTestCase):
         with self.allow_warnings():
             item.set_filename('non-existant-path')
         self.check_size(item, None)
+
+class ItemChangeTrackerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'http://example.com/feed.rss')
+        self.item = testobjects.make_item(self.feed, u'my item')
+        app.db.finish_transaction()
+        self.tracker = Item.change_tracker
+        self.tracker.reset()
+        self.item_changes = []
+        self.tracker.connect('item-changes', self.on_item_changes)
+
+    def on_item_changes(self, tracker, msg):
+        self.item_changes.append(msg)
+
+    def change_item(self, success=True):
+        self.item.title = u'new title'
+        self.item.signal_change()
+        app.db.on_event_finished(None, success)
+        self.tracker.after_event_finished(None, success)
+
+    def test_send_changes(self):
+        self.change_item()
+        self.assertEquals(len(self.item_changes), 1)
+        self.assertEquals(self.item_changes[0].changed, set([self.item.id]))
+
+    def test_group_commit(self):
+        # with group commit, we should commit right away, rather than making
+        # the frontend wait for the timeout
+        app.db.set_group_commit(60, 100)
+        self.change_item()
+        self.assert_(not app.db.has_uncommitted_changes())
+        self.assertEquals(len(self.item_changes), 1)
+        self.assertEquals(self.item_changes[0].changed, set([self.item.id]))
+
+    def test_failed_event(self):
+        app.db.set_group_commit(60, 100)
+        with self.allow_warnings():
+            self.change_item(success=False)
+        self.assertEquals(self.item_changes, [])
+        self.assert_(not self.tracker.has_changes())
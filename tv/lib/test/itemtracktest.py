@@ -31,6 +31,7 @@
 
 import datetime
 import itertools
+import Queue
 
 from miro import app
 from miro import downloader
@@ -316,6 +317,19 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
     def test_initial_list(self):
         self.check_tracker_items()
 
+    def test_query_stats(self):
+        itemtrack.query_stats.reset()
+        self.setup_tracker()
+        with self.connection_pool.context() as connection:
+            report = itemtrack.query_stats.get_report(connection)
+        self.assertEquals(len(report['shapes']), 1)
+        shape_report = report['shapes'][0]
+        self.assert_(shape_report['shape'].startswith(
+            "SELECT item.id FROM item"))
+        self.assertEquals(shape_report['count'], 1)
+        self.assertEquals(shape_report['rows'], len(self.tracked_items))
+        self.assert_(len(shape_report['plan']) > 0)
+
     def test_background_fetch(self):
         # test that ItemTracker fetches its rows in the backend using
         # idle callbacks
@@ -448,6 +462,7 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         query = itemtrack.ItemTrackerQuery()
         query.add_condition('feed_id', '=', self.tracked_feed.id)
         query.set_search('foo')
+        query.set_order_by(['release_date'])
         self.tracker.change_query(query)
         self.check_one_signal('list-changed')
         self.check_tracker_items([item1, item3])
@@ -455,6 +470,7 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         query = itemtrack.ItemTrackerQuery()
         query.add_condition('feed_id', '=', self.tracked_feed.id)
         query.set_search('foo baz')
+        query.set_order_by(['release_date'])
         self.tracker.change_query(query)
         self.check_one_signal('list-changed')
         self.check_tracker_items([item3])
@@ -505,6 +521,9 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         # change the query to something that involves downloader columns
         query = itemtrack.ItemTrackerQuery()
         query.add_condition('feed.orig_url', '=', self.tracked_feed.orig_url)
+        # Without an ORDER BY, the order depends on the item index that
+        # sqlite picks.
+        query.set_order_by(['id'])
         self.tracker.change_query(query)
         self.check_one_signal('list-changed')
         self.check_tracker_items()
@@ -749,6 +768,91 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.tracker.connect('will-change', on_will_change)
         self.tracker.on_item_changes(self.get_items_changed_message())
 
+    def test_remove_while_loading_data(self):
+        # test the backend removing an item before all data is loaded
+        item2 = self.tracked_items[1]
+        item2.remove()
+        app.db.finish_transaction()
+        # item2 should still be in the tracker until we get the ItemChanges
+        # message
+        self.assertEquals(self.tracker.get_item(item2.id).id, item2.id)
+        self.process_items_changed_messages()
+        self.assertRaises(KeyError, self.tracker.get_item, item2.id)
+
+    def test_wal_checkpoint(self):
+        # test that we don't hold a read transaction open, which would stop
+        # the WAL file from being checkpointed.
+        self.tracker.get_items()
+        item = self.tracked_items[0]
+        item.title = u'new title'
+        item.signal_change()
+        self.process_items_changed_messages()
+        self.tracker.get_items()
+        app.db.cursor.execute("PRAGMA wal_checkpoint")
+        busy, log_frames, checkpointed_frames = app.db.cursor.fetchone()
+        self.assertEquals(log_frames, checkpointed_frames)
+
+    def test_prefetch_rows(self):
+        # test loading rows in the background with a RowLoader
+        results = Queue.Queue()
+        def result_scheduler(func, *args):
+            results.put((func, args))
+        row_loader = itemtrack.RowLoader(result_scheduler)
+        self.tracker.row_loader = row_loader
+        rows_loaded_handler = mock.Mock()
+        self.tracker.connect('rows-loaded', rows_loaded_handler)
+        self.tracker.prefetch_rows(0, 5)
+        if not self.tracker.item_fetcher.background_fetch:
+            # prefetching isn't supported, rows should be loaded as needed
+            self.assert_(results.empty())
+            self.assertEquals(self.tracker.get_display_row(0).id,
+                              self.tracker.id_list[0])
+            self.assertEquals(self.tracker.prefetch_stats['stalls'], 1)
+            self.check_tracker_items()
+            return
+        # while the rows load, we should get placeholders
+        self.assert_(isinstance(self.tracker.get_display_row(0),
+                                item.LoadingItemInfo))
+        func, args = results.get(timeout=5)
+        func(*args)
+        row_loader.shutdown()
+        self.assertEquals(rows_loaded_handler.call_count, 1)
+        loaded_ids = rows_loaded_handler.call_args[0][1]
+        self.assertSameSet(loaded_ids, self.tracker.id_list[:5])
+        for i in xrange(5):
+            row = self.tracker.get_display_row(i)
+            self.assertEquals(row.id, self.tracker.id_list[i])
+            self.assert_(not isinstance(row, item.DBErrorItemInfo))
+        # row 5 wasn't prefetched, so it has to be loaded synchronously
+        self.assertEquals(self.tracker.get_display_row(5).id,
+                          self.tracker.id_list[5])
+        self.assertEquals(self.tracker.prefetch_stats['prefetch_hits'], 5)
+        self.assertEquals(self.tracker.prefetch_stats['stalls'], 1)
+        self.assertEquals(self.tracker.prefetch_stats['placeholders'], 1)
+        self.check_tracker_items()
+
+    def test_change_while_prefetching(self):
+        # test an item changing while a prefetch is loading it
+        results = Queue.Queue()
+        def result_scheduler(func, *args):
+            results.put((func, args))
+        self.tracker.row_loader = itemtrack.RowLoader(result_scheduler)
+        self.tracker.prefetch_rows(0, len(self.tracker))
+        if not self.tracker.item_fetcher.background_fetch:
+            return
+        func, args = results.get(timeout=5)
+        self.tracker.row_loader.shutdown()
+        changed_item = self.tracked_items[0]
+        changed_item.title = u'new title'
+        changed_item.signal_change()
+        self.process_items_changed_messages()
+        func(*args)
+        # the prefetched data for the changed item is stale, it should have
+        # been dropped
+        self.assertEquals(self.tracker.get_item(changed_item.id).title,
+                          u'new title')
+        self.check_tracker_items()
+
 class ItemTrackTestNonWALMode(ItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
@@ -0,0 +1,403 @@
+import errno
+import httplib
+import os
+import socket
+import threading
+from cStringIO import StringIO
+
+from miro.test.framework import MiroTestCase
+
+from miro.libdaap import libdaap
+from miro.libdaap import subr
+
+class DMAPEncodeTest(MiroTestCase):
+    def test_encode(self):
+        reply = [('mlog', [('mstt', 200), ('mlid', 5)]),
+                 ('minm', 'abc')]
+        data = str(subr.encode_response(reply))
+        self.assertEquals(data,
+                          'mlog\x00\x00\x00\x18'
+                          'mstt\x00\x00\x00\x04\x00\x00\x00\xc8'
+                          'mlid\x00\x00\x00\x04\x00\x00\x00\x05'
+                          'minm\x00\x00\x00\x03abc')
+
+    def test_round_trip(self):
+        reply = [('adbs', [
+            ('mstt', 200),
+            ('mlcl', [
+                ('mlit', [('mikd', 2), ('miid', i), ('minm', 'item %d' % i)])
+                for i in xrange(10)]),
+            ('mudl', [('miid', 11)]),
+        ])]
+        data = str(subr.encode_response(reply))
+        self.assertEquals(subr.decode_response(data), reply)
+
+    def test_bad_value_skipped(self):
+        # values that don't fit in their type get left out
+        reply = [('mstt', 200), ('miid', -1), ('minm', 'abc')]
+        data = str(subr.encode_response(reply))
+        self.assertEquals(subr.decode_response(data),
+                          [('mstt', 200), ('minm', 'abc')])
+
+    def test_encoded_response(self):
+        data = subr.encode_response_data([('minm', 'abc')])
+        response = subr.EncodedResponse(data)
+        self.assertEquals(str(subr.encode_response(response)), data)
+        gzip_stream = subr.encode_response(response, 'gzip')
+        self.assertEquals(gzip_stream.get_headers(),
+                          [('Content-encoding', 'gzip')])
+        # the compressed data is only made once
+        self.assert_(response.gzip_data is not None)
+        self.assertEquals(str(subr.encode_response(response, 'gzip')),
+                          str(gzip_stream))
+
+class DMAPDecodeTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reply = [('adbs', [
+            ('mstt', 200),
+            ('mlcl', [
+                ('mlit', [('mikd', 2), ('miid', i), ('minm', 'item %d' % i)])
+                for i in xrange(3)]),
+            ('mudl', [('miid', 11)]),
+        ])]
+        self.data = subr.encode_response_data(self.reply)
+        self.correct_events = [
+            (None, 'adbs', None),
+            ('adbs', 'mstt', 200),
+            ('adbs', 'mlcl', None),
+        ] + [('mlcl', 'mlit', value) for code, value in self.reply[0][1][1][1]]
+        self.correct_events += [
+            ('adbs', 'mudl', None),
+            ('mudl', 'miid', 11),
+        ]
+
+    def test_truncated(self):
+        self.assertEquals(subr.decode_response('minm\x00\x00\x00\x05abc'),
+                          [(-1, [])])
+        # lists that lie about their length
+        self.assertEquals(subr.decode_response('mlcl\x00\x00\x00\x10'
+                                               'minm\x00\x00\x00\x03abc'),
+                          [('mlcl', [('minm', 'abc')])])
+
+    def test_stream_decoder(self):
+        decoder = subr.DMAPStreamDecoder()
+        self.assertEquals(decoder.feed(self.data), self.correct_events)
+        decoder.close()
+
+    def test_stream_decoder_incremental(self):
+        decoder = subr.DMAPStreamDecoder()
+        events = []
+        for c in self.data:
+            events.extend(decoder.feed(c))
+        self.assertEquals(events, self.correct_events)
+        decoder.close()
+
+    def test_stream_decoder_truncated(self):
+        decoder = subr.DMAPStreamDecoder()
+        decoder.feed(self.data[:-3])
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_stream_decoder_bad_data(self):
+        decoder = subr.DMAPStreamDecoder()
+        self.assertRaises(ValueError, decoder.feed,
+                          'zzzz\x00\x00\x00\x00')
+
+class FakeHTTPResponse(object):
+    def __init__(self, data, content_encoding=None):
+        self.status = 200
+        self.version = 11
+        self.data = StringIO(data)
+        self.content_encoding = content_encoding
+
+    def getheader(self, name):
+        if name == 'Content-encoding':
+            return self.content_encoding
+        return None
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+class DaapClientListingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.client = libdaap.DaapClient('127.0.0.1', 3689)
+        self.client.READ_SIZE = 7
+        reply = [('adbs', [
+            ('mstt', 200),
+            ('mlcl', [
+                ('mlit', [('miid', 1), ('minm', 'one'), ('asfm', 'mp3')]),
+                ('mlit', [('miid', 2), ('minm', 'two')]),
+            ]),
+            ('mudl', [('miid', 3)]),
+        ])]
+        self.data = subr.encode_response_data(reply)
+        self.correct_entries = [
+            ('item', 1, {'dmap.itemname': 'one', 'daap.songformat': 'mp3'}),
+            ('item', 2, {'dmap.itemname': 'two', 'daap.songformat': None}),
+            ('deleted', 3, None),
+        ]
+
+    def check_listing(self, response):
+        meta = 'dmap.itemname,daap.songformat,not.a.real.key'
+        self.assertEquals(list(self.client.iter_listing(response, meta)),
+                          self.correct_entries)
+
+    def test_listing(self):
+        self.check_listing(FakeHTTPResponse(self.data))
+
+    def test_gzip_listing(self):
+        self.check_listing(FakeHTTPResponse(subr.gzip_data(self.data),
+                                            'gzip'))
+
+class ChunkedStreamTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.data = ''.join(chr(i % 256) for i in xrange(100000))
+        self.path = os.path.join(self.tempdir, 'media.mp3')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def make_stream(self, rangehdr=None):
+        start, end = subr.parse_range(rangehdr)
+        return subr.encode_response([(open(self.path, 'rb'), self.path,
+                                      start, end)])
+
+    def send_stream(self, stream):
+        # send stream over a socket and return what was received
+        sender, receiver = socket.socketpair()
+        received = []
+        def read_thread():
+            while True:
+                data = receiver.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        thread = threading.Thread(target=read_thread)
+        thread.start()
+        try:
+            sent = stream.send(sender)
+        finally:
+            sender.close()
+            thread.join()
+            receiver.close()
+        self.assertEquals(sent, len(stream))
+        return ''.join(received)
+
+    def test_parse_range(self):
+        self.assertEquals(subr.parse_range(None), (None, None))
+        self.assertEquals(subr.parse_range('bytes=100-'), (100, None))
+        self.assertEquals(subr.parse_range('bytes=0-0'), (0, 0))
+        self.assertEquals(subr.parse_range('bytes=10-20,30-40'), (10, 20))
+        self.assertEquals(subr.parse_range('bytes=-500'), (-500, None))
+        self.assertEquals(subr.parse_range('bytes=20-10'), (None, None))
+        self.assertEquals(subr.parse_range('items=1-2'), (None, None))
+
+    def test_whole_file(self):
+        stream = self.make_stream()
+        self.assertEquals(len(stream), len(self.data))
+        self.assertEquals(stream.get_rangetext(), '')
+        self.assertEquals(self.send_stream(stream), self.data)
+
+    def test_ranges(self):
+        for rangehdr, start, end in (('bytes=1000-', 1000, 99999),
+                                     ('bytes=0-0', 0, 0),
+                                     ('bytes=500-1499', 500, 1499),
+                                     ('bytes=-100', 99900, 99999),
+                                     ('bytes=99000-200000', 99000, 99999)):
+            stream = self.make_stream(rangehdr)
+            self.assertEquals(stream.get_rangetext(),
+                              'bytes %d-%d/100000' % (start, end))
+            self.assertEquals(self.send_stream(stream),
+                              self.data[start:end+1])
+            self.assertEquals(str(self.make_stream(rangehdr)),
+                              self.data[start:end+1])
+
+    def test_unsatisfiable(self):
+        stream = self.make_stream('bytes=100000-')
+        self.assert_(not stream.satisfiable)
+        self.assertEquals(len(stream), 0)
+        self.assertEquals(stream.get_rangetext(), 'bytes */100000')
+
+    def test_mmap_fallback(self):
+        old_sendfile = subr.sendfile
+        subr.sendfile = None
+        try:
+            stream = self.make_stream('bytes=10-')
+            self.assertEquals(self.send_stream(stream), self.data[10:])
+        finally:
+            subr.sendfile = old_sendfile
+
+    def test_sendfile_eagain(self):
+        # sockets with a timeout are non-blocking underneath, so sendfile()
+        # can fail with EAGAIN.  We should wait and retry, not fall back.
+        calls = []
+        def fake_sendfile(out_fd, in_fd, offset, count):
+            calls.append(offset)
+            if len(calls) == 1:
+                raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            return os.write(out_fd, os.read(in_fd, count))
+        def fail_mmap(sock):
+            raise AssertionError("fell back to mmap")
+        old_sendfile = subr.sendfile
+        subr.sendfile = fake_sendfile
+        try:
+            stream = self.make_stream('bytes=10-')
+            stream._send_with_mmap = fail_mmap
+            self.assertEquals(self.send_stream(stream), self.data[10:])
+        finally:
+            subr.sendfile = old_sendfile
+        self.assertEquals(calls[:2], [10, 10])
+
+    def test_socket_error_not_retried(self):
+        # if the other end goes away, send() should raise instead of trying
+        # the next way of sending the file
+        old_sendfile = subr.sendfile
+        subr.sendfile = None
+        sender, receiver = socket.socketpair()
+        receiver.close()
+        try:
+            stream = self.make_stream()
+            self.assertRaises(socket.error, stream.send, sender)
+        finally:
+            sender.close()
+            subr.sendfile = old_sendfile
+
+class MockPoolBackend(object):
+    def __init__(self):
+        self.revision = 1
+        self.revision_callback = None
+        self.file_path = None
+
+    def get_current_revision(self):
+        return self.revision
+
+    def set_revision_callback(self, callback):
+        self.revision_callback = callback
+
+    def get_revision(self, session, old_revision, request):
+        # only called when the revision has already changed, so it doesn't
+        # have to block.
+        if old_revision == self.revision:
+            raise AssertionError("Pooled server blocked in get_revision()")
+        return self.revision
+
+    def bump_revision(self):
+        self.revision += 1
+        self.revision_callback()
+
+    def get_file(self, item_id, generation, ext, session, get_request_path,
+                 offset=0, chunk=None):
+        return open(self.file_path, 'rb'), self.file_path
+
+class DaapPoolServerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = MockPoolBackend()
+        self.server = libdaap.make_daap_server(self.backend, port=0,
+                                               pool=True, workers=1)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.server_thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        MiroTestCase.tearDown(self)
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.connections.append(conn)
+        return conn
+
+    def request(self, conn, path):
+        conn.request('GET', path)
+        return self.read_reply(conn)
+
+    def read_reply(self, conn):
+        response = conn.getresponse()
+        return response.status, subr.decode_response(response.read())
+
+    def login(self, conn):
+        status, reply = self.request(conn, '/login')
+        self.assertEquals(status, 200)
+        return subr.find_daap_tag('mlid', reply)
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        session = self.login(conn)
+        # the same connection should handle more requests
+        status, reply = self.request(conn, '/server-info')
+        self.assertEquals(status, 200)
+        status, reply = self.request(conn, '/activity?session-id=%d' % session)
+        self.assertEquals(status, 204)
+
+    def test_update_waits_without_worker(self):
+        conn = self.connect()
+        session = self.login(conn)
+        update_path = '/update?session-id=%d&revision-number=1' % session
+        conn.request('GET', update_path)
+        # while the update waits, our only worker should be free to handle
+        # other connections.
+        conn2 = self.connect()
+        self.assertEquals(self.request(conn2, '/server-info')[0], 200)
+        self.assertEquals(len(self.server.waiting), 1)
+        self.backend.bump_revision()
+        status, reply = self.read_reply(conn)
+        self.assertEquals(status, 200)
+        self.assertEquals(subr.find_daap_tag('musr', reply), 2)
+        # if the revision has already changed, we reply right away
+        status, reply = self.request(conn, update_path)
+        self.assertEquals(subr.find_daap_tag('musr', reply), 2)
+
+    def test_stream_without_worker(self):
+        # big enough that the stream can't fit in the socket buffers while
+        # we don't read it
+        data = os.urandom(8 * 1024 * 1024)
+        self.backend.file_path = os.path.join(self.tempdir, 'media.mp3')
+        with open(self.backend.file_path, 'wb') as f:
+            f.write(data)
+        conn = self.connect()
+        session = self.login(conn)
+        conn.request('GET', '/databases/1/items/1.mp3?session-id=%d' %
+                     session)
+        response = conn.getresponse()
+        self.assertEquals(response.status, 200)
+        # while the stream is being sent, our only worker should be free to
+        # handle other connections.
+        conn2 = self.connect()
+        self.assertEquals(self.request(conn2, '/server-info')[0], 200)
+        self.assert_(response.read() == data)
+        # the connection goes back to the pool after the stream
+        status, reply = self.request(conn, '/activity?session-id=%d' % session)
+        self.assertEquals(status, 204)
+
+    def test_maxconn(self):
+        self.server.set_maxconn(1)
+        self.login(self.connect())
+        status, reply = self.request(self.connect(), '/login')
+        self.assertEquals(status, 503)
+
+class ResponseCacheTest(MiroTestCase):
+    def test_revision_change(self):
+        cache = subr.ResponseCache()
+        response = subr.EncodedResponse('data')
+        cache.set(1, 'items', response)
+        self.assertEquals(cache.get(1, 'items'), response)
+        self.assertEquals(cache.get(1, 'playlists'), None)
+        # a new revision throws out the old responses
+        self.assertEquals(cache.get(2, 'items'), None)
+        self.assertEquals(len(cache), 0)
+
+    def test_max_size(self):
+        cache = subr.ResponseCache(max_size=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(1, key, subr.EncodedResponse(key))
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get(1, 'a'), None)
@@ -0,0 +1,128 @@
+import gc
+import os
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from miro import app
+from miro import httpclient
+from miro import memoryreport
+from miro import messagehandler
+from miro import messages
+from miro import util
+from miro.feed import Feed
+from miro.tabs import TabOrder
+from miro.test import testobjects
+from miro.test.framework import EventLoopTest
+from miro.test.messagetest import TestFrontendMessageHandler
+
+class TestCache(util.Cache):
+    def create_new_value(self, key, invalidator=None):
+        return key * 2
+
+class MemoryReportTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        # don't run ps for every report
+        self.patch_function('miro.util.get_mem_usage', lambda: 1000)
+        httpclient.curl_manager.get_memory_counts.return_value = {
+            'transfers': 0}
+        self.feed, self.items = testobjects.make_feed_with_items(10)
+        self.path = os.path.join(self.tempdir, 'memory-report.json')
+        self.reporter = memoryreport.MemoryReporter(self.path)
+
+    def tearDown(self):
+        self.reporter.stop()
+        messages.BackendMessage.reset_handler()
+        messages.FrontendMessage.reset_handler()
+        EventLoopTest.tearDown(self)
+
+    def get_counts(self, subsystem):
+        return memoryreport.get_report()['subsystems'][subsystem]
+
+    def test_report(self):
+        report = memoryreport.get_report()
+        self.assertEquals(report['name'], 'MemoryReport')
+        self.assertEquals(report['rss'], 1000)
+        self.assertSameSet(report['subsystems'].keys(),
+                           ['database', 'messages', 'sharing', 'workers',
+                            'search'])
+        self.assertEquals(report['subsystems']['workers'],
+                          {'worker.tasks_in_progress': 0,
+                           'curl.transfers': 0})
+        # make sure the report can be exported
+        json.dumps(report)
+
+    def test_database(self):
+        counts = self.get_counts('database')
+        self.assertEquals(counts['objects.Item'], 10)
+        self.assertEquals(counts['objects.Feed'], 1)
+        app.db.cache.set('test-category', 1, object())
+        app.db.cache.set('test-category', 2, object())
+        counts = self.get_counts('database')
+        self.assertEquals(counts['cache.test-category'], 2)
+
+    def test_search_index(self):
+        counts = self.get_counts('search')
+        self.assert_(counts['item_fts.segments'] > 0)
+        self.assert_(counts['item_fts.blocks'] >= 0)
+        # devices and shares don't have an item_fts table
+        app.db.cursor.execute("DROP TABLE item_fts")
+        self.assertEquals(self.get_counts('search'), {})
+
+    def test_cache_shrink(self):
+        cache = TestCache(4)
+        for i in range(10):
+            cache.get(i)
+        # shrinking the cache throws out the invalidators too
+        self.assertEquals(len(cache.invalidators), len(cache.dict))
+
+    def test_view_trackers(self):
+        Feed(u'dtv:search')
+        TabOrder(u'channel')
+        test_handler = TestFrontendMessageHandler()
+        messages.FrontendMessage.install_handler(test_handler)
+        messages.BackendMessage.install_handler(
+            messagehandler.BackendMessageHandler(None))
+        messages.TrackChannels().send_to_backend()
+        self.runUrgentCalls()
+        before = self.get_counts('messages')['ChannelTracker.last_sent_info']
+        Feed(u'http://example.com/2')
+        self.runUrgentCalls()
+        after = self.get_counts('messages')['ChannelTracker.last_sent_info']
+        self.assertEquals(after, before + 1)
+
+        messages.QueryMemoryReport().send_to_backend()
+        self.runUrgentCalls()
+        message = test_handler.messages[-1]
+        self.assert_(isinstance(message, messages.CurrentMemoryReport))
+        self.assertEquals(message.report['subsystems']['database']
+                          ['objects.Feed'], 3)
+
+    def test_export(self):
+        self.reporter.export()
+        testobjects.make_item(self.feed, u'new item')
+        report = self.reporter.export()
+        lines = open(self.path).readlines()
+        self.assertEquals(len(lines), 2)
+        self.assertEquals(json.loads(lines[1]), report)
+        growth = memoryreport.find_growth(json.loads(lines[0]), report)
+        self.assert_(('database', 'objects.Item', 10, 11) in growth)
+
+    def test_export_error(self):
+        def broken_report():
+            raise RuntimeError("changed size during iteration")
+        self.patch_function('miro.memoryreport.get_report', broken_report)
+        self.assertRaises(RuntimeError, self.reporter._on_timeout)
+        # we still schedule the next report
+        self.assert_(self.reporter._dc is not None)
+
+    def test_export_rotate(self):
+        self.reporter.MAX_FILE_SIZE = 0
+        self.reporter.export()
+        self.reporter.export()
+        self.reporter.export()
+        self.assertEquals(len(open(self.path).readlines()), 1)
+        self.assertEquals(len(open(self.path + '.old').readlines()), 1)
@@ -48,6 +48,8 @@ class MockMetadataProcessor(object):
             'echonest': {},
         }
         self.canceled_files = set()
+        # sizes of the MutagenBatchTasks we've seen
+        self.batch_sizes = []
         # store the codes we see in query_echonest calls
         self.query_echonest_codes = {}
         self.query_echonest_metadata = {}
@@ -88,6 +90,12 @@ class MockMetadataProcessor(object):
 
         if isinstance(task, workerprocess.MutagenTask):
             self.add_task_data(task.source_path, 'mutagen', task_data)
+        elif isinstance(task, workerprocess.MutagenBatchTask):
+            # handle each path in the batch like a separate MutagenTask
+            self.batch_sizes.append(len(task.source_paths))
+            for path in task.source_paths:
+                self.add_task_data(path, 'mutagen',
+                                   self._batch_task_data(task, path, callback))
         elif isinstance(task, workerprocess.MovieDataProgramTask):
             self.add_task_data(task.source_path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
@@ -95,6 +103,15 @@ class MockMetadataProcessor(object):
         else:
             raise TypeError(task)
 
+    def _batch_task_data(self, batch_task, path, callback):
+        def path_callback(task, result):
+            callback(batch_task,
+                     workerprocess.MutagenBatchResult({path: result}, 0.01))
+        def path_errback(task, error):
+            callback(batch_task,
+                     workerprocess.MutagenBatchResult({path: error}, 0.01))
+        return (batch_task, path_callback, path_errback)
+
     def exec_codegen(self, codegen_info, path, callback, errback):
         task_data = (callback, errback)
         self.add_task_data(path, 'echonest-codegen', task_data)
@@ -1227,6 +1244,36 @@ class MetadataManagerTest(MiroTestCase):
             run_echonest_codegen(i+6, i+7)
         run_echonest(195, 200)
 
+    def test_batching(self):
+        # test that files added with bulk_add() get sent to mutagen in
+        # batches
+        paths = ['/videos/song-%d.mp3' % i for i in xrange(30)]
+        with self.metadata_manager.bulk_add():
+            for p in paths:
+                self.metadata_manager.add_file(p)
+        processor = self.metadata_manager.mutagen_processor
+        self.assertEquals(self.processor.batch_sizes, [10, 10, 10])
+        self.assertSameSet(self.processor.mutagen_paths(), paths)
+        for p in paths[:10]:
+            self.processor.run_mutagen_callback(p, {
+                'file_type': u'audio',
+                'duration': 100,
+            })
+        # each batch took 0.01 seconds per file, so the batch size should
+        # increase
+        self.assert_(processor.batch_size > 10)
+        self.assertEquals(processor.task_count(), 20)
+        self.metadata_manager.run_updates()
+        for p in paths[:10]:
+            status = metadata.MetadataStatus.get_by_path(p)
+            self.assertEquals(status.mutagen_status, status.STATUS_COMPLETE)
+        # test errors for batches
+        with self.allow_warnings():
+            self.processor.run_mutagen_errback(paths[10], IOError())
+        self.metadata_manager.run_updates()
+        status = metadata.MetadataStatus.get_by_path(paths[10])
+        self.assertEquals(status.mutagen_status, status.STATUS_FAILURE)
+
     def test_move(self):
         # add a couple files at different points in the metadata process
         self.check_add_file('foo.avi')
@@ -1567,6 +1614,170 @@ class DeviceMetadataTest(EventLoopTest):
         del device_item_metadata['net_lookup_enabled']
         self.assertDictEquals(device_item_metadata, item_metadata)
 
+class MetadataResultCacheTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.processor = MockMetadataProcessor()
+        self.patch_function('miro.workerprocess.send', self.processor.send)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                                self.tempdir)
+
+    def process_threads(self):
+        # Looking up cached results takes two trips to the thread pool: one
+        # for the fingerprint and one to copy the images.
+        for i in range(2):
+            self.processThreads()
+            self.runPendingIdles()
+
+    def run_updates(self):
+        self.process_threads()
+        self.metadata_manager.run_updates()
+        # results get stored after we calculate the fingerprint in the
+        # thread pool
+        self.process_threads()
+
+    def make_file(self, filename, content):
+        path = os.path.join(self.tempdir, filename)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        return path
+
+    def test_fingerprint(self):
+        calc_fingerprint = metadata.MetadataResultCache.calc_fingerprint
+        path1 = self.make_file('one.mp3', 'a' * 200000)
+        path2 = self.make_file('two.mp3', 'a' * 200000)
+        path3 = self.make_file('three.mp3', 'a' * 199999 + 'b')
+        self.assertEquals(calc_fingerprint(path1), calc_fingerprint(path2))
+        self.assertNotEquals(calc_fingerprint(path1), calc_fingerprint(path3))
+        self.assertEquals(calc_fingerprint(os.path.join(self.tempdir, 'x')),
+                          None)
+
+    def test_lru(self):
+        cache = metadata.MetadataResultCache(2)
+        cache.set('a', u'mutagen', {'title': u'a'})
+        cache.set('b', u'mutagen', {'title': u'b'})
+        # access a so that b is the least recently used
+        self.assertEquals(cache.get('a', u'mutagen'), {'title': u'a'})
+        cache.set('c', u'mutagen', {'title': u'c'})
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b', u'mutagen'), None)
+        self.assertEquals(cache.get('a', u'mutagen'), {'title': u'a'})
+        self.assertEquals(cache.get('a', u'movie-data'), None)
+
+    def test_reuse_result(self):
+        path1 = self.make_file('one.mp3', 'a' * 1000)
+        path2 = self.make_file('two.mp3', 'a' * 1000)
+        self.metadata_manager.add_file(path1)
+        self.processor.run_mutagen_callback(path1, {
+            'file_type': u'audio',
+            'duration': 100,
+            'title': u'Title',
+        })
+        self.run_updates()
+        # path2 has the same contents, so we shouldn't run mutagen again
+        self.metadata_manager.add_file(path2)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.run_updates()
+        metadata2 = self.metadata_manager.get_metadata(path2)
+        self.assertEquals(metadata2['title'], u'Title')
+        self.assertEquals(metadata2['duration'], 100)
+        status = metadata.MetadataStatus.get_by_path(path2)
+        self.assertEquals(status.mutagen_status, status.STATUS_COMPLETE)
+        self.assertEquals(status.current_processor, None)
+
+    def test_removed_during_lookup(self):
+        path1 = self.make_file('one.mp3', 'a' * 1000)
+        path2 = self.make_file('two.mp3', 'a' * 1000)
+        self.metadata_manager.add_file(path1)
+        self.processor.run_mutagen_callback(path1, {
+            'file_type': u'audio',
+            'title': u'Title',
+        })
+        self.run_updates()
+        task_count = self.metadata_manager.worker_task_count()
+        # the lookup runs in the thread pool
+        self.metadata_manager.add_file(path2)
+        self.assertEquals(self.metadata_manager.worker_task_count(),
+                          task_count + 1)
+        self.metadata_manager.remove_file(path2)
+        self.assertEquals(self.metadata_manager.worker_task_count(),
+                          task_count)
+        self.run_updates()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertRaises(KeyError, self.metadata_manager.get_metadata, path2)
+
+    def test_size_check(self):
+        cache = metadata.MetadataResultCache()
+        cache.set('1000-a-b', u'mutagen', {'title': u'a'})
+        cache.set('1000-c-d', u'mutagen', {'title': u'c'})
+        self.assert_(cache.has_size(1000))
+        self.assert_(not cache.has_size(2000))
+        cache.remove('1000-a-b')
+        self.assert_(cache.has_size(1000))
+        cache.remove('1000-c-d')
+        self.assert_(not cache.has_size(1000))
+
+    def test_no_fingerprint_for_new_size(self):
+        path1 = self.make_file('one.mp3', 'a' * 1000)
+        path2 = self.make_file('two.mp3', 'a' * 2000)
+        self.metadata_manager.add_file(path1)
+        self.processor.run_mutagen_callback(path1, {
+            'file_type': u'audio',
+        })
+        self.run_updates()
+        # there's nothing cached with path2's size, so we shouldn't read it
+        # in the eventloop
+        mock_calc = self.patch_function(
+            'miro.metadata.MetadataResultCache.calc_fingerprint',
+            mock.Mock(return_value=None))
+        self.metadata_manager.add_file(path2)
+        self.assertEquals(mock_calc.call_count, 0)
+        self.assertEquals(self.processor.mutagen_paths(), [path2])
+
+    def test_different_content(self):
+        path1 = self.make_file('one.mp3', 'a' * 1000)
+        path2 = self.make_file('two.mp3', 'b' * 1000)
+        self.metadata_manager.add_file(path1)
+        self.processor.run_mutagen_callback(path1, {
+            'file_type': u'audio',
+            'duration': 100,
+            'title': u'Title',
+        })
+        self.run_updates()
+        self.metadata_manager.add_file(path2)
+        self.process_threads()
+        self.assertEquals(self.processor.mutagen_paths(), [path2])
+
+    def test_screenshot_copied(self):
+        path1 = self.make_file('one.avi', 'a' * 1000)
+        path2 = self.make_file('two.avi', 'a' * 1000)
+        screenshot = self.make_file('one.avi.png', 'PNG DATA')
+        self.metadata_manager.add_file(path1)
+        self.processor.run_mutagen_callback(path1, {
+            'file_type': u'video',
+        })
+        self.run_updates()
+        self.processor.run_movie_data_callback(path1, {
+            'file_type': u'video',
+            'duration': 100,
+            'screenshot': screenshot,
+        })
+        self.run_updates()
+        self.metadata_manager.add_file(path2)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [])
+        # once the cached mutagen result is in, we look up the movie data
+        # result
+        self.run_updates()
+        self.run_updates()
+        screenshot2 = self.metadata_manager.get_metadata(path2)['screenshot']
+        # each item should get its own screenshot file, since we delete it
+        # with the item
+        self.assertNotEquals(screenshot2, screenshot)
+        self.assertEquals(open(screenshot2).read(), 'PNG DATA')
+
 class TestCodegen(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
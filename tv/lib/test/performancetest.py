@@ -0,0 +1,837 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""performancetest -- Benchmarks for large libraries.
+
+These tests create a synthetic library that's much bigger than the fixtures
+that the other tests use, then time the code paths that slow down as the
+library grows:
+
+- restoring the database at startup
+- opening and scrolling the item list tabs
+- running the tab queries with and without the indexes that the index
+  advisor proposed
+- searching
+- reconciling a feed update with the items we already have
+- importing metadata for new files
+- listing items for the DAAP server
+- scanning a device for files
+- the memory used by objects restored from the database
+
+They aren't run by default.  Run them by naming the module or one of its
+classes::
+
+    ./test.sh performancetest
+    ./test.sh performancetest.TabBenchmark
+
+The tests only check that the results are correct, the timings are
+collected and printed at the end of the run.  These environment variables
+control the run:
+
+- MIRO_BENCHMARK_SCALE -- multiply the size of the library by this (default
+  1.0, which is 10000 items)
+- MIRO_BENCHMARK_RESULTS -- write the results as JSON to this path
+- MIRO_BENCHMARK_BASELINE -- compare the results against a JSON file
+  written by an earlier run and list the benchmarks that got slower
+
+To compare two commits, run the benchmarks on the first one with
+MIRO_BENCHMARK_RESULTS set, then on the second with MIRO_BENCHMARK_BASELINE
+set to the same file.
+"""
+
+import datetime
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from miro import app
+from miro import database
+from miro import devices
+from miro import feed
+from miro import feedparserutil
+from miro import item
+from miro import metadata
+from miro import models
+from miro import prefs
+from miro import schema
+from miro import sharing
+from miro import startup
+from miro.data import indexadvisor
+from miro.data import itemtrack
+from miro.data.item import ItemSource
+from miro.fileobject import FilenameType
+from miro.test import mock
+from miro.test import testobjects
+from miro.test.framework import EventLoopTest, MiroTestCase
+from miro.test.metadatatest import MockMetadataProcessor
+
+SCALE = float(os.environ.get('MIRO_BENCHMARK_SCALE', 1.0))
+RESULTS_PATH = os.environ.get('MIRO_BENCHMARK_RESULTS')
+BASELINE_PATH = os.environ.get('MIRO_BENCHMARK_BASELINE')
+# benchmarks whose median is this much slower than the baseline get
+# reported.  Differences under SLOWER_MIN_TIME seconds are just noise.
+SLOWER_THRESHOLD = 0.2
+SLOWER_MIN_TIME = 0.001
+
+def scaled(count):
+    return max(int(count * SCALE), 1)
+
+class BenchmarkResults(object):
+    """Collects the timings for a benchmark run."""
+    def __init__(self):
+        # maps benchmark names to dicts with the keys times, median and
+        # params
+        self.benchmarks = {}
+
+    def add(self, name, times, **params):
+        times = sorted(times)
+        self.benchmarks[name] = {
+            'times': times,
+            'median': times[len(times) // 2],
+            'params': params,
+        }
+
+    def to_dict(self):
+        return {
+            'revision': get_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'scale': SCALE,
+            'benchmarks': self.benchmarks,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def find_slower(self, baseline, threshold=SLOWER_THRESHOLD):
+        """Find benchmarks that got slower since an earlier run.
+
+        :param baseline: dict returned by to_dict() for the earlier run
+        :returns: list of (name, baseline median, median) tuples
+        """
+        slower = []
+        for name, info in sorted(self.benchmarks.items()):
+            try:
+                baseline_median = baseline['benchmarks'][name]['median']
+            except KeyError:
+                continue
+            if (info['median'] > baseline_median * (1 + threshold) and
+                    info['median'] - baseline_median > SLOWER_MIN_TIME):
+                slower.append((name, baseline_median, info['median']))
+        return slower
+
+    def print_report(self, stream, baseline=None):
+        stream.write("\nbenchmark results (scale: %s)\n" % SCALE)
+        for name, info in sorted(self.benchmarks.items()):
+            stream.write("%-40s %0.4fs\n" % (name, info['median']))
+        if baseline is not None:
+            slower = self.find_slower(baseline)
+            if baseline['scale'] != SCALE:
+                stream.write("\nbaseline was run with scale: %s\n" %
+                             baseline['scale'])
+            stream.write("\n%d benchmarks slower than %s (%s)\n" %
+                         (len(slower), BASELINE_PATH, baseline['revision']))
+            for name, baseline_median, median in slower:
+                stream.write("%-40s %0.4fs -> %0.4fs\n" %
+                             (name, baseline_median, median))
+
+results = BenchmarkResults()
+
+def get_revision():
+    """Get the git revision that we're running, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def tearDownModule():
+    if not results.benchmarks:
+        return
+    baseline = None
+    if BASELINE_PATH:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    results.print_report(sys.stderr, baseline)
+    if RESULTS_PATH:
+        results.write(RESULTS_PATH)
+
+def time_runs(func, runs):
+    """Call func runs times and return a list of how long each call took."""
+    times = []
+    for i in xrange(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+# words to make up titles with, so that searches have something to find
+TITLE_WORDS = [u'news', u'music', u'video', u'episode', u'interview',
+               u'live', u'review', u'show', u'tutorial', u'trailer',
+               u'concert', u'podcast', u'weekly', u'special', u'highlights',
+               u'documentary', u'lecture', u'comedy', u'sports', u'travel']
+
+class LibraryGenerator(object):
+    """Creates a synthetic library in app.db.
+
+    Feeds and playlists are created with the normal DDBObject code.  For
+    items we create one template Item and FileItem, then insert copies of
+    their rows with the columns that differ between items changed.  That's
+    much faster than creating Item objects, but the rows still go through
+    LiveStorage's converters, so they're the same as what the item code
+    saves.  The fulltext search triggers fill in item_fts as usual.
+
+    Downloaded items are FileItems with a metadata_status row and a mutagen
+    metadata entry, like they have once the metadata manager is done with
+    them.  Their files don't exist.
+    """
+
+    def __init__(self, media_dir, feed_count, items_per_feed,
+                 downloaded_ratio=0.2, playlist_count=10, playlist_size=100,
+                 seed=1):
+        self.media_dir = media_dir
+        self.feed_count = feed_count
+        self.items_per_feed = items_per_feed
+        self.downloaded_ratio = downloaded_ratio
+        self.playlist_count = playlist_count
+        self.playlist_size = playlist_size
+        self.random = random.Random(seed)
+        self.feeds = []
+        self.playlists = []
+        self.item_ids = []
+        self.downloaded_ids = []
+
+    def params(self):
+        return {
+            'feeds': self.feed_count,
+            'items': len(self.item_ids),
+            'downloaded': len(self.downloaded_ids),
+        }
+
+    def generate(self):
+        self.feeds = [testobjects.make_feed()
+                      for i in xrange(self.feed_count)]
+        template = testobjects.make_item(self.feeds[0], u'template')
+        file_template = testobjects.make_file_item(self.feeds[0],
+                                                   u'file-template',
+                                                   ext='.mp3')
+        app.db.finish_transaction()
+        next_id = app.db.get_last_id() + 1
+        items = []
+        file_items = []
+        statuses = []
+        entries = []
+        start_date = datetime.datetime(2010, 1, 1)
+        for feed_ in self.feeds:
+            feed_title = feed_.get_title()
+            for i in xrange(self.items_per_feed):
+                item_id = next_id
+                next_id += 1
+                title = u'%s %d' % (
+                    u' '.join(self.random.sample(TITLE_WORDS, 3)), item_id)
+                release_date = start_date + datetime.timedelta(
+                    minutes=self.random.randint(0, 1000000))
+                values = {
+                    'id': item_id,
+                    'feed_id': feed_.id,
+                    'parent_title': feed_title,
+                    'title': title,
+                    'entry_title': title,
+                    'rss_id': u'guid-%d' % item_id,
+                    'release_date': release_date,
+                    'creation_time': release_date,
+                }
+                self.item_ids.append(item_id)
+                if self.random.random() >= self.downloaded_ratio:
+                    values['url'] = u'http://example.com/%d.mkv' % item_id
+                    items.append(values)
+                    continue
+                self.downloaded_ids.append(item_id)
+                file_type = self.random.choice([u'audio', u'video'])
+                if file_type == u'audio':
+                    filename = 'item-%d.mp3' % item_id
+                else:
+                    filename = 'item-%d.mp4' % item_id
+                path = os.path.join(self.media_dir, filename)
+                downloaded_time = release_date + datetime.timedelta(days=1)
+                values.update({
+                    'url': u'file://%s' % path,
+                    'filename': path,
+                    'short_filename': filename,
+                    'enclosure_format': os.path.splitext(filename)[1],
+                    'file_type': file_type,
+                    'downloaded_time': downloaded_time,
+                })
+                if self.random.random() < 0.5:
+                    values['watched_time'] = downloaded_time
+                    values['last_watched'] = downloaded_time
+                file_items.append(values)
+                status_id = next_id
+                next_id += 1
+                statuses.append({
+                    'id': status_id,
+                    'path': path,
+                    'file_type': file_type,
+                    'mutagen_status': metadata.MetadataStatus.STATUS_COMPLETE,
+                    'moviedata_status': metadata.MetadataStatus.STATUS_SKIP,
+                    'echonest_status': metadata.MetadataStatus.STATUS_SKIP,
+                    'finished_status':
+                        metadata.MetadataStatus.FINISHED_STATUS_VERSION,
+                    'max_entry_priority':
+                        metadata.MetadataEntry.source_priority_map['mutagen'],
+                })
+                entries.append({
+                    'id': next_id,
+                    'status_id': status_id,
+                    'source': u'mutagen',
+                    'priority':
+                        metadata.MetadataEntry.source_priority_map['mutagen'],
+                    'disabled': False,
+                    'file_type': file_type,
+                    'duration': self.random.randint(60, 3600) * 1000,
+                    'title': title,
+                    'album': u'album %d' % (item_id % 100),
+                    'artist': u'artist %d' % (item_id % 50),
+                    'drm': False,
+                })
+                next_id += 1
+        self.copy_rows(models.Item, template.id, items)
+        self.copy_rows(models.FileItem, file_template.id, file_items)
+        status = metadata.MetadataStatus.get_by_path(file_template.filename)
+        self.copy_rows(metadata.MetadataStatus, status.id, statuses)
+        self.copy_rows(metadata.MetadataEntry, None, entries)
+        app.db_info.update_last_id()
+        # The metadata manager reads the paths it knows about when it's
+        # created, make a new one that knows about the rows we added.
+        item.setup_metadata_manager(self.media_dir, self.media_dir)
+        for i in xrange(self.playlist_count):
+            item_ids = self.random.sample(self.item_ids,
+                                          min(self.playlist_size,
+                                              len(self.item_ids)))
+            self.playlists.append(models.SavedPlaylist(u'playlist %d' % i,
+                                                       item_ids))
+        app.db.finish_transaction()
+
+    def copy_rows(self, obj_class, template_id, rows):
+        """Insert copies of a row with some values changed.
+
+        :param obj_class: DDBObject class for the table
+        :param template_id: id of the row to copy, if None then values
+            start out as None
+        :param rows: list of dicts mapping column names to the values to
+            change for each copy
+        """
+        schema = app.db._schema_map[obj_class]
+        columns = [name for name, schema_item in schema.fields]
+        if template_id is None:
+            template = dict.fromkeys(columns)
+        else:
+            app.db.cursor.execute("SELECT %s FROM %s WHERE id=?" %
+                                  (', '.join(columns), schema.table_name),
+                                  (template_id,))
+            decoder = app.db._converter.row_decoder(schema, as_dict=True)
+            template = decoder(app.db.cursor.fetchone())
+        encoder = app.db._converter.row_encoder(schema)
+        def make_row(changes):
+            values = template.copy()
+            values.update(changes)
+            return encoder([values[name] for name in columns])
+        app.db.cursor.executemany(app.db._insert_sql_for_schema(schema),
+                                  [make_row(changes) for changes in rows])
+
+class LibraryBenchmark(EventLoopTest):
+    """Base class for benchmarks that run against a synthetic library.
+
+    The library is stored on disk, like it is for a real user, and the data
+    package is set up so that ItemTrackers can use it.
+    """
+    FEED_COUNT = 100
+    ITEMS_PER_FEED = 100
+    RUNS = 3
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.init_data_package()
+        # the metadata manager needs to use the new database
+        item.setup_metadata_manager(self.tempdir, self.tempdir)
+        self.library = LibraryGenerator(self.make_temp_dir_path(),
+                                        scaled(self.FEED_COUNT),
+                                        self.ITEMS_PER_FEED)
+        self.library.generate()
+
+    def add_result(self, name, times, **params):
+        all_params = self.library.params()
+        all_params.update(params)
+        results.add(name, times, **all_params)
+
+class StartupBenchmark(LibraryBenchmark):
+    def restore(self):
+        # This follows startup_for_frontend(), minus the parts that don't
+        # touch the database.
+        self.reload_database(FilenameType(self.db_path))
+        startup.setup_global_feeds()
+        startup.fix_database_inconsistencies()
+        startup.setup_tabs()
+        item.setup_metadata_manager(self.tempdir, self.tempdir)
+        self.feeds = list(models.Feed.make_view())
+        self.playlists = list(models.SavedPlaylist.make_view())
+
+    def test_startup_restore(self):
+        times = time_runs(self.restore, self.RUNS)
+        self.add_result('startup_restore', times)
+        # the global feeds get added on top of ours
+        self.assertEquals(len(self.feeds),
+                          len(self.library.feeds) + 4)
+        self.assertEquals(len(self.playlists),
+                          len(self.library.playlists))
+
+class TabBenchmark(LibraryBenchmark):
+    # rows to read when scrolling through a tab
+    SCROLL_ROWS = 1000
+
+    def setUp(self):
+        LibraryBenchmark.setUp(self)
+        self.idle_scheduler = mock.Mock()
+
+    def scroll(self, tracker):
+        for i in xrange(min(self.SCROLL_ROWS, len(tracker))):
+            tracker.get_row(i)
+
+    def time_tab(self, name, query):
+        """Time opening a tab and scrolling through it.
+
+        :returns: the number of rows in the tab
+        """
+        open_times = []
+        scroll_times = []
+        for i in xrange(self.RUNS):
+            start = time.time()
+            tracker = itemtrack.ItemTracker(self.idle_scheduler, query.copy(),
+                                            ItemSource())
+            open_times.append(time.time() - start)
+            start = time.time()
+            self.scroll(tracker)
+            scroll_times.append(time.time() - start)
+            row_count = len(tracker)
+            tracker.destroy()
+        self.add_result('tab_open.%s' % name, open_times, rows=row_count)
+        self.add_result('tab_scroll.%s' % name, scroll_times,
+                        rows=min(self.SCROLL_ROWS, row_count))
+        return row_count
+
+    def test_tabs(self):
+        feed_id = self.library.feeds[0].id
+        for tab in testobjects.TABS:
+            row_count = self.time_tab(tab,
+                                      testobjects.make_tab_query(tab, feed_id))
+            if tab == 'feed':
+                # the template items are in the first feed as well
+                self.assertEquals(row_count, self.library.items_per_feed + 2)
+
+    def test_search(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.set_search(u'interview')
+        query.set_order_by(['title'], ['nocase'])
+        row_count = self.time_tab('search', query)
+        app.db.cursor.execute("SELECT COUNT(*) FROM item "
+                              "WHERE title LIKE '%interview%'")
+        self.assertEquals(row_count, app.db.cursor.fetchone()[0])
+
+class FeedRefreshBenchmark(LibraryBenchmark):
+    # entries in the feed.  Each update keeps half of them and adds the same
+    # number of new ones.
+    ENTRY_COUNT = 500
+
+    def setUp(self):
+        LibraryBenchmark.setUp(self)
+        self.entry_count = scaled(self.ENTRY_COUNT)
+        app.config.set(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS,
+                       self.entry_count)
+        self.feed = testobjects.make_feed()
+        self.feed_impl = feed.RSSFeedImpl(self.feed.get_url(),
+                                          ufeed=self.feed)
+        self.feed.finish_generate_feed(self.feed_impl)
+        self.random = random.Random(1)
+
+    def make_parsed(self, first_entry):
+        entries = []
+        for i in xrange(first_entry, first_entry + self.entry_count):
+            entries.append("""\
+<item>
+ <title>%(title)s</title>
+ <guid>refresh-guid-%(i)d</guid>
+ <pubDate>Wed, 16 Mar 2011 12:03:42 EST</pubDate>
+ <enclosure url="http://example.com/refresh/%(i)d.mp4" type="video/mp4" />
+ <description>Description for %(title)s</description>
+</item>""" % {'i': i, 'title': ' '.join(self.random.sample(TITLE_WORDS, 3))})
+        rss = """<?xml version="1.0"?>
+<rss version="2.0">
+ <channel>
+  <title>Benchmark Feed</title>
+  <link>http://example.com/</link>
+  <description>Feed for FeedRefreshBenchmark</description>
+%s
+ </channel>
+</rss>""" % '\n'.join(entries)
+        return feedparserutil.parse(rss)
+
+    def test_feed_refresh(self):
+        # parse everything up front, we only want to time the
+        # reconciliation with the items in the database.
+        shift = self.entry_count // 2
+        parsed_list = [self.make_parsed(i * shift)
+                       for i in xrange(self.RUNS + 1)]
+        self.feed_impl.feedparser_callback(parsed_list[0])
+        app.db.finish_transaction()
+        def refresh():
+            self.feed_impl.feedparser_callback(parsed_list.pop(0))
+            app.db.finish_transaction()
+        del parsed_list[0]
+        times = time_runs(refresh, self.RUNS)
+        self.add_result('feed_refresh', times, entries=self.entry_count,
+                        new_entries=self.entry_count - shift)
+        rss_ids = set(i.get_rss_id() for i in self.feed.items)
+        last_first_entry = self.RUNS * shift
+        for i in xrange(last_first_entry,
+                        last_first_entry + self.entry_count):
+            self.assert_('refresh-guid-%d' % i in rss_ids)
+
+class MetadataImportBenchmark(LibraryBenchmark):
+    FILE_COUNT = 1000
+
+    def setUp(self):
+        LibraryBenchmark.setUp(self)
+        self.file_count = scaled(self.FILE_COUNT)
+        self.processor = MockMetadataProcessor()
+        self.patch_function('miro.workerprocess.send', self.processor.send)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                                self.tempdir)
+        self.run_count = 0
+
+    def import_files(self):
+        paths = ['/import-%d/song-%d.mp3' % (self.run_count, i)
+                 for i in xrange(self.file_count)]
+        self.run_count += 1
+        with self.metadata_manager.bulk_add():
+            for path in paths:
+                self.metadata_manager.add_file(path)
+        # the mutagen batches get sent as the earlier ones finish
+        while self.processor.mutagen_paths():
+            for path in self.processor.mutagen_paths():
+                self.processor.run_mutagen_callback(path, {
+                    'file_type': u'audio',
+                    'duration': 100,
+                    'title': u'song',
+                    'album': u'album',
+                })
+            self.metadata_manager.run_updates()
+        app.db.finish_transaction()
+        return paths
+
+    def test_metadata_import(self):
+        times = time_runs(self.import_files, self.RUNS)
+        self.add_result('metadata_import', times, files=self.file_count)
+        status = metadata.MetadataStatus.get_by_path(
+            '/import-0/song-%d.mp3' % (self.file_count - 1))
+        self.assertEquals(status.mutagen_status, status.STATUS_COMPLETE)
+
+class SharingBenchmark(LibraryBenchmark):
+    def setUp(self):
+        LibraryBenchmark.setUp(self)
+        startup.setup_tabs()
+        app.config.set(prefs.SHARE_AUDIO, True)
+        app.config.set(prefs.SHARE_VIDEO, True)
+        app.config.set(prefs.SHARE_FEED, True)
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop_tracking()
+        LibraryBenchmark.tearDown(self)
+
+    def list_items(self):
+        backend = sharing.SharingManagerBackend()
+        self.backends.append(backend)
+        backend.start_tracking()
+        self.daap_items = backend.get_items()
+
+    def test_daap_list(self):
+        times = time_runs(self.list_items, self.RUNS)
+        self.add_result('daap_list', times)
+        valid_ids = [daap_id for daap_id, daap_data in self.daap_items.items()
+                     if daap_data['valid']]
+        # the template file item gets shared as well
+        self.assertEquals(len(valid_ids), len(self.library.downloaded_ids) + 1)
+
+class DeviceScanBenchmark(LibraryBenchmark):
+    FILE_COUNT = 1000
+
+    def setUp(self):
+        LibraryBenchmark.setUp(self)
+        self.file_count = scaled(self.FILE_COUNT)
+        self.device = testobjects.make_mock_device()
+        for directory, ext, count in (('Music', 'mp3', self.file_count // 2),
+                                      ('Video', 'mp4', self.file_count -
+                                       self.file_count // 2)):
+            os.makedirs(os.path.join(self.device.mount, directory))
+            for i in xrange(count):
+                path = os.path.join(self.device.mount, directory,
+                                    'file-%d.%s' % (i, ext))
+                with open(path, 'w') as f:
+                    f.write("fake-data")
+        app.device_manager = mock.Mock()
+        app.device_manager.running = True
+        app.device_manager._is_hidden.return_value = False
+
+    def tearDown(self):
+        del app.device_manager
+        LibraryBenchmark.tearDown(self)
+
+    def scan(self):
+        devices.scan_device_for_files(self.device)
+        self.runPendingIdles()
+
+    def test_device_scan(self):
+        # the first scan adds all the files, later ones find nothing new
+        self.add_result('device_scan.initial', time_runs(self.scan, 1),
+                        files=self.file_count)
+        self.add_result('device_scan.rescan', time_runs(self.scan, self.RUNS),
+                        files=self.file_count)
+        device_items = models.DeviceItem.make_view(db_info=self.device.db_info)
+        self.assertEquals(len(list(device_items)), self.file_count)
+
+def object_size(obj):
+    """Calculate how many bytes obj and its attribute dict use."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+class SignalBenchmarkObject(database.DDBObject):
+    pass
+
+class SignalBenchmarkObjectSchema(schema.ObjectSchema):
+    klass = SignalBenchmarkObject
+    table_name = 'signal_benchmark'
+    fields = [
+        ('id', schema.SchemaInt()),
+    ]
+
+class SignalMemoryBenchmark(MiroTestCase):
+    """Restore a big table of objects that nothing connects to.
+
+    The objects shouldn't allocate any signal tables.
+    """
+    OBJECT_COUNT = 100000
+    RUNS = 3
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.object_count = scaled(self.OBJECT_COUNT)
+        self.reload_database(schema_version=0,
+                object_schemas=[SignalBenchmarkObjectSchema])
+        app.db.cursor.executemany(
+            "INSERT INTO signal_benchmark (id) VALUES (?)",
+            ((i,) for i in xrange(self.object_count)))
+        app.db_info.update_last_id()
+
+    def restore(self):
+        app.db.forget_all_objects()
+        self.objects = list(SignalBenchmarkObject.make_view())
+
+    def test_restore(self):
+        times = time_runs(self.restore, self.RUNS)
+        size = sum(object_size(obj) for obj in self.objects)
+        results.add('signal_memory.restore', times,
+                    objects=self.object_count, bytes=size)
+        self.assertEquals(len(self.objects), self.object_count)
+        for obj in self.objects:
+            self.assert_('signal_callbacks' not in obj.__dict__)
+
+class CompactBenchmarkObject(database.DDBObject):
+    compact_storage = True
+
+class CompactBenchmarkObjectSchema(schema.ObjectSchema):
+    klass = CompactBenchmarkObject
+    table_name = 'compact_benchmark'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('name', schema.SchemaString()),
+        ('count', schema.SchemaInt()),
+        ('data', schema.SchemaDict(schema.SchemaString(),
+                                   schema.SchemaInt())),
+    ]
+
+class NormalBenchmarkObject(CompactBenchmarkObject):
+    compact_storage = False
+
+class NormalBenchmarkObjectSchema(CompactBenchmarkObjectSchema):
+    klass = NormalBenchmarkObject
+    table_name = 'normal_benchmark'
+
+class CompactStorageBenchmark(MiroTestCase):
+    """Compare restoring objects that store their fields in __slots__ with
+    restoring ones that use __dict__.
+    """
+    OBJECT_COUNT = 20000
+    RUNS = 3
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.object_count = scaled(self.OBJECT_COUNT)
+        self.reload_database(schema_version=0,
+                object_schemas=[CompactBenchmarkObjectSchema,
+                                NormalBenchmarkObjectSchema])
+        for klass in (CompactBenchmarkObject, NormalBenchmarkObject):
+            app.db.cursor.executemany(
+                "INSERT INTO %s (id, name, count, data) "
+                "VALUES (?, ?, ?, '{}')" % app.db.table_name(klass),
+                ((i, u'object-%d' % i, i) for i in
+                 xrange(self.object_count)))
+        app.db_info.update_last_id()
+
+    def time_restore(self, name, klass):
+        """Time restoring the objects for klass.
+
+        :returns: the number of bytes that the objects use
+        """
+        def restore():
+            app.db.forget_all_objects()
+            self.objects = list(klass.make_view())
+        times = time_runs(restore, self.RUNS)
+        self.assertEquals(len(self.objects), self.object_count)
+        size = sum(object_size(obj) for obj in self.objects)
+        results.add('compact_storage.%s' % name, times,
+                    objects=self.object_count, bytes=size)
+        return size
+
+    def test_restore(self):
+        compact_size = self.time_restore('compact', CompactBenchmarkObject)
+        normal_size = self.time_restore('normal', NormalBenchmarkObject)
+        self.assert_(compact_size < normal_size)
+
+class TabIndexBenchmark(MiroTestCase):
+    """Compare the tab queries with and without the indexes from upgrade202.
+
+    This uses its own item table, with remote_downloader rows that are as
+    big as the ones for torrents, since that's what makes scanning
+    remote_downloader slow.
+    """
+    ITEM_COUNT = 100000
+    FEED_COUNT = 200
+    RUNS = 3
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database()
+        itemtrack.query_stats.reset()
+        self.item_count = scaled(self.ITEM_COUNT)
+        feed_count = scaled(self.FEED_COUNT)
+        r = random.Random(1)
+        cursor = app.db.cursor
+        cursor.executemany("INSERT INTO feed (id, orig_url) VALUES (?, ?)",
+                           ((i, u'http://example.com/%d' % i)
+                            for i in xrange(1, feed_count + 1)))
+        start_date = datetime.datetime(2010, 1, 1)
+        items = []
+        downloaders = []
+        for i in xrange(1, self.item_count + 1):
+            release_date = start_date + datetime.timedelta(
+                minutes=r.randint(0, 1000000))
+            downloader_id = file_type = downloaded_time = None
+            watched_time = last_watched = None
+            # about 1 in 5 items are downloaded
+            if r.random() < 0.2:
+                downloader_id = i
+                file_type = r.choice([u'video', u'audio', u'other'])
+                downloaded_time = start_date + datetime.timedelta(minutes=i)
+                if r.random() < 0.5:
+                    watched_time = last_watched = downloaded_time
+                if r.random() < 0.005:
+                    state = u'downloading'
+                else:
+                    state = u'finished'
+                downloaders.append((downloader_id, state, i))
+            items.append((i, r.randint(1, feed_count), downloader_id,
+                          file_type, release_date, downloaded_time,
+                          watched_time, last_watched, u'item %d' % i))
+        cursor.executemany("INSERT INTO item (id, is_file_item, feed_id, "
+                           "downloader_id, file_type, deleted, expired, "
+                           "pending_manual_download, release_date, "
+                           "downloaded_time, watched_time, last_watched, "
+                           "title) "
+                           "VALUES (?, 0, ?, ?, ?, 0, 0, 0, ?, ?, ?, ?, ?)",
+                           items)
+        # metainfo makes the downloader rows as big as they are for torrents
+        cursor.executemany("INSERT INTO remote_downloader "
+                           "(id, state, main_item_id, metainfo) "
+                           "VALUES (?, ?, ?, zeroblob(2000))", downloaders)
+        app.db.finish_transaction()
+
+    def analyze(self):
+        # DatabaseMaintenance runs ANALYZE, so the query planner has
+        # statistics to work with on a real database.
+        app.db.cursor.execute("ANALYZE")
+
+    def time_tabs(self, name):
+        for tab in testobjects.TABS:
+            query = testobjects.make_tab_query(tab)
+            times = time_runs(lambda: query.select_ids(app.db.connection),
+                              self.RUNS)
+            results.add('tab_index.%s.%s' % (tab, name), times,
+                        items=self.item_count)
+
+    def test_tab_index(self):
+        testobjects.drop_tab_indexes(app.db.cursor)
+        self.analyze()
+        self.time_tabs('before')
+        advisor = indexadvisor.IndexAdvisor(app.db.connection)
+        self.assertSameSet([(p.table, p.columns)
+                            for p in advisor.propose(itemtrack.query_stats)],
+                           [(table, columns)
+                            for (name, table, columns)
+                            in testobjects.TAB_INDEXES])
+        testobjects.create_tab_indexes(app.db.cursor)
+        self.analyze()
+        self.time_tabs('after')
@@ -80,8 +80,10 @@ class PlaylistTestCase(PlaylistTestBase):
         tracker.connect('added', self.add_callback)
         tracker.connect('removed', self.remove_callback)
         playlist.add_item(self.i4)
+        self.flush_test_changes()
         self.check_callbacks([self.i4], [])
         playlist.remove_item(self.i3)
+        self.flush_test_changes()
         self.check_callbacks([self.i4], [self.i3])
 
     def test_expire_removes_item(self):
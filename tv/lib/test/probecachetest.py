@@ -0,0 +1,89 @@
+import os
+import time
+
+from miro.test.framework import MiroTestCase
+
+from miro import probecache
+
+class ProbeCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_path = os.path.join(self.tempdir, 'probe-cache')
+        self.cache = probecache.ProbeCache(self.cache_path)
+        self.media_path = os.path.join(self.tempdir, 'video.mp4')
+        self.write_media_file('data')
+        self.probe_count = 0
+
+    def write_media_file(self, data):
+        f = open(self.media_path, 'wb')
+        f.write(data)
+        f.close()
+
+    def probe(self, path):
+        self.probe_count += 1
+        return {'container': 'mp4', 'count': self.probe_count}
+
+    def test_get(self):
+        result = self.cache.get('media-info', self.media_path, self.probe)
+        self.assertEquals(result['count'], 1)
+        result = self.cache.get('media-info', self.media_path, self.probe)
+        self.assertEquals(result['count'], 1)
+        # different kinds are stored separately
+        self.cache.get('needs-transcode', self.media_path, self.probe)
+        self.assertEquals(self.probe_count, 2)
+
+    def test_file_changed(self):
+        self.cache.get('media-info', self.media_path, self.probe)
+        self.write_media_file('new data')
+        result = self.cache.get('media-info', self.media_path, self.probe)
+        self.assertEquals(result['count'], 2)
+
+    def test_errors_not_cached(self):
+        def probe_error(path):
+            raise ValueError("no input #0")
+        self.assertRaises(ValueError, self.cache.get, 'media-info',
+                          self.media_path, probe_error)
+        self.assertEquals(len(self.cache), 0)
+
+    def test_max_size(self):
+        cache = probecache.ProbeCache(self.cache_path, max_size=2)
+        paths = []
+        for i in xrange(3):
+            path = os.path.join(self.tempdir, 'video-%d.mp4' % i)
+            open(path, 'wb').write('data')
+            paths.append(path)
+            cache.get('media-info', path, self.probe)
+        self.assertEquals(len(cache), 2)
+        # the first path should have been evicted
+        cache.get('media-info', paths[0], self.probe)
+        self.assertEquals(self.probe_count, 4)
+
+    def test_save_and_load(self):
+        self.cache.get('media-info', self.media_path, self.probe)
+        self.cache.save()
+        cache2 = probecache.ProbeCache(self.cache_path)
+        cache2.load()
+        result = cache2.get('media-info', self.media_path, self.probe)
+        self.assertEquals(result['count'], 1)
+        self.assertEquals(self.probe_count, 1)
+
+    def test_load_bad_file(self):
+        open(self.cache_path, 'wb').write('bad data')
+        with self.allow_warnings():
+            self.cache.load()
+        self.assertEquals(len(self.cache), 0)
+
+    def test_prefetch(self):
+        self.cache.prefetch([self.media_path], self.cache_probe)
+        for i in xrange(50):
+            if os.path.exists(self.cache_path):
+                break
+            time.sleep(0.1)
+        self.assertEquals(self.probe_count, 1)
+        # prefetch should save the cache once it's done
+        cache2 = probecache.ProbeCache(self.cache_path)
+        cache2.load()
+        self.assertEquals(len(cache2), 1)
+
+    def cache_probe(self, path):
+        return self.cache.get('media-info', path, self.probe)
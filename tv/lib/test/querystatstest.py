@@ -0,0 +1,139 @@
+import os
+import sqlite3
+
+from miro.data import querystats
+from miro.test.framework import MiroTestCase
+
+class QueryStatsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.stats = querystats.QueryStats('test')
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, "
+                                "feed_id INTEGER, title TEXT)")
+        self.connection.execute("CREATE INDEX item_feed ON item (feed_id)")
+
+    def tearDown(self):
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def get_shape_report(self, shape, connection=None):
+        report = self.stats.get_report(connection)
+        for shape_report in report['shapes']:
+            if shape_report['shape'] == shape:
+                return shape_report
+        raise AssertionError("%s not in report" % shape)
+
+    def test_statement_shape(self):
+        self.assertEquals(querystats.statement_shape(
+            "SELECT id FROM item\n  WHERE feed_id=12 AND title='it''s'"),
+            "SELECT id FROM item WHERE feed_id=? AND title=?")
+        self.assertEquals(querystats.statement_shape(
+            "SELECT id FROM item WHERE id IN (1, 2, 3)"),
+            "SELECT id FROM item WHERE id IN (...)")
+        self.assertEquals(querystats.statement_shape(
+            "SELECT id FROM item WHERE id in (?,?)"),
+            "SELECT id FROM item WHERE id IN (...)")
+        # numbers inside names stay
+        self.assertEquals(querystats.statement_shape(
+            "SELECT docid FROM item_fts4 LIMIT 10"),
+            "SELECT docid FROM item_fts4 LIMIT ?")
+
+    def test_record(self):
+        for i in range(100):
+            self.stats.record("SELECT id FROM item WHERE feed_id=%d" % i, (),
+                              i / 100.0, 2)
+        shape_report = self.get_shape_report(
+            "SELECT id FROM item WHERE feed_id=?")
+        self.assertEquals(shape_report['count'], 100)
+        self.assertEquals(shape_report['rows'], 200)
+        self.assertClose(shape_report['total_time'], 49.5)
+        self.assertClose(shape_report['mean_time'], 0.495)
+        self.assertEquals(shape_report['max_time'], 0.99)
+        self.assertEquals(shape_report['p50'], 0.5)
+        self.assertEquals(shape_report['p90'], 0.9)
+        self.assertEquals(shape_report['p99'], 0.99)
+
+    def test_sort_order(self):
+        self.stats.record("SELECT id FROM item", (), 0.1, 0)
+        self.stats.record("SELECT title FROM item", (), 0.5, 0)
+        self.stats.record("SELECT id FROM item", (), 0.1, 0)
+        report = self.stats.get_report()
+        self.assertEquals([r['shape'] for r in report['shapes']],
+                          ["SELECT title FROM item", "SELECT id FROM item"])
+
+    def test_explain(self):
+        self.stats.record("SELECT id FROM item WHERE title=?", (u'foo',),
+                          0.2, 0)
+        self.stats.record("SELECT id FROM item WHERE feed_id=?", (1,), 0.1, 0)
+        self.stats.record("UPDATE item SET title=? WHERE feed_id=?",
+                          (u'foo', 1), 0.3)
+        scan = self.get_shape_report("SELECT id FROM item WHERE title=?",
+                                     self.connection)
+        self.assertEquals(scan['full_scans'], ['item'])
+        self.assert_(len(scan['plan']) > 0)
+        indexed = self.get_shape_report("SELECT id FROM item WHERE feed_id=?",
+                                        self.connection)
+        self.assertEquals(indexed['full_scans'], [])
+        # we only explain SELECT statements
+        update = self.get_shape_report(
+            "UPDATE item SET title=? WHERE feed_id=?", self.connection)
+        self.assert_('plan' not in update)
+        report = self.stats.get_report(self.connection)
+        self.assertEquals(querystats.count_full_scans(report, 'item'), 1)
+
+    def test_explain_count(self):
+        self.stats.record("SELECT id FROM item WHERE title=?", (u'foo',),
+                          0.2, 0)
+        self.stats.record("SELECT id FROM item WHERE feed_id=?", (1,), 0.1, 0)
+        report = self.stats.get_report(self.connection, explain_count=1)
+        self.assertEquals(['plan' in r for r in report['shapes']],
+                          [True, False])
+
+    def test_explain_error(self):
+        self.stats.record("SELECT id FROM missing_table", (), 0.2, 0)
+        with self.allow_warnings():
+            shape_report = self.get_shape_report(
+                "SELECT id FROM missing_table", self.connection)
+        self.assert_('plan' not in shape_report)
+
+    def test_max_shapes(self):
+        self.stats.MAX_SHAPES = 2
+        self.stats.record("SELECT id FROM item", (), 0.1, 0)
+        self.stats.record("SELECT title FROM item", (), 0.1, 0)
+        self.stats.record("SELECT feed_id FROM item", (), 0.1, 0)
+        self.stats.record("SELECT id FROM item", (), 0.1, 0)
+        report = self.stats.get_report()
+        self.assertEquals(len(report['shapes']), 2)
+        self.assertEquals(sum(r['count'] for r in report['shapes']), 3)
+
+    def test_query_shapes(self):
+        self.stats.record("SELECT id FROM item WHERE feed_id=1", (), 0.1, 0,
+                          'feed')
+        self.stats.record("SELECT id FROM item WHERE feed_id IN (1, 2)", (),
+                          0.2, 0, 'feed')
+        self.stats.record("SELECT id FROM item WHERE title=?", (u'foo',),
+                          0.2, 0, 'title')
+        self.stats.record("SELECT title FROM item", (), 0.5, 0)
+        # statements with the same query shape get combined
+        self.assertEquals(
+            [(shape, count) for (shape, count, total_time, example)
+             in self.stats.get_query_shapes()],
+            [('feed', 2), ('title', 1)])
+
+    def test_reset(self):
+        self.stats.record("SELECT id FROM item", (), 0.1, 0)
+        self.stats.reset()
+        self.assertEquals(self.stats.get_report()['shapes'], [])
+
+    def test_write_json(self):
+        self.stats.record("SELECT id FROM item WHERE title=?", (u'foo',),
+                          0.2, 0)
+        path = os.path.join(self.tempdir, 'query-stats.json')
+        reports = [self.stats.get_report(self.connection)]
+        querystats.write_json(path, reports)
+        f = open(path)
+        try:
+            self.assertEquals(querystats.json.load(f), reports)
+        finally:
+            f.close()
@@ -0,0 +1,121 @@
+import os
+import tempfile
+
+from miro.test.framework import MiroTestCase
+
+from miro import segmentcache
+
+class SegmentCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'transcode-cache')
+        self.cache = segmentcache.SegmentCache(self.cache_dir)
+        self.media_path = os.path.join(self.tempdir, 'video.avi')
+        self.write_file(self.media_path, 'data')
+        self.key = self.cache.make_key(self.media_path, 'profile')
+
+    def write_file(self, path, data):
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def make_segment(self, data):
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        return f
+
+    def test_add_and_get(self):
+        self.assertEquals(self.cache.get_segment(self.key, 0), None)
+        segment = self.make_segment('segment 0')
+        self.cache.add_segment(self.key, 0, segment)
+        # the segment should be rewound so the caller can still send it
+        self.assertEquals(segment.read(), 'segment 0')
+        self.assertEquals(self.cache.get_segment(self.key, 0).read(),
+                          'segment 0')
+        self.assert_(self.cache.has_segment(self.key, 0))
+        self.assert_(not self.cache.has_segment(self.key, 1))
+
+    def test_make_key(self):
+        # different profiles and changes to the file give different keys
+        self.assertNotEquals(self.key,
+                             self.cache.make_key(self.media_path, 'other'))
+        self.write_file(self.media_path, 'new data')
+        self.assertNotEquals(self.key,
+                             self.cache.make_key(self.media_path, 'profile'))
+        self.assertEquals(self.cache.make_key(
+            os.path.join(self.tempdir, 'missing.avi'), 'profile'), None)
+
+    def test_find_missing(self):
+        for chunk in (0, 1, 3):
+            self.cache.add_segment(self.key, chunk, self.make_segment('x'))
+        self.assertEquals(self.cache.find_missing(self.key, 0), 2)
+        self.assertEquals(self.cache.find_missing(self.key, 3), 4)
+        self.assert_(not self.cache.is_complete(self.key))
+        self.cache.add_segment(self.key, 2, self.make_segment('x'))
+        self.cache.set_chunk_count(self.key, 4)
+        self.assert_(self.cache.is_complete(self.key))
+
+    def test_max_size(self):
+        cache = segmentcache.SegmentCache(self.cache_dir, max_size=10)
+        for chunk in xrange(3):
+            cache.add_segment(self.key, chunk, self.make_segment('abcd'))
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.total_size, 8)
+        # the least recently used segment should have been evicted
+        self.assertEquals(cache.get_segment(self.key, 0), None)
+        self.assertEquals(cache.find_missing(self.key, 1), 3)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+
+    def test_eviction_forgets_chunk_count(self):
+        cache = segmentcache.SegmentCache(self.cache_dir, max_size=10)
+        cache.add_segment(self.key, 0, self.make_segment('abcd'))
+        cache.add_segment(self.key, 1, self.make_segment('abcd'))
+        cache.set_chunk_count(self.key, 2)
+        self.assert_(cache.is_complete(self.key))
+        other_key = cache.make_key(self.media_path, 'other')
+        cache.add_segment(other_key, 0, self.make_segment('abcd'))
+        self.assertEquals(cache.get_chunk_count(self.key), None)
+
+    def test_pinned(self):
+        cache = segmentcache.SegmentCache(self.cache_dir, max_size=10)
+        cache.pin_key(self.key)
+        for chunk in xrange(3):
+            cache.add_segment(self.key, chunk, self.make_segment('abcd'))
+        # a transcode job is using the segments, so the cache grows past its
+        # max size instead of evicting them
+        self.assertEquals(len(cache), 3)
+        other_key = cache.make_key(self.media_path, 'other')
+        cache.add_segment(other_key, 0, self.make_segment('abcd'))
+        self.assertEquals(cache.get_segment(other_key, 0), None)
+        cache.unpin_key(self.key)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.total_size, 8)
+
+    def test_persistence(self):
+        self.cache.add_segment(self.key, 0, self.make_segment('segment 0'))
+        self.cache.add_segment(self.key, 1, self.make_segment('segment 1'))
+        self.cache.set_chunk_count(self.key, 2)
+        # leftovers from an interrupted copy get cleaned up
+        self.write_file(os.path.join(self.cache_dir, 'tmpabc.part'), 'x')
+        cache = segmentcache.SegmentCache(self.cache_dir)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.total_size, 18)
+        self.assert_(cache.is_complete(self.key))
+        self.assertEquals(cache.get_segment(self.key, 1).read(), 'segment 1')
+        self.assert_(not os.path.exists(
+            os.path.join(self.cache_dir, 'tmpabc.part')))
+
+    def test_persistence_max_size(self):
+        for chunk in xrange(3):
+            self.cache.add_segment(self.key, chunk, self.make_segment('abcd'))
+        cache = segmentcache.SegmentCache(self.cache_dir, max_size=10)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+
+    def test_clear(self):
+        self.cache.add_segment(self.key, 0, self.make_segment('x'))
+        self.cache.set_chunk_count(self.key, 1)
+        self.cache.clear()
+        self.assertEquals(os.listdir(self.cache_dir), [])
+        self.assertEquals(len(self.cache), 0)
+        self.assertEquals(self.cache.get_chunk_count(self.key), None)
@@ -264,6 +264,66 @@ class SharingTest(EventLoopTest):
             {1: 'new-title-1', 3: 'new-title-3'}))
         self.check_client_update()
 
+    def test_resume(self):
+        # test that we only fetch the changes when we re-connect to a share
+        self.share.start_tracking()
+        self.client.set_items(self.make_daap_items(
+            {1: 'title-1', 2: 'title-2'}))
+        self.check_client_connect()
+        self.assertEquals(self.share.get_synced_revision(),
+                          self.client.revision)
+        # the items should stick around after we disconnect
+        self.share.stop_tracking()
+        self.check_tracker_items({1: 'title-1', 2: 'title-2'})
+        # change the items while we're disconnected
+        self.client.set_items(self.make_daap_items(
+            {1: 'new-title-1', 3: 'title-3'}))
+        self.client.update()
+        self.share.start_tracking()
+        result = self.share.tracker.client_connect()
+        self.assert_(result.resumed)
+        self.assertSameSet(result.items.keys(), [1, 3])
+        self.assertEquals(result.deleted_items, [2])
+        self.share.tracker.client_connect_callback(result)
+        self.check_tracker_items({1: 'new-title-1', 3: 'title-3'})
+        self.assertEquals(self.share.get_synced_revision(),
+                          self.client.revision)
+
+    def test_resume_after_server_restart(self):
+        # test that we start from scratch if the server's revision goes
+        # backwards
+        self.share.start_tracking()
+        self.client.set_items(self.make_daap_items(
+            {1: 'title-1', 2: 'title-2'}))
+        self.client.update()
+        self.check_client_connect()
+        self.share.stop_tracking()
+        self.client.set_items(self.make_daap_items({3: 'title-3'}))
+        self.client.revision = 1
+        self.share.start_tracking()
+        result = self.share.tracker.client_connect()
+        self.assert_(not result.resumed)
+        self.share.tracker.client_connect_callback(result)
+        self.check_tracker_items({3: 'title-3'})
+
+    def test_resume_after_server_restart_higher_revision(self):
+        # test that we start from scratch if the server was restarted, even
+        # if its new revision is higher than the one we synced to
+        self.share.start_tracking()
+        self.client.set_items(self.make_daap_items(
+            {1: 'title-1', 2: 'title-2'}))
+        self.check_client_connect()
+        self.share.stop_tracking()
+        self.client.set_items(self.make_daap_items({3: 'title-3'}))
+        self.client.db_persistent_id = 67890
+        self.client.revision = 5
+        self.share.start_tracking()
+        result = self.share.tracker.client_connect()
+        self.assert_(not result.resumed)
+        self.share.tracker.client_connect_callback(result)
+        self.check_tracker_items({3: 'title-3'})
+        self.assertEquals(self.share.get_synced_database_id(), 67890)
+
     def test_playlists(self):
         # test sending TabInfo updates for playlists
 
@@ -438,6 +498,7 @@ class SharingServerTest(EventLoopTest):
         self.assertEquals(self.backend.data_set.revision, old_revision)
 
     def send_changes_from_trackers(self):
+        self.flush_test_changes()
         app.db.finish_transaction()
         models.Item.change_tracker.send_changes()
         self.backend.data_set.after_event_finished(mock.Mock(), True)
@@ -21,10 +21,22 @@ class TestSignaller(signals.SignalEmitter):
     def do_signal_three(self, *args):
         self.signal_three_callbacks.append(args)
 
+class LazyTestSignaller(signals.LazySignalEmitter):
+    signal_names = ('signal1', 'signal2', 'signal-three')
+
+    def __init__(self):
+        signals.LazySignalEmitter.__init__(self)
+        self.signal_three_callbacks = []
+
+    def do_signal_three(self, *args):
+        self.signal_three_callbacks.append(args)
+
 class SignalsTest(MiroTestCase):
+    signaller_class = TestSignaller
+
     def setUp(self):
         self.callbacks = []
-        self.signaller = TestSignaller()
+        self.signaller = self.signaller_class()
         MiroTestCase.setUp(self)
 
     def callback(self, *args):
@@ -107,7 +119,7 @@ class SignalsTest(MiroTestCase):
 
     def test_nested_call_different_objects(self):
         # emiting the same signal on a different object should be okay
-        signaller2 = TestSignaller()
+        signaller2 = self.signaller_class()
         self.signaller.connect('signal1',
                 lambda obj: signaller2.emit('signal1'))
         self.signaller.emit('signal1')
@@ -161,3 +173,41 @@ class SignalsTest(MiroTestCase):
         self.signaller.emit('signal1')
         self.assertEquals(self.callbacks, [])
 
+    def test_weak_callback_count(self):
+        callback_obj = WeakCallbackTester(self)
+        self.signaller.connect('signal1', self.callback)
+        id = self.signaller.connect_weak('signal1', callback_obj.callback)
+        callbacks = self.signaller.get_callbacks('signal1')
+        self.assertEquals(callbacks.weak_count, 1)
+        self.signaller.disconnect(id)
+        self.assertEquals(callbacks.weak_count, 0)
+        self.signaller.connect_weak('signal1', callback_obj.callback)
+        del callback_obj
+        self.signaller.emit('signal1')
+        self.assertEquals(callbacks.weak_count, 0)
+        self.assertEquals(len(callbacks), 1)
+
+class LazySignalsTest(SignalsTest):
+    signaller_class = LazyTestSignaller
+
+    def test_shared_state(self):
+        signaller2 = self.signaller_class()
+        self.assert_('signal_callbacks' not in self.signaller.__dict__)
+        self.assertEquals(self.signaller.emit('signal1'), False)
+        self.assertEquals(len(self.signaller.get_callbacks('signal1')), 0)
+        self.assert_('signal_callbacks' not in self.signaller.__dict__)
+        # connecting should only create the tables for one object
+        self.signaller.connect('signal1', self.callback)
+        self.assert_('signal_callbacks' in self.signaller.__dict__)
+        self.assert_('signal_callbacks' not in signaller2.__dict__)
+        signaller2.emit('signal1')
+        self.assertEquals(self.callbacks, [])
+
+    def test_missing_signal_emit(self):
+        self.assertRaises(KeyError, self.signaller.emit, 'signal5')
+
+    def test_create_signal(self):
+        self.signaller.create_signal('signal4')
+        self.signaller.connect('signal4', self.callback)
+        self.signaller.emit('signal4', 'foo')
+        self.check_single_callback(self.signaller, 'foo')
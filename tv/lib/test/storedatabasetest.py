@@ -548,6 +548,177 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class GroupCommitTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.set_group_commit(60, 100)
+        # use a separate connection to see what's been committed
+        self.reader = sqlite3.connect(self.save_path)
+
+    def tearDown(self):
+        self.reader.close()
+        FakeSchemaTest.tearDown(self)
+
+    def committed_names(self):
+        return set(row[0] for row in
+                   self.reader.execute("SELECT name FROM human"))
+
+    def change_lee(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        app.db.on_event_finished(None, True)
+
+    def test_group_commit(self):
+        commit_count = app.db.get_commit_stats()['count']
+        self.change_lee()
+        # the commit should be deferred
+        self.assertEquals(self.committed_names(), set([u'lee']))
+        Human(u"bob", 30, 1.8, [], {})
+        app.db.on_event_finished(None, True)
+        self.assertEquals(self.committed_names(), set([u'lee']))
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_names(), set([u'lee2', u'bob']))
+        self.assertEquals(app.db.get_commit_stats()['count'],
+                          commit_count + 1)
+
+    def test_failed_event(self):
+        # a failed event should only rollback its own changes
+        self.change_lee()
+        Human(u"bob", 30, 1.8, [], {})
+        app.db.on_event_finished(None, False)
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_names(), set([u'lee2']))
+
+    def test_statement_limit(self):
+        app.db.set_group_commit(60, 2)
+        self.change_lee()
+        self.assertEquals(self.committed_names(), set([u'lee']))
+        Human(u"bob", 30, 1.8, [], {})
+        app.db.on_event_finished(None, True)
+        self.assertEquals(self.committed_names(), set([u'lee2', u'bob']))
+
+    def test_timeout(self):
+        app.db.set_group_commit(0.1, 100)
+        self.change_lee()
+        self.assertEquals(self.committed_names(), set([u'lee']))
+        time.sleep(0.2)
+        self.run_pending_timeouts()
+        self.assertEquals(self.committed_names(), set([u'lee2']))
+
+    def test_check_integrity(self):
+        self.change_lee()
+        self.assert_(app.db.check_integrity())
+        self.assertEquals(self.committed_names(), set([u'lee2']))
+
+class WriteBehindTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.bob = Human(u"bob", 30, 1.8, [], {})
+        app.db.finish_transaction()
+        app.db.set_write_behind(True)
+
+    def update_statements(self):
+        return [(sql, values, many)
+                for (sql, values, many) in app.db._statements_in_transaction
+                if sql.startswith('UPDATE')]
+
+    def test_coalesce(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.assertEquals(self.update_statements(), [])
+        app.db.flush_dirty_objects()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assert_('name=?' in updates[0][0])
+        self.assert_('age=?' in updates[0][0])
+
+    def test_executemany(self):
+        # objects that change the same columns use one executemany() call
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.bob.age = 31
+        self.bob.signal_change()
+        app.db.flush_dirty_objects()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(updates[0][2], True)
+        self.reload_test_database()
+        ages = set(h.age for h in Human.make_view())
+        self.assertEquals(ages, set([26, 31]))
+
+    def test_unchanged_complex_columns(self):
+        self.lee.high_scores[u'pong'] = 100
+        self.lee.signal_change()
+        app.db.flush_dirty_objects()
+        self.assert_('high_scores=?' in self.update_statements()[0][0])
+        app.db.finish_transaction()
+        # high_scores didn't change, so it shouldn't get written again
+        self.lee.age = 26
+        self.lee.signal_change()
+        app.db.flush_dirty_objects()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assert_('high_scores=?' not in updates[0][0])
+
+    def test_query_sees_changes(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        self.assertEquals(Human.make_view('name=?', (u'lee2',)).count(), 1)
+        self.assertEquals(list(Human.make_view('name=?', (u'lee2',))),
+                          [self.lee])
+
+    def test_rollback(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(app.db._dirty_objects, {})
+        self.assertEquals(app.db._pending_view_updates, {})
+
+    def test_view_trackers(self):
+        tracker = Human.make_view('age > 25').make_tracker()
+        added = []
+        tracker.connect('added', lambda tracker, obj: added.append(obj))
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.assertEquals(added, [])
+        app.db.on_event_finished(None, True)
+        self.assertEquals(added, [self.lee])
+
+    def test_remove_dirty_object(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        self.lee.remove()
+        app.db.flush_dirty_objects()
+        self.assertEquals(self.update_statements(), [])
+
+class LiveStorageQueryStatsTest(FakeSchemaTest):
+    def get_shape_report(self, prefix):
+        for shape_report in app.db.query_stats.get_report()['shapes']:
+            if shape_report['shape'].startswith(prefix):
+                return shape_report
+        return None
+
+    def test_record_queries(self):
+        app.db.finish_transaction()
+        app.db.query_stats.reset()
+        for age in (25, 14, 30):
+            app.db.execute("SELECT name FROM human WHERE age=?", (age,))
+        app.db.execute("SELECT name FROM human WHERE age=25")
+        shape_report = self.get_shape_report(
+            "SELECT name FROM human WHERE age=?")
+        self.assertEquals(shape_report['count'], 4)
+        # lee is the only one in the human table
+        self.assertEquals(shape_report['rows'], 2)
+        self.lee.age = 26
+        self.lee.signal_change()
+        app.db.flush_dirty_objects()
+        shape_report = self.get_shape_report("UPDATE human SET ")
+        self.assertEquals(shape_report['count'], 1)
+        self.assertEquals(shape_report['rows'], 0)
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -650,6 +821,62 @@ tm_isdst=0)}"""
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_repr_literals(self):
+        converter = storedatabase.SQLiteConverter()
+        values = [
+            {u'a': [1, -2L, 3.5, None], 'b': (True, False, u'\xe9')},
+            [datetime(2009, 6, 5, 1, 30, 0, 100)],
+            (),
+            -1.5,
+        ]
+        for value in values:
+            sql_value = converter._repr_to_sql(value, None)
+            self.assertEquals(converter._repr_from_sql(sql_value, None),
+                              value)
+
+    def test_repr_unsafe(self):
+        converter = storedatabase.SQLiteConverter()
+        for sql_value in ("__import__('os').getcwd()", "open('/dev/null')",
+                          "(lambda: 1)()", "[x for x in (1, 2)]",
+                          "u'abc'.upper()", "datetime.timedelta(1)",
+                          "inf"):
+            self.assertRaises(ValueError, converter._repr_from_sql,
+                              sql_value, None)
+        self.assertRaises(SyntaxError, converter._repr_from_sql, "{baddata",
+                          None)
+
+    def test_repr_cache_copies(self):
+        # cached values must still return new mutable objects, since the
+        # objects we restore change them in place
+        converter = storedatabase.SQLiteConverter()
+        val1 = converter._repr_from_sql("{'a': [1]}", None)
+        val2 = converter._repr_from_sql("{'a': [1]}", None)
+        self.assertEquals(val1, val2)
+        self.assert_(val1 is not val2)
+        self.assert_(val1['a'] is not val2['a'])
+
+    def test_row_decoder(self):
+        converter = storedatabase.SQLiteConverter()
+        values = [1, u'ben', 25, 3.4, ['a', 'b'], {u'game': 1234},
+                  {'x': (1, 2)}, 'abc\x00', set([u'red', u'blue'])]
+        sql_values = converter.row_encoder(HumanSchema)(values)
+        self.assertEquals(sql_values, [
+            converter.to_sql(HumanSchema, name, schema_item, value)
+            for (name, schema_item), value in zip(HumanSchema.fields, values)])
+        self.assertEquals(converter.row_decoder(HumanSchema)(sql_values),
+                          values)
+        self.assertEquals(
+            converter.row_decoder(HumanSchema, as_dict=True)(sql_values),
+            dict(zip([name for name, schema_item in HumanSchema.fields],
+                     values)))
+        # None is passed through without calling a converter
+        fields = HumanSchema.fields[5:7]
+        self.assertEquals(converter.row_decoder(HumanSchema, fields)(
+            (None, None)), [None, None])
+        # decoders are built once for each column list
+        self.assert_(converter.row_decoder(HumanSchema, fields) is
+                     converter.row_decoder(HumanSchema, fields))
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -422,6 +422,23 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+    def test_mutagen_batch(self):
+        workerprocess.startup()
+        filenames = ['mp3-0.mp3', 'mp3-1.mp3', 'mp3-2.mp3']
+        source_paths = [resources.path("testdata/metadata/" + f)
+                        for f in filenames]
+        msg = workerprocess.MutagenBatchTask(source_paths, self.tempdir)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        if self.error is not None:
+            raise self.error
+        results = self.result.results
+        self.assertEquals(set(results.keys()), set(source_paths))
+        self.assertEquals(results[source_paths[0]]['title'],
+                          'Invisible Walls')
+        self.assertEquals(results[source_paths[1]]['title'], 'Race Lieu')
+        self.assert_(self.result.processing_time >= 0)
+
 
 # TODO:
 #   Test task priority system in worker process
@@ -18,6 +18,7 @@ from miro import models
 from miro import messages
 from miro import sharing
 from miro import util
+from miro.data import itemtrack
 from miro.data.item import fetch_item_infos
 from miro.plat.utils import filename_to_unicode, unicode_to_filename
 from miro.test import mock
@@ -220,6 +221,12 @@ class MockDAAPClient(mock.Mock):
         self.last_sent_library = {}
         # last sent library used for the playlists() method
         self.last_sent_library_for_playlists = None
+        # DAAP revisions.  We bump the revision each time update() is called.
+        self.supports_update = True
+        self.old_revision = self.revision = 1
+        # persistent id of the server database.  Change it to simulate a
+        # server restart.
+        self.db_persistent_id = 12345
 
     def set_items(self, new_items):
         """Change the current set of items.
@@ -339,9 +346,26 @@ class MockDAAPClient(mock.Mock):
         self.last_sent_library_for_playlists = self.library.copy()
         return playlists, deleted_playlists
 
-    def databases(self, update):
+    def _iter_listing(self, listing):
+        data, deleted = listing
+        for daap_id, item_data in data.items():
+            yield ('item', daap_id, item_data.copy())
+        for daap_id in deleted:
+            yield ('deleted', daap_id, None)
+
+    def iter_items(self, playlist_id=None, meta=None, update=False):
+        return self._iter_listing(self.items(playlist_id, meta, update))
+
+    def iter_playlists(self, meta=None, update=False):
+        return self._iter_listing(self.playlists(meta, update))
+
+    def databases(self, update=False):
         return True
 
+    def update(self):
+        self.old_revision = self.revision
+        self.revision += 1
+
     def daap_get_file_request(self, daap_id, file_format):
         return u'/item-%s' % daap_id
 
@@ -398,3 +422,73 @@ def make_sharing_item(share, daap_id, path, title, file_type=u'video'):
         'db_info': share.db_info,
     }
     return item.SharingItem(daap_id, **kwargs)
+
+# indexes that upgrade202 created for the ItemTracker queries
+TAB_INDEXES = [
+    ('item_feed_release_date', 'item', ('feed_id', 'release_date')),
+    ('item_unwatched_downloaded', 'item',
+     ('expired', 'parent_id', 'watched_time', 'downloaded_time')),
+    ('item_file_type_last_watched', 'item', ('file_type', 'last_watched')),
+    ('downloader_state_item', 'remote_downloader',
+     ('state', 'main_item_id')),
+]
+
+def make_tab_query(tab, feed_id=5):
+    """Make the ItemTrackerQuery that we use to open a tab.
+
+    This copies what ItemList and the video display do.  The tabs sort by
+    title using the name collation, we use nocase instead since it's built
+    into sqlite.  Both are the same as far as indexes are concerned.
+    """
+    query = itemtrack.ItemTrackerQuery()
+    if tab == 'videos':
+        query.add_condition('file_type', '=', 'video')
+        query.add_condition('deleted', '=', False)
+        query.set_order_by(['title'], ['nocase'])
+    elif tab == 'feed':
+        query.add_condition('feed_id', '=', feed_id)
+        query.set_order_by(['-release_date'])
+    elif tab == 'downloading':
+        sql = ("((remote_downloader.state IN ('downloading', 'uploading', "
+               "'paused', 'uploading-paused', 'offline')) OR "
+               "(remote_downloader.state = 'failed' AND "
+               "feed.orig_url = 'dtv:manualFeed') OR "
+               "pending_manual_download) AND "
+               "remote_downloader.main_item_id=item.id")
+        columns = ['remote_downloader.state',
+                   'remote_downloader.main_item_id',
+                   'feed.orig_url',
+                   'pending_manual_download']
+        query.add_complex_condition(columns, sql, ())
+        query.set_order_by(['title'], ['nocase'])
+    elif tab == 'recently-downloaded':
+        query.add_condition('downloaded_time', 'IS NOT', None)
+        query.add_condition('expired', '=', False)
+        query.add_condition('parent_id', 'IS', None)
+        query.add_condition('watched_time', 'IS', None)
+        query.set_order_by(['-downloaded_time'])
+        query.set_limit(6)
+    elif tab == 'recently-played':
+        query.add_condition('file_type', '=', 'video')
+        query.add_condition('watched_time', 'IS NOT', None)
+        query.set_order_by(['-last_watched'])
+        query.set_limit(6)
+    else:
+        raise ValueError(tab)
+    return query
+
+TABS = ['videos', 'feed', 'downloading', 'recently-downloaded',
+        'recently-played']
+
+def drop_tab_indexes(cursor):
+    """Go back to the indexes that we had before upgrade202."""
+    for name, table, columns in TAB_INDEXES:
+        cursor.execute("DROP INDEX %s" % name)
+    cursor.execute("CREATE INDEX downloader_state ON remote_downloader "
+                   "(state)")
+
+def create_tab_indexes(cursor):
+    cursor.execute("DROP INDEX downloader_state")
+    for name, table, columns in TAB_INDEXES:
+        cursor.execute("CREATE INDEX %s ON %s (%s)" %
+                       (name, table, ', '.join(columns)))
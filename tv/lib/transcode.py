@@ -27,6 +27,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import collections
 import errno
 import logging
 import subprocess
@@ -40,6 +41,7 @@ import sys
 import SocketServer
 import threading
 
+from miro import app
 from miro import util
 from miro.plat.utils import (get_ffmpeg_executable_path, setup_ffmpeg_presets,
                              get_segmenter_executable_path, thread_body,
@@ -162,7 +164,16 @@ def needs_transcode(media_file):
     build a m3u8 playlist and what we get out of the Miro database may be 
     unreliable (does not exist).
 
+    Results are stored in app.probe_cache, so we only run ffmpeg once for
+    each version of a file.
+
     May throw exception if ffmpeg not found.  Remember to catch."""
+    if app.probe_cache is None:
+        return _probe_needs_transcode(media_file)
+    return app.probe_cache.get('needs-transcode', media_file,
+                               _probe_needs_transcode)
+
+def _probe_needs_transcode(media_file):
     ffmpeg_exe = get_ffmpeg_executable_path()
     kwargs = {"stdout": subprocess.PIPE,
               "stderr": subprocess.PIPE,
@@ -207,8 +218,10 @@ def needs_transcode(media_file):
         acopy = audio_can_copy(acodec, sample_rate)
         if not acopy:
             transcode = False
-    return (transcode, (seconds, has_audio, acodec, sample_rate,
-                        has_video, vcodec, size))
+    # store booleans instead of the match objects, so that the result can
+    # be pickled by the ProbeCache
+    return (transcode, (seconds, bool(has_audio), acodec, sample_rate,
+                        bool(has_video), vcodec, size))
 
 class TranscodeSinkServer(SocketServer.TCPServer):
     pass
@@ -259,13 +272,20 @@ class TranscodeRequestHandler(SocketServer.BaseRequestHandler):
 # the signaling.  This mainly allows for two things: (1) to allow the segmenter
 # signal when data is ready, and (2) for throttling.  One advantage of this
 # scheme is there is no need to deal with temporary files on the filesystem.
-# Once a chunk is sent to the client, it is thrown away.
+# Once a chunk is sent to the client, it is thrown away, except for the copy
+# in app.segment_cache (see segmentcache.py) which is shared by all sessions.
 #
 # When a client seeks to a position that is not in its current playing chunk
 # and does not have the seeked-to chunk in its cache, it may request
 # the chunk from the server.  In this case, the current transcode operation
-# stops, and a new transcode operation begins at the requested time offset
-# calculated based on which chunk was requested.
+# stops, and a new transcode operation begins.  Chunks from the requested
+# one onwards that are in the segment cache are sent from there, and the
+# new transcode operation begins at the time offset of the first chunk that
+# isn't cached.
+#
+# The Pretranscoder runs TranscodeObjects in pretranscode mode, where chunks
+# only go to the segment cache.  It's used to transcode popular items ahead
+# of time.
 class TranscodeObject(object):
     """TranscodeObject
 
@@ -286,14 +306,16 @@ class TranscodeObject(object):
     segment_duration = 10
     segmenter_args = [str(segment_duration)]
 
-    # Future work: we only have a high watermark, so the transcode job gets
-    # throttled when it reaches the high watermark and then starts again
-    # as items are consumed.  It may be good to have a low watermark as well.
+    # The transcode job gets throttled when the buffer reaches the high
+    # watermark and starts again once the client drains it down to the low
+    # watermark, so we don't start and stop ffmpeg for every chunk.
     buffer_high_watermark = 6
+    buffer_low_watermark = 2
 
     def __init__(self, media_file, itemid, generation, chunk, media_info,
-                 request_path_func):
+                 request_path_func, pretranscode=False):
         self.media_file = media_file
+        self.pretranscode = pretranscode
         self.in_shutdown = False
         if chunk is not None:
             self.time_offset = chunk * TranscodeObject.segment_duration
@@ -336,6 +358,14 @@ class TranscodeObject(object):
             self.current_chunk = self.start_chunk = chunk
         else:
             self.current_chunk = self.start_chunk = 0
+        # Chunks before transcode_chunk are sent from the segment cache.
+        # produced_chunk is the number of the next chunk we get from the
+        # segmenter.  Both get set in transcode().
+        self.segment_cache = app.segment_cache
+        self.cache_key = None
+        # key that we pinned in the segment cache, see _check_segment_cache()
+        self.pinned_key = None
+        self.transcode_chunk = self.produced_chunk = self.start_chunk
         self.chunk_buffer = []
         self.chunk_throttle = threading.Event()
         self.chunk_throttle.set()
@@ -346,7 +376,8 @@ class TranscodeObject(object):
 
         self.transcode_gate = threading.Event()
 
-        self.create_playlist()
+        if request_path_func is not None:
+            self.create_playlist()
         logging.debug('TranscodeObject created %s', self)
 
     def __del__(self):
@@ -390,9 +421,67 @@ class TranscodeObject(object):
             return False
         return True
 
+    def get_codec_args(self):
+        """Get the ffmpeg arguments that select the output codecs."""
+        args = []
+        video_needs_trancode = False
+        if self.has_video:
+            logging.debug('Video codec: %s', self.video_codec)
+            logging.debug('Video size: %s', self.video_size)
+            if video_can_copy(self.video_codec, self.video_size):
+                args += get_transcode_video_copy_options()
+            else:
+                args += get_transcode_video_options()
+                video_needs_transcode = True
+        if self.has_audio:
+            logging.debug('Audio codec: %s', self.audio_codec)
+            logging.debug('Audio sample rate: %s', self.audio_sample_rate)
+            if (valid_av_combo(self.video_codec, self.audio_codec) and
+              audio_can_copy(self.audio_codec, self.audio_sample_rate)):
+                args += get_transcode_audio_copy_options()
+            else:
+                args += get_transcode_audio_options()
+        else:
+           raise ValueError('no video or audio stream present')
+        return args
+
+    def _check_segment_cache(self, codec_args):
+        """Work out which chunks we can send from the segment cache.
+
+        :returns: True if all the chunks we need are cached
+        """
+        if self.segment_cache is None:
+            return False
+        profile = ' '.join(codec_args + TranscodeObject.segmenter_args)
+        self.cache_key = self.segment_cache.make_key(self.media_file, profile)
+        if self.cache_key is None:
+            return False
+        # Don't let the chunks that we're going to send from the cache get
+        # evicted before we send them.  shutdown() unpins the key.
+        with self.chunk_lock:
+            self.segment_cache.pin_key(self.cache_key)
+            self.pinned_key = self.cache_key
+        first_missing = self.segment_cache.find_missing(self.cache_key,
+                                                        self.start_chunk)
+        self.transcode_chunk = self.produced_chunk = first_missing
+        if first_missing > self.start_chunk:
+            logging.debug('transcode: chunks %d-%d cached', self.start_chunk,
+                          first_missing - 1)
+        chunk_count = self.segment_cache.get_chunk_count(self.cache_key)
+        return chunk_count is not None and first_missing >= chunk_count
+
     def transcode(self):
         rc = True
         try:
+            codec_args = self.get_codec_args()
+            if self._check_segment_cache(codec_args):
+                logging.debug('transcode: all chunks cached')
+                with self.chunk_lock:
+                    self.finished = True
+                self.transcode_gate.set()
+                return rc
+            self.time_offset = (self.transcode_chunk *
+                                TranscodeObject.segment_duration)
             ffmpeg_exe = get_ffmpeg_executable_path()
             kwargs = {"stdin": open(os.devnull, 'rb'),
                       "stdout": subprocess.PIPE,
@@ -403,26 +492,7 @@ class TranscodeObject(object):
                 logging.debug('transcode: start job @ %d' % self.time_offset)
                 args += TranscodeObject.time_offset_args + [
                     str(self.time_offset)]
-            video_needs_trancode = False
-            if self.has_video:
-                logging.debug('Video codec: %s', self.video_codec)
-                logging.debug('Video size: %s', self.video_size)
-                if video_can_copy(self.video_codec, self.video_size):
-                    args += get_transcode_video_copy_options()
-                else:
-                    args += get_transcode_video_options()
-                    video_needs_transcode = True
-            if self.has_audio:
-                logging.debug('Audio codec: %s', self.audio_codec)
-                logging.debug('Audio sample rate: %s', self.audio_sample_rate)
-                if (valid_av_combo(self.video_codec, self.audio_codec) and
-                  audio_can_copy(self.audio_codec, self.audio_sample_rate)):
-                    args += get_transcode_audio_copy_options()
-                else:
-                    args += get_transcode_audio_options()
-            else:
-               raise ValueError('no video or audio stream present')
-
+            args += codec_args
             args += TranscodeObject.output_args
             logging.debug('Running command %s' % ' '.join(args))
             self.ffmpeg_handle = Popen(args, **kwargs)
@@ -457,15 +527,33 @@ class TranscodeObject(object):
         self.tmp_file.write(d)
         if not d:
             self.tmp_file.flush()
+            has_data = bool(self.tmp_file.tell())
+            # Don't cache anything once we start shutting down, the segment
+            # may have been cut short when we killed the segmenter.  Copy
+            # outside the chunk lock so we don't hold up get_chunk().
+            if (has_data and self.cache_key is not None and
+              not self.in_shutdown):
+                self.segment_cache.add_segment(self.cache_key,
+                                               self.produced_chunk,
+                                               self.tmp_file)
             with self.chunk_lock:
                 # This is empty ... we haven't actually written anything.
                 # This an end of transcode marker.
-                if not self.tmp_file.tell():
+                if not has_data:
                     logging.debug('Transcode: end-of-transcode marker')
                     self.finished = True
+                    if self.cache_key is not None and not self.in_shutdown:
+                        self.segment_cache.set_chunk_count(
+                            self.cache_key, self.produced_chunk)
                 else:
+                    self.produced_chunk += 1
                     self.tmp_file.seek(0, os.SEEK_SET)
-                    self.chunk_buffer.append(self.tmp_file)
+                    if self.pretranscode:
+                        # nobody is going to consume this chunk, it's in
+                        # the segment cache now.
+                        self.tmp_file.close()
+                    else:
+                        self.chunk_buffer.append(self.tmp_file)
                     chunk_buffer_size = len(self.chunk_buffer)
                     if (chunk_buffer_size >= 
                       TranscodeObject.buffer_high_watermark):
@@ -504,6 +592,23 @@ class TranscodeObject(object):
                 raise
 
     def get_chunk(self):
+        # Chunks that were already in the segment cache when we started
+        # don't come from the segmenter.
+        with self.chunk_lock:
+            chunk = self.current_chunk
+            from_cache = chunk < self.transcode_chunk
+            if from_cache:
+                self.current_chunk += 1
+        if from_cache:
+            # This returns None if the segment file can't be read.  The
+            # client will retry the chunk, which makes a new TranscodeObject
+            # that transcodes from there.
+            tmpf = self.segment_cache.get_segment(self.cache_key, chunk)
+            if tmpf is None:
+                logging.warning('transcode: chunk %d missing from cache',
+                                chunk)
+            return tmpf
+
         # End of transcode check: if the transcode returned not enough
         # chunks, then send an empty file.
         with self.chunk_lock:
@@ -521,11 +626,24 @@ class TranscodeObject(object):
                 tmpf = self.chunk_buffer[0]
                 self.current_chunk += 1
                 self.chunk_buffer = self.chunk_buffer[1:]
-                self.chunk_throttle.set()
+                if (len(self.chunk_buffer) <=
+                  TranscodeObject.buffer_low_watermark):
+                    self.chunk_throttle.set()
             else:
                 tmpf = tempfile.TemporaryFile()
         return tmpf
 
+    def wait_finished(self):
+        """Block until the transcode job finishes or gets shut down.
+
+        This is for pretranscode mode, where nobody calls get_chunk().
+        """
+        while True:
+            with self.chunk_lock:
+                if self.finished or self.in_shutdown:
+                    return
+            self.chunk_sem.acquire()
+
     # Shutdown the transcode job.  If we quitting, make sure you call this
     # so the segmenter et al have a chance to clean up.
     def shutdown(self):
@@ -546,6 +664,10 @@ class TranscodeObject(object):
         # we end up unblocking it anyway.
         logging.info('TranscodeObject.shutdown')
         self.in_shutdown = True
+        with self.chunk_lock:
+            pinned_key, self.pinned_key = self.pinned_key, None
+        if pinned_key is not None:
+            self.segment_cache.unpin_key(pinned_key)
         self.transcode_gate.wait()
         try:
             self.ffmpeg_handle.kill()
@@ -586,3 +708,72 @@ class TranscodeObject(object):
         self.ffmpeg_handle = None
         self.segmenter_handle = None
         self.sink_thread = None
+
+class Pretranscoder(object):
+    """Transcodes items into the segment cache in the background.
+
+    Items are transcoded one at a time, in the order they were added, so
+    that we don't compete too much with the transcodes that clients are
+    actually waiting on.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.current = None
+        self.thread = None
+        self.in_shutdown = False
+
+    def add(self, media_file):
+        """Queue up media_file to be transcoded."""
+        if app.segment_cache is None:
+            return
+        with self.lock:
+            if self.in_shutdown or media_file in self.queue:
+                return
+            if self.current and self.current.media_file == media_file:
+                return
+            self.queue.append(media_file)
+            if self.thread is None:
+                self.thread = threading.Thread(target=thread_body,
+                                               args=[self._run],
+                                               name="Pretranscoder")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.in_shutdown or not self.queue:
+                    self.thread = None
+                    return
+                media_file = self.queue.popleft()
+            try:
+                self._pretranscode(media_file)
+            except StandardError:
+                logging.exception('Pretranscoder: error transcoding %s',
+                                  media_file)
+
+    def _pretranscode(self, media_file):
+        yes, info = needs_transcode(media_file)
+        transcode_obj = TranscodeObject(media_file, None, 0, None, info, None,
+                                        pretranscode=True)
+        with self.lock:
+            if self.in_shutdown:
+                return
+            self.current = transcode_obj
+        try:
+            logging.debug('Pretranscoder: transcoding %s', media_file)
+            if transcode_obj.transcode():
+                transcode_obj.wait_finished()
+        finally:
+            with self.lock:
+                self.current = None
+            transcode_obj.shutdown()
+
+    def shutdown(self):
+        with self.lock:
+            self.in_shutdown = True
+            self.queue.clear()
+            current = self.current
+        if current is not None:
+            current.shutdown()
@@ -451,37 +451,6 @@ def clamp_text(text, max_length=20):
     else:
         return text
 
-def db_mem_usage_test():
-    from miro import models
-    from miro.database import DDBObject
-    last_usage = get_mem_usage()
-    logging.debug("baseline memory usage: %s", last_usage)
-    for name in dir(models):
-        ddb_object_class = getattr(models, name)
-        try:
-            if not issubclass(ddb_object_class, DDBObject):
-                continue
-        except TypeError:
-            continue
-        if name == 'FileItem':
-            # Item and FileItem share a db table, so we only need to
-            # load one
-            continue
-
-        # make sure each object is loaded in memory and count the total
-        count = len(list(ddb_object_class.make_view()))
-        current_usage = get_mem_usage()
-        class_usage = current_usage-last_usage
-        if count == 0:
-            count = 1 # prevent zero division errors
-        logging.debug("memory usage for %s: %s (%d bytes per object)",
-                ddb_object_class.__name__, class_usage,
-                class_usage * 1024 / count)
-        last_usage = current_usage
-    logging.debug("total memory usage: %s", last_usage)
-    logging.debug("feed count: %s", models.Feed.make_view().count())
-    logging.debug("item count: %s", models.Item.make_view().count())
-
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
 
@@ -1190,6 +1159,7 @@ class Cache(object):
             new_access_times[key] = time
         self.dict = new_dict
         self.access_times = new_access_times
+        self.invalidators = new_invalidators
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
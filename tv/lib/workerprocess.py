@@ -96,6 +96,26 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class MutagenBatchTask(TaskMessage):
+    """Run mutagen on several files with a single message.
+
+    The result is a MutagenBatchResult.  Its results dict maps each source
+    path to either the metadata dict for that path or the exception that we
+    got while processing it.  Paths that were canceled while the task was
+    queued are left out.
+    """
+    priority = 10
+    def __init__(self, source_paths, cover_art_directory):
+        TaskMessage.__init__(self)
+        self.source_paths = source_paths
+        self.cover_art_directory = cover_art_directory
+
+    def __str__(self):
+        return 'MutagenBatchTask (%d paths)' % len(self.source_paths)
+
+MutagenBatchResult = namedtuple('MutagenBatchResult',
+                                'results processing_time')
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -141,7 +161,7 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # one.  Put it in main_thread_tasks and handle once
                 # there's no more tasks waiting in to be processed
                 self.main_thread_tasks.append((method, msg))
-            elif isinstance(msg, MutagenTask):
+            elif isinstance(msg, (MutagenTask, MutagenBatchTask)):
                 # If we're using the alarm, then MutagenTasks need to run in
                 # the main thread as well.  Signals aren't support outside of
                 # the main thread.
@@ -164,6 +184,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # if we're here, it means we want to use the signals
                 handle_task(self.handle_mutagen_task_with_alarm, msg)
                 continue
+            elif isinstance(msg, MutagenBatchTask):
+                handle_task(self.handle_mutagen_batch_task_with_alarm, msg)
+                continue
             handle_task(method, msg)
 
         # block waiting for the next message.  We know that one of the
@@ -192,8 +215,13 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque()
+        for method, task in self.main_thread_tasks:
+            if isinstance(task, MutagenBatchTask):
+                _remove_batch_paths(task, path_set)
+            elif task.source_path in path_set:
+                continue
+            filtered_tasks.append((method, task))
         self.main_thread_tasks = filtered_tasks
         return None
 
@@ -222,6 +250,30 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         with util.alarm(2):
             return self.handle_mutagen_task(msg)
 
+    def handle_mutagen_batch_task(self, msg):
+        return self._process_mutagen_batch(msg, False)
+
+    def handle_mutagen_batch_task_with_alarm(self, msg):
+        return self._process_mutagen_batch(msg, True)
+
+    def _process_mutagen_batch(self, msg, use_alarm):
+        start_time = clock.clock()
+        results = {}
+        for path in msg.source_paths:
+            try:
+                if use_alarm:
+                    with util.alarm(2):
+                        result = filetags.process_file(
+                            path, msg.cover_art_directory)
+                else:
+                    result = filetags.process_file(path,
+                                                   msg.cover_art_directory)
+            except StandardError, e:
+                logging.info("mutagen error: %s (%s)", path, e)
+                result = e
+            results[path] = result
+        return MutagenBatchResult(results, clock.clock() - start_time)
+
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue
 
@@ -340,6 +392,13 @@ class WorkerTaskQueue(object):
             for cls in (MutagenTask, MovieDataProgramTask):
                 queue = self.queue_map[cls.priority]
                 queue.filter_messages(filter_func, cls)
+            # Keep batch tasks in the queue, even if all their paths get
+            # removed.  The main process is still waiting for a result.
+            def filter_batch(msg):
+                _remove_batch_paths(msg, path_set)
+                return True
+            queue = self.queue_map[MutagenBatchTask.priority]
+            queue.filter_messages(filter_batch, MutagenBatchTask)
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -347,6 +406,10 @@ class WorkerTaskQueue(object):
             self.should_quit = True
             self.condition.notify_all()
 
+def _remove_batch_paths(msg, path_set):
+    """Remove canceled paths from a MutagenBatchTask."""
+    msg.source_paths = [p for p in msg.source_paths if p not in path_set]
+
 def handle_task(handler_method, msg):
     """Process a TaskMessage."""
     # If we are running movie data, send the MovieDataTaskStatus message.
@@ -430,6 +493,9 @@ class MiroTaskQueue(object):
     def reset(self):
         self.tasks_in_progress = {}
 
+    def get_memory_counts(self):
+        return {'tasks_in_progress': len(self.tasks_in_progress)}
+
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
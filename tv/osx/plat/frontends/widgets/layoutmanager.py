@@ -144,6 +144,9 @@ class FontPool(object):
 class LayoutManager(object):
     font_pool = FontPool()
     default_font = font_pool.get(1.0, False, False, None)
+    # Our styles don't change at runtime, so layouts never go out of date
+    # (see the GTK LayoutManager).
+    style_generation = 0
 
     def __init__(self):
         self.current_font = self.default_font